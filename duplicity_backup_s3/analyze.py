@@ -0,0 +1,211 @@
+"""Growth and churn analytics over the history of a backup.
+
+The signature tars in the local archive directory of duplicity tell which
+files were part of every backup set. Every set is summarised once into a small
+record that is cached, such that re-running an analysis only processes the
+sets that were added since. The size of a file at the time of a backup is
+estimated from its signature (to within a block); when a signature can not be
+read, the size of the file as it currently is on disk is used. All byte counts
+are estimates.
+"""
+import json
+import os
+import posixpath
+from collections import Counter
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import List, Optional
+
+from duplicity_backup_s3.archive import SIGNATURE, backup_files, signature_sizes
+from duplicity_backup_s3.defaults import (
+    ANALYZE_CHURN_RATIO,
+    ANALYZE_DEPTH,
+    CACHE_DIR,
+    VOLATILE_PATTERNS,
+)
+from duplicity_backup_s3.state import profile_key
+
+# version of the cached records, bump when the record format changes
+CACHE_VERSION = 2
+
+
+def _directory(path: str, depth: int) -> str:
+    """Directory of a path, truncated to `depth` levels."""
+    parts = posixpath.dirname(path).split("/")
+    return "/".join(parts[:depth]) or "."
+
+
+def _size(root: Path, path: str) -> int:
+    try:
+        return os.lstat(str(root / path)).st_size
+    except OSError:
+        return 0
+
+
+def summarise_set(
+    sigtar: Path, backuproot: Path, depth: int, keep_files: bool = True
+) -> dict:
+    """Summarise a single backup set from its signature tar.
+
+    :param sigtar: path to the signature tar in the archive directory
+    :param backuproot: root of the backup to find the size of the files whose
+        signature can not be read
+    :param depth: depth of the directories to aggregate on
+    :param keep_files: keep the changed files with their size in the record,
+        which is not needed (and large) for full backup sets.
+    :return: record with the per directory bytes and files
+    """
+    dir_bytes, dir_files = Counter(), Counter()
+    changed = {}
+    deleted = 0
+    for kind, path, size in signature_sizes(sigtar):
+        if kind == "deleted":
+            deleted += 1
+            continue
+        if kind != "signature":
+            continue
+        if size is None:
+            size = _size(backuproot, path)
+        directory = _directory(path, depth)
+        dir_bytes[directory] += size
+        dir_files[directory] += 1
+        if keep_files:
+            changed[path] = size
+    return dict(
+        bytes=dict(dir_bytes),
+        files=dict(dir_files),
+        changed=changed,
+        deleted=deleted,
+    )
+
+
+def load_summaries(
+    archive_dir: Path,
+    backuproot: Path,
+    remote_uri: str,
+    depth: int = ANALYZE_DEPTH,
+    cache_dir: Path = None,
+) -> List[dict]:
+    """Summaries of all backup sets in the archive directory, using a cache.
+
+    :return: list of set summaries, sorted by time
+    """
+    cache_path = (
+        Path(cache_dir or CACHE_DIR) / "analyze" / f"{profile_key(remote_uri)}.json"
+    )
+    try:
+        with cache_path.open() as fd:
+            cache = json.load(fd)
+        if cache.get("version") != CACHE_VERSION or cache.get("depth") != depth:
+            cache = {}
+    except (OSError, ValueError):
+        cache = {}
+    cached_sets = cache.get("sets", {})
+
+    summaries = []
+    for sigtar in backup_files(archive_dir, kind=SIGNATURE):
+        if ".gpg" in sigtar.name:
+            continue
+        summary = cached_sets.get(sigtar.name)
+        if summary is None:
+            summary = summarise_set(
+                archive_dir / sigtar.name,
+                backuproot,
+                depth,
+                keep_files=sigtar.type == "inc",
+            )
+            summary.update(
+                name=sigtar.name, type=sigtar.type, time=sigtar.end.isoformat()
+            )
+        summaries.append(summary)
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(".tmp")
+    with tmp_path.open("w") as fd:
+        json.dump(
+            dict(
+                version=CACHE_VERSION,
+                depth=depth,
+                sets={summary["name"]: summary for summary in summaries},
+            ),
+            fd,
+        )
+    os.replace(str(tmp_path), str(cache_path))
+    return summaries
+
+
+def exclude_candidate(path: str) -> str:
+    """Exclude pattern that would catch a frequently changing file."""
+    name = posixpath.basename(path)
+    for pattern in VOLATILE_PATTERNS:
+        if fnmatch(name, pattern):
+            return f"**/{pattern}"
+    directory = posixpath.dirname(path)
+    return f"{directory}/**" if directory else path
+
+
+def analyze(
+    summaries: List[dict],
+    churn_ratio: float = ANALYZE_CHURN_RATIO,
+    top: int = 10,
+) -> dict:
+    """Aggregate the summaries of the backup sets into a report.
+
+    :param summaries: summaries of the backup sets, sorted by time
+    :param churn_ratio: fraction of the incrementals a file must change in to
+        be considered churn
+    :param top: number of entries of every section of the report
+    :return: report with `growth`, `churn_dirs`, `churn_files` and `excludes`
+    """
+    fulls = [s for s in summaries if s["type"] == "full"]
+    incrementals = [s for s in summaries if s["type"] == "inc"]
+
+    # growth per directory between the first and the last full backup
+    first = Counter(fulls[0]["bytes"]) if fulls else Counter()
+    last = Counter(fulls[-1]["bytes"]) if fulls else Counter()
+    growth = Counter(last)
+    growth.subtract(first)
+
+    churn_bytes = Counter()  # type: Counter
+    changes = Counter()  # type: Counter
+    sizes = {}
+    for summary in incrementals:
+        churn_bytes.update(summary["bytes"])
+        changes.update(summary["changed"].keys())
+        sizes.update(summary["changed"])
+
+    runs = len(incrementals)
+    churn_files = [
+        (path, count)
+        for path, count in changes.most_common()
+        if runs and count / runs >= churn_ratio
+    ]
+
+    excludes = Counter()  # type: Counter
+    for path, count in churn_files:
+        excludes[exclude_candidate(path)] += sizes.get(path, 0) * count
+
+    def _per_run(counter: Counter) -> List[tuple]:
+        return [(key, value / runs) for key, value in counter.most_common(top)]
+
+    return dict(
+        sets=len(summaries),
+        fulls=len(fulls),
+        incrementals=runs,
+        growth=[(d, b) for d, b in growth.most_common(top) if b > 0],
+        churn_dirs=_per_run(churn_bytes) if runs else [],
+        churn_files=[
+            (path, count, sizes.get(path, 0)) for path, count in churn_files[:top]
+        ],
+        excludes=_per_run(excludes) if runs else [],
+    )
+
+
+def format_bytes(value: Optional[float]) -> str:
+    """Human readable amount of bytes."""
+    value = float(value or 0)
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(value) < 1024:
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} TB"
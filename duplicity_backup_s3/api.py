@@ -0,0 +1,479 @@
+"""Asynchronous library API of the duplicity commands.
+
+The actions of :class:`AsyncDuplicityS3` are coroutines that run duplicity
+with `asyncio.create_subprocess_exec`, such that a single event loop can run
+many backups concurrently. Unlike the `do_*` methods of :class:`DuplicityS3`
+they do not print to the console nor exit, but return a :class:`RunResult`.
+
+Example::
+
+    backup = AsyncDuplicityS3(config="duplicity_backup_s3.yaml")
+    result = loop.run_until_complete(backup.incremental())
+    if not result.succeeded:
+        print(result.errors)
+"""
+import asyncio
+import copy
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from duplicity_backup_s3.defaults import (
+    WATCHDOG_GRACE_PERIOD,
+    WATCHDOG_RETRIES,
+    WINDOW_CLOSED_RETURNCODE,
+)
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.pagecache import nocache_command, read_meminfo, usage
+from duplicity_backup_s3.policies import EXCLUDED_FILELIST, chain_uri
+from duplicity_backup_s3.results import RunResult
+from duplicity_backup_s3.runner import AsyncProcessRunner
+from duplicity_backup_s3.scratch import ScratchError, owner_prefix, with_tempdir
+from duplicity_backup_s3.state import load_state, update_state
+
+
+class AsyncDuplicityS3(DuplicityS3):
+    """
+    Asynchronous duplicity S3 commands returning structured results.
+
+    The options of the actions override the options of the object for that
+    action only, so one object can run several actions concurrently.
+
+    :ivar output: (optional) callable receiving the output of duplicity
+    """
+
+    def __init__(self, output: Optional[Callable[[str], None]] = None, **options):
+        """Initiate the object with options, see :class:`DuplicityS3`.
+
+        :param output: (optional) callable receiving the output of duplicity
+        """
+        super().__init__(**options)
+        self.output = output
+
+    def _command(self, builder: Callable[..., List[str]], *args, **options):
+        """Build the arguments of a command with temporary options."""
+        saved = self.options
+        self.options = {
+            **saved,
+            **{key: value for key, value in options.items() if value is not None},
+        }
+        try:
+            return builder(*args)
+        finally:
+            self.options = saved
+
+    def _with_options(self, **options) -> "AsyncDuplicityS3":
+        """Copy of the object with temporary options, for the blocking helpers.
+
+        Unlike :meth:`_command`, the copy can be used in an executor while
+        other actions run on the object.
+        """
+        clone = copy.copy(self)
+        clone.options = {
+            **self.options,
+            **{key: value for key, value in options.items() if value is not None},
+        }
+        return clone
+
+    async def _run(
+        self,
+        cmd_args: List[str],
+        deadline: Optional[datetime] = None,
+        archive_dir: Path = None,
+        nocache: bool = False,
+    ) -> RunResult:
+        """Run a duplicity command in the event loop.
+
+        :param cmd_args: the arguments of the duplicity command
+        :param deadline: (optional) moment to stop duplicity at a volume boundary
+        :param archive_dir: (optional) archive directory of the chain
+        :param nocache: run duplicity under the `nocache` helper
+        :return: the result of the run
+        """
+        command = [self.duplicity_cmd(), *cmd_args]
+        try:
+            scratch = self._make_scratch(cmd_args[0])
+        except ScratchError as e:
+            return self._skipped(cmd_args[0], f"Error: {e}", returncode=1)
+        runtime_env = self._runtime_env()
+        if scratch is not None:
+            command = with_tempdir(command, scratch)
+            runtime_env["TMPDIR"] = scratch
+        if nocache:
+            command[:0] = [nocache_command()]
+        watchdog = self._config.get("watchdog") or {}
+        retries = watchdog.get("retries", WATCHDOG_RETRIES) if watchdog else 0
+        started, start = datetime.now(), time.monotonic()
+        log = self._open_log()
+
+        def output(text: str) -> None:
+            if self.output is not None:
+                self.output(text)
+            if log is not None:
+                log.write(text)
+
+        try:
+            for _ in range(retries + 1):
+                runner = AsyncProcessRunner(
+                    command,
+                    env=runtime_env,
+                    stall_timeout=watchdog.get("stall_timeout"),
+                    grace_period=watchdog.get("grace_period", WATCHDOG_GRACE_PERIOD),
+                    output=output,
+                    **self._deadline_options(deadline, archive_dir),
+                )
+                completed = await runner.run()
+                if runner.deadline_reached or runner.stall_event is None:
+                    break
+                self.stall_events.append(runner.stall_event)
+        finally:
+            if log is not None:
+                await asyncio.get_event_loop().run_in_executor(None, log.close)
+            if scratch is not None:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+        returncode = completed.returncode
+        if runner.deadline_reached:
+            returncode = WINDOW_CLOSED_RETURNCODE
+        self.last_tail = list(runner.tail)
+        self.last_run = RunResult.from_output(
+            command,
+            returncode,
+            started,
+            time.monotonic() - start,
+            self.last_tail,
+            action=cmd_args[0],
+            stalled=runner.stall_event is not None,
+            window_closed=runner.deadline_reached,
+            log_path=str(log.path) if log is not None else None,
+            resources=runner.resources,
+        )
+        return self.last_run
+
+    async def _run_mirrored(
+        self,
+        dupe: "AsyncDuplicityS3",
+        remote: str,
+        builder: Callable[[str, Optional[str]], List[str]],
+    ) -> RunResult:
+        """Run a command on a chain through the volume cache.
+
+        See :meth:`_volume_mirror`, the mirror is set up in an executor.
+
+        :param dupe: the object with the options of the action
+        :param remote: remote uri of the chain
+        :param builder: callable building the command from the uri to read
+            from and the `--name` of the archive directory
+        """
+        loop = asyncio.get_event_loop()
+        mirror = dupe._volume_mirror(remote)
+        uri, name = await loop.run_in_executor(None, mirror.__enter__)
+        try:
+            return await self._run(builder(uri, name))
+        finally:
+            await loop.run_in_executor(None, mirror.__exit__, None, None, None)
+
+    async def _probe(self) -> None:
+        """Probe the capabilities of duplicity without blocking the loop."""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, lambda: self.capabilities)
+
+    async def _preflight_failure(self, action: str) -> Optional[RunResult]:
+        """Run the pre-flight checks and probe duplicity without blocking the loop.
+
+        :param action: the duplicity action that is about to run
+        :return: the result of the action when a check failed, else None
+        """
+        loop = asyncio.get_event_loop()
+        results = await loop.run_in_executor(None, self._preflight_results, action)
+        failed = [result for result in results if not result.ok]
+        if failed:
+            return RunResult.from_output(
+                [],
+                1,
+                datetime.now(),
+                0.0,
+                [f"Error: pre-flight check {r.name}: {r.message}" for r in failed],
+                action=action,
+            )
+        await self._probe()
+        return None
+
+    @staticmethod
+    def _skipped(action: str, message: str, returncode: int = 0) -> RunResult:
+        """Create the result of an action that did not run duplicity."""
+        return RunResult.from_output(
+            [], returncode, datetime.now(), 0.0, [message], action=action
+        )
+
+    async def _pre_backup_includes(self, includes: Optional[List[str]]):
+        """Run the pre-backup steps without blocking the loop.
+
+        :param includes: the configured includes
+        :return: the includes with the staging directory, or the result of the
+            backup when a step that aborts the backup failed
+        """
+        from duplicity_backup_s3.prebackup import run_pre_backup, staging_dir
+
+        loop = asyncio.get_event_loop()
+        self.pre_backup_results = await loop.run_in_executor(
+            None, run_pre_backup, self._config
+        )
+        failed = [r for r in self.pre_backup_results if not r.succeeded]
+        if any(r.on_failure == "abort" for r in failed):
+            return RunResult.from_output(
+                [],
+                1,
+                datetime.now(),
+                0.0,
+                [f"Error: pre-backup step {r.name}: {r.error}" for r in failed],
+                action="incr",
+            )
+        if includes:
+            return [str(staging_dir(self._config)), *includes]
+        return includes
+
+    async def _backup_chains(
+        self,
+        scanned: dict,
+        deadline: Optional[datetime],
+        cache_mode: Optional[str],
+        result: RunResult,
+    ) -> RunResult:
+        """Back up the chains of the policies, see :meth:`_backup_policies`.
+
+        :return: the result of the first failed chain, or of the main chain
+        """
+        for policy in self.policies:
+            if result.window_closed:
+                break
+            chain_result = await self._run(
+                self._policy_command(policy, scanned[policy.name]["filelist"]),
+                deadline,
+                self._chain_archive_dir(chain_uri(self.remote_uri, policy)),
+                nocache=cache_mode == "nocache",
+            )
+            # report the first chain that failed, or else the main chain
+            if not chain_result.succeeded and (
+                result.succeeded or chain_result.window_closed
+            ):
+                result = chain_result
+        return result
+
+    async def incremental(
+        self, ignore_window: bool = False, ignore_journal: bool = False
+    ) -> RunResult:
+        """Incremental backup, see :meth:`DuplicityS3.do_incremental`.
+
+        :param ignore_window: start the backup outside of the backup window
+        :param ignore_journal: back up even when the change journal tells that
+            nothing changed
+        """
+        deadline, outside = self._window_deadline(ignore_window)
+        if outside is not None:
+            return self._skipped("incr", outside)
+        failure = await self._preflight_failure("incr")
+        if failure is not None:
+            return failure
+
+        includes = self._config.get("includes")
+        if self._config.get("pre_backup") and not self.dry_run:
+            includes = await self._pre_backup_includes(includes)
+            if isinstance(includes, RunResult):
+                return includes
+
+        loop = asyncio.get_event_loop()
+        state = load_state(self.remote_uri)
+        dupe = self._with_options(ignore_journal=ignore_journal or None)
+        if await loop.run_in_executor(None, dupe._journal_unchanged, state):
+            if not self.dry_run:
+                update_state(self.remote_uri, last_success=time.time())
+            return self._skipped(
+                "incr",
+                "No changes since the last backup according to the journal, "
+                "skipping the backup.",
+            )
+
+        scanned = {}
+        if self.policies:
+            scanned = await loop.run_in_executor(None, self._scan_policies, includes)
+        decision = self._adaptive_full(state)
+        action = "full" if decision is not None and decision.full else "incr"
+        cache_mode = self._cache_friendly()
+        meminfo = read_meminfo()
+        result = await self._run(
+            self._incremental_command(
+                includes,
+                exclude_filelist=scanned.get(EXCLUDED_FILELIST, {}).get("filelist"),
+                full=action == "full",
+            ),
+            deadline,
+            nocache=cache_mode == "nocache",
+        )
+        started, since, dropped = result.started, None, 0
+        if cache_mode == "evict":
+            since = self._read_since(state, started)
+            dropped = await loop.run_in_executor(
+                None, self._drop_page_cache, includes, since
+            )
+        if not self.dry_run:
+            self._record_backup(
+                action,
+                result.returncode,
+                started,
+                result,
+                state,
+                usage(meminfo, dropped),
+            )
+
+        result = await self._backup_chains(scanned, deadline, cache_mode, result)
+        if self.policies and cache_mode == "evict":
+            await loop.run_in_executor(None, self._drop_page_cache, includes, since)
+
+        if not self.dry_run:
+            self._record_outcome(result.returncode, started)
+            if result.succeeded and "checksums" in self._config:
+                await loop.run_in_executor(None, self._update_checksums)
+        return result
+
+    async def restore(
+        self, target: str, file: str = None, time: str = None
+    ) -> RunResult:
+        """Restore a backup into the target directory.
+
+        The chains of the policies are restored too, a single file is restored
+        from the first chain that has it, see :meth:`DuplicityS3.do_restore`.
+
+        :param target: directory to restore into
+        :param file: (optional) only restore this file or directory
+        :param time: (optional) restore the backup at this time
+        :return: the result of the first chain that failed, else of the main
+            chain or of the chain the file was restored from
+        """
+        failure = await self._preflight_failure("restore")
+        if failure is not None:
+            return failure
+        dupe = self._with_options(file=file, time=time)
+        loop = asyncio.get_event_loop()
+        if "storage" in self._config:
+            staged = await loop.run_in_executor(None, dupe._stage_restore)
+            if not staged:
+                return self._skipped(
+                    "restore",
+                    "Error: the archived volumes of the restore are not staged.",
+                    returncode=1,
+                )
+
+        async def restore_chain(remote: str, force: bool = False) -> RunResult:
+            return await self._run_mirrored(
+                dupe,
+                remote,
+                lambda uri, name: dupe._restore_command(
+                    target, uri, force=force, name=name
+                ),
+            )
+
+        chains = await loop.run_in_executor(None, dupe._restore_chains)
+        if file is not None:
+            for _, remote in chains:
+                result = await restore_chain(remote)
+                if result.succeeded:
+                    break
+            return result
+
+        result = None
+        for index, (_, remote) in enumerate(chains):
+            chain_result = await restore_chain(remote, force=index > 0)
+            if result is None or (result.succeeded and not chain_result.succeeded):
+                result = chain_result
+        return result
+
+    async def verify(
+        self, file: str = None, time: str = None, manifest: bool = False
+    ) -> RunResult:
+        """Verify a backup, see :meth:`DuplicityS3.do_verify`.
+
+        :param file: (optional) only verify this file or directory
+        :param time: (optional) verify the backup at this time
+        :param manifest: compare the files against the content manifest instead,
+            without running duplicity
+        """
+        if manifest:
+            loop = asyncio.get_event_loop()
+            returncode = await loop.run_in_executor(
+                None, self._with_options(file=file)._verify_checksums
+            )
+            return self._skipped(
+                "verify",
+                "The files match the content manifest."
+                if returncode == 0
+                else "The files do not match the content manifest.",
+                returncode=returncode,
+            )
+        failure = await self._preflight_failure("verify")
+        if failure is not None:
+            return failure
+        try:
+            scratch = self._choose_scratch("verify")
+        except ScratchError as e:
+            return self._skipped("verify", f"Error: {e}", returncode=1)
+        with tempfile.TemporaryDirectory(prefix=owner_prefix(), dir=scratch) as target:
+            dupe = self._with_options(file=file, time=time)
+            return await self._run_mirrored(
+                dupe,
+                self.remote_uri,
+                lambda uri, name: dupe._verify_command(target, uri, name),
+            )
+
+    async def cleanup(self, force: bool = None) -> RunResult:
+        """Cleanup the extraneous files of a backup."""
+        failure = await self._preflight_failure("cleanup")
+        if failure is not None:
+            return failure
+        return await self._run(self._command(self._cleanup_command, force=force))
+
+    async def collection_status(self) -> RunResult:
+        """Status of the backup collection."""
+        failure = await self._preflight_failure("collection-status")
+        if failure is not None:
+            return failure
+        return await self._run(self._collection_status_command())
+
+    async def list_current_files(self, time: str = None) -> RunResult:
+        """List the files of a backup.
+
+        The last lines of the listing are available in the `output` of the
+        result, use the `output` callable for the complete listing.
+        """
+        failure = await self._preflight_failure("list-current-files")
+        if failure is not None:
+            return failure
+        return await self._run(
+            self._command(self._list_current_files_command, time=time)
+        )
+
+    async def remove_older(
+        self,
+        time: str = None,
+        all_but_n_full: int = None,
+        all_incremental_but_n_full: int = None,
+        force: bool = None,
+    ) -> RunResult:
+        """Remove older backups, see :meth:`DuplicityS3.do_remove_older`.
+
+        :raises ValueError: when no remove action is provided.
+        """
+        cmd_args = self._command(
+            self._remove_older_command,
+            time=time,
+            all_but_n_full=all_but_n_full,
+            all_incremental_but_n_full=all_incremental_but_n_full,
+            force=force,
+        )
+        failure = await self._preflight_failure(cmd_args[0])
+        if failure is not None:
+            return failure
+        return await self._run(cmd_args)
@@ -0,0 +1,209 @@
+"""Access to the local duplicity archive directory.
+
+Duplicity keeps a local copy of the manifests and signatures of a backup in
+its archive directory (`~/.cache/duplicity/<backup name>`). The backup name
+defaults to the md5 hash of the remote url.
+"""
+import hashlib
+import re
+import struct
+import tarfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from duplicity_backup_s3.defaults import DUPLICITY_ARCHIVE_DIR
+
+# eg. 'duplicity-inc.20230105T100000Z.to.20230106T100000Z.vol1.difftar.gpg'
+FILENAME_RE = re.compile(
+    r"^duplicity-(?P<type>full|inc|full-signatures|new-signatures)\."
+    r"(?:(?P<start>\d{8}T\d{6}Z)\.to\.)?(?P<end>\d{8}T\d{6}Z)\."
+    r"(?P<kind>manifest|vol(?P<volume>\d+)\.difftar|sigtar)"
+    r"(?P<extension>(?:\.[a-z0-9]+)*)$"
+)
+TIME_FORMAT = "%Y%m%dT%H%M%SZ"
+
+# a volume entry of a manifest, eg. 'Volume 1:'
+MANIFEST_VOLUME_RE = re.compile(r"^Volume (\d+):", re.MULTILINE)
+
+# magic numbers of the librsync signatures, with MD4 and BLAKE2 strong sums
+SIGNATURE_MAGICS = (0x72730136, 0x72730137)
+
+# intervals of duplicity, eg. `7D` or `1h30m` (`M` is 30 days, `Y` 365 days)
+INTERVAL_RE = re.compile(r"(\d+)([smhDWMY])")
+INTERVAL_UNITS = dict(s=1, m=60, h=3600, D=86400, W=7 * 86400, M=30 * 86400)
+INTERVAL_UNITS["Y"] = 365 * 86400
+
+# Kinds of files of a backup set
+MANIFEST = "manifest"
+VOLUME = "volume"
+SIGNATURE = "signature"
+
+
+class BackupFile(NamedTuple):
+    """A file of a backup set, as parsed from its (long) filename."""
+
+    name: str
+    type: str  # 'full' or 'inc'
+    kind: str  # `MANIFEST`, `VOLUME` or `SIGNATURE`
+    start: Optional[datetime]  # start of an incremental set
+    end: datetime  # time of the backup set
+    volume: Optional[int]
+    partial: bool
+
+    @property
+    def set_key(self) -> Tuple[str, Optional[datetime], datetime]:
+        """Key that is shared by all files of the same backup set."""
+        return self.type, self.start, self.end
+
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    if value is None:
+        return None
+    return datetime.strptime(value, TIME_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def parse_filename(name: str) -> Optional[BackupFile]:
+    """Parse the name of a duplicity file.
+
+    :param name: filename, eg. 'duplicity-full.20230105T100000Z.manifest'
+    :return: the parsed file or None when it is not a (long) duplicity filename.
+    """
+    match = FILENAME_RE.match(name)
+    if match is None:
+        return None
+    kind = match.group("kind")
+    if kind.startswith("vol"):
+        kind = VOLUME
+    elif kind == "sigtar":
+        kind = SIGNATURE
+    return BackupFile(
+        name=name,
+        type="full" if match.group("type").startswith("full") else "inc",
+        kind=kind,
+        start=_parse_time(match.group("start")),
+        end=_parse_time(match.group("end")),
+        volume=int(match.group("volume")) if match.group("volume") else None,
+        partial=match.group("extension").endswith(".part"),
+    )
+
+
+def backup_files(path: Path, kind: Optional[str] = None) -> List[BackupFile]:
+    """Complete duplicity files in an archive directory, sorted by time.
+
+    :param path: archive directory
+    :param kind: (optional) only return files of this kind
+    """
+    if not path.is_dir():
+        return []
+    files = [parse_filename(entry.name) for entry in path.iterdir()]
+    return sorted(
+        (f for f in files if f and not f.partial and (kind is None or f.kind == kind)),
+        key=lambda f: (f.end, f.type != "full"),
+    )
+
+
+def signature_sizes(path: Path) -> Iterator[Tuple[str, str, Optional[int]]]:
+    """Stream the members of a signature tar with the size of their files.
+
+    The members of a signature tar are prefixed with their kind: `signature/`
+    for regular files, `snapshot/` for directories and other special files and
+    `deleted/` for removed files. The size of a file is estimated from its librsync signature: a header with
+    the block length and the length of the strong sums, followed by a weak
+    (4 bytes) and a strong sum for every block of the file. The estimate is at
+    most one block larger than the file was at the time of the backup.
+
+    :param path: path to a (compressed, not encrypted) signature tar
+    :return: iterator of (kind, path relative to the backuproot, size), the
+        size is None when it can not be read from the member
+    """
+    with tarfile.open(str(path), mode="r|*") as tar:
+        for member in tar:
+            kind, _, name = member.name.partition("/")
+            if not name:
+                continue
+            size = None
+            if kind == "signature" and member.isfile():
+                header = tar.extractfile(member).read(12)
+                if len(header) == 12:
+                    magic, block_len, strong_len = struct.unpack(">III", header)
+                    if magic in SIGNATURE_MAGICS and block_len:
+                        size = (member.size - 12) // (4 + strong_len) * block_len
+            yield kind, name, size
+
+
+def extra_arg_value(extra_args: Optional[List[str]], name: str) -> Optional[str]:
+    """Value of an option in the extra arguments passed to duplicity.
+
+    Both `--name=value` and `--name value` forms are supported.
+
+    :param extra_args: list of extra arguments
+    :param name: the option, eg. `--archive-dir`
+    :return: the value or None when the option is not provided.
+    """
+    extra_args = extra_args or []
+    for index, arg in enumerate(extra_args):
+        if arg.startswith(f"{name}="):
+            return arg.split("=", 1)[1]
+        if arg == name and index + 1 < len(extra_args):
+            return extra_args[index + 1]
+    return None
+
+
+def archive_dir(
+    remote_uri: str, extra_args: Optional[List[str]] = None, chain: str = None
+) -> Path:
+    """Archive directory that duplicity uses for a remote.
+
+    :param remote_uri: remote uri of the backup
+    :param extra_args: extra arguments that may override `--archive-dir`
+        and `--name`
+    :param chain: (optional) name of the policy chain of the remote; with a
+        `--name` in the extra arguments, the chain gets `<name>-<chain>`
+    :return: path to the archive directory of the backup
+    """
+    root = extra_arg_value(extra_args, "--archive-dir")
+    name = extra_arg_value(extra_args, "--name")
+    if name is None:
+        name = hashlib.md5(remote_uri.encode("utf-8")).hexdigest()
+    elif chain is not None:
+        name = f"{name}-{chain}"
+    return Path(root).expanduser() / name if root else DUPLICITY_ARCHIVE_DIR / name
+
+
+def partial_manifests(path: Path) -> List[Path]:
+    """Partial manifests of interrupted or running backups in an archive dir."""
+    if not path.is_dir():
+        return []
+    return sorted(path.glob("duplicity-*.manifest.part"))
+
+
+def parse_interval(value: str) -> Optional[timedelta]:
+    """Parse an interval in the time format of duplicity, eg. `7D` or `1h30m`.
+
+    :return: the interval, or None when the value is not an interval (eg. a date)
+    """
+    value = str(value).strip()
+    if not value or INTERVAL_RE.sub("", value):
+        return None
+    return timedelta(
+        seconds=sum(
+            int(amount) * INTERVAL_UNITS[unit]
+            for amount, unit in INTERVAL_RE.findall(value)
+        )
+    )
+
+
+def last_full(path: Path) -> Optional[datetime]:
+    """Time of the most recent complete full backup in an archive directory."""
+    fulls = [f.end for f in backup_files(path, MANIFEST) if f.type == "full"]
+    return fulls[-1] if fulls else None
+
+
+def manifest_volumes(path: Path) -> List[int]:
+    """Numbers of the volumes listed in a (plain) manifest, empty when unreadable."""
+    try:
+        text = path.read_text(encoding="utf-8", errors="replace")
+    except OSError:
+        return []
+    return [int(number) for number in MANIFEST_VOLUME_RE.findall(text)]
@@ -0,0 +1,331 @@
+"""Audit of the backup files on S3 against the local archive directory.
+
+`collection-status` only reports what duplicity believes is on the remote.
+The audit checks that every file the local manifests reference exists: the
+manifest, the signatures and every volume of every backup set. The remote is
+listed once (the kinds of duplicity files in parallel), or read from a local
+copy of an S3 Inventory report, and compared in memory; no data is
+downloaded.
+
+The report contains the files that are
+
+* missing: referenced by a local manifest, but not on the remote,
+* truncated: empty, or smaller than at the previous audit,
+* changed: another size or ETag than at the previous audit, eg. rewritten or
+  moved to another storage class,
+* orphaned: on the remote, without a manifest of their set (eg. the leftovers
+  of an interrupted backup that was never resumed),
+* unknown: manifests on the remote that the local archive does not know; run
+  `status` to sync the archive directory.
+
+The sizes and ETags of the audited files are kept in the cache and compared
+on the next audit.
+"""
+import csv
+import gzip
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import unquote_plus, urlsplit
+
+from duplicity_backup_s3.archive import (
+    MANIFEST,
+    SIGNATURE,
+    VOLUME,
+    BackupFile,
+    backup_files,
+    manifest_volumes,
+    parse_filename,
+)
+from duplicity_backup_s3.defaults import (
+    CACHE_DIR,
+    INVENTORY_CSV_SCHEMA,
+    STORAGE_PARALLEL,
+)
+from duplicity_backup_s3.state import profile_key
+from duplicity_backup_s3.storage import StorageError, list_files
+
+# the kinds of duplicity files, listed in parallel
+LIST_STARTS = (
+    "duplicity-full.",
+    "duplicity-full-signatures.",
+    "duplicity-inc.",
+    "duplicity-new-signatures.",
+)
+
+# name of a file without its extensions (`.gpg`, `.gz`), eg.
+# ('full', 'volume', None, datetime(...), 1)
+FileKey = Tuple[str, str, object, object, Optional[int]]
+
+
+class RemoteObject(NamedTuple):
+    """A duplicity file on the remote, by its name below the prefix."""
+
+    name: str
+    size: int
+    etag: str
+
+
+class AuditReport(NamedTuple):
+    """Result of the audit of a chain."""
+
+    sets: int  # backup sets in the local archive
+    files: int  # files referenced by their manifests
+    missing: List[str]
+    truncated: List[str]
+    changed: List[str]
+    orphaned: List[str]
+    unknown: List[str]
+
+    @property
+    def ok(self) -> bool:
+        """Whether all referenced files exist and are intact."""
+        return not self.missing and not self.truncated
+
+
+def file_key(backup_file: BackupFile) -> FileKey:
+    """Identify a file of a backup set regardless of its extensions."""
+    return (
+        backup_file.type,
+        backup_file.kind,
+        backup_file.start,
+        backup_file.end,
+        backup_file.volume,
+    )
+
+
+def _file_name(key: FileKey) -> str:
+    """Name of a file without its extensions, for the report."""
+    type_, kind, start, end, volume = key
+    stamp = f"{end:%Y%m%dT%H%M%SZ}"
+    if start is not None:
+        stamp = f"{start:%Y%m%dT%H%M%SZ}.to.{stamp}"
+    if kind == SIGNATURE:
+        prefix = "full-signatures" if type_ == "full" else "new-signatures"
+        return f"duplicity-{prefix}.{stamp}.sigtar"
+    if kind == VOLUME:
+        return f"duplicity-{type_}.{stamp}.vol{volume}.difftar"
+    return f"duplicity-{type_}.{stamp}.manifest"
+
+
+def expected_files(path: Path) -> Tuple[int, Dict[FileKey, str]]:
+    """Return the files of the backup sets in the local archive directory.
+
+    :param path: the archive directory of the chain
+    :return: the number of sets, and the expected files by their key
+    """
+    expected = {}
+    manifests = backup_files(path, MANIFEST)
+    for manifest in manifests:
+        type_, _, start, end, _ = file_key(manifest)
+        keys = [
+            (type_, MANIFEST, start, end, None),
+            (type_, SIGNATURE, start, end, None),
+        ] + [
+            (type_, VOLUME, start, end, number)
+            for number in manifest_volumes(path / manifest.name)
+        ]
+        expected.update((key, _file_name(key)) for key in keys)
+    return len(manifests), expected
+
+
+def list_remote(
+    client, bucket: str, prefix: str, parallel: int = STORAGE_PARALLEL
+) -> Dict[str, RemoteObject]:
+    """List the duplicity files of a chain, the kinds of files in parallel.
+
+    :raises StorageError: when the listing fails
+    """
+    with ThreadPoolExecutor(max_workers=min(parallel, len(LIST_STARTS))) as pool:
+        listings = list(
+            pool.map(
+                lambda start: list_files(client, bucket, prefix, start), LIST_STARTS
+            )
+        )
+    objects = {}
+    for listing in listings:
+        for f in listing:
+            name = f.key.replace(prefix, "", 1)
+            objects[name] = RemoteObject(name, f.size, f.etag)
+    return objects
+
+
+def _inventory_rows(path: Path) -> Iterator[Tuple[str, str, int, str]]:
+    """Rows of an S3 Inventory report as (bucket, key, size, etag).
+
+    :param path: the `manifest.json` of the report, with its data files in
+        the same directory, or a single CSV (optionally gzipped) data file
+        with the columns of `INVENTORY_CSV_SCHEMA`
+    """
+    if path.suffix == ".json":
+        manifest = json.loads(path.read_text())
+        file_format = manifest.get("fileFormat", "CSV").upper()
+        schema = manifest.get("fileSchema", INVENTORY_CSV_SCHEMA)
+        data_files = [
+            path.parent / Path(urlsplit(f["key"]).path).name
+            for f in manifest.get("files", [])
+        ]
+    else:
+        file_format = "PARQUET" if path.suffix == ".parquet" else "CSV"
+        schema, data_files = INVENTORY_CSV_SCHEMA, [path]
+
+    for data_file in data_files:
+        if file_format == "CSV":
+            columns = [c.strip().lower() for c in schema.split(",")]
+            opener = gzip.open if data_file.suffix == ".gz" else open
+            with opener(str(data_file), "rb") as fd:
+                reader = csv.reader(io.TextIOWrapper(fd, encoding="utf-8"))
+                for values in reader:
+                    row = dict(zip(columns, values))
+                    yield (
+                        row["bucket"],
+                        unquote_plus(row["key"]),
+                        int(row.get("size") or 0),
+                        row.get("etag", ""),
+                    )
+        elif file_format == "PARQUET":
+            try:
+                import pyarrow.parquet as parquet
+            except ImportError:
+                raise StorageError(
+                    "Reading a Parquet inventory needs pyarrow, install it with "
+                    "`pip install pyarrow`."
+                )
+            table = parquet.read_table(str(data_file))
+            columns = {
+                name.replace("_", "").lower(): name for name in table.column_names
+            }
+            for row in table.to_pylist():
+                yield (
+                    row[columns["bucket"]],
+                    row[columns["key"]],
+                    row.get(columns.get("size")) or 0,
+                    row.get(columns.get("etag")) or "",
+                )
+        else:
+            raise StorageError(f"Inventory reports in {file_format} are not supported.")
+
+
+def read_inventory(
+    path: Path, chains: Iterable[Tuple[str, str]]
+) -> Dict[Tuple[str, str], Dict[str, RemoteObject]]:
+    """Read the duplicity files of the chains from an S3 Inventory report.
+
+    :param path: see :func:`_inventory_rows`
+    :param chains: bucket and prefix of every chain
+    :return: the files of every chain, by bucket and prefix
+    """
+    found: Dict[Tuple[str, str], Dict[str, RemoteObject]] = {
+        chain: {} for chain in chains
+    }
+    prefixes = {}
+    for bucket, prefix in found:
+        prefixes.setdefault(bucket, []).append(prefix)
+    for bucket, key, size, etag in _inventory_rows(path):
+        for prefix in prefixes.get(bucket, ()):
+            name = key.replace(prefix, "", 1) if key.startswith(prefix) else None
+            if name and "/" not in name and parse_filename(name) is not None:
+                found[bucket, prefix][name] = RemoteObject(name, int(size), etag)
+    return found
+
+
+def _baseline_path(remote_uri: str, cache_dir: Path = None) -> Path:
+    return Path(cache_dir or CACHE_DIR) / "audit" / f"{profile_key(remote_uri)}.json"
+
+
+def load_baseline(remote_uri: str, cache_dir: Path = None) -> Dict[str, list]:
+    """Sizes and ETags of the files at the previous audit, by name."""
+    try:
+        return json.loads(_baseline_path(remote_uri, cache_dir).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_baseline(
+    remote_uri: str,
+    remote: Dict[str, RemoteObject],
+    report: AuditReport,
+    cache_dir: Path = None,
+) -> None:
+    """Keep the sizes and ETags of the audited files for the next audit.
+
+    Truncated files keep their previous size, such that they are reported
+    until they are repaired.
+    """
+    baseline = load_baseline(remote_uri, cache_dir)
+    baseline = {
+        name: baseline[name]
+        if name in report.truncated and name in baseline
+        else [obj.size, obj.etag]
+        for name, obj in remote.items()
+    }
+    path = _baseline_path(remote_uri, cache_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(baseline))
+
+
+def audit(
+    path: Path,
+    remote: Dict[str, RemoteObject],
+    baseline: Optional[Dict[str, list]] = None,
+) -> AuditReport:
+    """Compare the files on the remote with the manifests of the archive dir.
+
+    :param path: the archive directory of the chain
+    :param remote: the duplicity files of the chain on the remote
+    :param baseline: (optional) sizes and ETags at the previous audit
+    """
+    baseline = baseline or {}
+    sets, expected = expected_files(path)
+    # sets of interrupted backups that duplicity resumes
+    in_progress = {
+        f.set_key
+        for f in (parse_filename(p.name) for p in path.glob("*.manifest.part"))
+        if f is not None
+    }
+
+    found: Dict[FileKey, RemoteObject] = {}
+    remote_sets = set()
+    for name, obj in remote.items():
+        parsed = parse_filename(name)
+        if parsed is None:
+            continue
+        found[file_key(parsed)] = obj
+        if parsed.kind == MANIFEST:
+            remote_sets.add(parsed.set_key)
+    local_sets = {(key[0], key[2], key[3]) for key in expected}
+
+    missing, truncated, changed = [], [], []
+    for key, name in sorted(expected.items(), key=lambda item: item[1]):
+        obj = found.get(key)
+        if obj is None:
+            missing.append(name)
+            continue
+        size, etag = baseline.get(obj.name, (None, None))
+        if obj.size == 0 or (size is not None and obj.size < size):
+            truncated.append(obj.name)
+        elif size is not None and (obj.size != size or obj.etag != etag):
+            changed.append(obj.name)
+
+    orphaned, unknown = [], []
+    for key, obj in sorted(found.items(), key=lambda item: item[1].name):
+        set_key = (key[0], key[2], key[3])
+        if key in expected or set_key in in_progress:
+            continue
+        if set_key in local_sets:
+            orphaned.append(obj.name)  # eg. a volume beyond the manifest
+        elif key[1] == MANIFEST:
+            unknown.append(obj.name)
+        elif set_key not in remote_sets:
+            orphaned.append(obj.name)
+    return AuditReport(
+        sets=sets,
+        files=len(expected),
+        missing=missing,
+        truncated=truncated,
+        changed=changed,
+        orphaned=orphaned,
+        unknown=unknown,
+    )
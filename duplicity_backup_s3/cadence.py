@@ -0,0 +1,177 @@
+"""Adaptive cadence of the full backups.
+
+A fixed `full_if_older_than` either lets the chain of incrementals grow long,
+such that a restore downloads and applies many sets, or uploads full backups
+that are hardly needed. In adaptive mode a new full backup starts when the
+estimated time to restore the latest backup exceeds `max_restore_time`, or
+when the chain exceeds `max_incrementals` or its incrementals outgrow the full
+backup by `max_incremental_ratio`.
+
+The length of the chain is read from the local archive directory. The bytes
+of every backup are tracked in the state of the profile from the statistics of
+duplicity; a full backup that was not measured (eg. resumed over several
+backup windows) is estimated from the number of volumes in its manifest. The
+download throughput is measured by full restores, until then it is taken from
+the configuration or else from the upload throughput of the backups.
+"""
+from datetime import datetime
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+from duplicity_backup_s3.archive import (
+    MANIFEST,
+    backup_files,
+    manifest_volumes,
+    parse_interval,
+)
+from duplicity_backup_s3.defaults import ADAPTIVE_SET_OVERHEAD
+
+
+class Chain(NamedTuple):
+    """The current chain of a backup: the last full backup and its incrementals."""
+
+    full: Optional[datetime]  # time of the full backup, None without one
+    incrementals: int
+    full_bytes: Optional[int]  # None when neither measured nor estimated
+    incremental_bytes: int
+
+
+class Decision(NamedTuple):
+    """Whether the next backup is a full backup, and why."""
+
+    full: bool
+    reason: str
+    restore_time: Optional[float]  # estimated seconds to restore the chain
+
+
+def chain_length(path: Path) -> Tuple[Optional[datetime], int]:
+    """Return the time of the last full backup and the incrementals since.
+
+    :param path: the archive directory of the chain
+    :return: the time of the full backup (None without one) and the number of
+        incrementals
+    """
+    manifests = backup_files(path, MANIFEST)
+    fulls = [f.end for f in manifests if f.type == "full"]
+    if not fulls:
+        return None, 0
+    full = fulls[-1]
+    return full, sum(1 for f in manifests if f.type == "inc" and f.end > full)
+
+
+def current_chain(path: Path, tracked: Optional[dict], volsize: int) -> Chain:
+    """Return the current chain, with its tracked or estimated sizes.
+
+    :param path: the archive directory of the chain
+    :param tracked: the `chain` of the state, see :func:`track`
+    :param volsize: the volume size in MB, to estimate an unmeasured full
+    """
+    full, incrementals = chain_length(path)
+    if full is None:
+        return Chain(None, 0, None, 0)
+    tracked = tracked or {}
+    if tracked.get("full") != full.isoformat():
+        tracked = {}
+    full_bytes = tracked.get("full_bytes")
+    if full_bytes is None:
+        name = "duplicity-full.{:%Y%m%dT%H%M%SZ}.manifest".format(full)
+        volumes = len(manifest_volumes(path / name))
+        # the last volume is half full on average
+        full_bytes = int((volumes - 0.5) * volsize * 1e6) if volumes else None
+    return Chain(full, incrementals, full_bytes, tracked.get("incremental_bytes", 0))
+
+
+def track(
+    path: Path, tracked: Optional[dict], uploaded: Optional[int], started: datetime
+) -> dict:
+    """Account the bytes of a successful backup to its chain.
+
+    :param path: the archive directory of the chain, after the backup
+    :param tracked: the `chain` of the state before the backup
+    :param uploaded: bytes uploaded by the backup (`TotalDestinationSizeChange`)
+    :param started: start of the backup (timezone aware)
+    :return: the new `chain` of the state
+    """
+    full, _ = chain_length(path)
+    if full is None:
+        return {}
+    tracked = dict(tracked or {})
+    if tracked.get("full") != full.isoformat():
+        # a full backup that started before this run was resumed, its size is
+        # only partially known
+        return dict(
+            full=full.isoformat(),
+            full_bytes=uploaded if full >= started else None,
+            incremental_bytes=0,
+        )
+    tracked["incremental_bytes"] = tracked.get("incremental_bytes", 0) + (uploaded or 0)
+    return tracked
+
+
+def median(values: List[float]) -> Optional[float]:
+    """Return the median of the values, None without values."""
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+def restore_time(chain: Chain, throughput: Optional[float]) -> Optional[float]:
+    """Estimate the seconds to restore the latest backup of a chain.
+
+    Every set is downloaded and applied in turn, so the incrementals add a
+    fixed overhead each on top of the bytes to download.
+
+    :param chain: the current chain
+    :param throughput: download throughput in bytes per second
+    :return: the estimate, None when the size or throughput is unknown
+    """
+    if chain.full_bytes is None or not throughput:
+        return None
+    size = chain.full_bytes + chain.incremental_bytes
+    return size / throughput + chain.incrementals * ADAPTIVE_SET_OVERHEAD
+
+
+def decide(
+    settings: dict, chain: Chain, throughput: Optional[float], now: datetime
+) -> Decision:
+    """Decide whether the next backup starts a new chain with a full backup.
+
+    :param settings: the `adaptive_full` section of the configuration
+    :param chain: the current chain
+    :param throughput: download throughput in bytes per second, if known
+    :param now: the current time (timezone aware)
+    """
+    estimate = restore_time(chain, throughput)
+    if chain.full is None:
+        return Decision(True, "there is no full backup yet", estimate)
+
+    min_interval = parse_interval(settings.get("min_full_interval") or "")
+    if min_interval is not None and now - chain.full < min_interval:
+        return Decision(False, "the last full backup is too recent", estimate)
+
+    max_restore_time = settings.get("max_restore_time")
+    if (
+        max_restore_time is not None
+        and estimate is not None
+        and estimate >= max_restore_time * 60
+    ):
+        return Decision(
+            True,
+            f"the estimated restore time of {estimate / 60:.0f} minutes exceeds "
+            f"{max_restore_time} minutes",
+            estimate,
+        )
+    max_incrementals = settings.get("max_incrementals")
+    if max_incrementals is not None and chain.incrementals >= max_incrementals:
+        return Decision(
+            True, f"the chain has {chain.incrementals} incrementals", estimate
+        )
+    max_ratio = settings.get("max_incremental_ratio")
+    if max_ratio is not None and chain.full_bytes:
+        ratio = chain.incremental_bytes / chain.full_bytes
+        if ratio >= max_ratio:
+            return Decision(
+                True,
+                f"the incrementals are {ratio:.1f} times the size of the full backup",
+                estimate,
+            )
+    return Decision(False, "the chain is within the limits", estimate)
@@ -0,0 +1,101 @@
+"""Probe of the installed duplicity version and the options it supports.
+
+Probing runs `duplicity --version` and `duplicity --help`, which takes a
+while as duplicity loads all its backends. The result is cached on disk, keyed
+by the path and modification time of the duplicity binary, such that the probe
+only runs again after duplicity is upgraded.
+"""
+import json
+import os
+import re
+import subprocess
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+from duplicity_backup_s3.defaults import CACHE_DIR, PROBE_TIMEOUT
+
+VERSION_RE = re.compile(r"duplicity\s+v?(\d+(?:\.\d+)*)")
+OPTION_RE = re.compile(r"(?<![\w-])(--[a-z0-9][a-z0-9-]*)")
+
+
+class Capabilities(NamedTuple):
+    """Version and supported options of a duplicity binary."""
+
+    path: str
+    version: Optional[Tuple[int, ...]]
+    options: List[str]
+
+    def supports(self, option: str) -> bool:
+        """Check if duplicity supports an option, eg. `--s3-endpoint-url`."""
+        return option.split("=", 1)[0] in self.options
+
+
+def _run(binary: str, *args: str) -> str:
+    result = subprocess.run(
+        [binary, *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        timeout=PROBE_TIMEOUT,
+    )
+    return result.stdout or ""
+
+
+def parse_version(output: str) -> Optional[Tuple[int, ...]]:
+    """Parse the version from the output of `duplicity --version`."""
+    match = VERSION_RE.search(output)
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.group(1).split("."))
+
+
+def parse_options(output: str) -> List[str]:
+    """Parse the supported options from the output of `duplicity --help`."""
+    return sorted(set(OPTION_RE.findall(output)))
+
+
+def probe(binary: str, cache_dir: Path = None) -> Capabilities:
+    """Probe the capabilities of a duplicity binary, using the cache.
+
+    :param binary: full path to the duplicity binary
+    :param cache_dir: (optional) directory of the cache
+    :return: capabilities of the binary
+    :raises OSError: when duplicity could not be probed
+    """
+    cache_path = Path(cache_dir or CACHE_DIR) / "capabilities.json"
+    key = "{}:{}".format(binary, os.stat(binary).st_mtime_ns)
+    try:
+        with cache_path.open() as fd:
+            cache = json.load(fd)
+    except (OSError, ValueError):
+        cache = {}
+
+    if key in cache:
+        cached = cache[key]
+        return Capabilities(
+            path=binary,
+            version=tuple(cached["version"]) if cached.get("version") else None,
+            options=cached["options"],
+        )
+
+    try:
+        capabilities = Capabilities(
+            path=binary,
+            version=parse_version(_run(binary, "--version")),
+            options=parse_options(_run(binary, "--help")),
+        )
+    except subprocess.SubprocessError as e:
+        raise OSError(f"Could not probe duplicity: {e}") from e
+
+    # drop the entries of earlier versions of the same binary
+    cache = {k: v for k, v in cache.items() if not k.startswith(f"{binary}:")}
+    cache[key] = dict(version=capabilities.version, options=capabilities.options)
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(".tmp")
+        with tmp_path.open("w") as fd:
+            json.dump(cache, fd)
+        os.replace(str(tmp_path), str(cache_path))
+    except OSError:
+        pass  # the cache is an optimisation only
+    return capabilities
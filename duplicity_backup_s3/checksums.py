@@ -0,0 +1,371 @@
+"""Local content manifest of the backup for drift and bitrot checks.
+
+After a successful backup the files of the backup are hashed with BLAKE2 into
+a manifest that is kept next to the state of the profile. Only the entries that
+changed since the previous manifest are written (a delta generation), every
+`max_deltas` generations the manifest is compacted into a new full generation.
+Files whose size and modification time did not change are not hashed again.
+Every generation is signed with an HMAC, such that a tampered manifest is
+detected.
+
+`verify --manifest` compares the files on disk against the manifest without
+downloading anything: files with another size or modification time drifted,
+files with the same size and modification time but other content are corrupt
+(bitrot). The files are hashed by a pool of threads, which hash concurrently
+because hashlib releases the GIL on large buffers.
+"""
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from duplicity_backup_s3.defaults import (
+    CHECKSUM_BATCH,
+    CHECKSUM_BUFFER_SIZE,
+    CHECKSUM_DIGEST_SIZE,
+    CHECKSUM_MAX_DELTAS,
+    STATE_DIR,
+)
+from duplicity_backup_s3.state import profile_key
+
+FULL = "full"
+DELTA = "delta"
+
+
+class ChecksumError(ValueError):
+    """The manifest can not be read or its signature does not match."""
+
+
+class Entry(NamedTuple):
+    """A file in the manifest."""
+
+    size: int
+    mtime_ns: int
+    digest: str  # hex BLAKE2b digest of the content
+
+
+_buffers = threading.local()
+
+
+def hash_file(path: str) -> str:
+    """BLAKE2b digest of the content of a file.
+
+    The file is read into a buffer that is reused by the thread, such that
+    hashing does not allocate per read.
+    """
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _buffers.buffer = memoryview(bytearray(CHECKSUM_BUFFER_SIZE))
+    digest = hashlib.blake2b(digest_size=CHECKSUM_DIGEST_SIZE)
+    with open(path, "rb", buffering=0) as fd:
+        while True:
+            size = fd.readinto(buffer)
+            if not size:
+                break
+            digest.update(buffer[:size])
+    return digest.hexdigest()
+
+
+def checksums_dir(remote_uri: str, state_dir: Path = None) -> Path:
+    """Directory with the manifest generations of a backup profile."""
+    return Path(state_dir or STATE_DIR) / "checksums" / profile_key(remote_uri)
+
+
+def excluder(
+    excludes: Optional[List[str]], markers: Optional[List[str]]
+) -> Callable[[str, List[str]], bool]:
+    """Predicate that tells if a path is excluded from the backup.
+
+    Duplicity lets the first matching selection win and the includes precede
+    the excludes, so pass the excludes only when there are no includes.
+
+    :param excludes: glob patterns of excluded paths
+    :param markers: marker files of `--exclude-if-present`
+    :return: callable of the path and (for directories) the names it contains
+    """
+    patterns = [pattern.replace("**", "*") for pattern in excludes or []]
+    markers = markers or []
+
+    def excluded(path: str, names: List[str] = ()) -> bool:
+        if any(marker in names for marker in markers):
+            return True
+        return any(fnmatch(path, pattern) for pattern in patterns)
+
+    return excluded
+
+
+def walk(
+    roots: Iterable[Path], excluded: Callable[[str, List[str]], bool]
+) -> Iterator[Tuple[str, os.stat_result]]:
+    """Regular files below the roots with their stat, without following links."""
+    stack = [str(root) for root in roots]
+    while stack:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except NotADirectoryError:
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            if not excluded(path):
+                yield path, stat
+            continue
+        except OSError:
+            continue
+        if excluded(path, [entry.name for entry in entries]):
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    if not excluded(entry.path):
+                        yield entry.path, entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+
+def _batches(iterable: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _hash(path: str) -> Optional[str]:
+    try:
+        return hash_file(path)
+    except OSError:
+        return None  # removed or not readable
+
+
+def _sign(data: bytes, key: Optional[bytes]) -> Optional[str]:
+    if key is None:
+        return None
+    return hmac.new(key, data, hashlib.sha256).hexdigest()
+
+
+def generations(directory: Path) -> List[Path]:
+    """List the generations of the manifest from the last full one on."""
+    if not directory.is_dir():
+        return []
+    files = sorted(directory.glob("checksums.*.jsonl.gz"))
+    fulls = [index for index, path in enumerate(files) if f".{FULL}." in path.name]
+    if not fulls:
+        return []
+    last_full = fulls[-1]
+    return files[last_full:]
+
+
+def load(directory: Path, key: Optional[bytes] = None) -> Dict[str, Entry]:
+    """Load the manifest from its full generation and the deltas since.
+
+    :param directory: directory of the manifest
+    :param key: (optional) key of the HMAC signatures, when given every
+        generation must carry a valid signature
+    :return: entry per path relative to the backuproot
+    :raises ChecksumError: when a generation is unreadable or its signature
+        does not match
+    """
+    manifest: Dict[str, Entry] = {}
+    for path in generations(directory):
+        try:
+            data = path.read_bytes()
+            if key is not None:
+                signature = path.with_name(path.name + ".sig").read_text().strip()
+                if not hmac.compare_digest(signature, _sign(data, key)):
+                    raise ChecksumError(f"The signature of '{path}' does not match.")
+            for line in gzip.decompress(data).decode("utf-8").splitlines():
+                record = json.loads(line)
+                if len(record) == 1:
+                    manifest.pop(record[0], None)
+                else:
+                    manifest[record[0]] = Entry(*record[1:])
+        except (OSError, ValueError) as e:
+            if isinstance(e, ChecksumError):
+                raise
+            raise ChecksumError(f"Could not read '{path}': {e}")
+    return manifest
+
+
+def _write(
+    directory: Path,
+    kind: str,
+    records: Iterable[list],
+    key: Optional[bytes],
+) -> Path:
+    """Write a signed generation of the manifest."""
+    directory.mkdir(parents=True, exist_ok=True)
+    lines = "".join(json.dumps(record) + "\n" for record in records)
+    data = gzip.compress(lines.encode("utf-8"))
+    name = f"checksums.{datetime.now():%Y%m%dT%H%M%S%f}.{kind}.jsonl.gz"
+    path = directory / name
+    tmp_path = directory / f".{name}.tmp"
+    tmp_path.write_bytes(data)
+    signature = _sign(data, key)
+    if signature is not None:
+        path.with_name(name + ".sig").write_text(signature + "\n")
+    os.replace(str(tmp_path), str(path))
+    return path
+
+
+def update(
+    directory: Path,
+    root: Path,
+    roots: Iterable[Path],
+    excluded: Callable[[str, List[str]], bool] = lambda path, names=(): False,
+    key: Optional[bytes] = None,
+    workers: Optional[int] = None,
+    max_deltas: int = CHECKSUM_MAX_DELTAS,
+) -> dict:
+    """Hash the changed files and write a generation of the manifest.
+
+    :param directory: directory of the manifest
+    :param root: the backuproot, the paths are stored relative to it
+    :param roots: the included paths
+    :param excluded: predicate of the excluded paths, see :func:`excluder`
+    :param key: (optional) key to sign the manifest with
+    :param workers: (optional) number of hashing threads
+    :param max_deltas: delta generations after which a full one is written
+    :return: statistics with the number of `files`, `hashed`, `changed` and
+        `removed` files and the `path` of the generation
+    :raises ChecksumError: when the previous manifest can not be trusted
+    """
+    previous = load(directory, key)
+    deltas = len(generations(directory)) - 1  # -1 without a manifest
+    current: Dict[str, Entry] = {}
+    changed: Dict[str, Entry] = {}
+    hashed = 0
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for batch in _batches(walk(roots, excluded), CHECKSUM_BATCH):
+            todo = []
+            for path, stat in batch:
+                relpath = os.path.relpath(path, str(root))
+                entry = previous.get(relpath)
+                if (
+                    entry is not None
+                    and entry.size == stat.st_size
+                    and entry.mtime_ns == stat.st_mtime_ns
+                ):
+                    current[relpath] = entry
+                else:
+                    todo.append((relpath, path, stat))
+            for (relpath, path, stat), digest in zip(
+                todo, pool.map(_hash, [path for _, path, _ in todo])
+            ):
+                if digest is None:
+                    continue
+                hashed += 1
+                current[relpath] = changed[relpath] = Entry(
+                    stat.st_size, stat.st_mtime_ns, digest
+                )
+    removed = [relpath for relpath in previous if relpath not in current]
+
+    if deltas < 0 or deltas >= max_deltas:
+        kind = FULL
+        records = [[path, *entry] for path, entry in sorted(current.items())]
+    else:
+        kind = DELTA
+        records = [[path, *entry] for path, entry in sorted(changed.items())]
+        records.extend([path] for path in sorted(removed))
+    path = _write(directory, kind, records, key)
+    if kind == FULL:
+        for old in sorted(directory.glob("checksums.*")):
+            if old.name < path.name:
+                old.unlink()
+    return dict(
+        files=len(current),
+        hashed=hashed,
+        changed=len(changed),
+        removed=len(removed),
+        path=path,
+    )
+
+
+class Report(NamedTuple):
+    """Differences between the files on disk and the manifest."""
+
+    checked: int  # files hashed and compared
+    corrupt: List[str]  # same size and modification time, other content
+    modified: List[str]  # other size or modification time
+    missing: List[str]  # in the manifest, not on disk
+    new: List[str]  # on disk, not in the manifest
+
+    @property
+    def clean(self) -> bool:
+        """Check if the files on disk match the manifest."""
+        return not (self.corrupt or self.modified or self.missing or self.new)
+
+
+def compare(
+    manifest: Dict[str, Entry],
+    root: Path,
+    roots: Iterable[Path],
+    excluded: Callable[[str, List[str]], bool] = lambda path, names=(): False,
+    workers: Optional[int] = None,
+) -> Report:
+    """Compare the files on disk against the manifest.
+
+    Only files with the same size and modification time are hashed: those are
+    expected to have the same content.
+
+    :param manifest: the manifest, see :func:`load`
+    :param root: the backuproot
+    :param roots: the included paths
+    :param excluded: predicate of the excluded paths, see :func:`excluder`
+    :param workers: (optional) number of hashing threads
+    """
+    corrupt, modified, new = [], [], []
+    seen = set()
+    checked = 0
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for batch in _batches(walk(roots, excluded), CHECKSUM_BATCH):
+            todo = []
+            for path, stat in batch:
+                relpath = os.path.relpath(path, str(root))
+                seen.add(relpath)
+                entry = manifest.get(relpath)
+                if entry is None:
+                    new.append(relpath)
+                elif entry.size != stat.st_size or entry.mtime_ns != stat.st_mtime_ns:
+                    modified.append(relpath)
+                else:
+                    todo.append((relpath, path, entry))
+            for (relpath, _, entry), digest in zip(
+                todo, pool.map(_hash, [path for _, path, _ in todo])
+            ):
+                checked += 1
+                if digest is None:
+                    modified.append(relpath)
+                elif digest != entry.digest:
+                    corrupt.append(relpath)
+    missing = [relpath for relpath in manifest if relpath not in seen]
+    return Report(
+        checked=checked,
+        corrupt=sorted(corrupt),
+        modified=sorted(modified),
+        missing=sorted(missing),
+        new=sorted(new),
+    )
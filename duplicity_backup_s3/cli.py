@@ -1,14 +1,24 @@
 import click
 
 from duplicity_backup_s3 import __version__
+from duplicity_backup_s3.commands.analyze import analyze
+from duplicity_backup_s3.commands.audit import audit
 from duplicity_backup_s3.commands.cleanup import cleanup
+from duplicity_backup_s3.commands.diff import diff
+from duplicity_backup_s3.commands.discover_excludes import discover_excludes
+from duplicity_backup_s3.commands.dupes import dupes
+from duplicity_backup_s3.commands.freshness import freshness
 from duplicity_backup_s3.commands.incr import incr
 from duplicity_backup_s3.commands.init import init
 from duplicity_backup_s3.commands.list import list as list_files
 from duplicity_backup_s3.commands.remove import remove
 from duplicity_backup_s3.commands.restore import restore
+from duplicity_backup_s3.commands.schedule import schedule
+from duplicity_backup_s3.commands.standby import standby
 from duplicity_backup_s3.commands.status import status
+from duplicity_backup_s3.commands.tier import tier
 from duplicity_backup_s3.commands.verify import verify
+from duplicity_backup_s3.commands.watch import watch
 from duplicity_backup_s3.defaults import CONTEXT_SETTINGS
 
 
@@ -33,3 +43,13 @@ duplicity_backup_s3.add_command(cleanup)
 duplicity_backup_s3.add_command(status)
 duplicity_backup_s3.add_command(list_files)
 duplicity_backup_s3.add_command(remove)
+duplicity_backup_s3.add_command(diff)
+duplicity_backup_s3.add_command(analyze)
+duplicity_backup_s3.add_command(freshness)
+duplicity_backup_s3.add_command(schedule)
+duplicity_backup_s3.add_command(discover_excludes)
+duplicity_backup_s3.add_command(watch)
+duplicity_backup_s3.add_command(tier)
+duplicity_backup_s3.add_command(audit)
+duplicity_backup_s3.add_command(dupes)
+duplicity_backup_s3.add_command(standby)
@@ -0,0 +1,46 @@
+import click
+
+from duplicity_backup_s3.config import check_config_file
+from duplicity_backup_s3.defaults import (
+    ANALYZE_CHURN_RATIO,
+    ANALYZE_DEPTH,
+    CONFIG_FILEPATH,
+    CONTEXT_SETTINGS,
+)
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "-c",
+    "--config",
+    help="Config file location. Alternatively set the environment variable: "
+         "`DUPLICITY_BACKUP_S3_CONFIG`.",
+    envvar="DUPLICITY_BACKUP_S3_CONFIG",
+    default=CONFIG_FILEPATH,
+)
+@click.option(
+    "--depth",
+    type=int,
+    default=ANALYZE_DEPTH,
+    show_default=True,
+    help="Depth of the directories to aggregate the sizes on.",
+)
+@click.option(
+    "--churn-ratio",
+    type=click.FloatRange(0, 1),
+    default=ANALYZE_CHURN_RATIO,
+    show_default=True,
+    help="Fraction of the incrementals a file must change in to be reported.",
+)
+@click.option(
+    "--top", type=int, default=10, show_default=True, help="Length of the lists."
+)
+@click.option("--json", is_flag=True, help="Output the report as json.", default=False)
+@click.option("-v", "--verbose", is_flag=True, help="Be more verbose", default=False)
+def analyze(**options):
+    """Analyse the growth and churn of the backup across its history."""
+    check_config_file(options.get("config"), verbose=options.get("verbose"))
+
+    dup = DuplicityS3(**options)
+    return dup.do_analyze()
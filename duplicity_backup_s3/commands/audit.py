@@ -0,0 +1,30 @@
+import click
+
+from duplicity_backup_s3.config import check_config_file
+from duplicity_backup_s3.defaults import CONFIG_FILEPATH, CONTEXT_SETTINGS
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "-c",
+    "--config",
+    help="Config file location. Alternatively set the environment variable: "
+         "`DUPLICITY_BACKUP_S3_CONFIG`.",
+    envvar="DUPLICITY_BACKUP_S3_CONFIG",
+    default=CONFIG_FILEPATH,
+)
+@click.option(
+    "--inventory",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Read the remote files from a local copy of an S3 Inventory report "
+         "(its manifest.json, or a CSV or Parquet data file) instead of listing "
+         "the bucket.",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Be more verbose", default=False)
+def audit(**options):
+    """Check that the remote has every file the local manifests reference."""
+    check_config_file(options.get("config"), verbose=options.get("verbose"))
+
+    dupe = DuplicityS3(**options)
+    return dupe.do_audit()
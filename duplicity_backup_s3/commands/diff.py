@@ -0,0 +1,53 @@
+import click
+
+from duplicity_backup_s3.config import check_config_file
+from duplicity_backup_s3.defaults import CONFIG_FILEPATH, CONTEXT_SETTINGS
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "-c",
+    "--config",
+    help="Config file location. Alternatively set the environment variable: "
+         "`DUPLICITY_BACKUP_S3_CONFIG`.",
+    envvar="DUPLICITY_BACKUP_S3_CONFIG",
+    default=CONFIG_FILEPATH,
+)
+@click.option(
+    "--from",
+    "from_time",
+    help="Time of the older backup. eg. '8h', '7D', '1M', '2019-06-03', "
+         "'2020-12-08T21:40:00+01:00'",
+)
+@click.option(
+    "--to",
+    "to_time",
+    help="Time of the newer backup. eg. '8h', '7D', '1M', 'now', '2019-06-03', "
+         "'2020-12-08T21:40:00+01:00'. Defaults to the most recent backup.",
+)
+@click.option(
+    "--from-index",
+    help="Local file with the listing of the older backup (as saved from `list`), "
+         "used instead of `--from`.",
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "--to-index",
+    help="Local file with the listing of the newer backup (as saved from `list`), "
+         "used instead of `--to`.",
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option("--prefix", help="Only compare the files starting with this path.")
+@click.option("-v", "--verbose", is_flag=True, help="Be more verbose", default=False)
+def diff(**options):
+    """Show the added (A), removed (D) and modified (M) files between two backups."""
+    check_config_file(options.get("config"), verbose=options.get("verbose"))
+
+    if options.get("from_time") is None and options.get("from_index") is None:
+        raise click.UsageError(
+            "Provide the older backup with `--from` or `--from-index`."
+        )
+
+    dup = DuplicityS3(**options)
+    return dup.do_diff()
@@ -0,0 +1,43 @@
+import click
+
+from duplicity_backup_s3.config import check_config_file
+from duplicity_backup_s3.defaults import CONFIG_FILEPATH, CONTEXT_SETTINGS
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+
+
+@click.command("discover-excludes", context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "-c",
+    "--config",
+    help="Config file location. Alternatively set the environment variable: "
+         "`DUPLICITY_BACKUP_S3_CONFIG`.",
+    envvar="DUPLICITY_BACKUP_S3_CONFIG",
+    default=CONFIG_FILEPATH,
+)
+@click.option(
+    "--write",
+    is_flag=True,
+    help="Add the discovered excludes and `exclude_if_present` markers to the "
+         "config file.",
+    default=False,
+)
+@click.option(
+    "--only",
+    multiple=True,
+    help="Only report and write this pattern, eg. `node_modules` or "
+         "`CACHEDIR.TAG`. May be given multiple times.",
+)
+@click.option(
+    "--workers", type=int, help="Number of threads scanning the included paths."
+)
+@click.option("--json", is_flag=True, help="Output the report as json.", default=False)
+@click.option(
+    "--dry-run", envvar="DRY_RUN", is_flag=True, help="Dry run", default=False
+)
+@click.option("-v", "--verbose", is_flag=True, help="Be more verbose", default=False)
+def discover_excludes(**options):
+    """Discover caches and build artifacts that need no backup."""
+    check_config_file(options.get("config"), verbose=options.get("verbose"))
+
+    dupe = DuplicityS3(**options)
+    return dupe.do_discover_excludes()
@@ -0,0 +1,41 @@
+import click
+
+from duplicity_backup_s3.config import check_config_file
+from duplicity_backup_s3.defaults import (
+    CONFIG_FILEPATH,
+    CONTEXT_SETTINGS,
+    DUPES_MIN_SIZE,
+)
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "-c",
+    "--config",
+    help="Config file location. Alternatively set the environment variable: "
+         "`DUPLICITY_BACKUP_S3_CONFIG`.",
+    envvar="DUPLICITY_BACKUP_S3_CONFIG",
+    default=CONFIG_FILEPATH,
+)
+@click.option(
+    "--min-size",
+    type=int,
+    help=f"Only consider files of at least this many MB (Default: {DUPES_MIN_SIZE}).",
+    default=DUPES_MIN_SIZE,
+)
+@click.option(
+    "--propose",
+    type=click.Choice(["hardlinks", "excludes"]),
+    help="Print the commands that hard link the copies to their original, or "
+         "the excludes of the copies, before the report.",
+)
+@click.option("--workers", type=int, help="Number of processes hashing the files.")
+@click.option("--json", is_flag=True, help="Output the report as json.", default=False)
+@click.option("-v", "--verbose", is_flag=True, help="Be more verbose", default=False)
+def dupes(**options):
+    """Report the files that are backed up more than once."""
+    check_config_file(options.get("config"), verbose=options.get("verbose"))
+
+    dupe = DuplicityS3(**options)
+    return dupe.do_dupes()
@@ -0,0 +1,65 @@
+import sys
+
+import click
+
+from duplicity_backup_s3.config import search_config
+from duplicity_backup_s3.defaults import (
+    CONFIG_FILEPATH,
+    CONTEXT_SETTINGS,
+    FRESHNESS_CRITICAL,
+    FRESHNESS_WARNING,
+)
+from duplicity_backup_s3.freshness import UNKNOWN, check_freshness
+from duplicity_backup_s3.remote import remote_uri
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "-c",
+    "--config",
+    help="Config file location. Alternatively set the environment variable: "
+         "`DUPLICITY_BACKUP_S3_CONFIG`.",
+    envvar="DUPLICITY_BACKUP_S3_CONFIG",
+    default=CONFIG_FILEPATH,
+)
+@click.option(
+    "--warning",
+    type=float,
+    default=FRESHNESS_WARNING,
+    show_default=True,
+    help="Age in hours of the last successful backup to warn from.",
+)
+@click.option(
+    "--critical",
+    type=float,
+    default=FRESHNESS_CRITICAL,
+    show_default=True,
+    help="Age in hours of the last successful backup to be critical from.",
+)
+@click.option(
+    "--prometheus",
+    is_flag=True,
+    help="Output metrics in the Prometheus text format.",
+    default=False,
+)
+def freshness(**options):
+    """Check the age of the last successful backup, without contacting the remote.
+
+    Exits with 0 (OK), 1 (WARNING), 2 (CRITICAL) or 3 (UNKNOWN), like a Nagios
+    plugin.
+    """
+    import yaml
+
+    try:
+        config_path = search_config(options.get("config"), exit=False)
+        with config_path.open() as fd:
+            remote = remote_uri(yaml.safe_load(fd)["remote"])
+    except (OSError, yaml.YAMLError, KeyError, TypeError) as e:
+        click.echo(f"FRESHNESS UNKNOWN - could not read the configuration: {e}")
+        sys.exit(UNKNOWN)
+
+    result = check_freshness(
+        remote, warning=options["warning"] * 3600, critical=options["critical"] * 3600
+    )
+    click.echo(result.metrics() if options.get("prometheus") else result.message)
+    sys.exit(result.status)
@@ -17,6 +17,18 @@ from duplicity_backup_s3.duplicity_s3 import DuplicityS3
 @click.option(
     "--dry-run", envvar="DRY_RUN", is_flag=True, help="Dry run", default=False
 )
+@click.option(
+    "--ignore-window",
+    is_flag=True,
+    help="Start the backup even when outside of the configured backup window.",
+    default=False,
+)
+@click.option(
+    "--ignore-journal",
+    is_flag=True,
+    help="Run the backup even when the change journal reports no changes.",
+    default=False,
+)
 @click.option("-v", "--verbose", is_flag=True, help="Be more verbose", default=False)
 @click.option("--debug", is_flag=True, help="Be even more verbose", default=False)
 def incr(**options):
@@ -55,4 +55,7 @@ def remove(**options):
     check_config_file(options.get("config"), verbose=options.get("verbose"))
 
     dup = DuplicityS3(**options)
-    dup.do_remove_older()
+    try:
+        return dup.do_remove_older()
+    except ValueError as e:
+        raise click.UsageError(str(e))
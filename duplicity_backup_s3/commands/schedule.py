@@ -0,0 +1,62 @@
+import click
+
+from duplicity_backup_s3.config import check_config_file
+from duplicity_backup_s3.defaults import CONFIG_FILEPATH, CONTEXT_SETTINGS
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "-c",
+    "--config",
+    help="Config file location. Alternatively set the environment variable: "
+         "`DUPLICITY_BACKUP_S3_CONFIG`.",
+    envvar="DUPLICITY_BACKUP_S3_CONFIG",
+    default=CONFIG_FILEPATH,
+)
+@click.option(
+    "--fleet-size",
+    type=click.IntRange(min=1),
+    help="Number of hosts (and profiles) sharing the window. Defaults to "
+         "`schedule > fleet_size` in the config.",
+)
+@click.option(
+    "--window",
+    help="Backup window as 'HH:MM-HH:MM'. Defaults to the `window` in the config.",
+)
+@click.option(
+    "--duration",
+    type=click.IntRange(min=1),
+    help="Expected duration of a backup in minutes. Defaults to the median of "
+         "previous runs.",
+)
+@click.option("--hostname", help="Hostname to derive the slot from.")
+@click.option(
+    "--wait", is_flag=True, help="Sleep until the slot and run `incr`.", default=False
+)
+@click.option("--cron", is_flag=True, help="Print a crontab line.", default=False)
+@click.option(
+    "--systemd", is_flag=True, help="Print a systemd timer unit.", default=False
+)
+@click.option(
+    "--simulate",
+    is_flag=True,
+    help="Simulate the peak concurrency of the whole fleet.",
+    default=False,
+)
+@click.option(
+    "--dry-run", envvar="DRY_RUN", is_flag=True, help="Dry run", default=False
+)
+@click.option("-v", "--verbose", is_flag=True, help="Be more verbose", default=False)
+def schedule(**options):
+    """Find the slot of this host in the backup window shared by a fleet."""
+    check_config_file(options.get("config"), verbose=options.get("verbose"))
+
+    modes = [m for m in ("wait", "cron", "systemd", "simulate") if options.get(m)]
+    if len(modes) > 1:
+        raise click.UsageError(
+            "Use only one of `--wait`, `--cron`, `--systemd` and `--simulate`."
+        )
+
+    dupe = DuplicityS3(**options)
+    return dupe.do_schedule()
@@ -0,0 +1,45 @@
+import click
+
+from duplicity_backup_s3.config import check_config_file
+from duplicity_backup_s3.defaults import (
+    CONFIG_FILEPATH,
+    CONTEXT_SETTINGS,
+    STANDBY_PARALLEL,
+)
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "-c",
+    "--config",
+    help="Config file location. Alternatively set the environment variable: "
+         "`DUPLICITY_BACKUP_S3_CONFIG`.",
+    envvar="DUPLICITY_BACKUP_S3_CONFIG",
+    default=CONFIG_FILEPATH,
+)
+@click.option(
+    "--dry-run",
+    envvar="DRY_RUN",
+    is_flag=True,
+    help="Only print the changes the sync would apply.",
+    default=False,
+)
+@click.option(
+    "--target",
+    help="Standby directory to keep in sync (Default: `standby.directory` of the "
+         "config).",
+    type=click.Path(file_okay=False, writable=True),
+)
+@click.option(
+    "--parallel",
+    type=int,
+    help=f"Number of files restored at once (Default: {STANDBY_PARALLEL}).",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Be more verbose", default=False)
+def standby(**options):
+    """Sync a standby directory with the latest backup."""
+    check_config_file(options.get("config"), verbose=options.get("verbose"))
+
+    dupe = DuplicityS3(**options)
+    return dupe.do_standby()
@@ -19,6 +19,16 @@ from duplicity_backup_s3.duplicity_s3 import DuplicityS3
     "--time",
     help="Time of the backup to check. eg. '8h', '7D', '1M', 'now', '2019-06-03', '2020-12-08T21:40:00+01:00'",
 )
+@click.option(
+    "--manifest",
+    is_flag=True,
+    help="Compare the local files against the content manifest of the last "
+         "backups, without downloading.",
+    default=False,
+)
+@click.option(
+    "--workers", type=int, help="Number of threads hashing files (with --manifest)."
+)
 @click.option("-v", "--verbose", is_flag=True, help="Be more verbose", default=False)
 def verify(**options):
     """Verify backup."""
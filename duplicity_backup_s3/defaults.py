@@ -24,6 +24,112 @@ DUPLICITY_VERBOSITY = 3
 DUPLICITY_MORE_VERBOSITY = DUPLICITY_VERBOSITY + 1
 DUPLICITY_DEBUG_VERBOSITY = 5
 
+# Watchdog on the duplicity process (seconds)
+WATCHDOG_GRACE_PERIOD = 30
+WATCHDOG_POLL_INTERVAL = 1
+WATCHDOG_RETRIES = 1
+OUTPUT_TAIL_LINES = 200
+RESOURCE_SAMPLE_INTERVAL = 5  # seconds between samples of the resource usage
+
+# Backup window
+WINDOW_GRACE_PERIOD = 900  # seconds to wait for a volume boundary
+WINDOW_CLOSED_RETURNCODE = 75  # EX_TEMPFAIL, the backup continues next window
+
+# Pre-backup stage
+PRE_BACKUP_STAGING_DIR = ".pre_backup"
+PRE_BACKUP_PARALLEL = 2
+PRE_BACKUP_COMPRESSION_LEVEL = 6
+
+# Listings are sorted in chunks of this many entries
+LISTING_SORT_CHUNK = 500000
+
+# Growth and churn analytics
+ANALYZE_DEPTH = 2
+ANALYZE_CHURN_RATIO = 0.8
+VOLATILE_PATTERNS = [
+    "*.log",
+    "*.log.*",
+    "*-wal",
+    "*-shm",
+    "*-journal",
+    "*.tmp",
+    "*.pid",
+    "*.swp",
+    "*.cache",
+]
+
+# Probe of the duplicity capabilities
+PROBE_TIMEOUT = 60  # seconds
+MAX_CONCURRENCY = 4  # parallel volume uploads when supported by duplicity
+
+# Transfer settings
+DUPLICITY_VOLSIZE = 200  # MB, the default volume size of duplicity
+TRANSFER_MIN_CHUNK_SIZE = 5  # MB, the minimum part size of S3 multipart uploads
+TRANSFER_MAX_PROCS = 8
+RUN_HISTORY = 30  # number of runs kept in the state of a profile
+
+# Log capture of the duplicity output
+LOG_PREFIX = "duplicity_backup_s3"
+LOG_MAX_SIZE = 100  # MB, size after which a log file is rotated
+LOG_KEEP = 30  # number of log files kept in the `log-path`
+LOG_BUFFER_SIZE = 8 * 1024 * 1024  # bytes of output buffered for the writer
+ERROR_TAIL_LINES = 20  # lines of output shown when duplicity fails
+
+# Freshness check of the last successful backup (hours)
+FRESHNESS_WARNING = 26
+FRESHNESS_CRITICAL = 50
+
+# Staggered scheduling, expected duration of a backup without run history
+SCHEDULE_DURATION = 60  # minutes
+
+# Discovery of caches and build artifacts
+DISCOVER_EXAMPLES = 5  # matching directories reported per pattern
+
+# Change journal of the `watch` command
+JOURNAL_FLUSH_INTERVAL = 10  # seconds between writes of the journal
+JOURNAL_STALE_FLUSHES = 3  # missed writes after which the watcher is presumed dead
+JOURNAL_MAX_FILES = 1000000  # changed files kept in memory before a reset
+JOURNAL_MIN_INTERVAL = 60  # minutes between backups triggered by the watcher
+
+# Content manifest of the backup for local drift and bitrot checks
+CHECKSUM_DIGEST_SIZE = 32  # bytes of the BLAKE2b digests
+CHECKSUM_BUFFER_SIZE = 1024 * 1024  # bytes read at once per hashing thread
+CHECKSUM_BATCH = 1024  # files handed to the hashing threads at once
+CHECKSUM_MAX_DELTAS = 30  # delta generations before the manifest is compacted
+
+# Storage classes, rehydration of archived volumes before a restore
+STORAGE_RESTORE_TIER = "Standard"  # retrieval tier, `Expedited`, `Standard`, `Bulk`
+STORAGE_RESTORE_DAYS = 3  # days the rehydrated copies stay available
+STORAGE_PARALLEL = 16  # concurrent requests to S3
+STORAGE_POLL_INTERVAL = 300  # seconds between checks of the pending restores
+STORAGE_RESTORE_TIMEOUT = 48 * 3600  # seconds to wait for the restores
+
+# Scratch space of duplicity
+SCRATCH_PREFIX = "duplicity_s3__"
+SCRATCH_RESERVE = 100  # MB kept free besides the volumes in flight
+
+# Adaptive cadence of the full backups
+ADAPTIVE_SET_OVERHEAD = 10  # seconds to fetch and apply each incremental on restore
+ADAPTIVE_THROUGHPUT_HISTORY = 5  # measured download throughputs kept in the state
+
+# Audit of the remote files, columns of a CSV S3 Inventory without its manifest.json
+INVENTORY_CSV_SCHEMA = "Bucket, Key, Size, LastModifiedDate, ETag, StorageClass"
+
+# Local cache of downloaded volumes for repeated restores
+VOLUME_CACHE_MAX_SIZE = 10000  # MB
+
+# Pre-flight checks before every action
+PREFLIGHT_CHECKS = ["remote", "gpg", "scratch", "duplicity"]
+PREFLIGHT_TIMEOUT = 5  # seconds
+
+# Duplicate content in the backup
+DUPES_MIN_SIZE = 1  # MB, smaller files are not considered
+DUPES_SORT_BUFFER = 1000000  # files sorted in memory at once, the rest on disk
+DUPES_BATCH = 4096  # files handed to the hashing processes at once
+
+# Warm standby copy of the backup
+STANDBY_PARALLEL = 4  # files restored at once
+
 # helpers for platform specific stuff
 __platform = platform.system()
 ON_LINUX = os.name == "posix" or __platform == "Linux"
@@ -38,3 +144,18 @@ UNKNOWN_OPTIONS = {"ignore_unknown_options": True}.update(
 
 os.environ["XDG_CONFIG_DIRS"] = "/etc:/usr/local/etc"
 appdirs = AppDirs(appname="duplicity_backup", appauthor="jochem")
+
+# Local state of the backup profiles, kept between runs
+STATE_DIR = Path(
+    os.environ.get("DUPLICITY_BACKUP_S3_STATE_DIR", appdirs.user_state_dir)
+)
+
+# Cache of the application (eg. analytics)
+CACHE_DIR = Path(
+    os.environ.get("DUPLICITY_BACKUP_S3_CACHE_DIR", appdirs.user_cache_dir)
+)
+
+# Default archive directory of duplicity (local cache of the metadata)
+DUPLICITY_ARCHIVE_DIR = (
+    Path(os.path.expanduser(os.environ.get("XDG_CACHE_HOME", "~/.cache"))) / "duplicity"
+)
@@ -0,0 +1,233 @@
+"""Discovery of well-known caches and build artifacts in the backup.
+
+Directories such as `node_modules`, `__pycache__` and virtualenvs can be
+regenerated and need no backup. They are recognised by their name, or by a
+marker file inside them (`CACHEDIR.TAG`, `pyvenv.cfg`) that duplicity can
+exclude with `--exclude-if-present`. The included paths are scanned with a
+pool of threads, every thread walking its own subtrees, and the bytes and
+files below every match are counted towards the pattern that matched.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from duplicity_backup_s3.defaults import DISCOVER_EXAMPLES
+
+NAME = "exclude"
+MARKER = "exclude_if_present"
+
+# signature of the Cache Directory Tagging Specification
+CACHEDIR_TAG_SIGNATURE = b"Signature: 8a477f597d28d172789f06886806bc55"
+
+
+class Detector(NamedTuple):
+    """A well-known pattern of directories that need no backup."""
+
+    kind: str  # :data:`NAME` or :data:`MARKER`
+    value: str  # the directory name or the marker file
+    description: str
+
+    @property
+    def key(self) -> str:
+        """The configuration list the rule of the detector is written to.
+
+        The `discovered_excludes` precede the includes, unlike the `excludes`
+        they apply below the included paths as well.
+        """
+        return "discovered_excludes" if self.kind == NAME else "exclude_if_present"
+
+    @property
+    def rule(self) -> str:
+        """The exclude pattern, or the marker for `--exclude-if-present`."""
+        return f"**/{self.value}" if self.kind == NAME else self.value
+
+
+DETECTORS = [
+    Detector(MARKER, "CACHEDIR.TAG", "tagged cache directories"),
+    Detector(MARKER, "pyvenv.cfg", "python virtualenvs"),
+    Detector(NAME, "node_modules", "node packages"),
+    Detector(NAME, "__pycache__", "python bytecode"),
+    Detector(NAME, ".cache", "user caches"),
+]
+
+
+class Finding(NamedTuple):
+    """Bytes and files that a detector would exclude from the backup."""
+
+    detector: Detector
+    bytes: int
+    files: int
+    directories: int
+    examples: List[str]
+
+
+def _is_cachedir_tag(path: str) -> bool:
+    """Check if a `CACHEDIR.TAG` carries the signature of the specification."""
+    try:
+        with open(path, "rb") as fd:
+            return fd.read(len(CACHEDIR_TAG_SIGNATURE)) == CACHEDIR_TAG_SIGNATURE
+    except OSError:
+        return False
+
+
+def _match(
+    path: str, names: Iterable[str], detectors: List[Detector]
+) -> Optional[Detector]:
+    """Return the first detector that matches a directory, if any."""
+    for detector in detectors:
+        if detector.kind == NAME and os.path.basename(path) == detector.value:
+            return detector
+        if detector.kind == MARKER and detector.value in names:
+            if detector.value != "CACHEDIR.TAG" or _is_cachedir_tag(
+                os.path.join(path, detector.value)
+            ):
+                return detector
+    return None
+
+
+def _entries(path: str) -> Tuple[List[os.DirEntry], List[str]]:
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError:
+        return [], []
+    return entries, [entry.name for entry in entries]
+
+
+def _usage(path: str) -> Tuple[int, int]:
+    """Bytes and files below a directory, without following links."""
+    size = files = 0
+    stack = [path]
+    while stack:
+        for entry in _entries(stack.pop())[0]:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    size += entry.stat(follow_symlinks=False).st_size
+                    files += 1
+            except OSError:
+                continue
+    return size, files
+
+
+def _scan_tree(root: str, detectors: List[Detector]) -> Dict[str, list]:
+    """Find the matches below a single directory, see :func:`discover`."""
+    found: Dict[str, list] = {}
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        entries, names = _entries(path)
+        detector = _match(path, names, detectors)
+        if detector is not None:
+            size, files = _usage(path)
+            finding = found.setdefault(detector.rule, [0, 0, 0, []])
+            finding[0] += size
+            finding[1] += files
+            finding[2] += 1
+            if len(finding[3]) < DISCOVER_EXAMPLES:
+                finding[3].append(path)
+            continue  # matches below it are already counted
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+            except OSError:
+                continue
+    return found
+
+
+def _subtrees(roots: Iterable[Path], detectors: List[Detector]) -> List[str]:
+    """Split the roots into subtrees that are scanned concurrently.
+
+    Roots without a match of their own are split into their subdirectories,
+    such that a single large root is still spread over the workers.
+    """
+    subtrees = []
+    for root in roots:
+        entries, names = _entries(str(root))
+        if not root.is_dir() or _match(str(root), names, detectors) is not None:
+            subtrees.append(str(root))
+            continue
+        subtrees.extend(
+            entry.path for entry in entries if entry.is_dir(follow_symlinks=False)
+        )
+    return subtrees
+
+
+def discover(
+    roots: Iterable[Path],
+    detectors: List[Detector] = None,
+    workers: Optional[int] = None,
+) -> List[Finding]:
+    """Scan the roots of the backup for well-known caches and build artifacts.
+
+    A directory is counted towards the first detector that matches it, and is
+    not descended into further.
+
+    :param roots: the included paths, not below one another
+    :param detectors: the patterns to detect, defaults to :data:`DETECTORS`
+    :param workers: (optional) number of threads scanning the subtrees
+    :return: the findings, largest first
+    """
+    detectors = DETECTORS if detectors is None else detectors
+    totals: Dict[str, list] = {}
+    with ThreadPoolExecutor(
+        max_workers=workers or min(32, (os.cpu_count() or 1) * 4)
+    ) as pool:
+        for found in pool.map(
+            lambda subtree: _scan_tree(subtree, detectors), _subtrees(roots, detectors)
+        ):
+            for rule, (size, files, directories, paths) in found.items():
+                total = totals.setdefault(rule, [0, 0, 0, []])
+                total[0] += size
+                total[1] += files
+                total[2] += directories
+                total[3].extend(paths)
+
+    findings = [
+        Finding(
+            detector=detector,
+            bytes=totals[detector.rule][0],
+            files=totals[detector.rule][1],
+            directories=totals[detector.rule][2],
+            examples=sorted(totals[detector.rule][3])[:DISCOVER_EXAMPLES],
+        )
+        for detector in detectors
+        if detector.rule in totals
+    ]
+    return sorted(findings, key=lambda finding: finding.bytes, reverse=True)
+
+
+def configured(config: dict, detector: Detector) -> bool:
+    """Check if the configuration already excludes the pattern of a detector.
+
+    A pattern in the `excludes` only counts without includes: duplicity lets
+    the first matching selection win and the includes precede the excludes.
+    """
+    if detector.rule in (config.get(detector.key) or []):
+        return True
+    return (
+        detector.kind == NAME
+        and not config.get("includes")
+        and detector.rule in (config.get("excludes") or [])
+    )
+
+
+def add_rules(config: dict, findings: List[Finding]) -> List[str]:
+    """Add the rules of the findings to the `excludes` and `exclude_if_present`.
+
+    :param config: the configuration, updated in place
+    :param findings: the findings to exclude from the backup
+    :return: the rules that were added
+    """
+    added = []
+    for finding in findings:
+        if not configured(config, finding.detector):
+            config[finding.detector.key] = [
+                *(config.get(finding.detector.key) or []),
+                finding.detector.rule,
+            ]
+            added.append(finding.detector.rule)
+    return added
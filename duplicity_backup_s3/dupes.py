@@ -0,0 +1,200 @@
+"""Duplicate content in the backup.
+
+Duplicity stores every copy of a file, and as it does not preserve hard links,
+every link of a hard linked file as well. The duplicates are found in three
+passes that keep the memory bounded, independent of the number of files:
+
+1. The roots are walked and every file of at least `min_size` is written with
+   its size to sorted runs on disk (an external merge sort), `sort_buffer`
+   files at a time.
+2. The runs are merged by size. Files with a size of their own can not have
+   a duplicate and are never read. The others are hashed (BLAKE2b, read into
+   a reused buffer) by a pool of processes, once per inode, in batches.
+   The digests are written to sorted runs again.
+3. The runs are merged by size and digest: files with the same digest form a
+   group of identical content. The first file of a group (by root and path)
+   is the original, the others are its copies.
+"""
+import heapq
+import itertools
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from duplicity_backup_s3 import checksums
+from duplicity_backup_s3.checksums import walk
+from duplicity_backup_s3.defaults import DUPES_BATCH, DUPES_SORT_BUFFER
+
+
+class Copy(NamedTuple):
+    """A file of a group of identical content."""
+
+    root: int  # index of the root the file is below
+    inode: str  # `<device>:<inode>`, the same for hard links
+    path: str
+
+
+class Group(NamedTuple):
+    """Files with identical content, the first is the original."""
+
+    size: int
+    digest: str
+    files: List[Copy]
+
+    @property
+    def copies(self) -> List[Copy]:
+        """The files besides the original, that duplicity stores again."""
+        return self.files[1:]
+
+
+class Duplicates(NamedTuple):
+    """Duplicated content below a root of the backup."""
+
+    root: str
+    files: int  # copies of a file elsewhere in the backup
+    bytes: int
+
+
+def hash_file(path: str) -> Optional[str]:
+    """BLAKE2b digest of the content of a file, see :func:`checksums.hash_file`.
+
+    The file is read rather than mapped: a file that is truncated while it is
+    hashed would kill the worker with a SIGBUS through an mmap.
+
+    :return: None when the file is empty or can not be read (eg. it was removed)
+    """
+    try:
+        if os.stat(path).st_size == 0:
+            return None
+        return checksums.hash_file(path)
+    except OSError:
+        return None
+
+
+def _hash(item: Tuple[int, str, List[list]]) -> Tuple[int, str, List[list], str]:
+    """Hash an inode in the process pool, see :func:`find_duplicates`."""
+    size, inode, links = item
+    return size, inode, links, hash_file(links[0][1]) or ""
+
+
+def external_sort(
+    records: Iterable[list], directory: Path, buffer: int = DUPES_SORT_BUFFER
+) -> Iterator[list]:
+    """Sort records that do not fit in memory, through sorted runs on disk.
+
+    :param records: lists of json serialisable values that are comparable
+    :param directory: directory for the runs, removed by the caller
+    :param buffer: records sorted in memory at once
+    :return: the records in order
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    runs = []
+    records = iter(records)
+    while True:
+        chunk = sorted(itertools.islice(records, buffer))
+        if not chunk:
+            break
+        run = directory / f"run{len(runs)}.jsonl"
+        with run.open("w") as fd:
+            fd.writelines(json.dumps(record) + "\n" for record in chunk)
+        runs.append(run)
+
+    files = [run.open() for run in runs]
+    try:
+        yield from heapq.merge(*((json.loads(line) for line in fd) for fd in files))
+    finally:
+        for fd in files:
+            fd.close()
+
+
+def find_duplicates(
+    roots: List[Path],
+    excluded: Callable[[str, List[str]], bool],
+    directory: Path,
+    min_size: int = 1,
+    workers: Optional[int] = None,
+    sort_buffer: int = DUPES_SORT_BUFFER,
+) -> Iterator[Group]:
+    """Find the groups of files with identical content below the roots.
+
+    :param roots: the roots of the backup, not below one another
+    :param excluded: predicate of the excluded paths, see
+        :func:`duplicity_backup_s3.checksums.excluder`
+    :param directory: directory for the sorted runs, removed by the caller
+    :param min_size: bytes a file needs to be considered
+    :param workers: (optional) number of hashing processes
+    :param sort_buffer: records sorted in memory at once
+    :return: the groups, by increasing size
+    """
+    files = (
+        [stat.st_size, f"{stat.st_dev}:{stat.st_ino}", index, path]
+        for index, root in enumerate(roots)
+        for path, stat in walk([root], excluded)
+        if stat.st_size >= max(min_size, 1)
+    )
+    by_size = external_sort(files, directory / "sizes", sort_buffer)
+
+    def candidates() -> Iterator[Tuple[int, str, List[list]]]:
+        """Yield the inodes that share their size with another file."""
+        for size, records in itertools.groupby(by_size, key=lambda r: r[0]):
+            first = next(records)
+            second = next(records, None)
+            if second is None:
+                continue
+            records = itertools.chain([first, second], records)
+            for inode, links in itertools.groupby(records, key=lambda r: r[1]):
+                yield size, inode, [[root, path] for _, _, root, path in links]
+
+    def digests() -> Iterator[list]:
+        items = candidates()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                batch = list(itertools.islice(items, DUPES_BATCH))
+                if not batch:
+                    break
+                chunksize = max(1, len(batch) // ((workers or os.cpu_count() or 1) * 4))
+                for size, inode, links, digest in pool.map(
+                    _hash, batch, chunksize=chunksize
+                ):
+                    if digest:
+                        for root, path in links:
+                            yield [size, digest, root, path, inode]
+
+    by_digest = external_sort(digests(), directory / "digests", sort_buffer)
+    for (size, digest), records in itertools.groupby(
+        by_digest, key=lambda r: (r[0], r[1])
+    ):
+        group = Group(size, digest, [Copy(r[2], r[4], r[3]) for r in records])
+        if len(group.files) > 1:
+            yield group
+
+
+def summarize(
+    groups: Iterable[Group], roots: List[Path]
+) -> Tuple[List[Duplicates], int]:
+    """Count the duplicated files and bytes below every root.
+
+    :return: the duplicates of every root and the number of groups
+    """
+    totals = [[0, 0] for _ in roots]
+    count = 0
+    for group in groups:
+        count += 1
+        for copy in group.copies:
+            totals[copy.root][0] += 1
+            totals[copy.root][1] += group.size
+    return (
+        [
+            Duplicates(str(root), files, size)
+            for root, (files, size) in zip(roots, totals)
+        ],
+        count,
+    )
+
+
+def exclude_pattern(path: str) -> str:
+    """Exclude pattern that matches a path literally."""
+    return re.sub(r"([*?\[])", r"[\1]", path)
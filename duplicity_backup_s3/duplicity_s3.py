@@ -1,25 +1,120 @@
 import os
+import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
 import warnings
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from pprint import pprint
-from typing import List, Tuple, Union
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 from urllib.parse import urlsplit
 
 import yaml
 from envparse import env
 
+from duplicity_backup_s3.archive import (
+    archive_dir,
+    extra_arg_value,
+    last_full,
+    parse_interval,
+)
+from duplicity_backup_s3.cadence import (
+    Decision,
+    chain_length,
+    current_chain,
+    decide,
+    median,
+    track,
+)
+from duplicity_backup_s3.capabilities import Capabilities, probe
 from duplicity_backup_s3.defaults import (
+    ADAPTIVE_THROUGHPUT_HISTORY,
+    ANALYZE_CHURN_RATIO,
+    ANALYZE_DEPTH,
+    CACHE_DIR,
+    CHECKSUM_MAX_DELTAS,
     DUPLICITY_BACKUP_ARGS,
     DUPLICITY_BASIC_ARGS,
     DUPLICITY_DEBUG_VERBOSITY,
     DUPLICITY_MORE_VERBOSITY,
     DUPLICITY_VERBOSITY,
+    DUPLICITY_VOLSIZE,
+    ERROR_TAIL_LINES,
     FULL_IF_OLDER_THAN,
+    JOURNAL_FLUSH_INTERVAL,
+    JOURNAL_MIN_INTERVAL,
+    LOG_KEEP,
+    LOG_MAX_SIZE,
+    PREFLIGHT_CHECKS,
+    PREFLIGHT_TIMEOUT,
+    RUN_HISTORY,
+    SCHEDULE_DURATION,
+    SCRATCH_PREFIX,
+    SCRATCH_RESERVE,
+    STANDBY_PARALLEL,
+    STORAGE_PARALLEL,
+    STORAGE_POLL_INTERVAL,
+    STORAGE_RESTORE_DAYS,
+    STORAGE_RESTORE_TIER,
+    STORAGE_RESTORE_TIMEOUT,
+    VOLUME_CACHE_MAX_SIZE,
     NEED_SUBPROCESS_SHELL,
+    WATCHDOG_GRACE_PERIOD,
+    WATCHDOG_RETRIES,
+    WINDOW_CLOSED_RETURNCODE,
+    WINDOW_GRACE_PERIOD,
+)
+from duplicity_backup_s3.logcapture import RotatingLog
+from duplicity_backup_s3.pagecache import (
+    PageCacheUsage,
+    drop_files,
+    nocache_command,
+    read_meminfo,
+    usage,
+)
+from duplicity_backup_s3.policies import (
+    EXCLUDED_FILELIST,
+    Policy,
+    chain_uri,
+    distinct_roots,
+    find_chain,
+    policy_args,
+    scan,
+)
+from duplicity_backup_s3.preflight import (
+    DECRYPTING_ACTIONS,
+    CheckResult,
+    check_gpg_key,
+    check_remote,
+    run_checks,
+)
+from duplicity_backup_s3.remote import remote_uri
+from duplicity_backup_s3.resources import ResourceUsage
+from duplicity_backup_s3.results import RunResult
+from duplicity_backup_s3.runner import ProcessRunner, StallEvent
+from duplicity_backup_s3.scratch import (
+    ScratchError,
+    choose,
+    clean_stale,
+    free_space,
+    make_scratch,
+    owner_prefix,
+    with_tempdir,
+)
+from duplicity_backup_s3.state import load_state, profile_key, update_state
+from duplicity_backup_s3.stats import throughput
+from duplicity_backup_s3.transfer import transfer_args, transfer_settings
+from duplicity_backup_s3.utils import (
+    echo_failure,
+    echo_info,
+    echo_success,
+    echo_warning,
 )
-from duplicity_backup_s3.utils import echo_failure, echo_info
+from duplicity_backup_s3.window import BackupWindow, VolumeBoundary
 
 
 # /bin/duplicity
@@ -44,6 +139,8 @@ class DuplicityS3:
     :ivar verbose: verbosity level
     :ivar dry_run: boolean flag to do dry_run only
     :ivar env: environment object from parse environment
+    :ivar stall_events: stalls of duplicity detected by the watchdog
+    :ivar last_run: result of the last duplicity run
     """
 
     def __init__(self, **options):
@@ -72,12 +169,16 @@ class DuplicityS3:
         self._args = [f"-v{duplicity_verbosity}"] + DUPLICITY_BASIC_ARGS  # type: List
 
         self.dry_run: bool = options.get("dry_run", False)
+        self.stall_events: List[StallEvent] = []
+        self.last_tail: List[str] = []
+        self.last_run: Optional[RunResult] = None
+        self.pre_backup_results: list = []
 
         with warnings.catch_warnings():  # catch the warnings that env puts out.
             warnings.simplefilter("ignore", UserWarning)
             self.env.read_envfile()
 
-    def __runtime_env(self) -> dict:
+    def _runtime_env(self) -> dict:
         runtime_env = self._get_aws_secrets()
         if self._get_gpg_secrets():
             runtime_env["PASSPHRASE"] = self._get_gpg_secrets().get("PASSPHRASE")
@@ -162,34 +263,52 @@ class DuplicityS3:
 
         :return: remote url for the backup location.
         """
-        remote = self._config["remote"]
-        # fast bail when a URI is provided.
-        if "uri" in self._config["remote"]:
-            return remote.get("uri")
+        return remote_uri(self._config["remote"])
 
-        bucket = bucket_str = self._config["remote"].get("bucket") or ""
-        path = path_str = self._config["remote"].get("path") or ""
-        endpoint = endpoint_str = self._config["remote"].get("endpoint") or ""
+    @property
+    def archive_dir(self) -> Path:
+        """The local archive directory of duplicity for the remote."""
+        from duplicity_backup_s3.archive import archive_dir
+
+        return archive_dir(self.remote_uri, self._config.get("extra_args"))
+
+    def _chain_name(self, remote: Optional[str]) -> Optional[str]:
+        """Name of the policy of a chain, None for the main chain."""
+        for policy in self.policies:
+            if remote == chain_uri(self.remote_uri, policy):
+                return policy.name
+        return None
+
+    def _chain_archive_dir(self, remote: str) -> Path:
+        """Find the local archive directory of duplicity for a chain."""
+        return archive_dir(
+            remote, self._config.get("extra_args"), self._chain_name(remote)
+        )
 
-        if endpoint and bucket:
-            endpoint_str = f"{endpoint}/" if not endpoint.endswith("/") else endpoint
-        if not path.startswith("/"):
-            if path and bucket:
-                path_str = f"/{path}" if not bucket_str.endswith("/") else path
-            if path and endpoint and not bucket:
-                path_str = f"/{path}" if not endpoint_str.endswith("/") else path
+    def _chain_args(self, remote: Optional[str]) -> List[str]:
+        """Give a policy chain its own `--name`, when the extra arguments set one.
 
-        # construct target_uri from the '*_str'
-        target_uri = "".join((endpoint_str, bucket_str, path_str))
-        if not endpoint:
-            target_uri = f"s3+http://{target_uri}"
+        Without it, the chains would share the archive directory of the main chain.
+        """
+        name = self._chain_name(remote)
+        extra_args = self._config.get("extra_args")
+        if name is None or extra_arg_value(extra_args, "--name") is None:
+            return []
+        return ["--name", self._chain_archive_dir(remote).name]
 
-        # check if endpoint has a scheme in it. If not prepend s3://
-        scheme = urlsplit(target_uri).scheme
-        if not scheme:
-            target_uri = f"s3://{target_uri}"
+    @property
+    def chain_uris(self) -> List[str]:
+        """Remote uris of the main chain and the chains of the policies."""
+        return [self.remote_uri] + [
+            chain_uri(self.remote_uri, policy) for policy in self.policies
+        ]
 
-        return target_uri
+    @property
+    def backup_window(self) -> Optional[BackupWindow]:
+        """The backup window from the configuration or None when not configured."""
+        if not self._config.get("window"):
+            return None
+        return BackupWindow.from_config(self._config["window"])
 
     def _extend_args(self, args: Union[List, None] = None) -> List:
         """
@@ -198,27 +317,52 @@ class DuplicityS3:
         The most common arguments which are added are:
         `--s3-endpoint-url`, `--encrypt-key` or `--no-encryption`, `--dry-run`
 
+        Version specific options are only added when the installed duplicity
+        supports them (see :mod:`duplicity_backup_s3.capabilities`). The fastest
+        supported options, such as `--s3-use-multiprocessing` and
+        `--concurrency`, are turned on automatically.
+
         :return: A list of arguments to add
         """
         if args is None or not isinstance(args, (List, Tuple)):
-            args = self._args
-        # TODO: not supported in older style duplicity (version 0.7.19 not) need
-        #  to refactor to make this version dependend as the new s3:// url
-        #  constructor does not work.
-        # if self._endpoint_uri:
-        #     args.extend(["--s3-endpoint-url", self._endpoint_uri])
+            args = list(self._args)
+        capabilities = self.capabilities
+
+        def supported(option: str) -> bool:
+            # without a probe, assume the option is supported as before
+            return capabilities is None or capabilities.supports(option)
+
+        # the default `--s3-use-new-style` is dropped by duplicity 2.0 and up.
+        args[:] = [a for a in args if a != "--s3-use-new-style" or supported(a)]
+
+        # `--s3-endpoint-url` requires a s3:// uri without the host, and a
+        # duplicity version that supports it (not 0.7.19 and older).
+        if (
+            self._endpoint_uri
+            and capabilities is not None
+            and capabilities.supports("--s3-endpoint-url")
+            and urlsplit(self._endpoint_uri).scheme in ("http", "https")
+            and urlsplit(self.remote_uri).scheme in ("s3", "boto3+s3")
+        ):
+            args.extend(["--s3-endpoint-url", self._endpoint_uri])
         if self._get_gpg_secrets().get("GPG_KEY", False):
             args.extend(["--encrypt-key", self._get_gpg_secrets().get("GPG_KEY")])
         elif not self._get_gpg_secrets():
             args.append("--no-encryption")
         if self.dry_run:
             args.append("--dry-run")
-        if self._config["remote"].get("s3-european-buckets", True):
+        if self._config["remote"].get("s3-european-buckets", True) and supported(
+            "--s3-european-buckets"
+        ):
             # Default added. May be suppressed in config.
             args.append("--s3-european-buckets")
-        if self._config["remote"].get("use-new-style", True):
+        if self._config["remote"].get("use-new-style", True) and supported(
+            "--s3-use-new-style"
+        ):
             # Default added. May be suppressed in config.
             args.append("--s3-use-new-style")
+        if capabilities is not None or self._config.get("transfer"):
+            args.extend(transfer_args(self._transfer_settings(), supported))
 
         # add additional argument that are passable to duplicity.
         if self._config.get("extra_args") and isinstance(
@@ -227,9 +371,39 @@ class DuplicityS3:
             args.extend(self._config["extra_args"])
         return args
 
-    def _execute(self, *cmd_args, runtime_env: dict = None) -> int:
-        """Execute the duplicity command."""
+    def _execute(
+        self,
+        *cmd_args,
+        runtime_env: dict = None,
+        deadline: datetime = None,
+        archive_dir: Path = None,
+        nocache: bool = False,
+    ) -> int:
+        """Execute the duplicity command.
+
+        :param cmd_args: the arguments of the duplicity command
+        :param runtime_env: environment to run duplicity in
+        :param deadline: (optional) moment to stop duplicity at a volume boundary
+        :param archive_dir: (optional) archive directory of the chain to detect
+            the volume boundaries in, defaults to the one of the main chain
+        :param nocache: run duplicity under the `nocache` helper, see
+            :mod:`duplicity_backup_s3.pagecache`
+        :return: the returncode of duplicity, `WINDOW_CLOSED_RETURNCODE` when it
+            was stopped at the deadline.
+        """
         command = [self.duplicity_cmd(), *cmd_args]
+        try:
+            scratch = self._make_scratch(cmd_args[0])
+        except ScratchError as e:
+            echo_failure(str(e))
+            return 1
+        if scratch is not None:
+            command = with_tempdir(command, scratch)
+            runtime_env = dict(
+                os.environ if runtime_env is None else runtime_env, TMPDIR=scratch
+            )
+        if nocache:
+            command[:0] = [nocache_command()]
 
         if self.verbose:
             print("command used:")
@@ -244,20 +418,325 @@ class DuplicityS3:
                 ]
             )
 
-        self.last_results = subprocess.run(
-            command, shell=NEED_SUBPROCESS_SHELL, env=runtime_env
+        log = self._open_log()
+
+        def output(text: str) -> None:
+            ProcessRunner._write_stdout(text)
+            if log is not None:
+                log.write(text)
+
+        try:
+            watchdog = self._config.get("watchdog") or {}
+            retries = watchdog.get("retries", WATCHDOG_RETRIES) if watchdog else 0
+            started, start = datetime.now(), time.monotonic()
+            for attempt in range(retries + 1):
+                runner = ProcessRunner(
+                    command,
+                    env=runtime_env,
+                    shell=NEED_SUBPROCESS_SHELL,
+                    stall_timeout=watchdog.get("stall_timeout"),
+                    grace_period=watchdog.get("grace_period", WATCHDOG_GRACE_PERIOD),
+                    output=output,
+                    **self._deadline_options(deadline, archive_dir),
+                )
+                self.last_results = runner.run()
+                self.last_tail = list(runner.tail)
+                self.last_run = RunResult.from_output(
+                    command,
+                    WINDOW_CLOSED_RETURNCODE
+                    if runner.deadline_reached
+                    else self.last_results.returncode,
+                    started,
+                    time.monotonic() - start,
+                    self.last_tail,
+                    action=cmd_args[0],
+                    stalled=runner.stall_event is not None,
+                    window_closed=runner.deadline_reached,
+                    log_path=str(log.path) if log is not None else None,
+                    resources=runner.resources,
+                )
+                if self.verbose and runner.resources is not None:
+                    echo_info(f"Resources: {runner.resources.summary}")
+                if runner.deadline_reached:
+                    echo_warning(
+                        "The backup window closed, duplicity was stopped. The backup "
+                        "is resumed by the next run."
+                    )
+                    return WINDOW_CLOSED_RETURNCODE
+                if runner.stall_event is None:
+                    break
+
+                self.stall_events.append(runner.stall_event)
+                echo_warning(
+                    "The duplicity command made no progress for {:.0f} seconds and "
+                    "was terminated.".format(runner.stall_event.idle_seconds)
+                )
+                if attempt < retries:
+                    echo_info(
+                        f"Retrying the duplicity command ({attempt + 1}/{retries})."
+                    )
+
+            try:
+                self.last_results.check_returncode()
+            except subprocess.CalledProcessError:
+                echo_failure(
+                    "The duplicity command exited with an error. "
+                    "Command may not have succeeded."
+                )
+                if self.verbose:
+                    tail = "\n".join(self.last_tail[-ERROR_TAIL_LINES:])
+                    echo_info(f"More information on the error:\n{tail}")
+                if log is not None:
+                    echo_info(f"The complete output is logged in {log.path}")
+            return self.last_results.returncode
+        finally:
+            self._close_log(log)
+            if scratch is not None:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+    def _scratch_need(self, action: str) -> int:
+        """Bytes of scratch space a duplicity action is expected to need.
+
+        A backup builds a volume while `concurrency` volumes upload, a restore
+        or verify downloads a volume while it extracts another.
+        """
+        volsize = max(
+            [self._config.get("volsize", DUPLICITY_VOLSIZE)]
+            + [policy.volsize for policy in self.policies if policy.volsize]
+        )
+        if action in ("incr", "incremental", "full"):
+            volumes = self._transfer_settings().get("concurrency", 1) + 1
+        elif action in ("restore", "verify"):
+            volumes = 2
+        else:
+            volumes = 0
+        reserve = (self._config.get("scratch") or {}).get("reserve", SCRATCH_RESERVE)
+        return (volsize * volumes + reserve) * 1024 * 1024
+
+    def _choose_scratch(self, action: str) -> Optional[str]:
+        """Pick the scratch directory for an action, None when not configured.
+
+        Stale scratch directories of earlier runs are removed first.
+
+        :raises ScratchError: when none of the directories has room
+        """
+        directories = (self._config.get("scratch") or {}).get("directories") or []
+        if not getattr(self, "_scratch_cleaned", False):
+            self._scratch_cleaned = True
+            removed = clean_stale(directories or [tempfile.gettempdir()])
+            if removed and self.verbose:
+                echo_info(f"Removed {len(removed)} stale scratch directories.")
+        if not directories:
+            return None
+        directory = choose(directories, self._scratch_need(action))
+        if self.verbose:
+            echo_info(f"Using the scratch directory {directory}.")
+        return directory
+
+    def _make_scratch(self, action: str) -> Optional[str]:
+        """Create the scratch directory of a run, None when not configured.
+
+        :raises ScratchError: when none of the directories has room
+        """
+        directory = self._choose_scratch(action)
+        return make_scratch(directory) if directory is not None else None
+
+    def _preflight_results(self, action: str) -> List[CheckResult]:
+        """Run the pre-flight checks of an action, see :mod:`preflight`.
+
+        :param action: the duplicity action that is about to run
+        :return: the results, empty without the `preflight` section
+        """
+        if "preflight" not in self._config:
+            return []
+        settings = self._config.get("preflight") or {}
+        enabled = settings.get("checks", PREFLIGHT_CHECKS)
+
+        def scratch() -> str:
+            directories = (self._config.get("scratch") or {}).get("directories")
+            need = self._scratch_need(action)
+            directory = choose(directories or [tempfile.gettempdir()], need)
+            free = free_space(directory) or 0
+            return (
+                f"{directory} has {free / 1e6:.0f} MB free, "
+                f"the run needs {need / 1e6:.0f} MB"
+            )
+
+        def duplicity() -> str:
+            binary = self.duplicity_cmd()
+            capabilities = getattr(self, "_capabilities", None)
+            if capabilities is None:
+                capabilities = self._capabilities = probe(binary)
+            version = capabilities.version
+            return "{} {}".format(
+                binary, ".".join(map(str, version)) if version else "(unknown version)"
+            )
+
+        checks = dict(
+            remote=lambda: check_remote(self.remote_uri, self._s3_client),
+            gpg=lambda: check_gpg_key(
+                self._get_gpg_secrets().get("GPG_KEY"),
+                secret=action in DECRYPTING_ACTIONS,
+            ),
+            scratch=scratch,
+            duplicity=duplicity,
+        )
+        if action not in ("incr", "full", *DECRYPTING_ACTIONS):
+            checks.pop("gpg")
+        return run_checks(
+            {name: check for name, check in checks.items() if name in enabled},
+            timeout=settings.get("timeout", PREFLIGHT_TIMEOUT),
         )
 
+    def _preflight(self, action: str) -> bool:
+        """Run the pre-flight checks of an action and report the failures.
+
+        :return: False when a check failed and the action should not run
+        """
+        results = self._preflight_results(action)
+        for result in results:
+            if not result.ok:
+                echo_failure(f"Pre-flight check '{result.name}': {result.message}")
+            elif self.verbose:
+                echo_info(
+                    f"Pre-flight check '{result.name}': {result.message} "
+                    f"({result.duration:.2f}s)"
+                )
+        return all(result.ok for result in results)
+
+    def _open_log(self) -> Optional[RotatingLog]:
+        """Open the log of this run in the configured `log-path`, if any."""
+        log_path = self._config.get("log-path")
+        if not log_path:
+            return None
+        rotation = self._config.get("log_rotation") or {}
+        log = RotatingLog(
+            Path(log_path),
+            max_size=rotation.get("max_size", LOG_MAX_SIZE) * 1024 * 1024,
+            keep=rotation.get("keep", LOG_KEEP),
+            compress=rotation.get("compress", True),
+            key=profile_key(self.remote_uri),
+        )
         try:
-            self.last_results.check_returncode()
-        except subprocess.CalledProcessError as e:
-            echo_failure(
-                "The duplicity command exited with an error. "
-                "Command may not have succeeded."
+            return log.open()
+        except OSError as e:
+            echo_warning(f"Could not open the log in '{log_path}': {e}")
+            return None
+
+    @staticmethod
+    def _close_log(log: Optional[RotatingLog]) -> None:
+        """Close the log of a run and report output that could not be logged."""
+        if log is None:
+            return
+        log.close()
+        if log.error is not None:
+            echo_warning(f"Writing the log {log.path} failed: {log.error}")
+        if log.dropped:
+            echo_warning(
+                f"{log.dropped} bytes of output were not logged, the disk of "
+                "the log could not keep up."
             )
-            if self.verbose:
-                echo_info(f"More information on the error:\n{e.output}")
-        return self.last_results.returncode
+
+    def _iter_output(self, *cmd_args, runtime_env: dict = None) -> Iterator[str]:
+        """Execute the duplicity command and stream its output line by line.
+
+        :raises subprocess.CalledProcessError: when duplicity exits with an error
+            after the output is exhausted.
+        """
+        command = [self.duplicity_cmd(), *cmd_args]
+        if self.verbose:
+            echo_info(f"command used: {' '.join(command)}")
+
+        process = subprocess.Popen(
+            command,
+            shell=NEED_SUBPROCESS_SHELL,
+            env=runtime_env,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            errors="replace",
+        )
+        try:
+            yield from process.stdout
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                process.terminate()
+            self.last_results = subprocess.CompletedProcess(command, process.wait())
+        self.last_results.check_returncode()
+
+    def iter_current_files(self, time: str = None) -> Iterator[str]:
+        """Stream the output of `list-current-files` of the backup at `time`."""
+        args = self._extend_args(list(self._args))
+        if time is not None:
+            args.extend(["--time", time])
+        return self._iter_output(
+            "list-current-files",
+            *args,
+            self.remote_uri,
+            runtime_env=self._runtime_env(),
+        )
+
+    def _deadline_options(
+        self, deadline: Optional[datetime], archive_dir: Path = None
+    ) -> dict:
+        """Options of the :class:`ProcessRunner` to stop duplicity at a deadline."""
+        if deadline is None:
+            return {}
+        window = self._config.get("window") or {}
+        return dict(
+            deadline=time.monotonic() + (deadline - datetime.now()).total_seconds(),
+            deadline_grace=window.get("grace_period", WINDOW_GRACE_PERIOD),
+            at_boundary=VolumeBoundary(archive_dir or self.archive_dir),
+        )
+
+    @property
+    def capabilities(self) -> Optional[Capabilities]:
+        """Capabilities of the installed duplicity, None when it cannot be probed."""
+        if not hasattr(self, "_capabilities"):
+            try:
+                self._capabilities = probe(self.duplicity_cmd())
+            except OSError:
+                self._capabilities = None
+        return self._capabilities
+
+    def _transfer_settings(self) -> dict:
+        """Upload settings, derived from previous runs in `auto` mode."""
+        throughputs = sorted(
+            run["throughput"]
+            for run in load_state(self.remote_uri).get("runs", [])
+            if run.get("throughput")
+        )
+        return transfer_settings(
+            self._config.get("transfer"),
+            volsize=self._config.get("volsize", DUPLICITY_VOLSIZE),
+            throughput=throughputs[len(throughputs) // 2] if throughputs else None,
+        )
+
+    def _record_run(
+        self,
+        action: str,
+        returncode: int,
+        started: datetime,
+        statistics: dict,
+        resources: Optional[ResourceUsage] = None,
+        page_cache: Optional[PageCacheUsage] = None,
+    ) -> None:
+        """Record a run with its statistics and resources in the state."""
+        run = dict(
+            action=action,
+            time=started.isoformat(),
+            duration=(datetime.now() - started).total_seconds(),
+            returncode=returncode,
+            bytes=statistics.get("TotalDestinationSizeChange"),
+            throughput=throughput(statistics),
+            resources=resources._asdict() if resources is not None else None,
+        )
+        if page_cache is not None:
+            run["page_cache"] = dict(page_cache._asdict(), evicted=page_cache.evicted)
+        runs = load_state(self.remote_uri).get("runs", [])
+        update_state(self.remote_uri, runs=(runs + [run])[-RUN_HISTORY:])
+
+    _duplicity_cmds: dict = {}
 
     @classmethod
     def duplicity_cmd(cls, search_path=None) -> str:
@@ -270,23 +749,42 @@ class DuplicityS3:
         """
         from shutil import which
 
+        if search_path in cls._duplicity_cmds:
+            return cls._duplicity_cmds[search_path]
+
         duplicity_cmd = which("duplicity", path=search_path)
 
         if not duplicity_cmd:
             raise OSError("Could not find `duplicity` in path, is it installed?")
 
+        cls._duplicity_cmds[search_path] = duplicity_cmd
         return duplicity_cmd
 
     @staticmethod
-    def get_cludes(includes: List[str] = None, excludes: List[str] = None) -> List[str]:
+    def get_cludes(
+        includes: List[str] = None,
+        excludes: List[str] = None,
+        exclude_if_present: List[str] = None,
+        discovered_excludes: List[str] = None,
+    ) -> List[str]:
         """
         Get includes or excludes command arguments.
 
         :param includes: list of file includes (absolute paths, not relative from root)
         :param excludes: list of file excludes (absolute paths, not relative from root)
+        :param exclude_if_present: list of marker files, directories that contain
+            one of them are excluded (also below the includes)
+        :param discovered_excludes: list of excludes that precede the includes,
+            such that they also apply below the includes
         :return:
         """
         arg_list = []
+        if exclude_if_present:
+            arg_list.extend(
+                [f"--exclude-if-present={marker}" for marker in exclude_if_present]
+            )
+        if discovered_excludes:
+            arg_list.extend([f"--exclude={path}" for path in discovered_excludes])
         if includes:
             arg_list.extend([f"--include={path}" for path in includes])
         if excludes:
@@ -297,27 +795,511 @@ class DuplicityS3:
         """
         Incremental duplicity Backup.
 
+        When a backup window is configured, the backup only starts within the
+        window and is stopped at the first volume boundary after the window
+        closes. Duplicity resumes the interrupted backup on the next run.
+
         :return: error code
         """
-        action = "incr"
-        source = self._config.get("backuproot")
         target = self.remote_uri
+
+        deadline, outside = self._window_deadline(self.options.get("ignore_window"))
+        if outside is not None:
+            echo_info(outside)
+            return 0
+        if not self._preflight("incr"):
+            return 1
+        state = load_state(target)
+
+        includes = self._config.get("includes")
+        if self._config.get("pre_backup"):
+            if not self._pre_backup():
+                return 1
+            if includes:
+                from duplicity_backup_s3.prebackup import staging_dir
+
+                includes = [str(staging_dir(self._config)), *includes]
+
+        if state.get("partial_since"):
+            echo_info(
+                "Resuming the backup that was interrupted when the backup window "
+                f"closed at {state['partial_since']}."
+            )
+
+        if self._journal_unchanged(state):
+            echo_info(
+                "No changes since the last backup according to the journal, "
+                "skipping the backup."
+            )
+            if not self.dry_run:
+                update_state(target, last_success=time.time())
+            return 0
+
+        action = self._backup_action(state)
+        scanned = self._scan_policies(includes) if self.policies else {}
+
+        cache_mode = self._cache_friendly()
+        meminfo = read_meminfo()
+        started = datetime.now()
+        returncode = self._execute(
+            *self._incremental_command(
+                includes,
+                exclude_filelist=scanned.get(EXCLUDED_FILELIST, {}).get("filelist"),
+                full=action == "full",
+            ),
+            runtime_env=self._runtime_env(),
+            deadline=deadline,
+            nocache=cache_mode == "nocache",
+        )
+        since = self._read_since(state, started) if cache_mode == "evict" else None
+        dropped = self._drop_page_cache(includes, since) if cache_mode == "evict" else 0
+        page_cache = usage(meminfo, dropped)
+        if page_cache is not None and (cache_mode or self.verbose):
+            echo_info(f"Page cache: {page_cache.summary}.")
+        if not self.dry_run:
+            self._record_backup(
+                action, returncode, started, self.last_run, state, page_cache
+            )
+
+        returncode = self._backup_policies(scanned, deadline, cache_mode, returncode)
+        if self.policies and cache_mode == "evict":
+            self._drop_page_cache(includes, since)
+
+        if not self.dry_run:
+            self._record_outcome(returncode, started)
+            if returncode == 0 and "checksums" in self._config:
+                self._update_checksums()
+        return returncode
+
+    def _window_deadline(
+        self, ignore_window: bool = False
+    ) -> Tuple[Optional[datetime], Optional[str]]:
+        """Find when a backup that starts now must stop for the backup window.
+
+        :param ignore_window: start the backup outside of the window
+        :return: the closing of the window (None without a window or outside of
+            it) and the reason not to start the backup, None to start it
+        """
+        window = self.backup_window
+        if window is None:
+            return None, None
+        now = datetime.now()
+        if window.contains(now):
+            return window.closes_at(now), None
+        if ignore_window:
+            return None, None
+        return None, (
+            f"Outside of the backup window {window.start:%H:%M}-"
+            f"{window.end:%H:%M}, not starting the backup."
+        )
+
+    def _backup_action(self, state: dict) -> str:
+        """Decide on a `full` or `incr` backup with the `adaptive_full` settings."""
+        decision = self._adaptive_full(state)
+        if decision is None:
+            return "incr"
+        if decision.full or self.verbose:
+            estimate = (
+                f" (estimated restore time {decision.restore_time / 60:.0f} minutes)"
+                if decision.restore_time is not None
+                else ""
+            )
+            start = "Starting a full backup" if decision.full else "No full backup"
+            echo_info(f"{start}, {decision.reason}{estimate}.")
+        return "full" if decision.full else "incr"
+
+    def _record_backup(
+        self,
+        action: str,
+        returncode: int,
+        started: datetime,
+        run: Optional[RunResult],
+        state: dict,
+        page_cache: Optional[PageCacheUsage] = None,
+    ) -> None:
+        """Record the backup of the main chain and track its chain.
+
+        :param action: `incr` or `full`
+        :param returncode: returncode of duplicity
+        :param started: start of the backup
+        :param run: the result of the duplicity run, None when it did not run
+        :param state: the state of the profile before the backup
+        :param page_cache: (optional) the page cache usage of the backup
+        """
+        statistics = run.statistics if run is not None else {}
+        resources = run.resources if run is not None else None
+        self._record_run(action, returncode, started, statistics, resources, page_cache)
+        if returncode == 0 and "adaptive_full" in self._config:
+            update_state(
+                self.remote_uri,
+                chain=track(
+                    self.archive_dir,
+                    state.get("chain"),
+                    statistics.get("TotalDestinationSizeChange"),
+                    started.astimezone(timezone.utc),
+                ),
+            )
+
+    def _backup_policies(
+        self,
+        scanned: dict,
+        deadline: Optional[datetime],
+        cache_mode: Optional[str],
+        returncode: int,
+    ) -> int:
+        """Back up the chains of the policies after the main chain.
+
+        :param scanned: the filelists of the chains, see :meth:`_scan_policies`
+        :param deadline: (optional) moment to stop at for the backup window
+        :param cache_mode: see :meth:`_cache_friendly`
+        :param returncode: returncode of the main chain
+        :return: the returncode of the first failed chain, or of the main chain
+        """
+        for policy in self.policies:
+            if returncode == WINDOW_CLOSED_RETURNCODE:
+                break
+            echo_info(f"Backing up the files of the policy '{policy.name}'.")
+            chain_returncode = self._execute(
+                *self._policy_command(policy, scanned[policy.name]["filelist"]),
+                runtime_env=self._runtime_env(),
+                deadline=deadline,
+                archive_dir=self._chain_archive_dir(chain_uri(self.remote_uri, policy)),
+                nocache=cache_mode == "nocache",
+            )
+            if chain_returncode == WINDOW_CLOSED_RETURNCODE or not returncode:
+                returncode = chain_returncode
+        return returncode
+
+    def _record_outcome(self, returncode: int, started: datetime) -> None:
+        """Record an interrupted backup to resume, or the last successful one."""
+        if returncode == WINDOW_CLOSED_RETURNCODE:
+            update_state(self.remote_uri, partial_since=datetime.now().isoformat())
+        elif returncode == 0:
+            update_state(
+                self.remote_uri,
+                partial_since=None,
+                last_success=time.time(),
+                journal_checkpoint=started.timestamp(),
+            )
+
+    def _cache_friendly(self) -> Optional[str]:
+        """Resolve the `cache_friendly` mode of the backup.
+
+        :return: `nocache` to run duplicity under the helper, `evict` to drop
+            the pages after the backup, None to leave the page cache alone
+        """
+        mode = self._config.get("cache_friendly")
+        if mode is None or mode == "evict":
+            return mode
+        if nocache_command() is not None:
+            return "nocache"
+        if mode == "nocache":
+            echo_warning(
+                "The `nocache` helper is not installed, the pages of the backed up "
+                "files are dropped after the backup instead."
+            )
+        return "evict"
+
+    def _read_since(self, state: dict, started: datetime) -> Optional[datetime]:
+        """Start of the previous backup, None when this run was a full backup.
+
+        Duplicity only reads the files that changed since the previous backup,
+        and all of them for a full backup.
+        """
+        full, _ = chain_length(self.archive_dir)
+        checkpoint = state.get("journal_checkpoint")
+        if checkpoint is None or (
+            full is not None and full >= started.astimezone(timezone.utc)
+        ):
+            return None
+        return datetime.fromtimestamp(checkpoint)
+
+    def _drop_page_cache(
+        self, includes: Optional[List[str]], since: Optional[datetime]
+    ) -> int:
+        """Drop the cached pages of the files that the backup read.
+
+        :param includes: the includes of the backup
+        :param since: see :func:`duplicity_backup_s3.pagecache.drop_files`
+        :return: the bytes of the dropped files
+        """
+        from duplicity_backup_s3.checksums import walk
+
+        return drop_files(walk(self._scan_roots(includes), self._excluded()), since)
+
+    def _journal_unchanged(self, state: dict) -> bool:
+        """Check if the change journal tells that a backup can be skipped.
+
+        Without a trustworthy journal, with an interrupted backup to resume,
+        pre-backup dumps or a full backup that is due, the backup always runs.
+
+        :param state: the state of the profile
+        """
+        if "journal" not in self._config or self.options.get("ignore_journal"):
+            return False
+
+        from duplicity_backup_s3.journal import pending_changes, request_flush
+
+        # changes since the last write of the journal are not in it yet
+        started = time.time()
+        request_flush(self.remote_uri)
+        pending = pending_changes(
+            self.remote_uri, state.get("journal_checkpoint"), fresh_since=started
+        )
+        if pending is None:
+            if self.verbose:
+                echo_info("The change journal is not usable, scanning all files.")
+            return False
+        if self.verbose:
+            echo_info(
+                f"Journal: {pending.files} changed files in {pending.directories} "
+                f"directories, up to {pending.bytes / 1e6:.1f} MB to back up."
+            )
+        if (
+            pending.files
+            or state.get("partial_since")
+            or self._config.get("pre_backup")
+        ):
+            return False
+        return not self._full_due()
+
+    def _full_due(self) -> bool:
+        """Check if duplicity would start a new full backup of any chain."""
+        decision = self._adaptive_full(load_state(self.remote_uri))
+        if decision is not None and decision.full:
+            return True
+        default = self._config.get("full_if_older_than", FULL_IF_OLDER_THAN)
+        main = [] if decision is not None else [(self.archive_dir, default)]
+        chains = main + [
+            (
+                self._chain_archive_dir(chain_uri(self.remote_uri, policy)),
+                policy.full_if_older_than or default,
+            )
+            for policy in self.policies
+        ]
+        for path, full_if_older_than in chains:
+            interval, full = parse_interval(full_if_older_than), last_full(path)
+            if interval is None or full is None:
+                return True
+            if datetime.now(timezone.utc) - full >= interval:
+                return True
+        return False
+
+    def _incremental_command(
+        self,
+        includes: Optional[List[str]],
+        exclude_filelist: Optional[Path] = None,
+        full: bool = False,
+    ) -> List[str]:
+        """Arguments of the duplicity `incr` (or `full`) command.
+
+        :param includes: the includes of the backup
+        :param exclude_filelist: (optional) filelist with the files of the
+            policy chains, which are excluded from the main chain
+        :param full: start a new chain with a full backup
+        """
         args = self._extend_args()
+        if self._config.get("volsize"):
+            args.extend(["--volsize", str(self._config["volsize"])])
+        args.extend(self._storage_args())
+        args.extend(DUPLICITY_BACKUP_ARGS)
+        if not full and "adaptive_full" not in self._config:
+            args.extend(
+                [
+                    "--full-if-older-than",
+                    self._config.get("full_if_older_than", FULL_IF_OLDER_THAN),
+                ]
+            )
+        if exclude_filelist is not None:
+            # the first matching selection wins, so it precedes the includes
+            args.append(f"--exclude-filelist={exclude_filelist}")
         args.extend(
-            [
-                *DUPLICITY_BACKUP_ARGS,
-                "--full-if-older-than",
-                self._config.get("full_if_older_than", FULL_IF_OLDER_THAN),
-                *self.get_cludes(
-                    includes=self._config.get("includes"),
-                    excludes=self._config.get("excludes"),
-                ),
-            ]
+            self.get_cludes(
+                includes=includes,
+                excludes=self._config.get("excludes"),
+                exclude_if_present=self._config.get("exclude_if_present"),
+                discovered_excludes=self._config.get("discovered_excludes"),
+            )
         )
+        action = "full" if full else "incr"
+        return [action, *args, self._config.get("backuproot"), self.remote_uri]
 
-        return self._execute(
-            action, *args, source, target, runtime_env=self.__runtime_env()
+    def _adaptive_full(self, state: dict) -> Optional[Decision]:
+        """Decide on a full backup of the main chain in adaptive mode.
+
+        :param state: the state of the profile
+        :return: the decision, None when not in adaptive mode or while an
+            interrupted backup is to be resumed
+        """
+        settings = self._config.get("adaptive_full")
+        if settings is None or state.get("partial_since"):
+            return None
+        chain = current_chain(
+            self.archive_dir,
+            state.get("chain"),
+            self._config.get("volsize", DUPLICITY_VOLSIZE),
         )
+        return decide(
+            settings,
+            chain,
+            self._download_throughput(state),
+            datetime.now(timezone.utc),
+        )
+
+    def _download_throughput(self, state: dict) -> Optional[float]:
+        """Download throughput in bytes/s to estimate the restore time with.
+
+        Measured by the last full restores, else configured, else estimated
+        from the upload throughput of the last backups.
+        """
+        measured = median(state.get("download_throughputs") or [])
+        if measured is None:
+            measured = self._config["adaptive_full"].get("download_throughput")
+        if measured is None:
+            runs = [run for run in state.get("runs", []) if run.get("throughput")]
+            measured = median([run["throughput"] for run in runs])
+        return measured * 1e6 if measured else None
+
+    def _record_download(self, started: datetime) -> None:
+        """Record the download throughput of a full restore of the main chain."""
+        state = load_state(self.remote_uri)
+        chain = current_chain(
+            self.archive_dir,
+            state.get("chain"),
+            self._config.get("volsize", DUPLICITY_VOLSIZE),
+        )
+        duration = (datetime.now() - started).total_seconds()
+        if chain.full_bytes is None or duration <= 0:
+            return
+        size = chain.full_bytes + chain.incremental_bytes
+        throughputs = state.get("download_throughputs") or []
+        update_state(
+            self.remote_uri,
+            download_throughputs=(throughputs + [size / 1e6 / duration])[
+                -ADAPTIVE_THROUGHPUT_HISTORY:
+            ],
+        )
+
+    @property
+    def policies(self) -> List[Policy]:
+        """Policies that route files into chains of their own."""
+        return [Policy.from_config(p) for p in self._config.get("policies") or []]
+
+    @property
+    def _policies_dir(self) -> Path:
+        """Directory with the filelists of the last scan of the policies."""
+        return CACHE_DIR / "policies" / profile_key(self.remote_uri)
+
+    def _scan_policies(self, includes: Optional[List[str]]) -> Dict[str, dict]:
+        """Scan the backup for the files of the policy chains.
+
+        :param includes: the includes of the backup, limiting the scan
+        :return: the filelists with their amount of files and bytes, see
+            :func:`duplicity_backup_s3.policies.scan`
+        """
+        backuproot = Path(os.path.abspath(self._config.get("backuproot")))
+        scanned = scan(
+            backuproot, self.policies, self._scan_roots(includes), self._policies_dir
+        )
+        if self.verbose:
+            for policy in self.policies:
+                info = scanned[policy.name]
+                echo_info(
+                    f"Policy '{policy.name}': {info['files']} files, "
+                    f"{info['bytes'] / 1e6:.1f} MB"
+                )
+        return scanned
+
+    def _scan_roots(self, includes: Optional[List[str]]) -> List[Path]:
+        """Paths to scan for the backup, the includes or else the backuproot."""
+        import glob
+
+        if not includes:
+            return [Path(os.path.abspath(self._config.get("backuproot")))]
+        return distinct_roots(
+            Path(os.path.abspath(path))
+            for include in includes
+            for path in glob.glob(include, recursive=True)
+        )
+
+    def _policy_command(self, policy: Policy, filelist: Path) -> List[str]:
+        """Arguments of the duplicity `incr` command of a policy chain."""
+        capabilities = self.capabilities
+        args = self._extend_args()
+        args.extend(
+            policy_args(
+                policy,
+                supported=lambda option: capabilities is None
+                or capabilities.supports(option),
+                encrypted=bool(self._get_gpg_secrets()),
+            )
+        )
+        if not policy.volsize and self._config.get("volsize"):
+            args.extend(["--volsize", str(self._config["volsize"])])
+        args.extend(self._storage_args())
+        args.extend([*DUPLICITY_BACKUP_ARGS, "--full-if-older-than"])
+        args.append(
+            policy.full_if_older_than
+            or self._config.get("full_if_older_than", FULL_IF_OLDER_THAN)
+        )
+        args.extend(
+            self.get_cludes(
+                excludes=self._config.get("excludes"),
+                exclude_if_present=self._config.get("exclude_if_present"),
+                discovered_excludes=self._config.get("discovered_excludes"),
+            )
+        )
+        args.extend([f"--include-filelist={filelist}", "--exclude=**"])
+        uri = chain_uri(self.remote_uri, policy)
+        args.extend(self._chain_args(uri))
+        return ["incr", *args, self._config.get("backuproot"), uri]
+
+    def _storage_args(self) -> List[str]:
+        """Duplicity options that upload the data volumes in their storage class."""
+        from duplicity_backup_s3.storage import storage_args
+
+        capabilities = self.capabilities
+        return storage_args(
+            self._config.get("storage"),
+            supported=lambda option: capabilities is None
+            or capabilities.supports(option),
+        )
+
+    def _s3_client(self):
+        """S3 client for the remote, with the AWS secrets and the endpoint."""
+        from duplicity_backup_s3.storage import s3_client
+
+        secrets = self._get_aws_secrets()
+        endpoint = self._endpoint_uri
+        if endpoint and urlsplit(endpoint).scheme not in ("http", "https"):
+            endpoint = None
+        return s3_client(
+            endpoint,
+            aws_access_key_id=secrets.get("AWS_ACCESS_KEY_ID") or None,
+            aws_secret_access_key=secrets.get("AWS_SECRET_ACCESS_KEY") or None,
+        )
+
+    def _pre_backup(self) -> bool:
+        """Run the pre-backup stage and report on the timings of the steps.
+
+        :return: False when a step failed with the `abort` failure policy.
+        """
+        from duplicity_backup_s3.prebackup import report_pre_backup, run_pre_backup
+
+        if self.dry_run:
+            echo_info("Dry run, skipping the pre-backup stage.")
+            return True
+
+        echo_info("Running the pre-backup stage.")
+        started = time.monotonic()
+        self.pre_backup_results = run_pre_backup(self._config)
+        report_pre_backup(self.pre_backup_results, time.monotonic() - started)
+
+        failed = [r for r in self.pre_backup_results if not r.succeeded]
+        if any(r.on_failure == "abort" for r in failed):
+            echo_failure("The pre-backup stage failed, not starting the backup.")
+            return False
+        return True
 
     def do_restore(self) -> int:
         """Restore the backup.
@@ -332,10 +1314,172 @@ class DuplicityS3:
 
         :return: return_code of duplicity
         """
-        action = "restore"
-        restore_from_url = self.remote_uri
         target = self.options.get("target")
+
+        if self.verbose:
+            echo_info(f"restoring backup in directory: {target}")
+
+        if not self._preflight("restore"):
+            return 1
+        if "storage" in self._config and not self._stage_restore():
+            return 1
+
+        if not self.policies:
+            started = datetime.now()
+            returncode = self._restore_chain(target)
+            if (
+                returncode == 0
+                and "adaptive_full" in self._config
+                and "volume_cache" not in self._config
+                and not self.dry_run
+                and self.options.get("file") is None
+                and self.options.get("time") is None
+            ):
+                self._record_download(started)
+            return returncode
+
+        chains = self._restore_chains()
+        file = self.options.get("file")
+        if file is not None:
+            for name, remote in chains:
+                if self.verbose:
+                    echo_info(f"Restoring '{file}' from the chain {remote}")
+                returncode = self._restore_chain(target, remote)
+                if returncode == 0:
+                    break
+            return returncode
+
+        returncode = 0
+        for index, (name, remote) in enumerate(chains):
+            if self.verbose:
+                echo_info(f"Restoring the chain {remote}")
+            chain_returncode = self._restore_chain(target, remote, force=index > 0)
+            returncode = returncode or chain_returncode
+        return returncode
+
+    def _restore_chains(self) -> List[Tuple[Optional[str], str]]:
+        """Chains to restore: the main chain and the chains of the policies.
+
+        When a single file is restored, the chain it was routed to in the last
+        backup comes first.
+
+        :return: the policy name (None for the main chain) and remote uri per chain
+        """
+        chains = [(None, self.remote_uri)] + [
+            (policy.name, chain_uri(self.remote_uri, policy))
+            for policy in self.policies
+        ]
+        file = self.options.get("file")
+        if file is not None and self.policies:
+            routed = find_chain(
+                {p.name: self._policies_dir / f"{p.name}.list" for p in self.policies},
+                os.path.join(
+                    os.path.abspath(self._config.get("backuproot")), file.strip("/")
+                ),
+            )
+            chains.sort(key=lambda chain: chain[0] != routed)
+        return chains
+
+    def _restore_chain(
+        self, target: Union[str, Path], remote: str = None, force: bool = False
+    ) -> int:
+        """Restore a chain, through the volume cache when configured.
+
+        :param target: directory to restore into
+        :param remote: (optional) remote uri of the chain, defaults to the main one
+        :param force: restore into the target even when it exists
+        :return: return_code of duplicity
+        """
+        with self._volume_mirror(remote or self.remote_uri) as (uri, name):
+            return self._execute(
+                *self._restore_command(target, uri, force=force, name=name),
+                runtime_env=self._runtime_env(),
+            )
+
+    @contextmanager
+    def _volume_mirror(self, remote: str) -> Iterator[Tuple[str, Optional[str]]]:
+        """Mirror the files that a restore of a chain reads into the volume cache.
+
+        See :mod:`duplicity_backup_s3.volume_cache`. When the cache can not be
+        used (eg. without boto3), the remote is used directly.
+
+        :param remote: remote uri of the chain
+        :return: context with the uri to restore from and the `--name` of the
+            archive directory of the chain, if it must be passed
+        """
+        settings = self._config.get("volume_cache")
+        if settings is None:
+            yield remote, None
+            return
+        from duplicity_backup_s3.storage import (
+            StorageError,
+            bucket_and_prefix,
+            list_files,
+            restore_files,
+            restore_time,
+        )
+        from duplicity_backup_s3.volume_cache import VolumeCache, needed_files
+
+        archive = self._chain_archive_dir(remote)
+        try:
+            bucket, prefix = bucket_and_prefix(remote)
+            client = self._s3_client()
+            files = list_files(client, bucket, prefix)
+            volumes = restore_files(files, restore_time(self.options.get("time")))
+            needed = needed_files(archive, files, volumes, self.options.get("file"))
+            cache = VolumeCache(
+                Path(settings.get("directory") or CACHE_DIR / "volumes"),
+                settings.get("max_size", VOLUME_CACHE_MAX_SIZE) * 1024**2,
+            )
+        except (StorageError, ValueError, OSError) as e:
+            echo_warning(f"Not using the volume cache: {e}")
+            yield remote, None
+            return
+
+        subdirectory = profile_key(remote)
+        cached = [f for f in files if f.key in needed]
+        with cache.pin(f"{subdirectory}/{f.file.name}" for f in cached):
+            try:
+                hits, downloads = cache.fetch(
+                    client,
+                    bucket,
+                    subdirectory,
+                    cached,
+                    (self._config.get("storage") or {}).get(
+                        "parallel", STORAGE_PARALLEL
+                    ),
+                )
+            except StorageError as e:
+                echo_warning(f"Not using the volume cache: {e}")
+                yield remote, None
+                return
+            if self.verbose:
+                echo_info(f"Volume cache: {hits} files cached, {downloads} downloaded.")
+            with tempfile.TemporaryDirectory(
+                prefix=".view_", dir=str(cache.directory)
+            ) as view:
+                cache.view(subdirectory, files, needed, Path(view))
+                yield f"file://{view}", archive.name
+
+    def _restore_command(
+        self,
+        target: Union[str, Path],
+        remote: str = None,
+        force: bool = False,
+        name: str = None,
+    ) -> List[str]:
+        """Arguments of the duplicity `restore` command.
+
+        :param target: directory to restore into
+        :param remote: (optional) remote uri of the chain, defaults to the main one
+        :param force: restore into the target even when it exists
+        :param name: (optional) the `--name` of the archive directory, when the
+            chain is restored from another uri (the volume cache)
+        """
         args = self._extend_args()
+        if force:
+            args.append("--force")
+        args.extend(["--name", name] if name is not None else self._chain_args(remote))
 
         if self.options.get("file") is not None:
             args.extend(["--file-to-restore", self.options.get("file")])
@@ -343,13 +1487,70 @@ class DuplicityS3:
         if self.options.get("time") is not None:
             args.extend(["--time", self.options.get("time")])
 
-        if self.verbose:
-            echo_info(f"restoring backup in directory: {target}")
+        return ["restore", *args, remote or self.remote_uri, str(target)]
 
-        return self._execute(
-            action, *args, restore_from_url, target, runtime_env=self.__runtime_env()
+    def _stage_restore(self) -> bool:
+        """Rehydrate the archived volumes the restore needs, see :func:`stage`.
+
+        :return: False when the volumes could not be staged in time.
+        """
+        from duplicity_backup_s3.archive import VOLUME
+        from duplicity_backup_s3.storage import (
+            ARCHIVE_CLASSES,
+            StorageError,
+            bucket_and_prefix,
+            list_files,
+            restore_files,
+            restore_time,
+            stage,
         )
 
+        storage = self._config.get("storage") or {}
+        settings = storage.get("restore") or {}
+        try:
+            at, every_chain = restore_time(self.options.get("time")), False
+        except ValueError:
+            # without knowing the backup set, stage the volumes of all sets
+            at, every_chain = None, True
+        bucket, _ = bucket_and_prefix(self.remote_uri)
+        try:
+            client = self._s3_client()
+            needed = []
+            for remote in self.chain_uris:
+                files = list_files(client, *bucket_and_prefix(remote))
+                if every_chain:
+                    needed.extend(f for f in files if f.file.kind == VOLUME)
+                else:
+                    needed.extend(restore_files(files, at))
+            if self.dry_run:
+                archived = [f for f in needed if f.storage_class in ARCHIVE_CLASSES]
+                echo_info(f"Dry run, not staging {len(archived)} archived volumes.")
+                return True
+            staging = stage(
+                client,
+                bucket,
+                needed,
+                days=settings.get("days", STORAGE_RESTORE_DAYS),
+                tier=settings.get("tier", STORAGE_RESTORE_TIER),
+                parallel=storage.get("parallel", STORAGE_PARALLEL),
+                poll_interval=settings.get("poll_interval", STORAGE_POLL_INTERVAL),
+                timeout=settings.get("timeout", STORAGE_RESTORE_TIMEOUT),
+                log=echo_info if self.verbose else lambda message: None,
+            )
+        except StorageError as e:
+            echo_failure(str(e))
+            return False
+        if not staging.ready:
+            echo_failure(
+                f"The archived volumes were not restored within "
+                f"{settings.get('timeout', STORAGE_RESTORE_TIMEOUT)} seconds, "
+                f"run the restore again later."
+            )
+            return False
+        if staging.archived:
+            echo_success(f"Staged {staging.archived} archived volumes.")
+        return True
+
     def do_verify(self) -> int:
         """Verify the backup.
 
@@ -365,27 +1566,163 @@ class DuplicityS3:
             The --time option allows to select a backup to verify against.
             The --compare-data option enables data comparison.
 
+        With the `manifest` option the files are compared against the local
+        content manifest instead, without downloading anything.
+
         :return: return_code of duplicity
         """
         from duplicity_backup_s3.utils import temp_chdir
 
-        with temp_chdir() as target:
-            source = self.remote_uri
-            action = "verify"
-            args = self._extend_args()
-
-            if self.options.get("file") is not None:
-                args.extend(["--file-to-restore", self.options.get("file")])
-
-            if self.options.get("time") is not None:
-                args.extend(["--time", self.options.get("time")])
+        if self.options.get("manifest"):
+            return self._verify_checksums()
 
+        if not self._preflight("verify"):
+            return 1
+        try:
+            scratch = self._choose_scratch("verify")
+        except ScratchError as e:
+            echo_failure(str(e))
+            return 1
+        with temp_chdir(dir=scratch, prefix=owner_prefix()) as target:
             if self.verbose:
                 echo_info(f"verifying backup in directory: {target}")
 
-            return self._execute(
-                action, *args, source, target, runtime_env=self.__runtime_env()
+            with self._volume_mirror(self.remote_uri) as (uri, name):
+                return self._execute(
+                    *self._verify_command(target, uri, name),
+                    runtime_env=self._runtime_env(),
+                )
+
+    @property
+    def _checksums_key(self) -> Optional[bytes]:
+        """Key to sign the content manifest with, defaults to the gpg passphrase."""
+        key = (self._config.get("checksums") or {}).get("key")
+        if key is None:
+            key = self._get_gpg_secrets().get("PASSPHRASE")
+        return key.encode("utf-8") if key else None
+
+    def _excluded(self):
+        """Predicate of the paths that are excluded from the backup."""
+        from duplicity_backup_s3.checksums import excluder
+
+        # the includes precede the excludes, the first matching selection wins
+        excludes = self._config.get("excludes")
+        if self._config.get("includes"):
+            excludes = None
+        return excluder(
+            [*(self._config.get("discovered_excludes") or []), *(excludes or [])],
+            self._config.get("exclude_if_present"),
+        )
+
+    def _update_checksums(self) -> None:
+        """Update the content manifest of the backup after a successful backup."""
+        from duplicity_backup_s3.checksums import ChecksumError, checksums_dir, update
+
+        settings = self._config.get("checksums") or {}
+        try:
+            result = update(
+                checksums_dir(self.remote_uri),
+                Path(os.path.abspath(self._config.get("backuproot"))),
+                self._scan_roots(self._config.get("includes")),
+                self._excluded(),
+                key=self._checksums_key,
+                workers=settings.get("workers"),
+                max_deltas=settings.get("max_deltas", CHECKSUM_MAX_DELTAS),
+            )
+        except (ChecksumError, OSError) as e:
+            echo_warning(f"Could not update the content manifest: {e}")
+            return
+        if self.verbose:
+            echo_info(
+                "Content manifest: {files} files, {hashed} hashed, {changed} "
+                "changed, {removed} removed.".format(**result)
+            )
+
+    def _verify_checksums(self) -> int:
+        """Compare the files on disk against the content manifest.
+
+        :return: 0 when the files match the manifest, 1 otherwise
+        """
+        from duplicity_backup_s3.checksums import (
+            ChecksumError,
+            checksums_dir,
+            compare,
+            load,
+        )
+
+        try:
+            manifest = load(checksums_dir(self.remote_uri), self._checksums_key)
+        except ChecksumError as e:
+            echo_failure(str(e))
+            return 1
+        if not manifest:
+            echo_failure(
+                "There is no content manifest yet, it is written after a successful "
+                "`incr` when the `checksums` section is configured."
+            )
+            return 1
+
+        root = Path(os.path.abspath(self._config.get("backuproot")))
+        roots = self._scan_roots(self._config.get("includes"))
+        file = self.options.get("file")
+        if file is not None:
+            prefix = os.path.normpath(file.strip("/"))
+            roots = [root / prefix]
+            manifest = {
+                path: entry
+                for path, entry in manifest.items()
+                if path == prefix or path.startswith(prefix + os.sep)
+            }
+        settings = self._config.get("checksums") or {}
+        report = compare(
+            manifest,
+            root,
+            roots,
+            self._excluded(),
+            workers=self.options.get("workers") or settings.get("workers"),
+        )
+
+        if report.corrupt:
+            echo_failure(
+                f"Corrupt: {len(report.corrupt)} files with the same size and "
+                "modification time, but other content"
             )
+            for path in report.corrupt:
+                print(f"  {path}")
+        for title, paths in (
+            ("Modified", report.modified),
+            ("Missing", report.missing),
+            ("New", report.new),
+        ):
+            if paths:
+                echo_warning(f"{title}: {len(paths)} files")
+                if self.verbose:
+                    for path in paths:
+                        print(f"  {path}")
+        if report.clean:
+            echo_success(f"All {report.checked} files match the content manifest.")
+            return 0
+        return 1
+
+    def _verify_command(
+        self, target: Union[str, Path], remote: str = None, name: str = None
+    ) -> List[str]:
+        """Arguments of the duplicity `verify` command.
+
+        :param target: directory to compare with
+        :param remote: (optional) uri to verify from, defaults to the remote
+        :param name: (optional) the `--name` of the archive directory
+        """
+        args = self._extend_args()
+        args.extend(["--name", name] if name is not None else self._chain_args(remote))
+
+        if self.options.get("file") is not None:
+            args.extend(["--file-to-restore", self.options.get("file")])
+
+        if self.options.get("time") is not None:
+            args.extend(["--time", self.options.get("time")])
+
+        return ["verify", *args, remote or self.remote_uri, str(target)]
 
     def do_cleanup(self) -> int:
         """
@@ -402,16 +1739,29 @@ class DuplicityS3:
         :return: returncode
         """
         target = self.remote_uri
+
+        if self.verbose:
+            echo_info(f"Cleanup the backup in target: '{target}'")
+
+        if not self._preflight("cleanup"):
+            return 1
+        returncode = 0
+        for remote in self.chain_uris:
+            chain_returncode = self._execute(
+                *self._cleanup_command(remote), runtime_env=self._runtime_env()
+            )
+            returncode = returncode or chain_returncode
+        return returncode
+
+    def _cleanup_command(self, remote: str = None) -> List[str]:
+        """Arguments of the duplicity `cleanup` command."""
         args = self._extend_args()
-        action = "cleanup"
+        args.extend(self._chain_args(remote))
 
         if self.options.get("force"):
             args.append("--force")
 
-        if self.verbose:
-            echo_info(f"Cleanup the backup in target: '{target}'")
-
-        return self._execute(action, *args, target, runtime_env=self.__runtime_env())
+        return ["cleanup", *args, remote or self.remote_uri]
 
     def do_collection_status(self) -> int:
         """
@@ -425,13 +1775,19 @@ class DuplicityS3:
         :return: returncode
         """
         target = self.remote_uri
-        action = "collection-status"
-        args = self._extend_args()
 
         if self.verbose:
             echo_info(f"Collection status of the backup in target: '{target}'")
 
-        return self._execute(action, *args, target, runtime_env=self.__runtime_env())
+        if not self._preflight("collection-status"):
+            return 1
+        return self._execute(
+            *self._collection_status_command(), runtime_env=self._runtime_env()
+        )
+
+    def _collection_status_command(self) -> List[str]:
+        """Arguments of the duplicity `collection-status` command."""
+        return ["collection-status", *self._extend_args(), self.remote_uri]
 
     def do_list_current_files(self) -> int:
         """
@@ -448,16 +1804,24 @@ class DuplicityS3:
         :return: returncode
         """
         target = self.remote_uri
+
+        if self.verbose:
+            echo_info(f"Collection status of the backup in target: '{target}'")
+
+        if not self._preflight("list-current-files"):
+            return 1
+        return self._execute(
+            *self._list_current_files_command(), runtime_env=self._runtime_env()
+        )
+
+    def _list_current_files_command(self) -> List[str]:
+        """Arguments of the duplicity `list-current-files` command."""
         args = self._extend_args()
-        action = "list-current-files"
 
         if self.options.get("time") is not None:
             args.extend(["--time", self.options.get("time")])
 
-        if self.verbose:
-            echo_info(f"Collection status of the backup in target: '{target}'")
-
-        return self._execute(action, *args, target, runtime_env=self.__runtime_env())
+        return ["list-current-files", *args, self.remote_uri]
 
     def do_remove_older(self) -> int:
         """Remove older backup sets.
@@ -486,9 +1850,29 @@ class DuplicityS3:
             A value of 1 means that only the single most recent backup chain
             will be kept intact. Note that --force will be needed to delete
             the files instead of just listing them.
+
+        :return: returncode
+        :raises ValueError: when no remove action is provided in the options
         """
         target = self.remote_uri
-        args = self._extend_args()
+        commands = [self._remove_older_command(remote) for remote in self.chain_uris]
+
+        if self.verbose:
+            echo_info(f"Collection status of the backup in target: '{target}'")
+
+        if not self._preflight(commands[0][0]):
+            return 1
+        returncode = 0
+        for command in commands:
+            chain_returncode = self._execute(*command, runtime_env=self._runtime_env())
+            returncode = returncode or chain_returncode
+        return returncode
+
+    def _remove_older_command(self, remote: str = None) -> List[str]:
+        """Arguments of the duplicity `remove-*` commands.
+
+        :raises ValueError: when no remove action is provided in the options.
+        """
         action = None
 
         if self.options.get("time") is not None:
@@ -501,15 +1885,806 @@ class DuplicityS3:
                 str(self.options.get("all_incremental_but_n_full")),
             ]
         if action is None:
-            echo_failure("Please provide a remove action")
-            if self.verbose:
-                print(self.options)
-            sys.exit(1)
+            raise ValueError("Please provide a remove action")
 
+        args = self._extend_args()
+        args.extend(self._chain_args(remote))
         if self.options.get("force"):
             args.append("--force")
 
+        return [*action, *args, remote or self.remote_uri]
+
+    def do_diff(self) -> int:
+        """Show the differences in files between two backups.
+
+        Both listings are retrieved with `list-current-files` (or read from
+        a local index file, as saved from the `list` command), sorted with
+        bounded memory and compared using a streaming merge. Every added (A),
+        removed (D) or modified (M) file is printed on a line.
+
+        :return: returncode
+        """
+        from duplicity_backup_s3.listing import (
+            diff_entries,
+            parse_listing,
+            sort_entries,
+        )
+
+        prefix = self.options.get("prefix")
+        listings = []
+        for name in ("from", "to"):
+            index = self.options.get(f"{name}_index")
+            if index is not None:
+                listings.append(Path(index).open(errors="replace"))
+            else:
+                listings.append(
+                    self.iter_current_files(self.options.get(f"{name}_time"))
+                )
+
+        counts = {}
+        try:
+            old, new = (
+                sort_entries(parse_listing(lines, prefix)) for lines in listings
+            )
+            for status, entry in diff_entries(old, new):
+                counts[status] = counts.get(status, 0) + 1
+                print(f"{status} {entry.path}")
+        except subprocess.CalledProcessError as e:
+            echo_failure("Could not list the files of the backup.")
+            return e.returncode
+        finally:
+            for listing in listings:
+                listing.close()
+
         if self.verbose:
-            echo_info(f"Collection status of the backup in target: '{target}'")
+            echo_info(
+                "{} added, {} removed, {} modified".format(
+                    counts.get("A", 0), counts.get("D", 0), counts.get("M", 0)
+                )
+            )
+        return 0
+
+    def do_analyze(self) -> int:
+        """Report the growth and churn of the backup across its history.
+
+        The analysis is based on the signatures in the local archive directory
+        of duplicity (run `status` first to synchronise it with the remote).
+
+        :return: returncode
+        """
+        import json
+
+        from duplicity_backup_s3.analyze import analyze, format_bytes, load_summaries
+
+        summaries = load_summaries(
+            self.archive_dir,
+            Path(self._config.get("backuproot")),
+            self.remote_uri,
+            depth=self.options.get("depth") or ANALYZE_DEPTH,
+        )
+        if not summaries:
+            echo_failure(
+                f"No backup sets found in the archive directory '{self.archive_dir}'."
+            )
+            return 1
+
+        report = analyze(
+            summaries,
+            churn_ratio=self.options.get("churn_ratio") or ANALYZE_CHURN_RATIO,
+            top=self.options.get("top") or 10,
+        )
+        if self.options.get("json"):
+            print(json.dumps(report, indent=2))
+            return 0
+
+        echo_info(
+            "Analysed {sets} backup sets ({fulls} full, {incrementals} "
+            "incremental).".format(**report)
+        )
+        echo_info("\nGrowth per directory between the first and last full backup:")
+        for directory, size in report["growth"]:
+            print(f"  {format_bytes(size):>12}  {directory}")
+        echo_info("\nChanged bytes per incremental per directory:")
+        for directory, size in report["churn_dirs"]:
+            print(f"  {format_bytes(size):>12}  {directory}")
+        echo_info("\nFiles that change in almost every incremental:")
+        for path, count, size in report["churn_files"]:
+            print(f"  {count:>5}x {format_bytes(size):>12}  {path}")
+        echo_info("\nSuggested excludes (saved bytes per incremental):")
+        for pattern, size in report["excludes"]:
+            print(f"  {format_bytes(size):>12}  {pattern}")
+        return 0
+
+    def do_discover_excludes(self) -> int:
+        """Report the caches and build artifacts in the backup.
+
+        With the `write` option the excludes are added to the
+        `discovered_excludes` (which precede the includes) and the markers to
+        `exclude_if_present` of the configuration file. The original is kept
+        as `<config>.backup`.
+
+        :return: returncode
+        """
+        import json
+
+        from duplicity_backup_s3.analyze import format_bytes
+        from duplicity_backup_s3.discover import MARKER, add_rules, configured, discover
+
+        roots = self._scan_roots(self._config.get("includes"))
+        if self.verbose:
+            echo_info(f"Scanning {', '.join(str(root) for root in roots)}")
+        findings = discover(roots, workers=self.options.get("workers"))
+
+        only = self.options.get("only")
+        if only:
+            findings = [
+                f for f in findings if {f.detector.value, f.detector.rule} & set(only)
+            ]
+
+        if self.options.get("json"):
+            print(
+                json.dumps(
+                    [
+                        dict(
+                            rule=f.detector.rule,
+                            kind=f.detector.kind,
+                            description=f.detector.description,
+                            bytes=f.bytes,
+                            files=f.files,
+                            directories=f.directories,
+                            examples=f.examples,
+                            configured=configured(self._config, f.detector),
+                        )
+                        for f in findings
+                    ],
+                    indent=2,
+                )
+            )
+        elif not findings:
+            echo_info("No caches or build artifacts found.")
+        else:
+            echo_info("Caches and build artifacts that need no backup:")
+            for f in findings:
+                option = "--exclude-if-present " if f.detector.kind == MARKER else ""
+                note = " (configured)" if configured(self._config, f.detector) else ""
+                print(
+                    f"  {format_bytes(f.bytes):>12} {f.files:>9} files  "
+                    f"{option}{f.detector.rule}  {f.detector.description}{note}"
+                )
+                if self.verbose:
+                    for example in f.examples:
+                        print(f"  {'':>28}{example}")
+
+        if not self.options.get("write"):
+            return 0
+        if self._config_file is None:
+            echo_failure("No configuration file to write the excludes to.")
+            return 1
+
+        with self._config_file.open() as fd:
+            config = yaml.safe_load(fd) or {}
+        added = add_rules(config, findings)
+        if not added:
+            echo_info("The configuration already excludes all findings.")
+            return 0
+        if self.dry_run:
+            echo_info(f"Would add to '{self._config_file}': {', '.join(added)}")
+            return 0
+        backup = self._config_file.with_name(f"{self._config_file.name}.backup")
+        shutil.copy2(str(self._config_file), str(backup))
+        tmp_path = self._config_file.with_name(f".{self._config_file.name}.tmp")
+        with tmp_path.open("w") as fd:
+            yaml.safe_dump(config, fd, default_flow_style=False, sort_keys=False)
+        os.replace(str(tmp_path), str(self._config_file))
+        self._config = config
+        echo_success(
+            f"Added {', '.join(added)} to '{self._config_file}' "
+            f"(the original is kept as '{backup.name}')."
+        )
+        return 0
+
+    def do_dupes(self) -> int:
+        """Report the duplicated content in the backup, by included path.
+
+        With the `propose` option the hard links of the copies to their
+        original (on the same filesystem), or the excludes of the copies, are
+        printed while the groups are found.
+
+        :return: returncode
+        """
+        import json
+
+        from duplicity_backup_s3.analyze import format_bytes
+        from duplicity_backup_s3.dupes import (
+            exclude_pattern,
+            find_duplicates,
+            summarize,
+        )
+
+        propose = self.options.get("propose")
+        if propose and self.options.get("json"):
+            echo_failure("The proposals can not be combined with the json report.")
+            return 2
+
+        roots = self._scan_roots(self._config.get("includes"))
+        if self.verbose:
+            echo_info(f"Scanning {', '.join(str(root) for root in roots)}")
+        try:
+            scratch = self._choose_scratch("dupes")
+        except ScratchError as e:
+            echo_failure(str(e))
+            return 1
+
+        if propose == "excludes" and self._config.get("includes"):
+            echo_warning(
+                "The includes precede the excludes in duplicity, the proposed excludes "
+                "only take effect in a configuration without includes."
+            )
+
+        def proposals(groups):
+            if propose == "excludes":
+                print("excludes:")
+            for group in groups:
+                original = group.files[0]
+                for copy in group.copies:
+                    if propose == "excludes":
+                        print(f"  - {json.dumps(exclude_pattern(copy.path))}")
+                    elif propose == "hardlinks" and (
+                        copy.inode != original.inode
+                        and copy.inode.split(":")[0] == original.inode.split(":")[0]
+                    ):
+                        print(
+                            f"ln -f -- {shlex.quote(original.path)} "
+                            f"{shlex.quote(copy.path)}"
+                        )
+                yield group
+
+        with tempfile.TemporaryDirectory(prefix=owner_prefix(), dir=scratch) as tmp:
+            groups = find_duplicates(
+                roots,
+                self._excluded(),
+                Path(tmp),
+                min_size=(self.options.get("min_size") or 0) * 1024 * 1024,
+                workers=self.options.get("workers"),
+            )
+            duplicates, count = summarize(
+                proposals(groups) if propose else groups, roots
+            )
 
-        return self._execute(*action, *args, target, runtime_env=self.__runtime_env())
+        if self.options.get("json"):
+            print(
+                json.dumps(
+                    dict(
+                        groups=count,
+                        files=sum(d.files for d in duplicates),
+                        bytes=sum(d.bytes for d in duplicates),
+                        roots=[d._asdict() for d in duplicates],
+                    ),
+                    indent=2,
+                )
+            )
+        elif not count:
+            echo_info("No duplicated files found.")
+        else:
+            echo_info(f"Duplicated content in the backup ({count} distinct files):")
+            for d in duplicates:
+                print(f"  {format_bytes(d.bytes):>12} {d.files:>9} copies  {d.root}")
+            print(
+                f"  {format_bytes(sum(d.bytes for d in duplicates)):>12} "
+                f"{sum(d.files for d in duplicates):>9} copies  in total"
+            )
+        return 0
+
+    def do_standby(self) -> int:
+        """Sync the standby directory with the latest backup.
+
+        Only the files that changed since the last sync are restored, in
+        parallel, and the files that are no longer in the backup are removed,
+        see :mod:`duplicity_backup_s3.standby`.
+
+        :return: returncode
+        """
+        from duplicity_backup_s3.archive import MANIFEST, backup_files
+        from duplicity_backup_s3.standby import (
+            changes,
+            index_path,
+            place,
+            read_index,
+            remove,
+            write_index,
+        )
+
+        settings = self._config.get("standby") or {}
+        target = self.options.get("target") or settings.get("directory")
+        if not target:
+            echo_failure(
+                "No standby directory, configure `standby.directory` or pass --target."
+            )
+            return 1
+        target = Path(target).absolute()
+        if self.policies:
+            echo_warning(
+                "Only the main chain is kept in standby, the files of the backup "
+                "policies are not."
+            )
+        if not self._preflight("restore"):
+            return 1
+
+        index = index_path(self.remote_uri, target)
+        listed = index.with_name(index.name + ".new")
+        try:
+            count = write_index(self.iter_current_files(), listed)
+        except subprocess.CalledProcessError as e:
+            echo_failure("Could not list the files of the backup.")
+            return e.returncode
+        manifests = backup_files(self.archive_dir, MANIFEST)
+        if manifests:
+            # restore the listed backup, also when a newer one completes meanwhile
+            self.options["time"] = str(int(manifests[-1].end.timestamp()))
+
+        synced = index.exists() and target.is_dir()
+        if self.dry_run:
+            old = read_index(index if synced else None)
+            for change in changes(old, read_index(listed)):
+                print(f"{change.status} {change.path}")
+            listed.unlink()
+            return 0
+
+        target.mkdir(parents=True, exist_ok=True)
+        for stale in target.glob(f".{SCRATCH_PREFIX}*"):
+            shutil.rmtree(str(stale), ignore_errors=True)
+        staging = Path(tempfile.mkdtemp(prefix=f".{SCRATCH_PREFIX}", dir=str(target)))
+        try:
+            if synced:
+                restored, removed, failed = self._standby_sync(
+                    target, staging, read_index(index), read_index(listed)
+                )
+            else:
+                if self.verbose:
+                    echo_info(f"First sync, restoring the whole backup in {target}")
+                restored, removed, failed = count, 0, 0
+                returncode = self._restore_chain(staging / "restored")
+                if returncode != 0:
+                    listed.unlink()
+                    return returncode
+                names = {path.name for path in (staging / "restored").iterdir()}
+                for path in target.iterdir():
+                    if path != staging and path.name not in names:
+                        remove(path)
+                for name in names:
+                    place(staging / "restored" / name, target / name)
+        finally:
+            shutil.rmtree(str(staging), ignore_errors=True)
+
+        if failed:
+            listed.unlink()
+            echo_failure(
+                f"{failed} files could not be restored, they are retried by the next "
+                "sync."
+            )
+            return 1
+        os.replace(str(listed), str(index))
+        echo_success(
+            f"The standby {target} is in sync with the backup: {restored} paths "
+            f"restored, {removed} removed."
+        )
+        return 0
+
+    def _standby_sync(
+        self, target: Path, staging: Path, old: Iterator, new: Iterator
+    ) -> Tuple[int, int, int]:
+        """Apply the changes between the indexes to the standby directory.
+
+        Every changed file is restored by its own duplicity process, with its
+        own copy of the archive directory (duplicity locks it), into the
+        staging directory and then moved in place. The restores share one
+        mirror of the volume cache, and like :meth:`_execute` every restore
+        gets its own scratch directory and is watched by the watchdog.
+
+        :param target: the standby directory
+        :param staging: directory inside the standby directory for the restores
+        :param old: the index of the last sync
+        :param new: the index of the backup
+        :return: the number of restored, removed and failed files
+        """
+        from queue import Queue
+
+        from duplicity_backup_s3.standby import changes, copy_archive, place
+
+        settings = self._config.get("standby") or {}
+        parallel = self.options.get("parallel") or settings.get(
+            "parallel", STANDBY_PARALLEL
+        )
+        archives = Queue()  # type: Queue
+        for number in range(parallel):
+            archives.put(copy_archive(self.archive_dir, staging / f"archive{number}"))
+        (staging / "files").mkdir()
+        with self._volume_mirror(self.remote_uri) as (uri, name):
+            command = [self.duplicity_cmd(), "restore", *self._extend_args()]
+            command.extend(["--name", name or self.archive_dir.name, "--force"])
+            if self.options.get("time") is not None:
+                command.extend(["--time", self.options.get("time")])
+            runtime_env = self._runtime_env()
+
+            def restore(number: int, path: str) -> Optional[str]:
+                """Restore a file in place, return the error when it failed."""
+                archive = archives.get()
+                staged = staging / "files" / str(number)
+                try:
+                    error = self._standby_restore(
+                        command
+                        + ["--archive-dir", str(archive), "--file-to-restore", path]
+                        + [uri, str(staged)],
+                        runtime_env,
+                    )
+                finally:
+                    archives.put(archive)
+                if error is not None:
+                    return error
+                try:
+                    place(staged, target / path)
+                except OSError as e:
+                    return str(e)
+                return None
+
+            return self._standby_apply(target, changes(old, new), restore, parallel)
+
+    def _standby_restore(self, command: List[str], runtime_env: dict) -> Optional[str]:
+        """Run a single restore of a standby sync, from a thread of the pool.
+
+        Unlike :meth:`_execute` the output is not forwarded and the run is not
+        recorded, such that the restores can run concurrently.
+
+        :param command: the duplicity restore command
+        :param runtime_env: environment to run duplicity in
+        :return: the last line of output when the restore failed, else None
+        """
+        try:
+            scratch = self._make_scratch("restore")
+        except ScratchError as e:
+            return str(e)
+        if scratch is not None:
+            command = with_tempdir(command, scratch)
+            runtime_env = dict(runtime_env, TMPDIR=scratch)
+        watchdog = self._config.get("watchdog") or {}
+        retries = watchdog.get("retries", WATCHDOG_RETRIES) if watchdog else 0
+        try:
+            for _ in range(retries + 1):
+                runner = ProcessRunner(
+                    command,
+                    env=runtime_env,
+                    shell=NEED_SUBPROCESS_SHELL,
+                    stall_timeout=watchdog.get("stall_timeout"),
+                    grace_period=watchdog.get("grace_period", WATCHDOG_GRACE_PERIOD),
+                    output=lambda text: None,
+                )
+                returncode = runner.run().returncode
+                if runner.stall_event is None:
+                    break
+                self.stall_events.append(runner.stall_event)
+        finally:
+            if scratch is not None:
+                shutil.rmtree(scratch, ignore_errors=True)
+        if returncode == 0:
+            return None
+        return runner.tail[-1] if runner.tail else f"returncode {returncode}"
+
+    def _standby_apply(
+        self,
+        target: Path,
+        changed: Iterator,
+        restore: Callable[[int, str], Optional[str]],
+        parallel: int,
+    ) -> Tuple[int, int, int]:
+        """Restore, create and remove the changed paths of a standby sync.
+
+        :param target: the standby directory
+        :param changed: the changes, see :func:`duplicity_backup_s3.standby.changes`
+        :param restore: restores a file in place, returns the error when it failed
+        :param parallel: number of concurrent restores
+        :return: the number of restored, removed and failed files
+        """
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+        from duplicity_backup_s3.listing import REMOVED
+        from duplicity_backup_s3.standby import make_directory, remove
+
+        restored = removed = 0
+        failures = []
+
+        def collect(done) -> None:
+            nonlocal restored
+            for future in done:
+                path, error = pending.pop(future), future.result()
+                if error is None:
+                    restored += 1
+                else:
+                    echo_failure(f"Could not restore '{path}': {error}")
+                    failures.append(path)
+
+        pending = {}
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            for number, change in enumerate(changed):
+                if self.verbose:
+                    print(f"{change.status} {change.path}")
+                if change.status == REMOVED:
+                    remove(target / change.path)
+                    removed += 1
+                elif change.directory:
+                    make_directory(target / change.path)
+                else:
+                    if len(pending) >= parallel * 4:
+                        collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                    pending[pool.submit(restore, number, change.path)] = change.path
+            collect(wait(pending).done)
+        return restored, removed, len(failures)
+
+    def do_watch(self) -> int:
+        """Watch the included paths and keep the change journal of the profile.
+
+        Runs until interrupted. When the changes pass the `trigger_size` of the
+        `journal` configuration, an `incr` backup is started.
+
+        :return: returncode
+        """
+        from duplicity_backup_s3.journal import Watcher
+
+        journal = self._config.get("journal") or {}
+        roots = self._scan_roots(self._config.get("includes"))
+        trigger_size = journal.get("trigger_size")
+        watcher = Watcher(
+            self.remote_uri,
+            roots,
+            flush_interval=journal.get("flush_interval", JOURNAL_FLUSH_INTERVAL),
+            trigger_size=trigger_size * 1024 * 1024 if trigger_size else None,
+            min_interval=journal.get("min_interval", JOURNAL_MIN_INTERVAL) * 60,
+            trigger_command=[
+                sys.executable,
+                "-m",
+                "duplicity_backup_s3",
+                "incr",
+                "--config",
+                str(self._config_file),
+            ],
+            log=echo_info,
+        )
+        try:
+            watcher.start()
+        except OSError as e:
+            echo_failure(f"Could not watch the backup: {e}")
+            return 1
+        echo_info(
+            f"Watching {watcher.watches} directories below "
+            f"{', '.join(str(root) for root in roots)}."
+        )
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+        return 0
+
+    def _expected_duration(self) -> timedelta:
+        """Estimate the duration of a backup from the runs in the state."""
+        durations = sorted(
+            run["duration"]
+            for run in load_state(self.remote_uri).get("runs", [])
+            if run.get("action") == "incr" and run.get("duration")
+        )
+        if not durations:
+            return timedelta(minutes=SCHEDULE_DURATION)
+        return timedelta(seconds=durations[len(durations) // 2])
+
+    def do_schedule(self) -> int:
+        """Find the slot of this host in the backup window shared by a fleet.
+
+        The slot is derived from a hash of the hostname and the remote uri.
+        Depending on the options, wait until the slot and run the backup, print
+        a crontab line or systemd timer for the slot, or simulate the peak
+        concurrency of the whole fleet.
+
+        :return: returncode
+        """
+        import socket
+
+        from duplicity_backup_s3.schedule import (
+            cron_line,
+            simulate,
+            slot_offset,
+            slot_start,
+            slot_time,
+            systemd_timer,
+        )
+
+        schedule = self._config.get("schedule") or {}
+        try:
+            window = (
+                BackupWindow.parse(self.options["window"])
+                if self.options.get("window")
+                else self.backup_window
+            )
+        except ValueError as e:
+            echo_failure(str(e))
+            return 2
+        if window is None:
+            echo_failure("Configure a backup `window` or provide `--window`.")
+            return 2
+
+        fleet_size = self.options.get("fleet_size") or schedule.get("fleet_size", 1)
+        duration = self._expected_duration()
+        if self.options.get("duration") or schedule.get("duration"):
+            duration = timedelta(
+                minutes=self.options.get("duration") or schedule["duration"]
+            )
+
+        if self.options.get("simulate"):
+            result = simulate(self.remote_uri, window, fleet_size, duration)
+            echo_info(
+                f"Fleet of {fleet_size} hosts in the window {window.start:%H:%M}-"
+                f"{window.end:%H:%M}, backups of {duration}:"
+            )
+            print(f"  slot spacing:                 {result['slot_spacing']}")
+            print(f"  expected concurrent backups:  {result['expected']:.1f}")
+            print(f"  peak concurrent backups:      {result['peak']}")
+            print(f"  peak without staggering:      {result['unstaggered']}")
+            return 0
+
+        hostname = self.options.get("hostname") or socket.gethostname()
+        offset = slot_offset(hostname, self.remote_uri, window, fleet_size, duration)
+        now = datetime.now()
+        slot = slot_time(window, offset, now)
+        command = (
+            f"duplicity_backup_s3 incr --config {shlex.quote(str(self._config_file))}"
+        )
+
+        if self.options.get("cron"):
+            print(cron_line(slot, command))
+        elif self.options.get("systemd"):
+            print(systemd_timer(slot, f"Staggered backup to {self.remote_uri}"))
+        elif self.options.get("wait"):
+            start = slot_start(window, offset, now)
+            echo_info(f"Waiting for the slot of {hostname} at {start:%Y-%m-%d %H:%M}.")
+            time.sleep(max(0.0, (start - datetime.now()).total_seconds()))
+            return self.do_incremental()
+        else:
+            echo_info(
+                f"The slot of {hostname} starts at {slot:%H:%M}, {offset} after "
+                f"the opening of the window."
+            )
+        return 0
+
+    def do_tier(self) -> int:
+        """Move the data volumes of old chains to colder storage classes.
+
+        The volumes are copied onto themselves in the storage class of the
+        `storage > tiers`, concurrently. Manifests and signatures stay in their
+        class, such that the collection status of the backup stays cheap.
+
+        :return: returncode
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        from duplicity_backup_s3.storage import (
+            StorageError,
+            bucket_and_prefix,
+            change_class,
+            list_files,
+            transitions,
+        )
+
+        storage = self._config.get("storage") or {}
+        if not storage.get("tiers"):
+            echo_failure("Configure the `storage > tiers` to move volumes with.")
+            return 2
+        try:
+            client = self._s3_client()
+            moves = []
+            for remote in self.chain_uris:
+                bucket, prefix = bucket_and_prefix(remote)
+                moves.extend(
+                    (bucket, remote_file, storage_class)
+                    for remote_file, storage_class in transitions(
+                        list_files(client, bucket, prefix), storage["tiers"]
+                    )
+                )
+            size = sum(remote_file.size for _, remote_file, _ in moves)
+            if self.verbose or self.dry_run:
+                for _, remote_file, storage_class in moves:
+                    echo_info(
+                        f"{remote_file.key}: {remote_file.storage_class} -> "
+                        f"{storage_class}"
+                    )
+            if self.dry_run:
+                echo_info(
+                    f"Dry run, would move {len(moves)} volumes ({size / 1e6:.1f} MB)."
+                )
+                return 0
+            with ThreadPoolExecutor(
+                max_workers=storage.get("parallel", STORAGE_PARALLEL)
+            ) as pool:
+                futures = [
+                    pool.submit(change_class, client, bucket, f.key, storage_class)
+                    for bucket, f, storage_class in moves
+                ]
+                for future in futures:
+                    future.result()
+        except StorageError as e:
+            echo_failure(str(e))
+            return 1
+        echo_success(f"Moved {len(moves)} volumes ({size / 1e6:.1f} MB).")
+        return 0
+
+    def do_audit(self) -> int:
+        """Check that the remote has every file the local manifests reference.
+
+        The files of every chain are listed once, or read from the S3 Inventory
+        report of the `inventory` option, and compared with the manifests in
+        the archive directory by name, size and ETag, see :func:`audit`.
+
+        :return: returncode, 1 when files are missing or truncated
+        """
+        from duplicity_backup_s3.audit import (
+            audit,
+            list_remote,
+            load_baseline,
+            read_inventory,
+            save_baseline,
+        )
+        from duplicity_backup_s3.storage import StorageError, bucket_and_prefix
+
+        chains = {remote: bucket_and_prefix(remote) for remote in self.chain_uris}
+        try:
+            if self.options.get("inventory"):
+                listings = read_inventory(
+                    Path(self.options["inventory"]), chains.values()
+                )
+            else:
+                client = self._s3_client()
+                parallel = (self._config.get("storage") or {}).get(
+                    "parallel", STORAGE_PARALLEL
+                )
+                listings = {
+                    (bucket, prefix): list_remote(client, bucket, prefix, parallel)
+                    for bucket, prefix in chains.values()
+                }
+        except (StorageError, OSError, ValueError, KeyError) as e:
+            echo_failure(f"Could not list the remote files: {e}")
+            return 1
+
+        returncode = 0
+        for remote, (bucket, prefix) in chains.items():
+            remote_files = listings[bucket, prefix]
+            report = audit(
+                self._chain_archive_dir(remote), remote_files, load_baseline(remote)
+            )
+            if not self.dry_run:
+                save_baseline(remote, remote_files, report)
+            if not report.sets:
+                echo_warning(
+                    f"{remote}: no backup sets in the local archive directory, run "
+                    "`status` to synchronize it."
+                )
+            for name in report.missing:
+                echo_failure(f"Missing: {name}")
+            for name in report.truncated:
+                echo_failure(f"Truncated: {name}")
+            if self.verbose:
+                for name in report.changed:
+                    echo_warning(f"Changed since the last audit: {name}")
+                for name in report.orphaned:
+                    echo_warning(f"Orphaned: {name}")
+                for name in report.unknown:
+                    echo_warning(f"Not in the local archive: {name}")
+            summary = (
+                f"{remote}: {report.sets} sets, {report.files} files, "
+                f"{len(report.missing)} missing, {len(report.truncated)} truncated, "
+                f"{len(report.changed)} changed, {len(report.orphaned)} orphaned, "
+                f"{len(report.unknown)} unknown."
+            )
+            if report.ok:
+                echo_success(summary)
+            else:
+                echo_failure(summary)
+                returncode = 1
+        return returncode
@@ -0,0 +1,89 @@
+"""Freshness of the last successful backup of a profile.
+
+The freshness is answered from the local state file that is written after
+every successful incremental backup, so the remote is never contacted. This
+module (and the `freshness` command) does not import the duplicity related
+modules, such that a check runs in milliseconds and may run every minute.
+"""
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from duplicity_backup_s3.state import load_state
+
+# Nagios plugin exit codes
+OK, WARNING, CRITICAL, UNKNOWN = 0, 1, 2, 3
+STATUS_NAMES = {OK: "OK", WARNING: "WARNING", CRITICAL: "CRITICAL", UNKNOWN: "UNKNOWN"}
+
+
+class Freshness(NamedTuple):
+    """Result of a freshness check."""
+
+    remote: str
+    status: int  # `OK`, `WARNING`, `CRITICAL` or `UNKNOWN`
+    last_success: Optional[float]  # unix time of the last successful backup
+    age: Optional[float]  # seconds since the last successful backup
+    warning: float  # seconds
+    critical: float  # seconds
+
+    @property
+    def message(self) -> str:
+        """Single line summary in the format of a Nagios plugin."""
+        status = STATUS_NAMES[self.status]
+        if self.age is None:
+            return f"FRESHNESS {status} - no successful backup of {self.remote}"
+        return (
+            f"FRESHNESS {status} - last successful backup of {self.remote} "
+            f"{self.age / 3600:.1f} hours ago | age={self.age:.0f}s;"
+            f"{self.warning:.0f};{self.critical:.0f}"
+        )
+
+    def metrics(self) -> str:
+        """Metrics in the Prometheus text format, eg. for a textfile collector."""
+        labels = '{{remote="{}"}}'.format(self.remote.replace('"', '\\"'))
+        lines = [
+            "# TYPE duplicity_backup_s3_freshness_status gauge",
+            f"duplicity_backup_s3_freshness_status{labels} {self.status}",
+        ]
+        if self.last_success is not None:
+            lines += [
+                "# TYPE duplicity_backup_s3_last_success_timestamp_seconds gauge",
+                "duplicity_backup_s3_last_success_timestamp_seconds"
+                f"{labels} {self.last_success:.0f}",
+            ]
+        return "\n".join(lines)
+
+
+def check_freshness(
+    remote_uri: str,
+    warning: float,
+    critical: float,
+    now: Optional[float] = None,
+    state_dir: Path = None,
+) -> Freshness:
+    """Check the age of the last successful backup of a profile.
+
+    :param remote_uri: remote uri of the backup profile
+    :param warning: age in seconds from which the status is `WARNING`
+    :param critical: age in seconds from which the status is `CRITICAL`
+    :param now: (optional) unix time to compare with, defaults to now
+    :param state_dir: (optional) directory of the state files
+    :return: the freshness, `UNKNOWN` when no successful backup is recorded
+    """
+    last_success = load_state(remote_uri, state_dir).get("last_success")
+    age, status = None, UNKNOWN
+    if last_success is not None:
+        age = max(0.0, (time.time() if now is None else now) - last_success)
+        status = OK
+        if age >= critical:
+            status = CRITICAL
+        elif age >= warning:
+            status = WARNING
+    return Freshness(
+        remote=remote_uri,
+        status=status,
+        last_success=last_success,
+        age=age,
+        warning=warning,
+        critical=critical,
+    )
@@ -0,0 +1,568 @@
+"""Journal of the changes below the included paths, kept by an inotify watcher.
+
+The `watch` command runs a watcher (Linux only) that keeps an inotify watch on
+every directory of the backup. Changed files are collected in memory and every
+few seconds the watcher writes a compact journal of the dirty directories with
+the size of their changed files next to the state of the profile.
+
+`incr` uses the journal to skip a run when nothing changed since the start of
+the last successful backup (the checkpoint) and to estimate its size. It first
+asks the watcher to write the journal right away (with `SIGUSR1`), and only
+skips the run on a journal that was written after the run started. The
+journal is only trusted when the watcher is alive and has watched the whole
+tree since before the checkpoint. When the event queue of the kernel overflows,
+the watcher runs out of watches or it restarts, the journal can not tell what
+was missed and the next backup scans the whole tree, as without a journal.
+The journal may report more changes than duplicity will find (the excludes are
+not applied, and a file that changed back counts as changed), never fewer.
+"""
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import signal
+import struct
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from stat import S_ISDIR
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from duplicity_backup_s3.defaults import (
+    JOURNAL_FLUSH_INTERVAL,
+    JOURNAL_MAX_FILES,
+    JOURNAL_MIN_INTERVAL,
+    JOURNAL_STALE_FLUSHES,
+    STATE_DIR,
+)
+from duplicity_backup_s3.state import load_state, profile_key
+
+# version of the journal file, bump when the format changes
+JOURNAL_VERSION = 1
+
+# signal that asks the watcher to write the journal right away
+FLUSH_SIGNAL = getattr(signal, "SIGUSR1", None)
+
+# inotify flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+
+_EVENT = struct.Struct("iIII")
+
+
+class Event(NamedTuple):
+    """An inotify event."""
+
+    wd: int
+    mask: int
+    cookie: int
+    name: str
+
+
+class Inotify:
+    """Minimal binding of the inotify API of the Linux kernel."""
+
+    def __init__(self):
+        """Create a non blocking inotify instance.
+
+        :raises OSError: when inotify is not available
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available on this system")
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise self._error()
+
+    @staticmethod
+    def _error(path: str = None) -> OSError:
+        code = ctypes.get_errno()
+        return OSError(code, os.strerror(code), path)
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        """Watch a directory, returns the watch descriptor."""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise self._error(path)
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        """Stop watching, errors for watches that are already gone are ignored."""
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self) -> List[Event]:
+        """Read the queued events without blocking."""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            start, offset = offset + _EVENT.size, offset + _EVENT.size + length
+            name = data[start:offset].rstrip(b"\0")
+            events.append(Event(wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def fileno(self) -> int:
+        """File descriptor of the instance, eg. for `select`."""
+        return self.fd
+
+    def close(self) -> None:
+        """Close the instance, which removes all its watches."""
+        os.close(self.fd)
+
+
+def journal_path(remote_uri: str, state_dir: Path = None) -> Path:
+    """Path to the journal of a backup profile, next to its state."""
+    return Path(state_dir or STATE_DIR) / f"{profile_key(remote_uri)}.journal.json"
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Pending(NamedTuple):
+    """Changes since the checkpoint according to the journal."""
+
+    directories: int
+    files: int
+    bytes: int  # total size of the changed files, an upper bound of the upload
+
+
+def _read_journal(remote_uri: str, state_dir: Path = None) -> Optional[dict]:
+    try:
+        with journal_path(remote_uri, state_dir).open() as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def request_flush(
+    remote_uri: str, state_dir: Path = None, timeout: float = None
+) -> bool:
+    """Ask the watcher to write the journal and wait until it did.
+
+    The watcher is only signalled when its journal tells that it handles the
+    signal, else this waits for its next regular write.
+
+    :param remote_uri: remote uri of the backup profile
+    :param state_dir: (optional) directory of the state and the journal
+    :param timeout: (optional) seconds to wait, defaults to the flush interval
+        of the watcher
+    :return: True when the journal was written after the request
+    """
+    journal = _read_journal(remote_uri, state_dir)
+    if journal is None or not _alive(journal.get("pid", 0)):
+        return False
+    requested = time.time()
+    if FLUSH_SIGNAL is not None and journal.get("signal") == FLUSH_SIGNAL:
+        try:
+            os.kill(journal["pid"], FLUSH_SIGNAL)
+        except OSError:
+            pass
+    deadline = requested + (journal["interval"] if timeout is None else timeout)
+    while True:
+        if journal is not None and journal.get("updated", 0) >= requested:
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.1)
+        journal = _read_journal(remote_uri, state_dir)
+
+
+def pending_changes(
+    remote_uri: str,
+    checkpoint: Optional[float],
+    state_dir: Path = None,
+    now: float = None,
+    fresh_since: float = None,
+) -> Optional[Pending]:
+    """Return the changes since the checkpoint according to the journal.
+
+    :param remote_uri: remote uri of the backup profile
+    :param checkpoint: start time (epoch) of the last successful backup
+    :param state_dir: (optional) directory of the state and the journal
+    :param now: (optional) the current time, for testing
+    :param fresh_since: (optional) time the journal must be written after,
+        eg. the start of the backup, see :func:`request_flush`
+    :return: the pending changes, or None when the journal can not be trusted
+        and the whole tree has to be scanned.
+    """
+    journal = _read_journal(remote_uri, state_dir)
+    if journal is None:
+        return None
+    now = time.time() if now is None else now
+    if (
+        checkpoint is None
+        or (fresh_since is not None and journal["updated"] < fresh_since)
+        or journal.get("version") != JOURNAL_VERSION
+        or not journal.get("complete")
+        or journal["since"] > checkpoint
+        or now - journal["updated"] > JOURNAL_STALE_FLUSHES * journal["interval"]
+        or not _alive(journal["pid"])
+    ):
+        return None
+    dirty = [
+        entry for entry in journal["dirty"].values() if entry[2] >= checkpoint
+    ]  # entries are [files, bytes, last change]
+    return Pending(
+        directories=len(dirty),
+        files=sum(entry[0] for entry in dirty),
+        bytes=sum(entry[1] for entry in dirty),
+    )
+
+
+class Watcher:
+    """
+    Inotify watcher that keeps the change journal of a backup profile.
+
+    :ivar since: time (epoch) from which on every change is in the journal
+    :ivar complete: False when a directory could not be watched
+    :ivar resets: number of times the journal was reset, eg. on an overflow
+    """
+
+    def __init__(
+        self,
+        remote_uri: str,
+        roots: List[Path],
+        flush_interval: int = JOURNAL_FLUSH_INTERVAL,
+        max_files: int = JOURNAL_MAX_FILES,
+        trigger_size: Optional[int] = None,
+        min_interval: int = JOURNAL_MIN_INTERVAL * 60,
+        trigger_command: Optional[List[str]] = None,
+        state_dir: Path = None,
+        log: Callable[[str], None] = lambda message: None,
+    ):
+        """Initiate the watcher, the watches are added by :meth:`start`.
+
+        :param remote_uri: remote uri of the backup profile
+        :param roots: the included paths
+        :param flush_interval: seconds between writes of the journal
+        :param max_files: changed files kept in memory, beyond it the journal
+            is reset
+        :param trigger_size: (optional) bytes of changes that trigger a backup
+        :param min_interval: minimal seconds between triggered backups
+        :param trigger_command: the command that runs the backup
+        :param state_dir: (optional) directory of the state and the journal
+        :param log: callable that reports what the watcher does
+        """
+        self.remote_uri = remote_uri
+        self.roots = [str(root) for root in roots]
+        self.flush_interval = flush_interval
+        self.max_files = max_files
+        self.trigger_size = trigger_size
+        self.min_interval = min_interval
+        self.trigger_command = trigger_command
+        self.state_dir = state_dir
+        self.log = log
+        self.since = time.time()
+        self.complete = True
+        self.resets = 0
+        self.inotify: Optional[Inotify] = None
+        self._paths: Dict[int, str] = {}  # watch descriptor -> directory
+        self._changes: Dict[str, float] = {}  # changed file -> time of change
+        self._sizes: Dict[str, int] = {}  # changed file -> size at the last flush
+        self._moves: Dict[int, str] = {}  # cookie -> directory moved away
+        self._flushed = 0.0
+        self._triggered = 0.0
+        self._backup: Optional[subprocess.Popen] = None
+        self._flush_requested = False
+        self._wakeup: Optional[tuple] = None  # pipe written by the signal handler
+        self._signal: Optional[int] = None
+        self._previous_handler = None
+
+    def start(self) -> "Watcher":
+        """Watch the directory trees of the roots and write the first journal.
+
+        :raises OSError: when inotify is not available
+        """
+        self.inotify = Inotify()
+        self._handle_flush_signal()
+        for root in self.roots:
+            self._watch_tree(root)
+        # changes made while the watches were added may have been missed
+        self.since = time.time()
+        self.flush()
+        return self
+
+    def _handle_flush_signal(self) -> None:
+        """Flush on :data:`FLUSH_SIGNAL`, only possible in the main thread."""
+        if FLUSH_SIGNAL is None:
+            return
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        try:
+            self._previous_handler = signal.signal(FLUSH_SIGNAL, self._request)
+        except ValueError:
+            os.close(read_fd)
+            os.close(write_fd)
+            return
+        self._wakeup = (read_fd, write_fd)
+        self._signal = FLUSH_SIGNAL
+
+    def _request(self, signum, frame) -> None:
+        self._flush_requested = True
+        try:
+            os.write(self._wakeup[1], b"\0")
+        except OSError:
+            pass  # the pipe is full, a wakeup is pending already
+
+    @property
+    def watches(self) -> int:
+        """Number of watched directories."""
+        return len(self._paths)
+
+    def close(self) -> None:
+        """Stop watching."""
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        if self._wakeup is not None:
+            signal.signal(self._signal, self._previous_handler or signal.SIG_DFL)
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+            self._signal = None
+
+    def _watch_tree(self, root: str, changed: bool = False) -> None:
+        """Watch a directory and all directories below it.
+
+        :param changed: record all files below the directory as changed, for
+            directories that were created or moved into the tree
+        """
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            try:
+                wd = self.inotify.add_watch(path)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    self._incomplete(
+                        "Out of inotify watches, raise the sysctl "
+                        "`fs.inotify.max_user_watches`."
+                    )
+                    return
+                continue  # removed meanwhile or not readable
+            self._paths[wd] = path
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif changed:
+                            self._changed(entry.path)
+            except OSError:
+                continue
+
+    def _incomplete(self, reason: str) -> None:
+        if self.complete:
+            self.log(f"{reason} The journal is incomplete.")
+        self.complete = False
+
+    def reset(self, reason: str) -> None:
+        """Forget the collected changes after events may have been missed.
+
+        The journal is not trusted again before a backup started after now.
+        """
+        self.log(f"{reason} Resetting the journal, the next backup scans everything.")
+        self._changes.clear()
+        self._sizes.clear()
+        self.since = time.time()
+        self.resets += 1
+
+    def _changed(self, path: str) -> None:
+        self._changes[path] = time.time()
+        self._sizes.pop(path, None)
+        if len(self._changes) > self.max_files:
+            self.reset(f"More than {self.max_files} changed files.")
+
+    def _forget_tree(self, path: str) -> None:
+        """Stop watching the directories of a tree that left the roots."""
+        prefix = path.rstrip("/") + "/"
+        for wd, watched in list(self._paths.items()):
+            if watched == path or watched.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self._paths[wd]
+
+    def handle(self, event: Event) -> None:
+        """Record the change of a single event."""
+        if event.mask & IN_Q_OVERFLOW:
+            self.reset("The inotify event queue overflowed.")
+            return
+        directory = self._paths.get(event.wd)
+        if directory is None:
+            return
+        if event.mask & IN_IGNORED:
+            del self._paths[event.wd]
+            return
+        if event.mask & IN_DELETE_SELF:
+            return  # the parent reports the deletion
+        path = os.path.join(directory, event.name) if event.name else directory
+        if event.mask & IN_ISDIR:
+            if event.mask & IN_MOVED_FROM:
+                self._moves[event.cookie] = path
+            elif event.mask & IN_MOVED_TO:
+                # a directory moved within or into the tree, duplicity sees new files
+                moved_from = self._moves.pop(event.cookie, None)
+                if moved_from is not None:
+                    self._forget_tree(moved_from)
+                self._watch_tree(path, changed=True)
+            elif event.mask & IN_CREATE:
+                self._watch_tree(path, changed=True)
+            self._changed(path)
+            return
+        self._changed(path)
+
+    def poll(self, timeout: float) -> int:
+        """Wait up to `timeout` seconds for events and handle them.
+
+        :return: the number of events handled
+        """
+        readers = [self.inotify]
+        if self._wakeup is not None:
+            readers.append(self._wakeup[0])
+        ready, _, _ = select.select(readers, [], [], max(timeout, 0))
+        if self._wakeup is not None and self._wakeup[0] in ready:
+            try:
+                os.read(self._wakeup[0], 1024)
+            except BlockingIOError:
+                pass
+        if self.inotify not in ready:
+            return 0
+        events = self.inotify.read()
+        for event in events:
+            self.handle(event)
+        # directories moved out of the tree have no matching IN_MOVED_TO
+        for path in self._moves.values():
+            self._forget_tree(path)
+        self._moves.clear()
+        return len(events)
+
+    def flush(self) -> Pending:
+        """Write the journal of the changes since the checkpoint.
+
+        Changes from before the start of the last successful backup are in that
+        backup and are dropped.
+
+        :return: the pending changes
+        """
+        checkpoint = load_state(self.remote_uri, self.state_dir).get(
+            "journal_checkpoint"
+        )
+        if checkpoint is not None:
+            for path in [p for p, t in self._changes.items() if t < checkpoint]:
+                del self._changes[path]
+                self._sizes.pop(path, None)
+
+        dirty: Dict[str, list] = {}
+        for path, changed in self._changes.items():
+            if path not in self._sizes:
+                try:
+                    stat = os.lstat(path)
+                except OSError:
+                    self._sizes[path] = 0  # deleted
+                else:
+                    directory = S_ISDIR(stat.st_mode)
+                    self._sizes[path] = 0 if directory else stat.st_size
+            entry = dirty.setdefault(os.path.dirname(path), [0, 0, 0.0])
+            entry[0] += 1
+            entry[1] += self._sizes[path]
+            entry[2] = max(entry[2], changed)
+
+        self._flushed = time.time()
+        journal = dict(
+            version=JOURNAL_VERSION,
+            pid=os.getpid(),
+            since=self.since,
+            updated=self._flushed,
+            interval=self.flush_interval,
+            signal=self._signal,
+            complete=self.complete,
+            resets=self.resets,
+            checkpoint=checkpoint,
+            dirty=dirty,
+        )
+        path = journal_path(self.remote_uri, self.state_dir)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".journal_", dir=str(path.parent))
+        try:
+            with os.fdopen(fd, "w") as tmp:
+                json.dump(journal, tmp, separators=(",", ":"))
+            os.replace(tmp_path, str(path))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return Pending(
+            directories=len(dirty),
+            files=sum(entry[0] for entry in dirty.values()),
+            bytes=sum(entry[1] for entry in dirty.values()),
+        )
+
+    def _trigger(self, pending: Pending) -> None:
+        """Start a backup when the changes pass the trigger size."""
+        if self._backup is not None and self._backup.poll() is None:
+            return  # the triggered backup is still running
+        if (
+            not self.trigger_size
+            or not self.trigger_command
+            or pending.bytes < self.trigger_size
+            or time.time() - self._triggered < self.min_interval
+        ):
+            return
+        self.log(
+            f"{pending.files} files with {pending.bytes} bytes changed, "
+            "starting a backup."
+        )
+        self._triggered = time.time()
+        self._backup = subprocess.Popen(self.trigger_command)
+
+    def run(self, stop: Callable[[], bool] = lambda: False) -> None:
+        """Watch and write the journal until `stop` returns True."""
+        while not stop():
+            self.poll(self._flushed + self.flush_interval - time.time())
+            if (
+                self._flush_requested
+                or time.time() >= self._flushed + self.flush_interval
+            ):
+                self._flush_requested = False
+                self._trigger(self.flush())
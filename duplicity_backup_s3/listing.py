@@ -0,0 +1,118 @@
+"""Streaming helpers for file listings of a backup.
+
+The listings of `list-current-files` may contain millions of files. These
+helpers parse, sort and compare listings as streams. Sorting is done in chunks
+that are spilled to temporary files and merged afterwards, such that the memory
+use is bounded by the chunk size.
+"""
+import heapq
+import re
+import tempfile
+from itertools import islice
+from typing import IO, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from duplicity_backup_s3.defaults import LISTING_SORT_CHUNK
+
+# eg. 'Thu Jan  5 10:00:00 2023 path/to/file'
+LISTING_RE = re.compile(r"^(\w{3} \w{3} [ \d]\d \d\d:\d\d:\d\d \d{4}) (.+)$")
+
+ADDED = "A"
+REMOVED = "D"
+MODIFIED = "M"
+
+
+class Entry(NamedTuple):
+    """A file in a listing of the backup."""
+
+    path: str
+    mtime: str
+
+
+def parse_listing(
+    lines: Iterable[str], prefix: Optional[str] = None
+) -> Iterator[Entry]:
+    """Parse the output of `list-current-files` into entries.
+
+    Lines that are not part of the listing (eg. the 'Last full backup date'
+    header) are skipped.
+
+    :param lines: lines of the listing
+    :param prefix: (optional) only yield the paths in or equal to this path
+    """
+    directory = prefix.rstrip("/") if prefix is not None else None
+    for line in lines:
+        match = LISTING_RE.match(line.rstrip("\r\n"))
+        if match is None:
+            continue
+        entry = Entry(path=match.group(2), mtime=match.group(1))
+        if (
+            not directory
+            or entry.path == directory
+            or entry.path.startswith(directory + "/")
+        ):
+            yield entry
+
+
+def _spill(entries: List[Entry]) -> IO[str]:
+    """Write sorted entries to a temporary file, return it rewound."""
+    fd = tempfile.TemporaryFile(mode="w+", encoding="utf-8", prefix="duplicity_s3__")
+    fd.writelines(f"{entry.mtime}\t{entry.path}\n" for entry in entries)
+    fd.seek(0)
+    return fd
+
+
+def _read_spilled(fd: IO[str]) -> Iterator[Entry]:
+    with fd:
+        for line in fd:
+            mtime, path = line.rstrip("\n").split("\t", 1)
+            yield Entry(path=path, mtime=mtime)
+
+
+def sort_entries(
+    entries: Iterable[Entry], chunk_size: int = LISTING_SORT_CHUNK
+) -> Iterator[Entry]:
+    """Sort entries on their path with bounded memory.
+
+    :param entries: entries in any order
+    :param chunk_size: maximum number of entries kept in memory per chunk
+    :return: iterator of the entries sorted on path
+    """
+    entries = iter(entries)
+    chunks = []
+    while True:
+        chunk = sorted(islice(entries, chunk_size))
+        if not chunk:
+            break
+        if len(chunk) < chunk_size and not chunks:
+            # everything fits in memory, no need to spill
+            yield from chunk
+            return
+        chunks.append(_spill(chunk))
+    yield from heapq.merge(*(_read_spilled(fd) for fd in chunks))
+
+
+def diff_entries(
+    old: Iterable[Entry], new: Iterable[Entry]
+) -> Iterator[Tuple[str, Entry]]:
+    """Compare two sorted listings with a streaming merge.
+
+    :param old: entries of the older backup, sorted on path
+    :param new: entries of the newer backup, sorted on path
+    :return: iterator of (status, entry) where status is one of `ADDED`,
+        `REMOVED` or `MODIFIED`
+    """
+    old, new = iter(old), iter(new)
+    old_entry, new_entry = next(old, None), next(new, None)
+    while old_entry is not None or new_entry is not None:
+        if new_entry is None or (
+            old_entry is not None and old_entry.path < new_entry.path
+        ):
+            yield REMOVED, old_entry
+            old_entry = next(old, None)
+        elif old_entry is None or new_entry.path < old_entry.path:
+            yield ADDED, new_entry
+            new_entry = next(new, None)
+        else:
+            if old_entry.mtime != new_entry.mtime:
+                yield MODIFIED, new_entry
+            old_entry, new_entry = next(old, None), next(new, None)
@@ -0,0 +1,195 @@
+"""Capture of the duplicity output in rotated log files.
+
+The output is handed to a background writer through a bounded ring buffer.
+Writing to the buffer never waits for the disk: when the writer falls behind,
+the oldest buffered output is dropped (and marked as such in the log), so a
+slow disk can never stall the pipe of duplicity. Log files are rotated by size,
+rotated files are compressed and only the most recent log files are kept.
+"""
+import gzip
+import os
+import shutil
+import threading
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import Deque, List, Optional
+
+from duplicity_backup_s3.defaults import (
+    LOG_BUFFER_SIZE,
+    LOG_KEEP,
+    LOG_MAX_SIZE,
+    LOG_PREFIX,
+)
+
+
+def log_files(directory: Path, prefix: str = LOG_PREFIX) -> List[Path]:
+    """Log files (including the rotated ones) in a directory, oldest first."""
+    if not directory.is_dir():
+        return []
+    return sorted(
+        directory.glob(f"{prefix}-*.log*"), key=lambda path: path.stat().st_mtime
+    )
+
+
+class RotatingLog:
+    """
+    Non-blocking log of the output of a single run.
+
+    The log of a run is named after the profile, the start time of the run
+    and the process id, eg.
+    `duplicity_backup_s3-3f2a9c0b1d4e5f60-20230105T010000000000-4242.log`, such
+    that concurrent runs never share a log. When it grows beyond `max_size`
+    bytes it is rotated to a numbered file, eg.
+    `duplicity_backup_s3-3f2a9c0b1d4e5f60-20230105T010000000000-4242.1.log.gz`.
+
+    :ivar path: path of the current log file
+    :ivar dropped: bytes of output dropped because the writer fell behind
+    :ivar error: the error that stopped the writer, if any
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        max_size: int = LOG_MAX_SIZE * 1024 * 1024,
+        keep: int = LOG_KEEP,
+        compress: bool = True,
+        buffer_size: int = LOG_BUFFER_SIZE,
+        prefix: str = LOG_PREFIX,
+        key: str = None,
+    ):
+        """Initiate the log, the writer starts with :meth:`open`.
+
+        :param directory: directory of the log files
+        :param max_size: bytes after which a log file is rotated
+        :param keep: number of log files to keep in the directory
+        :param compress: compress the rotated log files
+        :param buffer_size: bytes of output that may be buffered
+        :param prefix: prefix of the log filenames
+        :param key: (optional) key of the backup profile, only the log files of
+            the profile are cleaned up
+        """
+        self.directory = Path(directory).expanduser()
+        self.max_size = max_size
+        self.keep = keep
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.prefix = f"{prefix}-{key}" if key else prefix
+        self.stem = f"{self.prefix}-{datetime.now():%Y%m%dT%H%M%S%f}-{os.getpid()}"
+        self.path = self.directory / f"{self.stem}.log"
+        self.dropped = 0
+        self.error: Optional[OSError] = None
+        self._chunks: Deque[bytes] = deque()
+        self._buffered = 0
+        self._pending_drop = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._fd = None
+        self._size = 0
+        self._rotations = 0
+
+    def open(self) -> "RotatingLog":
+        """Create the log directory and start the writer.
+
+        :raises OSError: when the log directory can not be created
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._fd = self.path.open("ab")
+        self._thread.start()
+        return self
+
+    def write(self, text: str) -> None:
+        """Hand output to the writer, without waiting for the disk."""
+        data = text.encode("utf-8", errors="replace")
+        with self._condition:
+            if self._closed or self.error is not None:
+                return
+            self._chunks.append(data)
+            self._buffered += len(data)
+            while self._buffered > self.buffer_size and len(self._chunks) > 1:
+                oldest = self._chunks.popleft()
+                self._buffered -= len(oldest)
+                self._pending_drop += len(oldest)
+                self.dropped += len(oldest)
+            self._condition.notify()
+
+    def close(self) -> None:
+        """Flush the buffered output, stop the writer and clean up old logs."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+        try:
+            self._cleanup()
+        except OSError:
+            pass
+
+    def __enter__(self) -> "RotatingLog":
+        return self.open()
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _drain(self) -> None:
+        """Write the buffered output to disk until the log is closed."""
+        while True:
+            with self._condition:
+                while not self._chunks and not self._closed:
+                    self._condition.wait()
+                chunks = list(self._chunks)
+                self._chunks.clear()
+                self._buffered = 0
+                dropped, self._pending_drop = self._pending_drop, 0
+                closed = self._closed
+            try:
+                if dropped:
+                    self._write(
+                        f"\n[... {dropped} bytes of output dropped ...]\n".encode()
+                    )
+                for chunk in chunks:
+                    self._write(chunk)
+                self._fd.flush()
+            except OSError as e:
+                self.error = e
+                break
+            if closed and not chunks:
+                break
+        try:
+            self._fd.close()
+        except OSError:
+            pass
+
+    def _write(self, data: bytes) -> None:
+        self._fd.write(data)
+        self._size += len(data)
+        if self._size >= self.max_size:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        """Move the current log file aside (compressed) and start a new one."""
+        self._fd.close()
+        rotated = self._rotated_path()
+        os.replace(str(self.path), str(rotated))
+        if self.compress:
+            with rotated.open("rb") as src:
+                with gzip.open(str(rotated) + ".gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            rotated.unlink()
+        self._fd = self.path.open("ab")
+        self._size = 0
+
+    def _rotated_path(self) -> Path:
+        """Path of the next rotation that is not taken, compressed or not."""
+        while True:
+            self._rotations += 1
+            rotated = self.directory / f"{self.stem}.{self._rotations}.log"
+            if not rotated.exists() and not Path(f"{rotated}.gz").exists():
+                return rotated
+
+    def _cleanup(self) -> None:
+        """Remove the oldest log files of the profile beyond the amount to keep."""
+        files = log_files(self.directory, self.prefix)
+        for path in files[: max(0, len(files) - self.keep)]:
+            path.unlink()
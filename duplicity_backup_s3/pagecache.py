@@ -0,0 +1,132 @@
+"""Page cache friendly backups.
+
+Duplicity reads every changed file of the backup through the page cache,
+which pushes the working set of the host (eg. of a database) out of memory.
+With `cache_friendly`, the pages that the backup read are dropped again:
+
+* `nocache`: duplicity runs under the `nocache` helper (a preload library,
+  https://github.com/Feh/nocache), which drops the pages of every file that
+  duplicity closes with `posix_fadvise(POSIX_FADV_DONTNEED)`. Pages that were
+  cached before duplicity read them are kept.
+* `evict`: after the backup, the pages of the files that the backup read
+  (those modified since the previous backup, all of them after a full backup)
+  are dropped with `posix_fadvise(POSIX_FADV_DONTNEED)`. This also drops the
+  pages of these files that were cached before the backup.
+* `auto`: `nocache` when the helper is installed, else `evict`.
+
+The page cache of the host is measured from `/proc/meminfo` before and after
+the backup. Other processes use the page cache at the same time, so this is
+an estimate of what the backup evicted.
+"""
+import os
+from datetime import datetime
+from shutil import which
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+from duplicity_backup_s3.resources import read_fields
+
+MEMINFO = "/proc/meminfo"
+
+
+class PageCacheUsage(NamedTuple):
+    """Page cache of the host before and after a backup, in bytes."""
+
+    cached_before: int
+    cached_after: int
+    active_before: int  # recently used file pages, the working set
+    active_after: int
+    dropped: int  # bytes of files whose pages were dropped after the backup
+
+    @property
+    def evicted(self) -> int:
+        """Bytes of the working set that were pushed out during the backup."""
+        return max(self.active_before - self.active_after, 0)
+
+    @property
+    def summary(self) -> str:
+        """Single line summary of the usage."""
+        summary = (
+            f"page cache {self.cached_before / 1e6:.1f} MB before, "
+            f"{self.cached_after / 1e6:.1f} MB after, "
+            f"{self.evicted / 1e6:.1f} MB of active file pages evicted"
+        )
+        if self.dropped:
+            summary += f", dropped the pages of {self.dropped / 1e6:.1f} MB of files"
+        return summary
+
+
+def read_meminfo() -> Optional[Tuple[int, int]]:
+    """Read the page cache and the active file pages of the host, in bytes.
+
+    :return: None when `/proc/meminfo` is not available (eg. on macOS)
+    """
+    fields = read_fields(MEMINFO)
+    if "Cached" not in fields:
+        return None
+    return fields["Cached"], fields.get("Active(file)", 0)
+
+
+def usage(
+    before: Optional[Tuple[int, int]], dropped: int = 0
+) -> Optional[PageCacheUsage]:
+    """Measure the page cache after a backup.
+
+    :param before: the result of :func:`read_meminfo` before the backup
+    :param dropped: the result of :func:`drop_files`
+    """
+    after = read_meminfo()
+    if before is None or after is None:
+        return None
+    return PageCacheUsage(before[0], after[0], before[1], after[1], dropped)
+
+
+def nocache_command() -> Optional[str]:
+    """Path of the `nocache` helper, None when it is not installed."""
+    return which("nocache")
+
+
+def drop_file(path: str) -> bool:
+    """Drop the cached pages of a file.
+
+    :return: False when the file can not be opened
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_NOATIME", 0))
+    except PermissionError:
+        # O_NOATIME needs the ownership of the file
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return False
+    except OSError:
+        return False
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+
+def drop_files(
+    files: Iterable[Tuple[str, os.stat_result]], since: Optional[datetime] = None
+) -> int:
+    """Drop the cached pages of the files that a backup read.
+
+    :param files: the files of the backup with their stat, see
+        :func:`duplicity_backup_s3.checksums.walk`
+    :param since: (optional) start of the previous backup, only the files
+        modified since are dropped, all of them when None
+    :return: the bytes of the dropped files
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return 0
+    threshold = since.timestamp() if since is not None else None
+    dropped = 0
+    for path, stat in files:
+        if threshold is not None and stat.st_mtime < threshold:
+            continue
+        if drop_file(path):
+            dropped += stat.st_size
+    return dropped
@@ -0,0 +1,205 @@
+"""Routing of files into separate backup chains by policy.
+
+Large and already compressed files (VM images, databases, media) are better
+backed up in a chain of their own: without compression, with larger volumes
+and with their own full backup cadence. A policy matches files by glob
+pattern, extension or size. Before a backup the backup root is scanned once
+and the matching files are written to a filelist per policy. The policy chain
+includes only the files of its filelist, while the main chain excludes all
+files that matched a policy.
+"""
+import os
+import re
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from duplicity_backup_s3.dupes import exclude_pattern
+
+# name of the filelist with the files of all policies, excluded from the main chain
+EXCLUDED_FILELIST = "main.exclude"
+
+
+class Policy(NamedTuple):
+    """A policy that routes matching files into a chain of their own."""
+
+    name: str
+    patterns: List[str]  # globs relative to the backuproot, or on the filename
+    extensions: List[str]  # lowercase, without the leading dot
+    min_size: Optional[int]  # bytes
+    path: str  # subpath of the chain on the remote
+    compression: bool
+    volsize: Optional[int]  # MB
+    full_if_older_than: Optional[str]
+
+    @classmethod
+    def from_config(cls, config: dict) -> "Policy":
+        """Create a policy from an entry of the `policies` configuration."""
+        min_size = config.get("min_size")
+        return cls(
+            name=config["name"],
+            patterns=list(config.get("patterns") or []),
+            extensions=[
+                ext.lower().lstrip(".") for ext in config.get("extensions") or []
+            ],
+            min_size=min_size * 1024 * 1024 if min_size is not None else None,
+            path=config.get("path", config["name"]).strip("/"),
+            compression=config.get("compression", True),
+            volsize=config.get("volsize"),
+            full_if_older_than=config.get("full_if_older_than"),
+        )
+
+    def matches(self, relpath: str, size: int) -> bool:
+        """Check if a file matches the policy.
+
+        :param relpath: path of the file relative to the backuproot
+        :param size: size of the file in bytes
+        """
+        name = relpath.rsplit("/", 1)[-1]
+        if self.min_size is not None and size >= self.min_size:
+            return True
+        if "." in name and name.rsplit(".", 1)[1].lower() in self.extensions:
+            return True
+        for pattern in self.patterns:
+            if fnmatch(relpath, pattern) or (
+                "/" not in pattern and fnmatch(name, pattern)
+            ):
+                return True
+        return False
+
+
+def chain_uri(remote_uri: str, policy: Policy) -> str:
+    """Remote uri of the chain of a policy, a subpath of the main remote."""
+    return f"{remote_uri.rstrip('/')}/{policy.path}"
+
+
+def _walk(root: str) -> Iterator[Tuple[str, int]]:
+    """Regular files below a root with their size, without following links."""
+    if os.path.isfile(root) and not os.path.islink(root):
+        yield root, os.lstat(root).st_size
+        return
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield entry.path, entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+
+
+def distinct_roots(roots: Iterable[Path]) -> List[Path]:
+    """Roots that are not below another root, such that no file is seen twice."""
+    distinct: List[Path] = []
+    for root in sorted({Path(root) for root in roots}):
+        if not any(root == other or other in root.parents for other in distinct):
+            distinct.append(root)
+    return distinct
+
+
+def filelist_line(path: str) -> str:
+    """Line of a filelist that matches a path literally.
+
+    Duplicity reads the lines of a filelist as glob patterns, and a line that
+    starts with `- ` or `+ ` as an exclude or include directive.
+    """
+    line = exclude_pattern(path)
+    if line[:2] in ("- ", "+ "):
+        line = f"[{line[0]}]{line[1:]}"
+    return line
+
+
+def _literal(line: str) -> str:
+    """Path matched by a line of a filelist, the reverse of :func:`filelist_line`."""
+    if line[:4] in ("[-] ", "[+] "):
+        line = line[1] + line[3:]
+    return re.sub(r"\[([*?\[])\]", r"\1", line)
+
+
+def scan(
+    backuproot: Path, policies: List[Policy], roots: Iterable[Path], out_dir: Path
+) -> Dict[str, dict]:
+    """Write the filelists of the policies from a scan of the backup.
+
+    Every file is routed to the first policy that matches. The filelists are
+    written while scanning, so memory does not grow with the number of files.
+
+    :param backuproot: root of the backup
+    :param policies: the policies, in order of precedence
+    :param roots: directories to scan, eg. the includes of the backup
+    :param out_dir: directory to write the filelists to
+    :return: per policy name a dict with the `filelist`, `files` and `bytes`,
+        and the filelist with all routed files under :data:`EXCLUDED_FILELIST`.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    result = {
+        policy.name: dict(filelist=out_dir / f"{policy.name}.list", files=0, bytes=0)
+        for policy in policies
+    }
+    result[EXCLUDED_FILELIST] = dict(
+        filelist=out_dir / f"{EXCLUDED_FILELIST}.list", files=0, bytes=0
+    )
+    outputs = {name: info["filelist"].open("w") for name, info in result.items()}
+    try:
+        for root in distinct_roots(roots):
+            for path, size in _walk(str(root)):
+                if "\n" in path:
+                    continue  # not representable in a filelist, keep it in main
+                relpath = os.path.relpath(path, str(backuproot))
+                for policy in policies:
+                    if policy.matches(relpath.replace(os.sep, "/"), size):
+                        break
+                else:
+                    continue
+                for name in (policy.name, EXCLUDED_FILELIST):
+                    outputs[name].write(f"{filelist_line(path)}\n")
+                    result[name]["files"] += 1
+                    result[name]["bytes"] += size
+    finally:
+        for output in outputs.values():
+            output.close()
+    return result
+
+
+def policy_args(
+    policy: Policy, supported=lambda option: True, encrypted: bool = False
+) -> List[str]:
+    """Duplicity arguments for the settings of a policy chain.
+
+    :param policy: the policy
+    :param supported: callable that checks if duplicity supports an option
+    :param encrypted: the backup is encrypted with gpg (which compresses too)
+    """
+    args = []
+    if policy.volsize:
+        args.extend(["--volsize", str(policy.volsize)])
+    if not policy.compression:
+        if supported("--no-compression"):
+            args.append("--no-compression")
+        if encrypted:
+            args.append("--gpg-options=--compress-algo=none")
+    return args
+
+
+def find_chain(filelists: Dict[str, Path], path: str) -> Optional[str]:
+    """Name of the policy whose last filelist contains a path (or below it).
+
+    :param filelists: filelist per policy name
+    :param path: absolute path of the file
+    """
+    for name, filelist in filelists.items():
+        try:
+            with filelist.open() as fd:
+                for line in fd:
+                    line = _literal(line.rstrip("\n"))
+                    if line == path or line.startswith(path.rstrip("/") + "/"):
+                        return name
+        except OSError:
+            continue
+    return None
@@ -0,0 +1,202 @@
+"""Pre-backup stage that dumps services into a staging directory.
+
+Every step runs a dump command. The output of the command is streamed through
+compression straight into the staging directory inside the `backuproot`, such
+that the dump is never written to disk uncompressed. Steps run concurrently
+with a bounded parallelism.
+"""
+import gzip
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+from duplicity_backup_s3.defaults import (
+    ON_WINDOWS,
+    PRE_BACKUP_COMPRESSION_LEVEL,
+    PRE_BACKUP_PARALLEL,
+    PRE_BACKUP_STAGING_DIR,
+)
+from duplicity_backup_s3.utils import echo_failure, echo_info
+
+
+class StepResult(NamedTuple):
+    """Result of a single pre-backup step."""
+
+    name: str
+    returncode: Optional[int]
+    duration: float
+    bytes_in: int
+    bytes_out: int
+    path: Optional[Path]
+    error: Optional[str]
+    on_failure: str
+
+    @property
+    def succeeded(self) -> bool:
+        """Check if the step succeeded."""
+        return self.error is None
+
+
+def staging_dir(config: dict) -> Path:
+    """Directory in which the dumps of the pre-backup stage are written.
+
+    :param config: the complete configuration
+    :return: absolute path of the staging directory
+    """
+    staging = (config.get("pre_backup") or {}).get("staging", PRE_BACKUP_STAGING_DIR)
+    return Path(config.get("backuproot", "")) / staging
+
+
+def run_step(step: dict, staging: Path) -> StepResult:
+    """Run a single dump command and stream its output compressed to disk.
+
+    The dump is written to a temporary file first, which replaces the previous
+    dump only when the command succeeded within its timeout.
+
+    :param step: configuration of the step
+    :param staging: staging directory
+    :return: the result of the step
+    """
+    name = step["name"]
+    on_failure = step.get("on_failure", "abort")
+    compress = step.get("compression", "gzip") == "gzip"
+    path = staging / (name + (".gz" if compress else ""))
+    part_path = staging / f".{path.name}.part"
+    command = step["command"]
+    started = time.monotonic()
+    bytes_in = 0
+    timed_out = threading.Event()
+
+    process = subprocess.Popen(
+        command,
+        shell=isinstance(command, str),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=not ON_WINDOWS,
+    )
+    stderr_tail = deque(maxlen=20)
+    stderr_reader = threading.Thread(
+        target=lambda: stderr_tail.extend(process.stderr), daemon=True
+    )
+    stderr_reader.start()
+
+    def _kill():
+        timed_out.set()
+        try:
+            if ON_WINDOWS:
+                process.kill()
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    timer = None
+    if step.get("timeout"):
+        timer = threading.Timer(step["timeout"], _kill)
+        timer.start()
+
+    try:
+        with part_path.open("wb") as raw:
+            out = (
+                gzip.GzipFile(
+                    filename=name,
+                    mode="wb",
+                    fileobj=raw,
+                    compresslevel=step.get("level", PRE_BACKUP_COMPRESSION_LEVEL),
+                )
+                if compress
+                else raw
+            )
+            try:
+                for chunk in iter(lambda: process.stdout.read(1 << 20), b""):
+                    bytes_in += len(chunk)
+                    out.write(chunk)
+            finally:
+                if compress:
+                    out.close()
+        returncode = process.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        process.stdout.close()
+        stderr_reader.join(timeout=1)
+
+    error = None
+    if timed_out.is_set():
+        error = f"timed out after {step['timeout']} seconds"
+    elif returncode != 0:
+        stderr = b"".join(stderr_tail).decode("utf-8", errors="replace").strip()
+        error = f"exited with returncode {returncode}" + (
+            f": {stderr.splitlines()[-1]}" if stderr else ""
+        )
+
+    if error is None:
+        os.replace(str(part_path), str(path))
+        bytes_out = path.stat().st_size
+    else:
+        part_path.unlink()
+        path, bytes_out = None, 0
+
+    return StepResult(
+        name=name,
+        returncode=returncode,
+        duration=time.monotonic() - started,
+        bytes_in=bytes_in,
+        bytes_out=bytes_out,
+        path=path,
+        error=error,
+        on_failure=on_failure,
+    )
+
+
+def run_pre_backup(config: dict) -> List[StepResult]:
+    """Run all steps of the pre-backup stage concurrently.
+
+    :param config: the complete configuration
+    :return: the results of the steps, in the order of the configuration
+    """
+    pre_backup = config.get("pre_backup") or {}
+    steps = pre_backup.get("steps") or []
+    staging = staging_dir(config)
+    staging.mkdir(parents=True, exist_ok=True)
+
+    def _run(step: dict) -> StepResult:
+        try:
+            return run_step(step, staging)
+        except OSError as e:
+            return StepResult(
+                name=step["name"],
+                returncode=None,
+                duration=0.0,
+                bytes_in=0,
+                bytes_out=0,
+                path=None,
+                error=str(e),
+                on_failure=step.get("on_failure", "abort"),
+            )
+
+    with ThreadPoolExecutor(
+        max_workers=pre_backup.get("parallel", PRE_BACKUP_PARALLEL)
+    ) as pool:
+        return list(pool.map(_run, steps))
+
+
+def report_pre_backup(results: List[StepResult], duration: float) -> None:
+    """Report the timings and results of the pre-backup stage on the console."""
+    for result in results:
+        if result.succeeded:
+            echo_info(
+                "  {r.name}: {r.duration:.1f}s, {mb_in:.1f} MB dumped, "
+                "{mb_out:.1f} MB written".format(
+                    r=result, mb_in=result.bytes_in / 1e6, mb_out=result.bytes_out / 1e6
+                )
+            )
+        else:
+            echo_failure(f"  {result.name}: {result.error} ({result.duration:.1f}s)")
+    echo_info(f"Pre-backup stage finished in {duration:.1f}s.")
@@ -0,0 +1,156 @@
+"""Pre-flight checks before duplicity runs.
+
+A run that fails on bad credentials, a wrong bucket, a missing GPG key, a full
+disk or a missing duplicity binary should not first scan the backup and sync
+the signatures. With the `preflight` section, these checks run concurrently
+before every action and the action stops when one of them fails:
+
+* `remote`: a single `LIST` of at most one key below the prefix of the
+  remote, which validates the credentials, the bucket and the permissions
+  (needs boto3, else skipped). A `file://` remote must be a writable
+  directory.
+* `gpg`: the key of `GPG_KEY` is in the keyring, a secret key for the
+  actions that decrypt.
+* `scratch`: the scratch space has room for the volumes in flight.
+* `duplicity`: the duplicity binary is installed and can be probed.
+
+Every check is a callable that returns a short description of what it found
+or raises an exception with the precise error.
+"""
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from shutil import which
+from typing import Callable, Dict, List, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+from duplicity_backup_s3.defaults import PREFLIGHT_TIMEOUT
+from duplicity_backup_s3.storage import StorageError, _call, bucket_and_prefix
+
+S3_SCHEMES = ("s3", "s3+http", "boto3+s3")
+
+# actions that decrypt the backup, and thus need the secret key
+DECRYPTING_ACTIONS = ("restore", "verify")
+
+
+class PreflightError(Exception):
+    """A pre-flight check failed."""
+
+
+class CheckResult(NamedTuple):
+    """Outcome of a pre-flight check."""
+
+    name: str
+    ok: bool
+    message: str
+    duration: float  # seconds
+
+
+def run_checks(
+    checks: Dict[str, Callable[[], str]], timeout: float = PREFLIGHT_TIMEOUT
+) -> List[CheckResult]:
+    """Run the checks concurrently.
+
+    :param checks: the checks by their name
+    :param timeout: seconds to wait for the checks, the ones that did not
+        finish by then fail
+    :return: the results in the order of the checks
+    """
+    if not checks:
+        return []
+    start = time.monotonic()
+    durations: Dict[str, float] = {}
+
+    def timed(name: str, check: Callable[[], str]) -> str:
+        try:
+            return check()
+        finally:
+            durations[name] = time.monotonic() - start
+
+    pool = ThreadPoolExecutor(max_workers=len(checks))
+    futures = {name: pool.submit(timed, name, check) for name, check in checks.items()}
+    wait(futures.values(), timeout=timeout)
+    pool.shutdown(wait=False)
+
+    results = []
+    for name, future in futures.items():
+        if not future.done():
+            results.append(
+                CheckResult(
+                    name, False, f"did not finish within {timeout:g} seconds", timeout
+                )
+            )
+            continue
+        try:
+            results.append(CheckResult(name, True, future.result(), durations[name]))
+        except Exception as e:
+            results.append(CheckResult(name, False, str(e), durations[name]))
+    return results
+
+
+def check_remote(remote_uri: str, client_factory: Callable[[], object]) -> str:
+    """Check that the remote is accessible with the credentials.
+
+    :param remote_uri: the remote of the backup
+    :param client_factory: creates the S3 client for the remote
+    :raises PreflightError: when the remote is not accessible
+    """
+    parts = urlsplit(remote_uri)
+    if parts.scheme == "file":
+        if not os.path.isdir(parts.path):
+            raise PreflightError(f"The remote directory {parts.path} does not exist.")
+        if not os.access(parts.path, os.W_OK | os.X_OK):
+            raise PreflightError(f"The remote directory {parts.path} is not writable.")
+        return f"{parts.path} is writable"
+    if parts.scheme not in S3_SCHEMES:
+        return f"skipped, {parts.scheme}:// remotes are not checked"
+
+    bucket, prefix = bucket_and_prefix(remote_uri)
+    try:
+        client = client_factory()
+    except StorageError:
+        return "skipped, needs boto3"
+    try:
+        _call(client, "list_objects_v2", Bucket=bucket, Prefix=prefix, MaxKeys=1)
+    except StorageError as e:
+        reasons = {
+            "InvalidAccessKeyId": "the AWS access key id does not exist",
+            "SignatureDoesNotMatch": "the AWS secret access key is wrong",
+            "AccessDenied": f"the credentials may not list s3://{bucket}/{prefix}",
+            "NoSuchBucket": f"the bucket {bucket} does not exist",
+        }
+        raise PreflightError(
+            f"The remote {remote_uri} is not accessible: "
+            f"{reasons.get(e.code, str(e))}."
+        )
+    return f"s3://{bucket}/{prefix} is accessible"
+
+
+def check_gpg_key(key: Optional[str], secret: bool = False) -> str:
+    """Check that the GPG key to encrypt (or decrypt) with is in the keyring.
+
+    :param key: the `GPG_KEY`, nothing to check without one (symmetric
+        encryption with the passphrase)
+    :param secret: check for the secret key, which decrypting needs
+    :raises PreflightError: when the key is not in the keyring
+    """
+    if not key:
+        return "no GPG_KEY, symmetric encryption"
+    gpg = which("gpg2") or which("gpg")
+    if gpg is None:
+        raise PreflightError("gpg is not installed.")
+    option = "--list-secret-keys" if secret else "--list-keys"
+    try:
+        result = subprocess.run(
+            [gpg, "--batch", "--with-colons", option, key],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=PREFLIGHT_TIMEOUT,
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        raise PreflightError(f"Could not run gpg: {e}")
+    if result.returncode != 0:
+        keyring = "secret keyring" if secret else "keyring"
+        raise PreflightError(f"The GPG key {key} is not in the {keyring} of gpg.")
+    return f"{'secret ' if secret else ''}key {key} found"
@@ -0,0 +1,52 @@
+"""Construction of the remote uri of a backup from the configuration.
+
+This module is kept free of heavy imports, such that light commands (eg.
+`freshness`) can find the remote of a backup profile quickly.
+"""
+from urllib.parse import urlsplit
+
+
+def remote_uri(remote: dict) -> str:
+    """
+    Construct the remote URL of the backup location.
+
+    Constructed from the `config > remote` settings in the configuration yaml.
+
+    When an `uri` is provided in the yaml it assumes that this uri is carefully
+    constucted by the user and this uri is the full target uri for the duplicity
+    command. It may be used as target_url or source_url in backups and restores.
+
+    When an `endpoint` is provided the url is constructed with this url. If not
+    provided the url is assumed to be on amazon s3 and a `s3+http://` is
+    constructed.
+
+    :param remote: the `remote` section of the configuration
+    :return: remote url for the backup location.
+    """
+    # fast bail when a URI is provided.
+    if "uri" in remote:
+        return remote.get("uri")
+
+    bucket = bucket_str = remote.get("bucket") or ""
+    path = path_str = remote.get("path") or ""
+    endpoint = endpoint_str = remote.get("endpoint") or ""
+
+    if endpoint and bucket:
+        endpoint_str = f"{endpoint}/" if not endpoint.endswith("/") else endpoint
+    if not path.startswith("/"):
+        if path and bucket:
+            path_str = f"/{path}" if not bucket_str.endswith("/") else path
+        if path and endpoint and not bucket:
+            path_str = f"/{path}" if not endpoint_str.endswith("/") else path
+
+    # construct target_uri from the '*_str'
+    target_uri = "".join((endpoint_str, bucket_str, path_str))
+    if not endpoint:
+        target_uri = f"s3+http://{target_uri}"
+
+    # check if endpoint has a scheme in it. If not prepend s3://
+    scheme = urlsplit(target_uri).scheme
+    if not scheme:
+        target_uri = f"s3://{target_uri}"
+
+    return target_uri
@@ -0,0 +1,198 @@
+"""Resource accounting of the duplicity child process.
+
+The CPU time, peak memory and disk I/O of a run are sampled from `/proc`
+while duplicity runs and completed with `getrusage(RUSAGE_CHILDREN)` once it
+exited. The counters of `/proc/<pid>/stat` and `/proc/<pid>/io` of duplicity
+include its descendants once these are reaped, so only duplicity itself is
+sampled for those. The resident memory is summed over the whole session of
+duplicity (gpg and the upload processes), as that is what a host needs.
+
+Without `/proc` (eg. on macOS) only `getrusage` is used, and without the
+`resource` module (Windows) no usage is reported.
+"""
+import os
+import sys
+import time
+from typing import NamedTuple, Optional
+
+from duplicity_backup_s3.defaults import RESOURCE_SAMPLE_INTERVAL
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# `ru_maxrss` is in kilobytes on Linux and in bytes on macOS
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+BLOCK_SIZE = 512  # unit of `ru_inblock` and `ru_oublock`
+
+
+class ResourceUsage(NamedTuple):
+    """Resources used by a duplicity run, including its child processes."""
+
+    user_cpu: float  # seconds
+    system_cpu: float  # seconds
+    max_rss: int  # bytes, peak resident memory of the process tree
+    read_bytes: int  # bytes read from storage
+    write_bytes: int  # bytes written to storage
+
+    @property
+    def summary(self) -> str:
+        """Single line summary of the usage."""
+        return (
+            f"CPU {self.user_cpu:.1f}s user, {self.system_cpu:.1f}s system, "
+            f"peak RSS {self.max_rss / 1e6:.1f} MB, "
+            f"read {self.read_bytes / 1e6:.1f} MB, "
+            f"written {self.write_bytes / 1e6:.1f} MB"
+        )
+
+
+def _children_rusage():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def read_proc_stat(pid: int) -> Optional[dict]:
+    """Read the session, CPU ticks and resident pages from `/proc/<pid>/stat`.
+
+    :return: dict with `session`, `utime`, `stime` (including the reaped
+        children) and `rss` (pages), or None when not available
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as fd:
+            data = fd.read()
+        # the command name may contain spaces and parentheses
+        fields = data.rsplit(")", 1)[1].split()
+        return dict(
+            session=int(fields[3]),
+            utime=int(fields[11]) + int(fields[13]),
+            stime=int(fields[12]) + int(fields[14]),
+            rss=int(fields[21]),
+        )
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_proc_fields(pid: int, name: str) -> dict:
+    """Read the `key: value` lines of `/proc/<pid>/<name>` as integers.
+
+    Values in kB (as in `/proc/<pid>/status`) are converted to bytes, lines
+    that are not numeric are skipped.
+    """
+    return read_fields(f"/proc/{pid}/{name}")
+
+
+def read_fields(path: str) -> dict:
+    """Read the `key: value` lines of a file of `/proc` as integers.
+
+    See :func:`read_proc_fields`, empty when the file can not be read.
+    """
+    fields = {}
+    try:
+        with open(path) as fd:
+            for line in fd:
+                key, _, value = line.partition(":")
+                parts = value.split()
+                if parts and parts[0].isdigit():
+                    unit = 1024 if parts[1:] == ["kB"] else 1
+                    fields[key] = int(parts[0]) * unit
+    except OSError:
+        pass
+    return fields
+
+
+class ResourceMonitor:
+    """
+    Account the resources of a child process and its descendants.
+
+    Call :meth:`sample` periodically while the child runs and :meth:`finish`
+    once it was waited for.
+
+    :param pid: process id of the child, the leader of its own session
+    :param children_rusage: complete the samples with the difference of
+        `getrusage(RUSAGE_CHILDREN)`. Only valid when no other children of
+        this process exit during the run.
+    :param interval: minimum seconds between two samples
+    """
+
+    def __init__(
+        self,
+        pid: int,
+        children_rusage: bool = True,
+        interval: float = RESOURCE_SAMPLE_INTERVAL,
+    ):
+        """Initiate the monitor, before the child exits."""
+        self.pid = pid
+        self.children_rusage = children_rusage
+        self.interval = interval
+        self.samples = 0
+        self._sampled_at: Optional[float] = None
+        self._clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self._before = _children_rusage() if children_rusage else None
+        self._cpu = (0, 0)  # ticks
+        self._io = (0, 0)  # bytes
+        self._max_rss = 0  # bytes
+
+    def _session_rss(self) -> int:
+        """Resident memory of all processes in the session of the child."""
+        page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        total = 0
+        try:
+            pids = [int(name) for name in os.listdir("/proc") if name.isdigit()]
+        except OSError:
+            return 0
+        for pid in pids:
+            stat = read_proc_stat(pid)
+            if stat is not None and stat["session"] == self.pid:
+                total += stat["rss"] * page_size
+        return total
+
+    def sample(self) -> None:
+        """Sample the counters of the running child, at most every `interval`."""
+        now = time.monotonic()
+        if self._sampled_at is not None and now - self._sampled_at < self.interval:
+            return
+        self._sampled_at = now
+        stat = read_proc_stat(self.pid)
+        if stat is None:
+            return
+        self.samples += 1
+        self._cpu = (stat["utime"], stat["stime"])
+        io = read_proc_fields(self.pid, "io")
+        if io:
+            self._io = (io.get("read_bytes", 0), io.get("write_bytes", 0))
+        peak = read_proc_fields(self.pid, "status").get("VmHWM", 0)
+        self._max_rss = max(self._max_rss, peak, self._session_rss())
+
+    def finish(self) -> Optional[ResourceUsage]:
+        """Return the usage of the run, after the child exited and was waited for.
+
+        :return: the usage, or None when nothing could be measured
+        """
+        user_cpu, system_cpu = (ticks / self._clock_ticks for ticks in self._cpu)
+        read_bytes, write_bytes = self._io
+        max_rss = self._max_rss
+        after = _children_rusage() if self._before is not None else None
+        if after is not None:
+            before = self._before
+            user_cpu = max(user_cpu, after.ru_utime - before.ru_utime)
+            system_cpu = max(system_cpu, after.ru_stime - before.ru_stime)
+            read_bytes = max(
+                read_bytes, (after.ru_inblock - before.ru_inblock) * BLOCK_SIZE
+            )
+            write_bytes = max(
+                write_bytes, (after.ru_oublock - before.ru_oublock) * BLOCK_SIZE
+            )
+            if after.ru_maxrss > before.ru_maxrss:
+                # the maximum of all children so far, only ours when it grew
+                max_rss = max(max_rss, after.ru_maxrss * MAXRSS_UNIT)
+        elif not self.samples:
+            return None
+        return ResourceUsage(
+            user_cpu=round(user_cpu, 3),
+            system_cpu=round(system_cpu, 3),
+            max_rss=max_rss,
+            read_bytes=read_bytes,
+            write_bytes=write_bytes,
+        )
@@ -0,0 +1,75 @@
+"""Structured results of duplicity runs."""
+import re
+from datetime import datetime
+from typing import Iterable, List, NamedTuple, Optional
+
+from duplicity_backup_s3.resources import ResourceUsage
+from duplicity_backup_s3.stats import parse_statistics
+
+# lines in the output of duplicity that report an error
+ERROR_RE = re.compile(r"^(?:(?:Error|Fatal)\b|Traceback|[\w.]*(?:Error|Exception):)")
+
+
+def error_lines(lines: Iterable[str]) -> List[str]:
+    """Lines of the output of duplicity that report an error."""
+    return [line.rstrip() for line in lines if ERROR_RE.match(line)]
+
+
+class RunResult(NamedTuple):
+    """Result of a single duplicity run."""
+
+    action: str
+    command: List[str]
+    returncode: int
+    started: datetime
+    duration: float  # seconds
+    statistics: dict  # parsed backup statistics, see `parse_statistics`
+    errors: List[str]  # lines of the output that report an error
+    output: List[str]  # the last lines of the output
+    stalled: bool = False  # terminated by the watchdog
+    window_closed: bool = False  # stopped at the end of the backup window
+    log_path: Optional[str] = None  # the log of the complete output
+    resources: Optional[ResourceUsage] = None  # CPU, memory and I/O of the run
+
+    @property
+    def succeeded(self) -> bool:
+        """Check if duplicity exited without error."""
+        return self.returncode == 0
+
+    @classmethod
+    def from_output(
+        cls,
+        command: List[str],
+        returncode: int,
+        started: datetime,
+        duration: float,
+        output: List[str],
+        action: Optional[str] = None,
+        **kwargs,
+    ) -> "RunResult":
+        """Create the result of a run from the (last lines of) its output.
+
+        :param command: the full duplicity command, including the binary
+        :param action: (optional) the action, defaults to the first argument
+        """
+        return cls(
+            action=action or (command[1] if len(command) > 1 else ""),
+            command=list(command),
+            returncode=returncode,
+            started=started,
+            duration=duration,
+            statistics=parse_statistics(output),
+            errors=error_lines(output),
+            output=list(output),
+            **kwargs,
+        )
+
+    def as_dict(self) -> dict:
+        """Return the result as a dict that can be serialised, eg. to json."""
+        result = self._asdict()
+        result.update(
+            started=self.started.isoformat(),
+            succeeded=self.succeeded,
+            resources=self.resources._asdict() if self.resources else None,
+        )
+        return result
@@ -0,0 +1,305 @@
+"""Supervised execution of the duplicity child process."""
+import asyncio
+import codecs
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from typing import Callable, List, NamedTuple, Optional
+
+from duplicity_backup_s3.defaults import (
+    ON_WINDOWS,
+    OUTPUT_TAIL_LINES,
+    WATCHDOG_GRACE_PERIOD,
+    WATCHDOG_POLL_INTERVAL,
+)
+from duplicity_backup_s3.resources import ResourceMonitor, ResourceUsage
+
+
+class StallEvent(NamedTuple):
+    """A stall of the duplicity child process detected by the watchdog."""
+
+    pid: int
+    started: float
+    detected: float
+    idle_seconds: float
+    tail: List[str]
+
+
+def read_proc_io(pid: int) -> Optional[int]:
+    """
+    Return the total amount of bytes read and written by a process.
+
+    The counters are read from `/proc/<pid>/io`. The `rchar` and `wchar`
+    counters include socket traffic, so an upload that is still moving data
+    is noticed as progress.
+
+    :param pid: process id
+    :return: sum of the I/O counters or None when these are not available.
+    """
+    try:
+        with open(f"/proc/{pid}/io") as fd:
+            counters = dict(line.split(":", 1) for line in fd if ":" in line)
+    except (OSError, ValueError):
+        return None
+    return sum(int(counters.get(key, 0)) for key in ("rchar", "wchar"))
+
+
+class ProcessRunner:
+    """
+    Run a command while forwarding and watching its output.
+
+    The output of the child (stdout and stderr combined) is forwarded to our
+    own stdout. When a `stall_timeout` is provided a watchdog checks both the
+    output and the I/O counters of the child. When neither progresses for
+    `stall_timeout` seconds, the process group of the child is terminated
+    gracefully (SIGTERM) and killed (SIGKILL) after `grace_period` seconds.
+
+    When a `deadline` is provided the child is terminated in the same way once
+    `at_boundary` returns True after the deadline passed, or at the latest
+    `deadline_grace` seconds after the deadline.
+
+    :ivar stall_event: :class:`StallEvent` when the child was terminated because
+        it stalled, otherwise None.
+    :ivar deadline_reached: True when the child was terminated at the deadline.
+    :ivar tail: the last lines of output of the child.
+    :ivar resources: :class:`ResourceUsage` of the child once it exited, None
+        when it could not be measured.
+    """
+
+    def __init__(
+        self,
+        command: List[str],
+        env: dict = None,
+        shell: bool = False,
+        stall_timeout: Optional[float] = None,
+        grace_period: float = WATCHDOG_GRACE_PERIOD,
+        poll_interval: float = WATCHDOG_POLL_INTERVAL,
+        output: Optional[Callable[[str], None]] = None,
+        deadline: Optional[float] = None,
+        deadline_grace: float = 0,
+        at_boundary: Optional[Callable[[], bool]] = None,
+    ):
+        """Initiate the runner.
+
+        :param command: command and arguments to execute
+        :param env: environment of the child process
+        :param shell: execute the command through the shell
+        :param stall_timeout: seconds without progress before the child is
+            terminated. None disables the watchdog.
+        :param grace_period: seconds between SIGTERM and SIGKILL
+        :param poll_interval: seconds between two checks of the watchdog
+        :param output: callable receiving the decoded output of the child,
+            defaults to writing to stdout.
+        :param deadline: time (as in `time.monotonic`) to stop the child
+        :param deadline_grace: seconds after the deadline to wait for a boundary
+        :param at_boundary: callable that returns True when the child may be
+            stopped cleanly
+        """
+        self.command = command
+        self.env = env
+        self.shell = shell
+        self.stall_timeout = stall_timeout
+        self.grace_period = grace_period
+        self.poll_interval = poll_interval
+        self.output = output or self._write_stdout
+        self.deadline = deadline
+        self.deadline_grace = deadline_grace
+        self.at_boundary = at_boundary
+        self.deadline_reached = False
+        self.process = None  # type: Optional[subprocess.Popen]
+        self.stall_event = None  # type: Optional[StallEvent]
+        self.resources: Optional[ResourceUsage] = None
+        self._monitor = None  # type: Optional[ResourceMonitor]
+        self.tail = deque(maxlen=OUTPUT_TAIL_LINES)
+        self._partial_line = ""
+        self._last_progress = 0.0
+        self._last_io = None  # type: Optional[int]
+        self._kill_at = None  # type: Optional[float]
+
+    @staticmethod
+    def _write_stdout(text: str) -> None:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    def run(self) -> subprocess.CompletedProcess:
+        """Run the command until it exits or is terminated by the watchdog.
+
+        :return: the completed process
+        """
+        self.started = self._last_progress = time.monotonic()
+        self.process = subprocess.Popen(
+            self.command,
+            shell=self.shell,
+            env=self.env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=not ON_WINDOWS,
+        )
+        self._monitor = ResourceMonitor(self.process.pid)
+        reader = threading.Thread(target=self._pump, daemon=True)
+        reader.start()
+
+        while True:
+            try:
+                returncode = self.process.wait(timeout=self.poll_interval)
+                break
+            except subprocess.TimeoutExpired:
+                self._check_progress()
+        self.resources = self._monitor.finish()
+
+        reader.join(timeout=self.grace_period)
+        if self._partial_line:
+            self.tail.append(self._partial_line)
+        return subprocess.CompletedProcess(self.command, returncode)
+
+    def _pump(self) -> None:
+        """Forward the output of the child and register it as progress."""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        fileno = self.process.stdout.fileno()
+        while True:
+            chunk = os.read(fileno, 65536)
+            if not chunk:
+                break
+            self._last_progress = time.monotonic()
+            text = decoder.decode(chunk)
+            self.output(text)
+            self._remember(text)
+        self.process.stdout.close()
+
+    def _remember(self, text: str) -> None:
+        """Keep the last lines of output in the tail."""
+        lines = (self._partial_line + text).split("\n")
+        self._partial_line = lines.pop()
+        self.tail.extend(lines)
+
+    def _check_progress(self) -> None:
+        """Check the I/O counters of the child and terminate it when stalled."""
+        now = time.monotonic()
+        if self._kill_at is not None:
+            if now >= self._kill_at:
+                self._signal(getattr(signal, "SIGKILL", signal.SIGTERM))
+                self._kill_at = None
+            return
+
+        if self.deadline is not None and now >= self.deadline:
+            overdue = now >= self.deadline + self.deadline_grace
+            if overdue or self.at_boundary is None or self.at_boundary():
+                self.deadline_reached = True
+                self.terminate()
+                return
+
+        if self._monitor is not None:
+            self._monitor.sample()
+
+        io_counter = read_proc_io(self.process.pid)
+        if io_counter is not None and io_counter != self._last_io:
+            self._last_io = io_counter
+            self._last_progress = now
+
+        idle = now - self._last_progress
+        if self.stall_timeout and idle > self.stall_timeout and not self.stall_event:
+            self.stall_event = StallEvent(
+                pid=self.process.pid,
+                started=self.started,
+                detected=now,
+                idle_seconds=idle,
+                tail=list(self.tail),
+            )
+            self.terminate()
+
+    def terminate(self) -> None:
+        """Gracefully terminate the child, kill it after the grace period."""
+        self._signal(signal.SIGTERM)
+        self._kill_at = time.monotonic() + self.grace_period
+
+    def _running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def _signal(self, signum: int) -> None:
+        """Send a signal to the process group of the child."""
+        if not self._running():
+            return
+        try:
+            if ON_WINDOWS:
+                self.process.send_signal(signum)
+            else:
+                os.killpg(self.process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+class AsyncProcessRunner(ProcessRunner):
+    """
+    Run a command in the event loop while watching its output.
+
+    Behaves like :class:`ProcessRunner`, but the child is started with
+    `asyncio.create_subprocess_exec` and :meth:`run` is a coroutine. The output
+    is only passed to `output` when provided. When the coroutine is cancelled
+    the child is terminated, and killed after the grace period.
+    """
+
+    def __init__(self, command: List[str], **kwargs):
+        """Initiate the runner, see :class:`ProcessRunner`."""
+        if kwargs.get("output") is None:
+            kwargs["output"] = lambda text: None
+        super().__init__(command, **kwargs)
+
+    async def run(self) -> subprocess.CompletedProcess:
+        """Run the command until it exits or is terminated by the watchdog.
+
+        :return: the completed process
+        """
+        self.started = self._last_progress = time.monotonic()
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command,
+            env=self.env,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=not ON_WINDOWS,
+        )
+        # other runs in the event loop are children of this process as well
+        self._monitor = ResourceMonitor(self.process.pid, children_rusage=False)
+        reader = asyncio.ensure_future(self._pump())
+        waiter = asyncio.ensure_future(self.process.wait())
+        try:
+            while not waiter.done():
+                await asyncio.wait([waiter], timeout=self.poll_interval)
+                if not waiter.done():
+                    self._check_progress()
+        except asyncio.CancelledError:
+            self._signal(signal.SIGTERM)
+            asyncio.get_event_loop().call_later(
+                self.grace_period,
+                self._signal,
+                getattr(signal, "SIGKILL", signal.SIGTERM),
+            )
+            reader.cancel()
+            raise
+
+        try:
+            await asyncio.wait_for(reader, self.grace_period)
+        except asyncio.TimeoutError:
+            pass
+        self.resources = self._monitor.finish()
+        if self._partial_line:
+            self.tail.append(self._partial_line)
+        return subprocess.CompletedProcess(self.command, waiter.result())
+
+    async def _pump(self) -> None:
+        """Pass on the output of the child and register it as progress."""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            chunk = await self.process.stdout.read(65536)
+            if not chunk:
+                break
+            self._last_progress = time.monotonic()
+            text = decoder.decode(chunk)
+            self.output(text)
+            self._remember(text)
+
+    def _running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
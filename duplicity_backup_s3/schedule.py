@@ -0,0 +1,129 @@
+"""Staggered scheduling of the backups of a fleet of hosts.
+
+Every host and backup profile gets a deterministic slot within the backup
+window, derived from a hash of the hostname and the remote uri. No coordinator
+is needed: hosts with the same settings spread themselves evenly (on average)
+over the window, instead of all starting their backup at the same moment.
+"""
+import hashlib
+from datetime import datetime, timedelta
+from typing import Iterable, List, Tuple
+
+from duplicity_backup_s3.window import BackupWindow
+
+
+def host_hash(hostname: str, remote_uri: str) -> int:
+    """Stable hash of a host and backup profile."""
+    digest = hashlib.sha256(f"{hostname}\0{remote_uri}".encode("utf-8")).hexdigest()
+    return int(digest[:16], 16)
+
+
+def slot_offset(
+    hostname: str,
+    remote_uri: str,
+    window: BackupWindow,
+    fleet_size: int,
+    duration: timedelta,
+) -> timedelta:
+    """Start of the slot of a host, relative to the opening of the window.
+
+    The window (minus the expected duration of a backup, such that the last
+    backup still finishes within the window) is divided in `fleet_size` slots.
+
+    :param hostname: name of the host
+    :param remote_uri: remote uri of the backup profile
+    :param window: the backup window
+    :param fleet_size: number of hosts (and profiles) that share the window
+    :param duration: expected duration of a backup
+    :return: offset of the slot from the opening of the window
+    """
+    spread = max(window.duration - duration, timedelta(0))
+    slot = host_hash(hostname, remote_uri) % max(fleet_size, 1)
+    offset = spread * slot / max(fleet_size, 1)
+    return timedelta(minutes=int(offset.total_seconds() // 60))
+
+
+def slot_time(window: BackupWindow, offset: timedelta, moment: datetime) -> datetime:
+    """Start of the slot in the window that opens at or before `moment`.
+
+    Unlike :func:`slot_start` this is always the slot itself, the daily time
+    for a crontab line or systemd timer.
+    """
+    return window.opens_at(moment) + offset
+
+
+def slot_start(window: BackupWindow, offset: timedelta, moment: datetime) -> datetime:
+    """Moment to start the backup, at or after `moment`.
+
+    Within the window the backup starts at its slot, or right away when the
+    slot already passed (eg. when the host was down). Outside of the window
+    the backup starts at the slot of the next window.
+    """
+    if window.contains(moment):
+        return max(moment, window.opens_at(moment) + offset)
+    return window.next_opening(moment) + offset
+
+
+def peak_concurrency(offsets: Iterable[timedelta], duration: timedelta) -> int:
+    """Maximum number of backups running at the same time.
+
+    :param offsets: start of the backups
+    :param duration: duration of every backup
+    """
+    events: List[Tuple[timedelta, int]] = []
+    for offset in offsets:
+        events.append((offset, 1))
+        events.append((offset + duration, -1))
+    running = peak = 0
+    # at equal moments a backup finishes before the next one starts
+    for _, change in sorted(events):
+        running += change
+        peak = max(peak, running)
+    return peak
+
+
+def simulate(
+    remote_uri: str, window: BackupWindow, fleet_size: int, duration: timedelta
+) -> dict:
+    """Simulate the slots of a fleet of (synthetic) hosts.
+
+    :return: dict with the `peak` concurrency of the staggered schedule, the
+        `expected` average concurrency and the `slot_spacing` between slots.
+    """
+    offsets = [
+        slot_offset(f"host{index:05d}", remote_uri, window, fleet_size, duration)
+        for index in range(fleet_size)
+    ]
+    spread = max(window.duration - duration, timedelta(0))
+    return dict(
+        fleet_size=fleet_size,
+        peak=peak_concurrency(offsets, duration),
+        expected=min(
+            fleet_size,
+            fleet_size * duration / (spread + duration) if duration else 0,
+        ),
+        slot_spacing=spread / fleet_size,
+        unstaggered=fleet_size,
+    )
+
+
+def cron_line(start: datetime, command: str) -> str:
+    """Crontab line that runs a command daily at the start of a slot.
+
+    A `%` in the command ends the command for cron, it is escaped.
+    """
+    escaped = command.replace("%", "\\%")
+    return f"{start.minute} {start.hour} * * * {escaped}"
+
+
+def systemd_timer(start: datetime, description: str) -> str:
+    """Systemd timer unit that fires daily at the start of a slot."""
+    return (
+        "[Unit]\n"
+        f"Description={description}\n\n"
+        "[Timer]\n"
+        f"OnCalendar=*-*-* {start:%H:%M}:00\n"
+        "Persistent=true\n\n"
+        "[Install]\n"
+        "WantedBy=timers.target"
+    )
@@ -0,0 +1,128 @@
+"""Placement of the scratch space of duplicity.
+
+Duplicity builds, encrypts and downloads its volumes in its temp directory,
+which defaults to the (often small) `/tmp`. With the `scratch` section the
+directories to use are configured in order of preference, eg. a NVMe disk, a
+tmpfs and a data disk. Before a run, the first directory with room for the
+volumes in flight is picked, and a directory of the run is created inside it
+that is passed to duplicity as `--tempdir` and `TMPDIR`.
+
+The directories of a run carry the pid of the process that created them
+(`duplicity_s3__pid-<pid>__*`). Directories left behind by a process that no
+longer runs are removed on the next start. Other directories are left alone,
+whatever their age.
+"""
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from duplicity_backup_s3.defaults import SCRATCH_PREFIX
+
+OWNER_RE = re.compile(rf"^{SCRATCH_PREFIX}pid-(\d+)__")
+
+# actions of duplicity that take an argument of their own
+ACTIONS_WITH_ARGUMENT = (
+    "remove-older-than",
+    "remove-all-but-n-full",
+    "remove-all-inc-of-but-n-full",
+)
+
+
+class ScratchError(OSError):
+    """None of the scratch directories has room for the run."""
+
+
+def free_space(path: str) -> Optional[int]:
+    """Bytes available in the filesystem of a path, None when not accessible."""
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return None
+
+
+def choose(directories: Iterable[str], need: int) -> str:
+    """Pick the first writable directory with at least `need` bytes free.
+
+    :param directories: the candidates in order of preference
+    :param need: bytes the run is expected to need
+    :raises ScratchError: when none of the directories has room
+    """
+    checked = []
+    for directory in directories:
+        free = free_space(directory)
+        if free is None or not os.access(directory, os.W_OK | os.X_OK):
+            checked.append(f"{directory} (not writable)")
+            continue
+        if free >= need:
+            return directory
+        checked.append(f"{directory} ({free / 1e6:.0f} MB free)")
+    raise ScratchError(
+        f"None of the scratch directories has {need / 1e6:.0f} MB free: "
+        + ", ".join(checked)
+    )
+
+
+def owner_prefix() -> str:
+    """Prefix of the scratch directories of this process, see :data:`OWNER_RE`."""
+    return f"{SCRATCH_PREFIX}pid-{os.getpid()}__"
+
+
+def with_tempdir(command: List[str], scratch: str) -> List[str]:
+    """Pass a scratch directory to a duplicity command as `--tempdir`.
+
+    The option follows the action, and the argument of the action if it has
+    one, such that they stay together.
+
+    :param command: the duplicity binary, the action and its arguments
+    :param scratch: the scratch directory of the run
+    """
+    position = 3 if command[1] in ACTIONS_WITH_ARGUMENT else 2
+    return [*command[:position], "--tempdir", scratch, *command[position:]]
+
+
+def make_scratch(directory: Optional[str]) -> str:
+    """Create the scratch directory of this run inside a directory.
+
+    :param directory: the scratch directory, None for the temp directory
+    """
+    return tempfile.mkdtemp(prefix=owner_prefix(), dir=directory)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # running as another user
+    return True
+
+
+def clean_stale(directories: Iterable[str]) -> List[str]:
+    """Remove the scratch directories of runs that ended without cleaning up.
+
+    Only directories created by :func:`make_scratch` are considered, they are
+    stale when the process in their name no longer runs.
+
+    :param directories: the directories to look for stale scratch directories
+    :return: the removed directories
+    """
+    removed = []
+    for directory in directories:
+        try:
+            entries = list(Path(directory).glob(f"{SCRATCH_PREFIX}pid-*"))
+        except OSError:
+            continue
+        for path in entries:
+            match = OWNER_RE.match(path.name)
+            if match is None or int(match.group(1)) == os.getpid():
+                continue
+            if not path.is_dir() or path.is_symlink():
+                continue
+            if not _alive(int(match.group(1))):
+                shutil.rmtree(str(path), ignore_errors=True)
+                removed.append(str(path))
+    return removed
@@ -0,0 +1,183 @@
+"""Warm standby copy of the backup.
+
+The `standby` command keeps a directory in sync with the latest backup, such
+that a failover points the service at a copy that is already current instead
+of waiting for a complete restore. Every sync:
+
+1. lists the files of the latest backup (`list-current-files`) into a new
+   index and compares it with the index of the previous sync, as streams (see
+   :mod:`duplicity_backup_s3.listing`);
+2. restores the added and modified files in parallel, every file with its own
+   `restore --file-to-restore` into a staging directory inside the standby
+   directory, from where it is moved in place atomically. With a volume
+   cache the restores share one mirror of the cache;
+3. removes the files that are no longer in the backup;
+4. keeps the new index for the next sync, only when every file was restored,
+   such that a failed sync is retried.
+
+The indexes are sorted on the components of the paths: a directory is directly
+followed by its contents. This tells the directories, which are created rather
+than restored with all of their contents, from the files.
+
+The first sync, without an index, restores the whole backup at once.
+"""
+import os
+import shutil
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+from duplicity_backup_s3.defaults import STATE_DIR
+from duplicity_backup_s3.listing import (
+    ADDED,
+    MODIFIED,
+    Entry,
+    diff_entries,
+    parse_listing,
+    sort_entries,
+)
+from duplicity_backup_s3.state import profile_key
+
+# sorts before any other character, such that a directory is followed by its
+# contents
+SEPARATOR = "\0"
+
+
+class Change(NamedTuple):
+    """A difference between the standby directory and the backup."""
+
+    status: str  # `ADDED`, `REMOVED` or `MODIFIED`
+    path: str
+    directory: bool  # a directory in the backup, False for removed paths
+
+
+class _Listed(NamedTuple):
+    path: str  # keyed on the path components
+    mtime: str
+    directory: bool
+
+
+def index_path(remote_uri: str, target: Path, state_dir: Path = None) -> Path:
+    """Path to the index of the last sync of a standby directory.
+
+    :param remote_uri: remote uri of the backup profile
+    :param target: the standby directory
+    :param state_dir: (optional) directory of the state files
+    """
+    return (
+        Path(state_dir or STATE_DIR)
+        / "standby"
+        / f"{profile_key(remote_uri)}-{profile_key(str(target))}.index"
+    )
+
+
+def _keyed(entries: Iterable[Entry]) -> Iterator[Entry]:
+    for entry in entries:
+        yield Entry(entry.path.replace("/", SEPARATOR), entry.mtime)
+
+
+def write_index(lines: Iterable[str], path: Path) -> int:
+    """Sort a listing of the backup on its path components into an index.
+
+    The index has the format of the listing, it can be read by the `diff`
+    command as well.
+
+    :param lines: the output of `list-current-files`
+    :param path: the index file to write
+    :return: the number of entries
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    count = 0
+    with path.open("w", encoding="utf-8", errors="replace") as fd:
+        for entry in sort_entries(_keyed(parse_listing(lines))):
+            fd.write(f"{entry.mtime} {entry.path.replace(SEPARATOR, '/')}\n")
+            count += 1
+    return count
+
+
+def read_index(path: Optional[Path]) -> Iterator[Entry]:
+    """Read an index, keyed on the path components.
+
+    :param path: the index file, nothing is read when None
+    """
+    if path is None:
+        return
+    with path.open(encoding="utf-8", errors="replace") as fd:
+        yield from _keyed(parse_listing(fd))
+
+
+def _with_directories(entries: Iterable[Entry]) -> Iterator[_Listed]:
+    """Tell the directories in keyed entries, with a look ahead of one entry."""
+    entries = iter(entries)
+    entry = next(entries, None)
+    while entry is not None:
+        following = next(entries, None)
+        directory = following is not None and following.path.startswith(
+            entry.path + SEPARATOR
+        )
+        yield _Listed(entry.path, entry.mtime, directory)
+        entry = following
+
+
+def changes(old: Iterable[Entry], new: Iterable[Entry]) -> Iterator[Change]:
+    """Compare the index of the last sync with the index of the backup.
+
+    :param old: keyed entries of the last sync, see :func:`read_index`
+    :param new: keyed entries of the backup
+    :return: the changes, a directory before its contents
+    """
+    for status, entry in diff_entries(old, _with_directories(new)):
+        path = entry.path.replace(SEPARATOR, "/")
+        if path == ".":
+            continue
+        yield Change(status, path, status in (ADDED, MODIFIED) and entry.directory)
+
+
+def make_directory(path: Path) -> None:
+    """Create a directory of the backup, replacing a file of that name."""
+    if path.is_symlink() or (path.exists() and not path.is_dir()):
+        path.unlink()
+    path.mkdir(parents=True, exist_ok=True)
+
+
+def place(staged: Path, path: Path) -> None:
+    """Move a restored file in place, replacing what is there."""
+    if not path.parent.is_dir():
+        make_directory(path.parent)
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(str(path))
+    os.replace(str(staged), str(path))
+
+
+def remove(path: Path) -> None:
+    """Remove a path that is no longer in the backup, if it still exists."""
+    try:
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(str(path))
+        else:
+            path.unlink()
+    except (FileNotFoundError, NotADirectoryError):
+        # removed with its directory, or replaced by a file
+        pass
+
+
+def copy_archive(archive: Path, directory: Path) -> Path:
+    """Copy the archive directory of duplicity for a concurrent restore.
+
+    Duplicity locks its archive directory, concurrent restores each need their
+    own. The files are hard linked when possible.
+
+    :param archive: the archive directory of the chain
+    :param directory: the directory to copy into, it gets the same name
+    :return: the `--archive-dir` of the copy
+    """
+    copy = directory / archive.name
+    copy.mkdir(parents=True, exist_ok=True)
+    if archive.is_dir():
+        for source in archive.iterdir():
+            if not source.is_file() or source.name == "lockfile":
+                continue
+            try:
+                os.link(str(source), str(copy / source.name))
+            except OSError:
+                shutil.copy2(str(source), str(copy / source.name))
+    return directory
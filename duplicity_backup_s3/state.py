@@ -0,0 +1,74 @@
+"""Local state of a backup profile that is kept between runs.
+
+The state is a small json file per remote, stored in the state directory of
+the application. It is written atomically, such that a reader never sees a
+half written file.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from duplicity_backup_s3.defaults import STATE_DIR
+
+
+def profile_key(remote_uri: str) -> str:
+    """Key of a backup profile, derived from the remote uri."""
+    return hashlib.sha1(remote_uri.encode("utf-8")).hexdigest()[:16]
+
+
+def state_path(remote_uri: str, state_dir: Path = None) -> Path:
+    """Path to the state file of the backup profile.
+
+    :param remote_uri: remote uri of the backup profile
+    :param state_dir: (optional) directory of the state files
+    :return: path to the state file
+    """
+    return Path(state_dir or STATE_DIR) / f"{profile_key(remote_uri)}.json"
+
+
+def load_state(remote_uri: str, state_dir: Path = None) -> dict:
+    """Load the state of a backup profile.
+
+    :return: the state or an empty dict when there is no (readable) state.
+    """
+    try:
+        with state_path(remote_uri, state_dir).open() as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(remote_uri: str, state: dict, state_dir: Path = None) -> Path:
+    """Atomically write the state of a backup profile.
+
+    :return: path to the state file
+    """
+    path = state_path(remote_uri, state_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".state_", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, "w") as tmp:
+            json.dump(dict(state, remote=remote_uri), tmp, indent=2, sort_keys=True)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.replace(tmp_path, str(path))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+
+def update_state(remote_uri: str, state_dir: Path = None, **changes) -> dict:
+    """Update some keys of the state of a backup profile.
+
+    A value of None removes the key from the state.
+
+    :return: the updated state
+    """
+    state = load_state(remote_uri, state_dir)
+    state.update(changes)
+    state = {key: value for key, value in state.items() if value is not None}
+    save_state(remote_uri, state, state_dir)
+    return state
@@ -0,0 +1,41 @@
+"""Parsing of the statistics that duplicity prints after a backup."""
+import re
+from typing import Iterable, Optional
+
+# eg. 'TotalDestinationSizeChange 1234 (1.21 KB)'
+STATISTIC_RE = re.compile(r"^([A-Z][A-Za-z]+) (-?\d+(?:\.\d+)?)(?: \(.*\))?$")
+STATISTICS_HEADER = "[ Backup Statistics ]"
+
+
+def parse_statistics(lines: Iterable[str]) -> dict:
+    """Parse the backup statistics block from the output of duplicity.
+
+    :param lines: (the last) lines of the output of duplicity
+    :return: dict with the statistics, eg. `ElapsedTime` or `Errors`. Empty when
+        the output does not contain statistics.
+    """
+    statistics = {}
+    in_block = False
+    for line in lines:
+        line = line.strip()
+        if STATISTICS_HEADER in line:
+            statistics, in_block = {}, True
+            continue
+        if not in_block:
+            continue
+        match = STATISTIC_RE.match(line)
+        if match is None:
+            in_block = not line.startswith("---")
+            continue
+        value = match.group(2)
+        statistics[match.group(1)] = float(value) if "." in value else int(value)
+    return statistics
+
+
+def throughput(statistics: dict) -> Optional[float]:
+    """Upload throughput in MB/s of a backup from its statistics."""
+    elapsed = statistics.get("ElapsedTime")
+    size = statistics.get("TotalDestinationSizeChange")
+    if not elapsed or size is None or size <= 0:
+        return None
+    return size / 1e6 / elapsed
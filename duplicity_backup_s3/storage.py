@@ -0,0 +1,379 @@
+"""Storage classes of the backup volumes on S3.
+
+New data volumes are uploaded in the storage class of `storage > volumes`
+through the options of duplicity, which keeps the manifests and signatures in
+the standard class, such that `list` and `status` stay fast. The `tiers` move
+the data volumes of old chains to colder classes: a chain is a full backup
+with its incrementals, and its age is the time since the next full backup
+superseded it. The current chain is never moved.
+
+Volumes in an archive class (Glacier, Deep Archive) must be rehydrated before
+duplicity can read them. Before a restore the volumes of the chain are staged:
+restores are requested in parallel and the restore waits until all volumes
+are available.
+
+The S3 API is accessed with boto3, which is only needed for these features.
+"""
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+from duplicity_backup_s3.archive import (
+    VOLUME,
+    BackupFile,
+    parse_filename,
+    parse_interval,
+)
+from duplicity_backup_s3.defaults import (
+    STORAGE_PARALLEL,
+    STORAGE_POLL_INTERVAL,
+    STORAGE_RESTORE_DAYS,
+    STORAGE_RESTORE_TIER,
+    STORAGE_RESTORE_TIMEOUT,
+)
+
+# storage classes from hot to cold, the archive classes need a restore
+STORAGE_CLASSES = [
+    "STANDARD",
+    "INTELLIGENT_TIERING",
+    "STANDARD_IA",
+    "ONEZONE_IA",
+    "GLACIER_IR",
+    "GLACIER",
+    "DEEP_ARCHIVE",
+]
+ARCHIVE_CLASSES = ("GLACIER", "DEEP_ARCHIVE")
+
+# storage class of new volumes and the matching duplicity option
+VOLUME_OPTIONS = {
+    "STANDARD_IA": "--s3-use-ia",
+    "ONEZONE_IA": "--s3-use-onezone-ia",
+    "GLACIER_IR": "--s3-use-glacier-ir",
+    "GLACIER": "--s3-use-glacier",
+    "DEEP_ARCHIVE": "--s3-use-deep-archive",
+}
+
+# objects larger than this can not be copied in a single request
+MAX_COPY_SIZE = 5 * 1024**3
+
+
+class StorageError(Exception):
+    """A storage operation on S3 failed.
+
+    :ivar code: the error code of S3, if any
+    """
+
+    def __init__(self, message: str, code: Optional[str] = None):
+        """Initiate the error with its message and the error code of S3."""
+        super().__init__(message)
+        self.code = code
+
+
+class RemoteFile(NamedTuple):
+    """A duplicity file on S3."""
+
+    key: str
+    size: int
+    storage_class: str
+    file: BackupFile
+    etag: str = ""
+
+
+def s3_client(endpoint_url: Optional[str] = None, **credentials):
+    """Create a boto3 S3 client.
+
+    :raises StorageError: when boto3 is not installed
+    """
+    try:
+        import boto3
+    except ImportError:
+        raise StorageError(
+            "The storage features need boto3, install it with `pip install boto3`."
+        )
+    return boto3.client("s3", endpoint_url=endpoint_url, **credentials)
+
+
+def _call(client, operation: str, **kwargs) -> dict:
+    """Call an operation of the S3 client, raising a :class:`StorageError`."""
+    try:
+        return getattr(client, operation)(**kwargs)
+    except Exception as e:  # the errors of botocore, which may not be installed
+        code = getattr(e, "response", {}).get("Error", {}).get("Code")
+        raise StorageError(f"{operation} failed: {e}", code=code)
+
+
+def bucket_and_prefix(remote_uri: str) -> Tuple[str, str]:
+    """Split the remote uri into the bucket and key prefix of the backup.
+
+    Supports `s3+http://bucket/prefix`, `boto3+s3://bucket/prefix` and
+    `s3://bucket/prefix` as well as the host form `s3://host[:port]/bucket/prefix`
+    and `s3:///bucket/prefix`.
+
+    :param remote_uri: remote uri of the backup (or a chain of it)
+    """
+    parts = urlsplit(remote_uri)
+    path = parts.path.strip("/")
+    if not parts.netloc or (
+        parts.scheme == "s3" and ("." in parts.netloc or ":" in parts.netloc)
+    ):
+        bucket, _, prefix = path.partition("/")
+    else:
+        bucket, prefix = parts.netloc, path
+    return bucket, f"{prefix}/" if prefix else ""
+
+
+def list_files(client, bucket: str, prefix: str, start: str = "") -> List[RemoteFile]:
+    """List the duplicity files of a backup on S3, sorted by time.
+
+    Only the files directly below the prefix are listed, not the ones of the
+    chains of the policies at a subpath.
+
+    :param start: (optional) only list the files whose name starts with this,
+        eg. `duplicity-inc.`
+    """
+    files = []
+    kwargs = dict(Bucket=bucket, Prefix=prefix + start, Delimiter="/")
+    while True:
+        response = _call(client, "list_objects_v2", **kwargs)
+        for obj in response.get("Contents", []):
+            parsed = parse_filename(obj["Key"].replace(prefix, "", 1))
+            if parsed is not None:
+                files.append(
+                    RemoteFile(
+                        key=obj["Key"],
+                        size=obj.get("Size", 0),
+                        storage_class=obj.get("StorageClass") or "STANDARD",
+                        file=parsed,
+                        etag=obj.get("ETag", "").strip('"'),
+                    )
+                )
+        if not response.get("IsTruncated"):
+            break
+        kwargs["ContinuationToken"] = response["NextContinuationToken"]
+    return sorted(files, key=lambda f: (f.file.end, f.file.type != "full"))
+
+
+def chains(files: List[RemoteFile]) -> List[List[RemoteFile]]:
+    """Group the files into chains, each a full backup with its incrementals."""
+    grouped: List[List[RemoteFile]] = []
+    for remote_file in files:
+        if not grouped or (
+            remote_file.file.type == "full"
+            and grouped[-1][0].file.set_key != remote_file.file.set_key
+        ):
+            grouped.append([])
+        grouped[-1].append(remote_file)
+    return grouped
+
+
+def _colder(storage_class: str, than: str) -> bool:
+    rank = {name: index for index, name in enumerate(STORAGE_CLASSES)}
+    return rank.get(storage_class, 0) > rank.get(than, 0)
+
+
+def transitions(
+    files: List[RemoteFile], tiers: List[dict], now: datetime = None
+) -> List[Tuple[RemoteFile, str]]:
+    """Find the data volumes that move to a colder storage class.
+
+    :param files: the files of the backup, see :func:`list_files`
+    :param tiers: the `storage > tiers`, each with `after_days` and `class`
+    :param now: (optional) the current time, for testing
+    :return: the volumes with their new storage class
+    """
+    now = now or datetime.now(timezone.utc)
+    moves = []
+    grouped = chains(files)
+    for chain, superseding in zip(grouped, grouped[1:]):
+        age = now - superseding[0].file.end
+        targets = [
+            tier["class"]
+            for tier in sorted(tiers, key=lambda tier: tier["after_days"])
+            if age >= timedelta(days=tier["after_days"])
+        ]
+        if not targets:
+            continue
+        for remote_file in chain:
+            if (
+                remote_file.file.kind == VOLUME
+                and remote_file.storage_class not in ARCHIVE_CLASSES
+                and _colder(targets[-1], remote_file.storage_class)
+                and remote_file.size <= MAX_COPY_SIZE
+            ):
+                moves.append((remote_file, targets[-1]))
+    return moves
+
+
+def change_class(client, bucket: str, key: str, storage_class: str) -> None:
+    """Move an object to another storage class by copying it onto itself."""
+    _call(
+        client,
+        "copy_object",
+        Bucket=bucket,
+        Key=key,
+        CopySource=dict(Bucket=bucket, Key=key),
+        StorageClass=storage_class,
+        MetadataDirective="COPY",
+    )
+
+
+def download(client, bucket: str, key: str, path: Path) -> None:
+    """Download an object into a file, which only appears once complete.
+
+    :raises StorageError: when the download fails
+    """
+    part = path.with_name(f"{path.name}.{os.getpid()}.part")
+    response = _call(client, "get_object", Bucket=bucket, Key=key)
+    try:
+        with open(str(part), "wb") as fd:
+            shutil.copyfileobj(response["Body"], fd, 1024 * 1024)
+        os.replace(str(part), str(path))
+    except OSError as e:
+        if part.exists():
+            part.unlink()
+        raise StorageError(f"Downloading {key} failed: {e}")
+
+
+def restore_time(value: Optional[str], now: datetime = None) -> Optional[datetime]:
+    """Parse the `--time` of a restore, None for the most recent backup.
+
+    Supports the intervals of duplicity (eg. `3D`), dates, local times and
+    seconds since the epoch.
+
+    :raises ValueError: when the time can not be parsed
+    """
+    if value is None or value == "now":
+        return None
+    interval = parse_interval(value)
+    if interval is not None:
+        return (now or datetime.now(timezone.utc)) - interval
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value), timezone.utc)
+    if len(value) > 6 and value[-6] in "+-" and value[-3] == ":":
+        value = value[:-3] + value[-2:]  # `%z` takes no colon before python 3.7
+    for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S%z", "%Y/%m/%d"):
+        try:
+            return datetime.strptime(value, fmt).astimezone(timezone.utc)
+        except ValueError:
+            continue
+    raise ValueError(f"Can not parse the time '{value}'.")
+
+
+def restore_files(files: List[RemoteFile], at: Optional[datetime]) -> List[RemoteFile]:
+    """Find the data volumes that a restore of the backup at a time needs.
+
+    :param files: the files of the backup, see :func:`list_files`
+    :param at: time of the backup to restore, None for the most recent one
+    """
+    needed = [
+        f for f in files if f.file.kind == VOLUME and (at is None or f.file.end <= at)
+    ]
+    grouped = chains(needed)
+    return grouped[-1] if grouped else []
+
+
+def _restore_status(head: dict) -> str:
+    """Return the restore status of an object: `none`, `ongoing` or `done`."""
+    restore = head.get("Restore")
+    if not restore:
+        return "none"
+    return "ongoing" if 'ongoing-request="true"' in restore else "done"
+
+
+class Staging(NamedTuple):
+    """Result of staging the volumes of a restore."""
+
+    archived: int  # volumes in an archive class
+    requested: int  # restores requested
+    ready: bool
+
+
+def stage(
+    client,
+    bucket: str,
+    files: List[RemoteFile],
+    days: int = STORAGE_RESTORE_DAYS,
+    tier: str = STORAGE_RESTORE_TIER,
+    parallel: int = STORAGE_PARALLEL,
+    poll_interval: float = STORAGE_POLL_INTERVAL,
+    timeout: float = STORAGE_RESTORE_TIMEOUT,
+    log: Callable[[str], None] = lambda message: None,
+    sleep: Callable[[float], None] = time.sleep,
+) -> Staging:
+    """Request the rehydration of archived volumes and wait until they are ready.
+
+    :param client: the S3 client
+    :param bucket: the bucket of the backup
+    :param files: the volumes the restore needs
+    :param days: days the rehydrated copies stay available
+    :param tier: retrieval tier, `Expedited`, `Standard` or `Bulk`
+    :param parallel: number of concurrent requests
+    :param poll_interval: seconds between checks of the pending restores
+    :param timeout: seconds to wait for the restores
+    :param log: callable that reports the progress
+    :param sleep: callable to wait with, for testing
+    """
+    archived = [f for f in files if f.storage_class in ARCHIVE_CLASSES]
+    if not archived:
+        return Staging(archived=0, requested=0, ready=True)
+
+    def status(remote_file: RemoteFile) -> str:
+        return _restore_status(
+            _call(client, "head_object", Bucket=bucket, Key=remote_file.key)
+        )
+
+    def request(remote_file: RemoteFile) -> Tuple[str, bool]:
+        current = status(remote_file)
+        if current != "none":
+            return current, False
+        try:
+            _call(
+                client,
+                "restore_object",
+                Bucket=bucket,
+                Key=remote_file.key,
+                RestoreRequest=dict(Days=days, GlacierJobParameters=dict(Tier=tier)),
+            )
+        except StorageError as e:
+            if e.code != "RestoreAlreadyInProgress":
+                raise
+        return "ongoing", True
+
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        results = list(pool.map(request, archived))
+        requested = sum(1 for _, new in results if new)
+        pending = [f for f, (state, _) in zip(archived, results) if state != "done"]
+        log(
+            f"{len(archived)} volumes are archived, requested {requested} restores, "
+            f"waiting for {len(pending)}."
+        )
+        waited = 0.0
+        while pending:
+            if waited >= timeout:
+                return Staging(len(archived), requested, ready=False)
+            sleep(poll_interval)
+            waited += poll_interval
+            pending = [
+                f
+                for f, state in zip(pending, pool.map(status, pending))
+                if state != "done"
+            ]
+            log(f"{len(archived) - len(pending)} of {len(archived)} volumes restored.")
+    return Staging(len(archived), requested, ready=True)
+
+
+def storage_args(
+    storage: Dict, supported: Callable[[str], bool] = lambda option: True
+) -> List[str]:
+    """Return the duplicity options that upload new volumes in their class.
+
+    :param storage: the `storage` section of the configuration
+    :param supported: callable that checks if duplicity supports an option
+    """
+    option = VOLUME_OPTIONS.get((storage or {}).get("volumes", "STANDARD"))
+    return [option] if option and supported(option) else []
@@ -0,0 +1,94 @@
+"""Upload settings of duplicity for S3 multipart uploads and concurrency.
+
+The settings come from the `transfer` section of the configuration. In `auto`
+mode the chunk size and the number of parallel processes and uploads are
+derived from the volume size, the number of CPUs and the throughput measured
+in previous runs. Explicitly configured settings always take precedence.
+"""
+import math
+import os
+from typing import Callable, List, Optional
+
+from duplicity_backup_s3.defaults import (
+    DUPLICITY_VOLSIZE,
+    MAX_CONCURRENCY,
+    TRANSFER_MAX_PROCS,
+    TRANSFER_MIN_CHUNK_SIZE,
+)
+
+# setting in the configuration and the matching duplicity option
+OPTIONS = {
+    "multipart_chunk_size": "--s3-multipart-chunk-size",
+    "multipart_max_procs": "--s3-multipart-max-procs",
+    "concurrency": "--concurrency",
+}
+
+
+def auto_settings(
+    volsize: int = DUPLICITY_VOLSIZE,
+    cpu_count: Optional[int] = None,
+    throughput: Optional[float] = None,
+) -> dict:
+    """Derive the upload settings from the volume size, CPUs and throughput.
+
+    Every volume is uploaded in parts by `multipart_max_procs` processes, while
+    `concurrency` volumes are uploaded in parallel. The total amount of upload
+    processes is kept around twice the amount of CPUs. A chunk is made large
+    enough to take about a second per process at the measured throughput, to
+    limit the overhead of the requests.
+
+    :param volsize: volume size in MB
+    :param cpu_count: number of CPUs, defaults to the CPUs of this host
+    :param throughput: throughput in MB/s measured in previous runs
+    :return: dict with `multipart_chunk_size` (MB), `multipart_max_procs` and
+        `concurrency`
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    procs = max(1, min(cpu_count, TRANSFER_MAX_PROCS))
+    chunk_size = math.ceil(volsize / procs)
+    if throughput:
+        chunk_size = max(chunk_size, math.ceil(throughput / procs))
+    chunk_size = max(TRANSFER_MIN_CHUNK_SIZE, min(chunk_size, volsize))
+    # a volume that fits in fewer chunks needs fewer processes
+    procs = max(1, min(procs, math.ceil(volsize / chunk_size)))
+    concurrency = max(1, min(MAX_CONCURRENCY, (2 * cpu_count) // procs))
+    return dict(
+        multipart_chunk_size=chunk_size,
+        multipart_max_procs=procs,
+        concurrency=concurrency,
+    )
+
+
+def transfer_settings(
+    transfer: Optional[dict],
+    volsize: int = DUPLICITY_VOLSIZE,
+    throughput: Optional[float] = None,
+) -> dict:
+    """Upload settings from the `transfer` section of the configuration.
+
+    Without a `transfer` section only the concurrency is set, to as many
+    parallel uploads as there are CPUs (up to a maximum).
+    """
+    if not transfer:
+        return dict(concurrency=min(os.cpu_count() or 1, MAX_CONCURRENCY))
+    settings = {}
+    if transfer.get("mode") == "auto":
+        settings = auto_settings(volsize, throughput=throughput)
+    settings.update({key: transfer[key] for key in OPTIONS if key in transfer})
+    return settings
+
+
+def transfer_args(settings: dict, supported: Callable[[str], bool]) -> List[str]:
+    """Duplicity arguments for the upload settings.
+
+    :param settings: upload settings, see :func:`transfer_settings`
+    :param supported: callable that checks if duplicity supports an option
+    :return: list of arguments
+    """
+    args = []
+    if supported("--s3-use-multiprocessing"):
+        args.append("--s3-use-multiprocessing")
+    for key, option in OPTIONS.items():
+        if key in settings and supported(option):
+            args.extend([option, str(settings[key])])
+    return args
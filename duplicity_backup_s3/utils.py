@@ -55,14 +55,16 @@ def echo_info(text: str, nl=True):
 
 
 @contextmanager
-def temp_chdir(cwd=None):
+def temp_chdir(cwd=None, dir=None, prefix="duplicity_s3__"):
     """Create temporary directory and change to it as a context to operate in.
 
     :param cwd: current working directory to change back to.
+    :param dir: (optional) directory to create the temporary directory in.
+    :param prefix: (optional) prefix of the name of the temporary directory.
     """
     from tempfile import TemporaryDirectory
 
-    with TemporaryDirectory(prefix="duplicity_s3__") as tempwd:
+    with TemporaryDirectory(prefix=prefix, dir=dir) as tempwd:
         origin = cwd or os.getcwd()
         os.chdir(tempwd)
 
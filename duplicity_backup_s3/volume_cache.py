@@ -0,0 +1,307 @@
+"""Local cache of downloaded volumes for repeated restores.
+
+Every `restore --file` downloads and decrypts the volumes that hold the file,
+so restoring one file after the other from the same backup set downloads the
+same large volumes again and again. With the `volume_cache` section, restores
+and verifies read from a local `file://` mirror of the remote instead, which
+is populated on demand:
+
+* The files of the chain are listed on S3 and the volumes that the restore
+  needs are selected like duplicity does: the volumes of the sets up to the
+  `--time`, and with `--file` only those whose path range in the (local)
+  manifest contains the file.
+* Volumes that are not cached yet are downloaded into the cache, in
+  parallel. The manifests are always mirrored, as duplicity compares them
+  with the local ones.
+* A view of the remote is assembled for the run: links to the cached files,
+  and empty placeholders for the files the run does not read (other volumes,
+  signatures the local archive has), such that duplicity sees the complete
+  remote and keeps its archive directory.
+
+The cache is bounded by `max_size`; the least recently used files are evicted
+first. Concurrent runs are coordinated with a lock file: the files a run uses
+are pinned until the run ends, such that another run does not evict them.
+"""
+import codecs
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from duplicity_backup_s3.archive import SIGNATURE, VOLUME, backup_files
+from duplicity_backup_s3.defaults import STORAGE_PARALLEL
+from duplicity_backup_s3.storage import RemoteFile, download
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# eg. 'StartingPath   "home/a b" 3' or 'EndingPath     home/c'
+PATH_RE = re.compile(
+    rb'^\s*(StartingPath|EndingPath)\s+("(?:[^"\\]|\\.)*"|\S+)(?:\s+\d+)?\s*$'
+)
+VOLUME_RE = re.compile(rb"^Volume (\d+):")
+
+Index = Tuple[bytes, ...]
+
+
+def _index(path: bytes) -> Index:
+    """Parse a (quoted) path of a manifest into its index, `.` is the root."""
+    if path.startswith(b'"'):
+        path = codecs.escape_decode(path[1:-1])[0]
+    return () if path == b"." else tuple(path.split(b"/"))
+
+
+def volume_ranges(path: Path) -> Dict[int, Tuple[Index, Index]]:
+    """Read the path range of every volume from a (plain) manifest.
+
+    :return: the first and last path of each volume by its number, empty when
+        the manifest can not be read
+    """
+    ranges: Dict[int, List[Index]] = {}
+    try:
+        lines = path.read_bytes().splitlines()
+    except OSError:
+        return {}
+    volume = None
+    for line in lines:
+        match = VOLUME_RE.match(line)
+        if match is not None:
+            volume = int(match.group(1))
+            ranges[volume] = [(), ()]
+            continue
+        match = PATH_RE.match(line)
+        if match is not None and volume is not None:
+            position = 0 if match.group(1) == b"StartingPath" else 1
+            ranges[volume][position] = _index(match.group(2))
+    return {volume: (start, end) for volume, (start, end) in ranges.items()}
+
+
+def containing_volumes(path: Path, file: str) -> Optional[Set[int]]:
+    """Find the volumes of a set that hold a file or the files of a directory.
+
+    Mirrors `Manifest.get_containing_volumes` of duplicity.
+
+    :param path: the manifest of the set in the archive directory
+    :param file: the path relative to the backup root, as for `--file`
+    :return: the volume numbers, None when the manifest can not be read
+    """
+    ranges = volume_ranges(path)
+    if not ranges:
+        return None
+    prefix = tuple(os.fsencode(file.strip("/")).split(b"/")) if file.strip("/") else ()
+    return {
+        volume
+        for volume, (start, end) in ranges.items()
+        if start[: len(prefix)] <= prefix <= end
+    }
+
+
+def needed_files(
+    archive: Path, files: List[RemoteFile], volumes: List[RemoteFile], file: str = None
+) -> Set[str]:
+    """Select the remote files a restore reads, by their key.
+
+    :param archive: the archive directory of the chain
+    :param files: all files of the chain on the remote
+    :param volumes: the volumes of the sets to restore, see :func:`restore_files`
+    :param file: (optional) the file or directory to restore
+    """
+    local = {(f.set_key, f.kind) for f in backup_files(archive) if f.kind == SIGNATURE}
+    needed = {f.key for f in files if f.file.kind not in (VOLUME, SIGNATURE)}
+    needed.update(
+        f.key
+        for f in files
+        if f.file.kind == SIGNATURE and (f.file.set_key, f.file.kind) not in local
+    )
+    contained: Dict[tuple, Optional[Set[int]]] = {}
+    for volume in volumes:
+        set_key = volume.file.set_key
+        if file is not None and set_key not in contained:
+            type_, start, end = set_key
+            name = f"duplicity-{type_}."
+            if start is not None:
+                name += f"{start:%Y%m%dT%H%M%SZ}.to."
+            contained[set_key] = containing_volumes(
+                archive / f"{name}{end:%Y%m%dT%H%M%SZ}.manifest", file
+            )
+        numbers = contained.get(set_key)
+        if numbers is None or volume.file.volume in numbers:
+            needed.add(volume.key)
+    return needed
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class VolumeCache:
+    """
+    Size bounded cache of remote files with least recently used eviction.
+
+    The files of a remote are kept in a subdirectory per remote, with their
+    remote name. Their modification time is their last use.
+
+    :param directory: directory of the cache
+    :param max_size: bytes the cache may hold
+    """
+
+    LOCK = ".lock"
+    PINS = ".pins"
+
+    def __init__(self, directory: Path, max_size: int):
+        """Initiate the cache in its directory."""
+        self.directory = Path(directory)
+        self.max_size = max_size
+        (self.directory / self.PINS).mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """Hold the lock of the cache, exclusive across processes."""
+        with open(str(self.directory / self.LOCK), "a") as fd:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _pinned(self) -> Set[str]:
+        """Collect the files used by running processes, relative to the cache."""
+        pinned = set()
+        for pins in (self.directory / self.PINS).iterdir():
+            if not pins.name.isdigit() or not _alive(int(pins.name)):
+                pins.unlink()
+                continue
+            try:
+                pinned.update(json.loads(pins.read_text()))
+            except (OSError, ValueError):
+                continue
+        return pinned
+
+    def _entries(self) -> List[Tuple[float, int, Path]]:
+        """List the cached files as (last use, size, path), least recent first."""
+        entries = []
+        for path in self.directory.glob("*/*"):
+            if path.parent.name.startswith(".") or path.name.endswith(".part"):
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self, incoming: int = 0, keep: Iterable[Path] = ()) -> List[Path]:
+        """Evict the least recently used files to make room, with the lock held.
+
+        :param incoming: bytes about to be added
+        :param keep: files that are not evicted, besides the pinned ones
+        :return: the evicted files
+        """
+        entries = self._entries()
+        size = sum(entry_size for _, entry_size, _ in entries) + incoming
+        pinned = self._pinned().union(
+            str(path.relative_to(self.directory)) for path in keep
+        )
+        evicted = []
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            if str(path.relative_to(self.directory)) in pinned:
+                continue
+            path.unlink()
+            size -= entry_size
+            evicted.append(path)
+        return evicted
+
+    @contextmanager
+    def pin(self, names: Iterable[str]) -> Iterator[None]:
+        """Protect cached files from eviction while the context is active.
+
+        :param names: the files, relative to the cache directory
+        """
+        pins = self.directory / self.PINS / str(os.getpid())
+        with self.lock():
+            pinned = json.loads(pins.read_text()) if pins.exists() else []
+            pins.write_text(json.dumps(pinned + list(names)))
+        try:
+            yield
+        finally:
+            with self.lock():
+                pins.unlink()
+
+    def fetch(
+        self,
+        client,
+        bucket: str,
+        subdirectory: str,
+        files: List[RemoteFile],
+        parallel: int = STORAGE_PARALLEL,
+    ) -> Tuple[int, int]:
+        """Download the files that are not cached yet, in parallel.
+
+        Files only appear in the cache once complete, such that concurrent
+        runs never read a partial file.
+
+        :param subdirectory: the directory of the remote in the cache
+        :return: the number of cache hits and of downloaded files
+        :raises StorageError: when a download fails
+        """
+        directory = self.directory / subdirectory
+        directory.mkdir(parents=True, exist_ok=True)
+        missing, now = [], time.time()
+        for remote_file in files:
+            path = directory / remote_file.file.name
+            try:
+                os.utime(str(path), (now, now))
+            except FileNotFoundError:
+                missing.append(remote_file)
+
+        with self.lock():
+            self.evict(
+                sum(f.size for f in missing),
+                keep=[directory / f.file.name for f in files],
+            )
+
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            futures = [
+                pool.submit(download, client, bucket, f.key, directory / f.file.name)
+                for f in missing
+            ]
+            for future in futures:
+                future.result()
+        return len(files) - len(missing), len(missing)
+
+    def view(
+        self,
+        subdirectory: str,
+        files: List[RemoteFile],
+        needed: Set[str],
+        directory: Path,
+    ) -> None:
+        """Assemble the view of the remote for duplicity in a directory.
+
+        :param subdirectory: the directory of the remote in the cache
+        :param files: all files of the remote
+        :param needed: keys of the files the run reads, they must be cached
+        :param directory: empty directory for the view
+        """
+        for remote_file in files:
+            link = directory / remote_file.file.name
+            if remote_file.key in needed:
+                link.symlink_to(self.directory / subdirectory / remote_file.file.name)
+            else:
+                link.touch()
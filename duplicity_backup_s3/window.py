@@ -0,0 +1,113 @@
+"""Backup window during which a backup is allowed to run."""
+import re
+from datetime import datetime, time, timedelta
+from pathlib import Path
+from typing import Optional
+
+from duplicity_backup_s3.archive import partial_manifests
+
+TIME_RE = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)$")
+
+
+def parse_time(value: str) -> time:
+    """Parse a 'HH:MM' string to a time.
+
+    :raises ValueError: when the value is not formatted as 'HH:MM'.
+    """
+    match = TIME_RE.match(str(value).strip())
+    if not match:
+        raise ValueError(f"Could not parse '{value}' as a time, use 'HH:MM'")
+    return time(int(match.group(1)), int(match.group(2)))
+
+
+class BackupWindow:
+    """
+    Daily window of time, eg. from 01:00 to 05:00.
+
+    A window may wrap around midnight, eg. from 22:00 to 04:00. A window with
+    an equal start and end covers the whole day.
+    """
+
+    def __init__(self, start: time, end: time):
+        """Initiate the window with a start and end time of the day."""
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def from_config(cls, config: dict) -> "BackupWindow":
+        """Create the window from the configuration.
+
+        :param config: a dict with a `start` and `end`.
+        """
+        return cls(parse_time(config.get("start")), parse_time(config.get("end")))
+
+    @classmethod
+    def parse(cls, value: str) -> "BackupWindow":
+        """Create the window from a 'HH:MM-HH:MM' string (eg. an option)."""
+        start, end = value.replace("–", "-").split("-", 1)
+        return cls(parse_time(start), parse_time(end))
+
+    def __repr__(self):
+        return "<BackupWindow {:%H:%M}-{:%H:%M}>".format(self.start, self.end)
+
+    @property
+    def duration(self) -> timedelta:
+        """Length of the window."""
+        start = timedelta(hours=self.start.hour, minutes=self.start.minute)
+        end = timedelta(hours=self.end.hour, minutes=self.end.minute)
+        return (end - start) % timedelta(days=1) or timedelta(days=1)
+
+    def opens_at(self, moment: datetime) -> datetime:
+        """Latest opening of the window at or before `moment`."""
+        opening = datetime.combine(moment.date(), self.start)
+        if opening > moment:
+            opening -= timedelta(days=1)
+        return opening
+
+    def contains(self, moment: datetime) -> bool:
+        """Check if a moment falls within the window."""
+        return moment < self.opens_at(moment) + self.duration
+
+    def closes_at(self, moment: datetime) -> datetime:
+        """Return the closing of the window that contains `moment`, or of the next."""
+        if self.contains(moment):
+            return self.opens_at(moment) + self.duration
+        return self.next_opening(moment) + self.duration
+
+    def next_opening(self, moment: datetime) -> datetime:
+        """First opening of the window after `moment`."""
+        return self.opens_at(moment) + timedelta(days=1)
+
+
+class VolumeBoundary:
+    """
+    Detect that duplicity finished a volume.
+
+    Duplicity rewrites the partial manifest in its archive directory after
+    every volume it writes. Calling this object returns True once the partial
+    manifest changed since the first call, or when no backup is in progress.
+    """
+
+    def __init__(self, archive_dir: Path):
+        """Initiate with the archive directory of the backup."""
+        self.archive_dir = archive_dir
+        self._baseline = None  # type: Optional[float]
+        self._armed = False
+
+    def _latest_mtime(self) -> Optional[float]:
+        mtimes = []
+        for path in partial_manifests(self.archive_dir):
+            try:
+                mtimes.append(path.stat().st_mtime)
+            except OSError:
+                continue
+        return max(mtimes) if mtimes else None
+
+    def __call__(self) -> bool:
+        """Check if duplicity reached a volume boundary."""
+        mtime = self._latest_mtime()
+        if not self._armed:
+            self._armed = True
+            self._baseline = mtime
+            return mtime is None
+        return mtime != self._baseline
@@ -62,9 +62,11 @@ setup(
     description="Duplicity backup to S3 for production servers using simple yaml "
                 "config file.",
     entry_points={
-        "console_scripts": (
-            "duplicity_backup_s3 = duplicity_backup_s3.cli:duplicity_backup_s3"
-        )
+        "console_scripts": [
+            "duplicity_backup_s3 = duplicity_backup_s3.cli:duplicity_backup_s3",
+            "duplicity_backup_s3_freshness = "
+            "duplicity_backup_s3.commands.freshness:freshness",
+        ]
     },
     install_requires=requirements,
     license="Apache Software License 2.0",
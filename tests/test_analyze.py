@@ -0,0 +1,107 @@
+import io
+import struct
+import tarfile
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from duplicity_backup_s3.analyze import analyze, load_summaries
+
+
+def write_sigtar(path: Path, members):
+    with tarfile.open(str(path), "w:gz") as tar:
+        for name in members:
+            info = tarfile.TarInfo(name)
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b"sign"))
+
+
+def signature(size, block_len=512, strong_len=32):
+    """A librsync (BLAKE2) signature of a file of `size` bytes."""
+    blocks = -(-size // block_len)
+    header = struct.pack(">III", 0x72730137, block_len, strong_len)
+    return header + b"s" * (4 + strong_len) * blocks
+
+
+def write_signatures(path: Path, sizes):
+    with tarfile.open(str(path), "w:gz") as tar:
+        for name, size in sizes.items():
+            data = signature(size)
+            info = tarfile.TarInfo(f"signature/{name}")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+class TestAnalyze(TestCase):
+    def setUp(self):
+        self._tempdir = TemporaryDirectory()
+        root = Path(self._tempdir.name)
+        self.archive_dir, self.backuproot, self.cache_dir = (
+            root / "archive",
+            root / "backuproot",
+            root / "cache",
+        )
+        self.archive_dir.mkdir()
+        (self.backuproot / "app" / "logs").mkdir(parents=True)
+        (self.backuproot / "app" / "logs" / "app.log").write_bytes(b"x" * 1000)
+        (self.backuproot / "app" / "data.db-wal").write_bytes(b"x" * 500)
+        (self.backuproot / "app" / "report.pdf").write_bytes(b"x" * 100)
+
+        write_sigtar(
+            self.archive_dir / "duplicity-full-signatures.20230101T010000Z.sigtar.gz",
+            ["snapshot/app", "signature/app/logs/app.log", "signature/app/report.pdf"],
+        )
+        for day in range(2, 6):
+            members = ["signature/app/logs/app.log", "signature/app/data.db-wal"]
+            if day == 3:
+                members.append("signature/app/report.pdf")
+            write_sigtar(
+                self.archive_dir / f"duplicity-new-signatures.2023010{day - 1}T010000Z"
+                f".to.2023010{day}T010000Z.sigtar.gz",
+                members,
+            )
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def _summaries(self):
+        return load_summaries(
+            self.archive_dir, self.backuproot, "s3://test", cache_dir=self.cache_dir
+        )
+
+    def test_churn_and_excludes(self):
+        report = analyze(self._summaries(), churn_ratio=0.8)
+
+        self.assertEqual((report["fulls"], report["incrementals"]), (1, 4))
+        self.assertEqual(
+            [path for path, _, _ in report["churn_files"]],
+            ["app/logs/app.log", "app/data.db-wal"],
+        )
+        self.assertEqual(
+            dict(report["excludes"]), {"**/*.log": 1000.0, "**/*-wal": 500.0}
+        )
+        self.assertEqual(dict(report["churn_dirs"])["app/logs"], 1000.0)
+
+    def test_summaries_are_cached(self):
+        first = self._summaries()
+        # corrupt the signatures, the cached summaries must be used
+        for sigtar in self.archive_dir.iterdir():
+            sigtar.write_bytes(b"garbage")
+        self.assertEqual(self._summaries(), first)
+
+    def test_growth_from_the_signatures(self):
+        for sigtar in self.archive_dir.iterdir():
+            sigtar.unlink()
+        write_signatures(
+            self.archive_dir / "duplicity-full-signatures.20230101T010000Z.sigtar.gz",
+            {"app/db/data": 1024, "app/report.pdf": 512},
+        )
+        write_signatures(
+            self.archive_dir / "duplicity-full-signatures.20230108T010000Z.sigtar.gz",
+            {"app/db/data": 4096, "app/report.pdf": 512},
+        )
+
+        report = analyze(self._summaries())
+
+        # the file grew, it is the same on disk for both backups
+        self.assertEqual(report["growth"], [("app/db", 3072)])
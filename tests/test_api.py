@@ -0,0 +1,227 @@
+import asyncio
+import json
+import stat
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.api import AsyncDuplicityS3
+from duplicity_backup_s3.capabilities import Capabilities
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.results import error_lines
+from duplicity_backup_s3.runner import AsyncProcessRunner
+
+FAKE_DUPLICITY = """#!{python}
+import sys
+
+if sys.argv[1] == "incr":
+    print("--------------[ Backup Statistics ]--------------")
+    print("ElapsedTime 2.00 (2.00 seconds)")
+    print("TotalDestinationSizeChange 4000000 (3.81 MB)")
+    print("Errors 0")
+    print("-------------------------------------------------")
+else:
+    print("Error: bucket does not exist", file=sys.stderr)
+    sys.exit(23)
+"""
+
+
+class TestAsyncDuplicityS3(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tempdir = TemporaryDirectory()
+        binary = Path(self.tempdir.name) / "duplicity"
+        binary.write_text(FAKE_DUPLICITY.format(python=sys.executable))
+        binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+        patcher = mock.patch.object(
+            DuplicityS3, "duplicity_cmd", return_value=str(binary)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.tempdir.cleanup()
+
+    def backup(self, **options):
+        backup = AsyncDuplicityS3(**options)
+        backup._config = dict(
+            backuproot=self.tempdir.name,
+            remote=dict(uri="s3://bucket/path"),
+        )
+        backup._capabilities = Capabilities(path="duplicity", version=None, options=[])
+        return backup
+
+    def test_actions_run_concurrently_with_results(self):
+        incremental, status = self.loop.run_until_complete(
+            asyncio.gather(
+                self.backup(dry_run=True).incremental(),
+                self.backup().collection_status(),
+            )
+        )
+
+        self.assertTrue(incremental.succeeded)
+        self.assertEqual(incremental.action, "incr")
+        self.assertEqual(incremental.statistics["TotalDestinationSizeChange"], 4000000)
+        self.assertEqual(incremental.statistics["ElapsedTime"], 2.0)
+        self.assertEqual(incremental.errors, [])
+
+        self.assertFalse(status.succeeded)
+        self.assertEqual(status.returncode, 23)
+        self.assertEqual(status.action, "collection-status")
+        self.assertEqual(status.errors, ["Error: bucket does not exist"])
+        self.assertEqual(status.as_dict()["succeeded"], False)
+        json.dumps(status.as_dict())  # the resources are serialisable
+
+    def test_options_of_an_action_are_temporary(self):
+        received = []
+        backup = self.backup(output=received.append)
+        self.loop.run_until_complete(backup.list_current_files(time="1D"))
+
+        self.assertIn("--time", backup.last_run.command)
+        self.assertNotIn("time", backup.options)
+        self.assertIn("bucket does not exist", "".join(received))
+
+    def test_restore_stages_the_archived_volumes(self):
+        backup = self.backup()
+        backup._config["storage"] = dict(restore=dict(timeout=1))
+        with mock.patch.object(
+            AsyncDuplicityS3, "_stage_restore", autospec=True, return_value=False
+        ) as stage:
+            result = self.loop.run_until_complete(
+                backup.restore(self.tempdir.name, time="1D")
+            )
+
+        self.assertEqual(stage.call_args[0][0].options["time"], "1D")
+        self.assertEqual(result.returncode, 1)
+        self.assertIsNone(backup.last_run)
+
+    def test_restore_and_verify_read_through_the_volume_cache(self):
+        mirrored = []
+
+        @contextmanager
+        def volume_mirror(dupe, remote):
+            mirrored.append(remote)
+            yield "file:///cache/view", "chain"
+            mirrored.append("released")
+
+        backup = self.backup()
+        with mock.patch.object(AsyncDuplicityS3, "_volume_mirror", volume_mirror):
+            for action in (backup.restore(self.tempdir.name), backup.verify()):
+                self.loop.run_until_complete(action)
+                command = backup.last_run.command
+                self.assertEqual(command[command.index("--name") + 1], "chain")
+                self.assertIn("file:///cache/view", command)
+
+        self.assertEqual(mirrored, ["s3://bucket/path", "released"] * 2)
+
+    def test_restore_walks_the_policy_chains(self):
+        commands = []
+        run = AsyncDuplicityS3._run
+
+        async def recording_run(backup, cmd_args, *args, **kwargs):
+            commands.append(cmd_args)
+            return await run(backup, cmd_args, *args, **kwargs)
+
+        backup = self.backup()
+        backup._config["policies"] = [dict(name="media", extensions=["jpg"])]
+        with mock.patch(
+            "duplicity_backup_s3.duplicity_s3.CACHE_DIR", Path(self.tempdir.name)
+        ), mock.patch.object(AsyncDuplicityS3, "_run", recording_run):
+            result = self.loop.run_until_complete(backup.restore("target"))
+            self.assertEqual(result.returncode, 23)
+            self.assertEqual(
+                [cmd_args[-2] for cmd_args in commands],
+                ["s3://bucket/path", "s3://bucket/path/media"],
+            )
+            self.assertIn("--force", commands[1])
+
+            # a file starts with the chain it was routed to
+            backup._policies_dir.mkdir(parents=True)
+            (backup._policies_dir / "media.list").write_text(
+                str(Path(self.tempdir.name) / "home" / "a.jpg") + "\n"
+            )
+            commands.clear()
+            self.loop.run_until_complete(backup.restore("target", file="home/a.jpg"))
+            self.assertEqual(
+                [cmd_args[-2] for cmd_args in commands],
+                ["s3://bucket/path/media", "s3://bucket/path"],
+            )
+
+    def test_incremental_is_skipped_without_changes_in_the_journal(self):
+        backup = self.backup(dry_run=True)
+        with mock.patch.object(
+            AsyncDuplicityS3, "_journal_unchanged", autospec=True, return_value=True
+        ) as unchanged:
+            result = self.loop.run_until_complete(backup.incremental())
+            self.assertTrue(result.succeeded)
+            self.assertIn("No changes since the last backup", result.output[0])
+            self.assertIsNone(backup.last_run)
+
+            self.loop.run_until_complete(backup.incremental(ignore_journal=True))
+            self.assertTrue(unchanged.call_args[0][0].options["ignore_journal"])
+
+    def test_content_manifest_is_updated_and_verified(self):
+        backup = self.backup()
+        backup._config["checksums"] = {}
+        with mock.patch(
+            "duplicity_backup_s3.state.STATE_DIR", Path(self.tempdir.name) / "state"
+        ), mock.patch.object(
+            AsyncDuplicityS3, "_update_checksums", autospec=True
+        ) as update, mock.patch.object(
+            AsyncDuplicityS3, "_verify_checksums", autospec=True, return_value=1
+        ) as verify:
+            self.assertTrue(
+                self.loop.run_until_complete(backup.incremental()).succeeded
+            )
+            update.assert_called_once_with(backup)
+
+            result = self.loop.run_until_complete(
+                backup.verify(file="home", manifest=True)
+            )
+            self.assertEqual(result.returncode, 1)
+            self.assertEqual(verify.call_args[0][0].options["file"], "home")
+            self.assertEqual(backup.last_run.action, "incr")
+
+    def test_remove_older_without_action_raises(self):
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(self.backup().remove_older())
+
+
+class TestAsyncProcessRunner(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_cancelled_run_terminates_the_child(self):
+        runner = AsyncProcessRunner(
+            [sys.executable, "-c", "import time; time.sleep(60)"], grace_period=1
+        )
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(asyncio.wait_for(runner.run(), 0.5))
+
+        deadline = time.monotonic() + 5
+        while runner.process.returncode is None and time.monotonic() < deadline:
+            self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertIsNotNone(runner.process.returncode)
+
+
+class TestErrorLines(TestCase):
+    def test_error_lines(self):
+        self.assertEqual(
+            error_lines(["Reading globbing filelist", "Error: access denied\n"]),
+            ["Error: access denied"],
+        )
+        self.assertEqual(
+            error_lines(["botocore.exceptions.ClientError: denied"]),
+            ["botocore.exceptions.ClientError: denied"],
+        )
@@ -0,0 +1,190 @@
+import gzip
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.audit import audit, list_remote, read_inventory
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+
+FULL = "duplicity-full.20230501T000000Z"
+INC = "duplicity-inc.20230501T000000Z.to.20230502T000000Z"
+SIGNATURES = [
+    "duplicity-full-signatures.20230501T000000Z.sigtar.gpg",
+    "duplicity-new-signatures.20230501T000000Z.to.20230502T000000Z.sigtar.gpg",
+]
+
+
+def manifest(volumes):
+    return "Hostname host\nLocaldir /data\n" + "".join(
+        f"Volume {n}:\n    StartingPath   .\n    Hash SHA1 abc\n"
+        for n in range(1, volumes + 1)
+    )
+
+
+def remote_files(prefix="path/"):
+    """The files of a full backup with 3 volumes and an incremental with 1."""
+    names = [f"{FULL}.manifest.gpg", f"{INC}.manifest.gpg", *SIGNATURES]
+    names += [f"{FULL}.vol{n}.difftar.gpg" for n in (1, 2, 3)]
+    names += [f"{INC}.vol1.difftar.gpg"]
+    return {f"{prefix}{name}": 1000 for name in names}
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = dict(objects)  # key -> size
+        self.prefixes = []
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter, ContinuationToken=None):
+        self.prefixes.append(Prefix)
+        return dict(
+            Contents=[
+                dict(Key=key, Size=size, ETag=f'"etag-{size}"')
+                for key, size in sorted(self.objects.items())
+                if key.startswith(Prefix)
+            ],
+            IsTruncated=False,
+        )
+
+
+class TestAudit(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.archive = Path(self.tempdir.name) / "archive"
+        self.archive.mkdir()
+        (self.archive / f"{FULL}.manifest").write_text(manifest(3))
+        (self.archive / f"{INC}.manifest").write_text(manifest(1))
+
+    def listing(self, objects):
+        return list_remote(FakeS3(objects), "bucket", "path/")
+
+    def test_complete(self):
+        client = FakeS3({**remote_files(), "path/media/x": 1, "path/notes.txt": 1})
+        remote = list_remote(client, "bucket", "path/")
+
+        report = audit(self.archive, remote)
+
+        self.assertTrue(report.ok)
+        self.assertEqual((report.sets, report.files), (2, 8))
+        self.assertEqual(len(client.prefixes), 4)
+        self.assertEqual(remote[SIGNATURES[0]].etag, "etag-1000")
+
+    def test_missing_orphaned_and_unknown(self):
+        objects = remote_files()
+        del objects[f"path/{FULL}.vol2.difftar.gpg"]
+        del objects[f"path/{SIGNATURES[1]}"]
+        # an interrupted backup that was never resumed, and one still to resume
+        objects[
+            "path/duplicity-inc.20230502T000000Z.to.20230503T000000Z"
+            ".vol1.difftar.gpg"
+        ] = 10
+        objects[
+            "path/duplicity-inc.20230502T000000Z.to.20230504T000000Z"
+            ".vol1.difftar.gpg"
+        ] = 10
+        (
+            self.archive
+            / "duplicity-inc.20230502T000000Z.to.20230504T000000Z.manifest.part"
+        ).touch()
+        # a backup of another host with the same archive name
+        objects["path/duplicity-full.20230601T000000Z.manifest.gpg"] = 10
+        objects["path/duplicity-full.20230601T000000Z.vol1.difftar.gpg"] = 10
+
+        report = audit(self.archive, self.listing(objects))
+
+        self.assertFalse(report.ok)
+        self.assertEqual(
+            report.missing,
+            [
+                f"{FULL}.vol2.difftar",
+                "duplicity-new-signatures.20230501T000000Z.to.20230502T000000Z.sigtar",
+            ],
+        )
+        self.assertEqual(
+            report.orphaned,
+            [
+                "duplicity-inc.20230502T000000Z.to.20230503T000000Z.vol1.difftar.gpg",
+            ],
+        )
+        self.assertEqual(
+            report.unknown, ["duplicity-full.20230601T000000Z.manifest.gpg"]
+        )
+
+    def test_truncated_and_changed_since_the_last_audit(self):
+        objects = remote_files()
+        objects[f"path/{FULL}.vol1.difftar.gpg"] = 0
+        objects[f"path/{FULL}.vol2.difftar.gpg"] = 500
+        objects[f"path/{FULL}.vol3.difftar.gpg"] = 2000
+        baseline = {name: [1000, "etag-1000"] for name in self.listing(remote_files())}
+        baseline[f"{INC}.vol1.difftar.gpg"] = [1000, "etag-other"]
+
+        report = audit(self.archive, self.listing(objects), baseline)
+
+        self.assertEqual(
+            report.truncated,
+            [f"{FULL}.vol1.difftar.gpg", f"{FULL}.vol2.difftar.gpg"],
+        )
+        self.assertEqual(
+            report.changed, [f"{FULL}.vol3.difftar.gpg", f"{INC}.vol1.difftar.gpg"]
+        )
+
+    def test_read_inventory(self):
+        directory = Path(self.tempdir.name)
+        rows = [
+            f'"bucket","{key.replace("/", "%2F")}","{size}","2023-05-01","etag"\n'
+            for key, size in {**remote_files(), **remote_files("path/media/")}.items()
+        ]
+        rows.append('"other","path/duplicity-full.20230501T000000Z.manifest","1"\n')
+        with gzip.open(str(directory / "data.csv.gz"), "wt") as fd:
+            fd.writelines(rows)
+        (directory / "manifest.json").write_text(
+            json.dumps(
+                dict(
+                    fileFormat="CSV",
+                    fileSchema="Bucket, Key, Size, LastModifiedDate, ETag",
+                    files=[dict(key="inventory/bucket/data/data.csv.gz")],
+                )
+            )
+        )
+
+        found = read_inventory(
+            directory / "manifest.json",
+            [("bucket", "path/"), ("bucket", "path/media/")],
+        )
+
+        self.assertEqual(len(found["bucket", "path/"]), 8)
+        self.assertEqual(len(found["bucket", "path/media/"]), 8)
+        self.assertTrue(audit(self.archive, found["bucket", "path/"]).ok)
+
+
+class TestAuditCommand(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        archive = Path(self.tempdir.name) / "archive"
+        archive.mkdir()
+        (archive / f"{FULL}.manifest").write_text(manifest(3))
+        (archive / f"{INC}.manifest").write_text(manifest(1))
+        self.config = Path(self.tempdir.name) / "config.yaml"
+        self.config.write_text(
+            f"backuproot: {self.tempdir.name}\n"
+            "remote:\n  uri: s3+http://bucket/path\n"
+            f"extra_args: [--archive-dir, {self.tempdir.name}, --name, archive]\n"
+        )
+        patcher = mock.patch(
+            "duplicity_backup_s3.audit.CACHE_DIR", Path(self.tempdir.name)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_audit(self):
+        client = FakeS3(remote_files())
+        dupe = DuplicityS3(config=str(self.config))
+        with mock.patch.object(DuplicityS3, "_s3_client", return_value=client):
+            self.assertEqual(dupe.do_audit(), 0)
+            # a volume that shrank since the last audit
+            client.objects[f"path/{FULL}.vol1.difftar.gpg"] = 10
+            self.assertEqual(dupe.do_audit(), 1)
+            # and is reported until it is repaired
+            self.assertEqual(dupe.do_audit(), 1)
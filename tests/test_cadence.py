@@ -0,0 +1,204 @@
+import json
+import stat
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.cadence import (
+    Chain,
+    chain_length,
+    current_chain,
+    decide,
+    restore_time,
+    track,
+)
+from duplicity_backup_s3.capabilities import Capabilities
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.state import load_state, update_state
+
+NOW = datetime(2023, 6, 1, tzinfo=timezone.utc)
+
+# records its arguments and prints the statistics of a backup
+FAKE_DUPLICITY = """#!{python}
+import json
+import sys
+
+with open({calls!r}, "a") as fd:
+    fd.write(json.dumps(sys.argv[1:]) + "\\n")
+print("--------------[ Backup Statistics ]--------------")
+print("TotalDestinationSizeChange 5000000 (4.77 MB)")
+"""
+
+
+def stamp(days):
+    return (NOW - timedelta(days=days)).strftime("%Y%m%dT%H%M%SZ")
+
+
+def write_chain(path, full, incrementals, volumes=0):
+    """Write the manifests of a chain into an archive directory."""
+    manifest = "".join(f"Volume {n}:\n    StartingPath   .\n" for n in range(volumes))
+    (path / f"duplicity-full.{stamp(full)}.manifest").write_text(manifest)
+    previous = full
+    for inc in incrementals:
+        (path / f"duplicity-inc.{stamp(previous)}.to.{stamp(inc)}.manifest").touch()
+        previous = inc
+
+
+class TestCadence(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = Path(self.tempdir.name)
+
+    def test_chain_length(self):
+        self.assertEqual(chain_length(self.path), (None, 0))
+        write_chain(self.path, 40, [35, 30])
+        write_chain(self.path, 20, [15, 10, 5])
+        (self.path / f"duplicity-inc.{stamp(5)}.to.{stamp(1)}.manifest.part").touch()
+
+        self.assertEqual(chain_length(self.path), (NOW - timedelta(days=20), 3))
+
+    def test_current_chain_estimates_an_unmeasured_full(self):
+        write_chain(self.path, 20, [15], volumes=4)
+
+        chain = current_chain(self.path, None, volsize=200)
+        self.assertEqual(chain, Chain(NOW - timedelta(days=20), 1, 700_000_000, 0))
+        # the sizes tracked for an older chain do not apply
+        old = dict(full=(NOW - timedelta(days=40)).isoformat(), full_bytes=1)
+        self.assertEqual(current_chain(self.path, old, volsize=200), chain)
+
+    def test_track(self):
+        write_chain(self.path, 20, [])
+        full = NOW - timedelta(days=20)
+
+        tracked = track(self.path, None, 1000, full - timedelta(minutes=1))
+        self.assertEqual(
+            tracked, dict(full=full.isoformat(), full_bytes=1000, incremental_bytes=0)
+        )
+        write_chain(self.path, 20, [15])
+        tracked = track(self.path, tracked, 50, NOW)
+        tracked = track(self.path, tracked, None, NOW)
+        self.assertEqual(tracked["incremental_bytes"], 50)
+        self.assertEqual(
+            current_chain(self.path, tracked, volsize=200), Chain(full, 1, 1000, 50)
+        )
+        # a full backup resumed after the start of this run was only partially seen
+        write_chain(self.path, 10, [])
+        self.assertIsNone(track(self.path, tracked, 10, NOW)["full_bytes"])
+
+    def test_restore_time(self):
+        chain = Chain(NOW, 30, 9_000_000_000, 3_000_000_000)
+        self.assertEqual(restore_time(chain, 10_000_000), 1200 + 30 * 10)
+        self.assertIsNone(restore_time(chain, None))
+        self.assertIsNone(restore_time(chain._replace(full_bytes=None), 10_000_000))
+
+    def test_decide(self):
+        chain = Chain(NOW - timedelta(days=10), 30, 9_000_000_000, 3_000_000_000)
+
+        def full(settings, chain=chain, throughput=10_000_000):
+            return decide(settings, chain, throughput, NOW).full
+
+        self.assertTrue(full({}, chain=Chain(None, 0, None, 0)))
+        self.assertFalse(full({}))
+        self.assertTrue(full(dict(max_restore_time=20)))
+        self.assertFalse(full(dict(max_restore_time=30)))
+        self.assertFalse(full(dict(max_restore_time=20), throughput=None))
+        self.assertTrue(full(dict(max_incrementals=30)))
+        self.assertTrue(full(dict(max_incremental_ratio=0.3)))
+        self.assertFalse(full(dict(max_incremental_ratio=0.5)))
+        self.assertFalse(full(dict(max_incrementals=1, min_full_interval="2W")))
+
+        decision = decide(dict(max_restore_time=20), chain, 10_000_000, NOW)
+        self.assertEqual(
+            decision.reason,
+            "the estimated restore time of 25 minutes exceeds 20 minutes",
+        )
+
+
+class TestAdaptiveBackup(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.archive = Path(self.tempdir.name) / "archive"
+        self.archive.mkdir()
+        self.calls = Path(self.tempdir.name) / "calls"
+        binary = Path(self.tempdir.name) / "duplicity"
+        binary.write_text(
+            FAKE_DUPLICITY.format(python=sys.executable, calls=str(self.calls))
+        )
+        binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+        for patcher in (
+            mock.patch.object(DuplicityS3, "duplicity_cmd", return_value=str(binary)),
+            mock.patch(
+                "duplicity_backup_s3.state.STATE_DIR", Path(self.tempdir.name) / "state"
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def dupe(self, **settings):
+        dupe = DuplicityS3()
+        dupe._config = dict(
+            backuproot=self.tempdir.name,
+            remote=dict(uri="s3://bucket/path"),
+            full_if_older_than="7D",
+            adaptive_full=settings,
+            extra_args=["--archive-dir", self.tempdir.name, "--name", "archive"],
+        )
+        dupe._capabilities = Capabilities(path="duplicity", version=None, options=[])
+        return dupe
+
+    def action(self):
+        calls = [json.loads(line) for line in self.calls.read_text().splitlines()]
+        self.calls.unlink()
+        self.assertNotIn("--full-if-older-than", calls[-1])
+        return calls[-1][0]
+
+    def test_full_when_the_chain_is_too_long(self):
+        write_chain(self.archive, 20, [15, 10])
+        dupe = self.dupe(max_incrementals=4)
+
+        self.assertEqual(dupe.do_incremental(), 0)
+        self.assertEqual(self.action(), "incr")
+        write_chain(self.archive, 20, [15, 10, 5])
+        self.assertEqual(dupe.do_incremental(), 0)
+        self.assertEqual(self.action(), "incr")
+        chain = load_state("s3://bucket/path")["chain"]
+        self.assertEqual(chain["incremental_bytes"], 5_000_000)
+
+        write_chain(self.archive, 20, [15, 10, 5, 1])
+        self.assertEqual(dupe.do_incremental(), 0)
+        self.assertEqual(self.action(), "full")
+        self.assertEqual(load_state("s3://bucket/path")["runs"][-1]["action"], "full")
+
+    def test_restore_time_with_the_measured_throughput(self):
+        write_chain(self.archive, 20, [15, 10])
+        update_state(
+            "s3://bucket/path",
+            chain=dict(
+                full=(NOW - timedelta(days=20)).isoformat(),
+                full_bytes=9_000_000_000,
+                incremental_bytes=0,
+            ),
+            download_throughputs=[10.0, 100.0, 1.0],
+        )
+        dupe = self.dupe(max_restore_time=30, download_throughput=1000)
+        # 9 GB at the measured 10 MB/s
+        self.assertEqual(dupe._adaptive_full(load_state(dupe.remote_uri)).full, False)
+
+        dupe._config["adaptive_full"]["max_restore_time"] = 10
+        self.assertTrue(dupe._full_due())
+        self.assertEqual(dupe.do_incremental(), 0)
+        self.assertEqual(self.action(), "full")
+
+    def test_restore_measures_the_download_throughput(self):
+        write_chain(self.archive, 20, [], volumes=2)
+        dupe = self.dupe()
+        dupe.options["target"] = self.tempdir.name
+
+        self.assertEqual(dupe.do_restore(), 0)
+
+        (measured,) = load_state("s3://bucket/path")["download_throughputs"]
+        self.assertGreater(measured, 0)
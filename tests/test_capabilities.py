@@ -0,0 +1,72 @@
+import os
+import stat
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from duplicity_backup_s3.capabilities import parse_options, parse_version, probe
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+
+FAKE_DUPLICITY = """#!{python}
+import sys
+from pathlib import Path
+
+calls = Path(__file__).with_name("calls")
+calls.write_text(calls.read_text() + "x" if calls.exists() else "x")
+if "--version" in sys.argv:
+    print("duplicity 2.1.4")
+else:
+    print("  --s3-endpoint-url=URL  custom endpoint\\n  --concurrency=N\\n  --dry-run")
+"""
+
+
+class TestCapabilities(TestCase):
+    def test_parse_version_and_options(self):
+        self.assertEqual(parse_version("duplicity 0.7.19"), (0, 7, 19))
+        self.assertEqual(parse_version("duplicity v2.1.4"), (2, 1, 4))
+        self.assertIsNone(parse_version("command not found"))
+        self.assertEqual(
+            parse_options("  --s3-use-new-style\n  --volsize=VOLSIZE --no-encryption"),
+            ["--no-encryption", "--s3-use-new-style", "--volsize"],
+        )
+
+    def test_probe_is_cached_by_binary_mtime(self):
+        with TemporaryDirectory() as tempdir:
+            binary = Path(tempdir) / "duplicity"
+            binary.write_text(FAKE_DUPLICITY.format(python=sys.executable))
+            binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+            calls = Path(tempdir) / "calls"
+
+            capabilities = probe(str(binary), cache_dir=Path(tempdir))
+            self.assertEqual(capabilities.version, (2, 1, 4))
+            self.assertTrue(capabilities.supports("--s3-endpoint-url"))
+            self.assertFalse(capabilities.supports("--s3-use-new-style"))
+            self.assertEqual(calls.read_text(), "xx")
+
+            self.assertEqual(probe(str(binary), cache_dir=Path(tempdir)), capabilities)
+            self.assertEqual(calls.read_text(), "xx")
+
+            # an upgrade of duplicity invalidates the cache
+            os.utime(str(binary), ns=(0, 10**9))
+            probe(str(binary), cache_dir=Path(tempdir))
+            self.assertEqual(calls.read_text(), "xxxx")
+
+    def test_extend_args_uses_supported_options(self):
+        from duplicity_backup_s3.capabilities import Capabilities
+
+        dupe = DuplicityS3()
+        dupe._config = dict(
+            remote=dict(uri="s3://bucket/path", endpoint="https://s3.example.com")
+        )
+        dupe._capabilities = Capabilities(
+            path="duplicity",
+            version=(2, 1, 4),
+            options=["--s3-endpoint-url", "--concurrency"],
+        )
+        args = dupe._extend_args(["--s3-use-new-style"])
+
+        self.assertNotIn("--s3-use-new-style", args)
+        self.assertNotIn("--s3-european-buckets", args)
+        self.assertIn("--s3-endpoint-url", args)
+        self.assertIn("--concurrency", args)
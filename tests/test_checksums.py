@@ -0,0 +1,105 @@
+import hashlib
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.checksums import (
+    ChecksumError,
+    compare,
+    excluder,
+    generations,
+    hash_file,
+    load,
+    update,
+)
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+
+KEY = b"secret"
+
+
+class TestChecksums(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.root = Path(self.tempdir.name) / "root"
+        self.manifest = Path(self.tempdir.name) / "manifest"
+        for path, content in (("a.txt", "a"), ("dir/b.txt", "b" * 3000000)):
+            (self.root / path).parent.mkdir(parents=True, exist_ok=True)
+            (self.root / path).write_text(content)
+
+    def update(self, **kwargs):
+        return update(self.manifest, self.root, [self.root], key=KEY, **kwargs)
+
+    def test_hash_file(self):
+        self.assertEqual(
+            hash_file(str(self.root / "dir/b.txt")),
+            hashlib.blake2b(b"b" * 3000000, digest_size=32).hexdigest(),
+        )
+
+    def test_only_changed_entries_are_written(self):
+        self.assertEqual(self.update()["hashed"], 2)
+        self.assertEqual(self.update()["hashed"], 0)
+
+        (self.root / "a.txt").write_text("changed")
+        (self.root / "dir/b.txt").unlink()
+        (self.root / "c.txt").write_text("c")
+        result = self.update()
+        self.assertEqual((result["changed"], result["removed"]), (2, 1))
+        self.assertEqual(len(generations(self.manifest)), 3)
+        self.assertEqual(set(load(self.manifest, KEY)), {"a.txt", "c.txt"})
+
+        # compaction into a new full generation
+        self.update(max_deltas=2)
+        self.assertEqual(len(generations(self.manifest)), 1)
+        self.assertEqual(set(load(self.manifest, KEY)), {"a.txt", "c.txt"})
+
+    def test_tampered_manifest_is_detected(self):
+        self.update()
+        path = generations(self.manifest)[0]
+        path.write_bytes(path.read_bytes() + b"\0")
+        with self.assertRaises(ChecksumError):
+            load(self.manifest, KEY)
+
+    def test_compare_detects_drift_and_bitrot(self):
+        (self.root / "cache").mkdir()
+        (self.root / "cache/CACHEDIR.TAG").write_text("tag")
+        excluded = excluder(None, ["CACHEDIR.TAG"])
+        update(self.manifest, self.root, [self.root], excluded)
+        manifest = load(self.manifest)
+        self.assertEqual(set(manifest), {"a.txt", os.path.join("dir", "b.txt")})
+        self.assertTrue(compare(manifest, self.root, [self.root], excluded).clean)
+
+        # bitrot: other content, same size and modification time
+        bitrot = self.root / "dir/b.txt"
+        stat = bitrot.stat()
+        bitrot.write_text("c" * 3000000)
+        os.utime(str(bitrot), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        (self.root / "a.txt").write_text("drifted")
+        (self.root / "new.txt").write_text("new")
+
+        report = compare(manifest, self.root, [self.root], excluded, workers=2)
+        self.assertEqual(report.corrupt, [os.path.join("dir", "b.txt")])
+        self.assertEqual(report.modified, ["a.txt"])
+        self.assertEqual(report.new, ["new.txt"])
+        self.assertEqual(report.missing, [])
+
+
+class TestVerifyManifest(TestCase):
+    def test_verify_manifest(self):
+        with TemporaryDirectory() as tempdir:
+            root = Path(tempdir) / "root"
+            root.mkdir()
+            (root / "a.txt").write_text("a")
+            dupe = DuplicityS3(manifest=True)
+            dupe._config = dict(
+                backuproot=str(root),
+                remote=dict(uri="s3://bucket/path"),
+                checksums=dict(key="secret"),
+            )
+            with mock.patch("duplicity_backup_s3.checksums.STATE_DIR", Path(tempdir)):
+                self.assertEqual(dupe.do_verify(), 1)  # no manifest yet
+                dupe._update_checksums()
+                self.assertEqual(dupe.do_verify(), 0)
+                (root / "b.txt").write_text("b")
+                self.assertEqual(dupe.do_verify(), 1)
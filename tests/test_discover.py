@@ -0,0 +1,116 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import yaml
+
+from duplicity_backup_s3.cli import duplicity_backup_s3
+from duplicity_backup_s3.discover import CACHEDIR_TAG_SIGNATURE, discover
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from tests.test_base import TestSetup
+
+
+def make_tree(root: Path) -> None:
+    files = {
+        "app/node_modules/left-pad/index.js": "x" * 100,
+        "app/node_modules/left-pad/.cache/c": "x" * 10,
+        "app/src/__pycache__/main.cpython-36.pyc": "x" * 20,
+        "app/src/main.py": "x" * 30,
+        "venv/pyvenv.cfg": "home = /usr/bin",
+        "venv/lib/site.py": "x" * 50,
+        "build/CACHEDIR.TAG": CACHEDIR_TAG_SIGNATURE.decode(),
+        "build/obj.o": "x" * 40,
+        "fake/CACHEDIR.TAG": "not a cache directory",
+    }
+    for path, content in files.items():
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text(content)
+
+
+class TestDiscover(TestCase):
+    def test_discover(self):
+        with TemporaryDirectory() as tempdir:
+            make_tree(Path(tempdir))
+            findings = {
+                f.detector.rule: f for f in discover([Path(tempdir)], workers=2)
+            }
+
+            self.assertEqual(
+                set(findings),
+                {"**/node_modules", "**/__pycache__", "pyvenv.cfg", "CACHEDIR.TAG"},
+            )
+            # the cache inside node_modules is counted once, for node_modules
+            self.assertEqual(findings["**/node_modules"].bytes, 110)
+            self.assertEqual(findings["**/node_modules"].files, 2)
+            self.assertEqual(findings["**/__pycache__"].bytes, 20)
+            self.assertEqual(findings["CACHEDIR.TAG"].files, 2)
+            self.assertEqual(
+                findings["pyvenv.cfg"].examples, [str(Path(tempdir) / "venv")]
+            )
+
+    def test_write_the_rules_to_the_config(self):
+        with TemporaryDirectory() as tempdir:
+            root = Path(tempdir) / "root"
+            make_tree(root)
+            config = Path(tempdir) / "config.yaml"
+            config.write_text(
+                f"backuproot: {root}\nremote:\n  uri: s3://bucket/path\n"
+                "excludes:\n  - '**/__pycache__'\n"
+            )
+
+            dupe = DuplicityS3(config=str(config), write=True, only=("CACHEDIR.TAG",))
+            self.assertEqual(dupe.do_discover_excludes(), 0)
+
+            written = yaml.safe_load(config.read_text())
+            self.assertEqual(written["excludes"], ["**/__pycache__"])
+            self.assertEqual(written["exclude_if_present"], ["CACHEDIR.TAG"])
+            self.assertTrue((Path(tempdir) / "config.yaml.backup").exists())
+            self.assertIn(
+                "--exclude-if-present=CACHEDIR.TAG", dupe._incremental_command(None)
+            )
+
+    def test_discovered_excludes_precede_the_includes(self):
+        with TemporaryDirectory() as tempdir:
+            root = Path(tempdir) / "root"
+            make_tree(root)
+            config = Path(tempdir) / "config.yaml"
+            config.write_text(
+                f"backuproot: {root}\nremote:\n  uri: s3://bucket/path\n"
+                f"includes:\n  - {root / 'app'}\n"
+                "excludes:\n  - '**/__pycache__'\n  - '**'\n"
+            )
+
+            dupe = DuplicityS3(config=str(config), write=True)
+            self.assertEqual(dupe.do_discover_excludes(), 0)
+
+            written = yaml.safe_load(config.read_text())
+            # an exclude after the includes has no effect below them
+            self.assertEqual(
+                written["discovered_excludes"], ["**/node_modules", "**/__pycache__"]
+            )
+            self.assertEqual(written["excludes"], ["**/__pycache__", "**"])
+            args = dupe._incremental_command(written["includes"])
+            include = args.index(f"--include={root / 'app'}")
+            self.assertLess(args.index("--exclude=**/node_modules"), include)
+            self.assertLess(args.index("--exclude=**/__pycache__"), include)
+            self.assertTrue(dupe._excluded()(str(root / "app/src/__pycache__")))
+
+
+class TestDiscoverCommand(TestSetup):
+    def test_discover_excludes_command(self):
+        with TemporaryDirectory() as tempdir:
+            root = Path(tempdir) / "root"
+            make_tree(root)
+            config = Path(tempdir) / "config.yaml"
+            config.write_text(f"backuproot: {root}\nremote:\n  uri: s3://bucket/path\n")
+
+            result = self.runner.invoke(
+                duplicity_backup_s3,
+                ["discover-excludes", "-c", str(config), "--write"],
+            )
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("**/node_modules", result.output)
+            self.assertIn("--exclude-if-present pyvenv.cfg", result.output)
+            # DRY_RUN is set, the config is not changed
+            self.assertIn("Would add", result.output)
+            self.assertNotIn("excludes", config.read_text())
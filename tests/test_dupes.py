@@ -0,0 +1,116 @@
+import json
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.checksums import excluder
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.dupes import (
+    exclude_pattern,
+    external_sort,
+    find_duplicates,
+    hash_file,
+    summarize,
+)
+
+
+class TestDupes(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = Path(self.tempdir.name)
+        self.media, self.releases = self.path / "media", self.path / "releases"
+        for directory in (self.media, self.releases, self.media / "copies"):
+            directory.mkdir()
+        (self.media / "a.mp4").write_bytes(b"a" * 1000)
+        (self.media / "copies" / "a [1].mp4").write_bytes(b"a" * 1000)
+        (self.releases / "a.tar").write_bytes(b"a" * 1000)
+        # same size, other content
+        (self.releases / "b.tar").write_bytes(b"b" * 1000)
+        (self.releases / "unique.tar").write_bytes(b"u" * 500)
+        # a hard link is stored again by duplicity
+        os.link(str(self.releases / "b.tar"), str(self.releases / "b-link.tar"))
+        (self.releases / "small").write_bytes(b"s")
+        (self.media / "small").write_bytes(b"s")
+
+    def find(self, **kwargs):
+        return list(
+            find_duplicates(
+                [self.media, self.releases],
+                excluder(None, None),
+                self.path / "tmp",
+                min_size=10,
+                sort_buffer=2,
+                **kwargs,
+            )
+        )
+
+    def test_external_sort(self):
+        records = [[3, "c"], [1, "a"], [2, "b"], [1, "0"], [5, "e"]]
+        self.assertEqual(
+            list(external_sort(records, self.path / "runs", buffer=2)),
+            sorted(records),
+        )
+        self.assertEqual(len(list((self.path / "runs").iterdir())), 3)
+
+    def test_hash_file(self):
+        self.assertEqual(
+            hash_file(str(self.media / "a.mp4")),
+            hash_file(str(self.releases / "a.tar")),
+        )
+        (self.path / "empty").touch()
+        self.assertIsNone(hash_file(str(self.path / "empty")))
+        self.assertIsNone(hash_file(str(self.path / "missing")))
+
+    def test_find_duplicates(self):
+        groups = self.find(workers=2)
+
+        self.assertEqual(
+            sorted(sorted(Path(f.path).name for f in group.files) for group in groups),
+            [["a [1].mp4", "a.mp4", "a.tar"], ["b-link.tar", "b.tar"]],
+        )
+        duplicates, count = summarize(groups, [self.media, self.releases])
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            [(d.files, d.bytes) for d in duplicates], [(1, 1000), (2, 2000)]
+        )
+
+    def test_exclude_pattern(self):
+        self.assertEqual(exclude_pattern("/media/a [1]*.mp4"), "/media/a [[]1][*].mp4")
+
+
+class TestDupesCommand(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        root = Path(self.tempdir.name)
+        (root / "a").write_bytes(b"x" * 2048)
+        (root / "b").write_bytes(b"x" * 2048)
+
+    def dupe(self, **options):
+        dupe = DuplicityS3(**options)
+        dupe._config = dict(
+            backuproot=self.tempdir.name, remote=dict(uri="s3://bucket/path")
+        )
+        return dupe
+
+    def test_report_and_proposals(self):
+        with mock.patch("builtins.print") as output:
+            self.assertEqual(self.dupe(min_size=0, json=True).do_dupes(), 0)
+        report = json.loads(output.call_args[0][0])
+        self.assertEqual((report["groups"], report["files"]), (1, 1))
+        self.assertEqual(report["roots"][0]["bytes"], 2048)
+
+        with mock.patch("builtins.print") as output:
+            self.assertEqual(self.dupe(min_size=0, propose="hardlinks").do_dupes(), 0)
+        self.assertEqual(
+            output.call_args_list[0][0][0],
+            f"ln -f -- {self.tempdir.name}/a {self.tempdir.name}/b",
+        )
+
+        # the proposals would end up in the middle of the json
+        with mock.patch("builtins.print") as output:
+            dupe = self.dupe(min_size=0, propose="excludes", json=True)
+            self.assertEqual(dupe.do_dupes(), 2)
+        output.assert_not_called()
@@ -45,6 +45,14 @@ class TestDuplicity_s3(TestSetup):
             f"Results of the run were: \n---\n{result}\n---",
         )
 
+    def test_remove_without_action(self):
+        cfg_file = Path(
+            Path(__file__).parent / "files" / "duplicity_backup_s3.tests.yaml"
+        )
+        result = self.runner.invoke(duplicity_backup_s3, f"remove --config={cfg_file}")
+        self.assertEqual(result.exit_code, 2, result.output)
+        self.assertIn("Please provide a remove action", result.output)
+
 
 class TestNonCLI(TestCase):
     def test_duplicity(self):
@@ -0,0 +1,86 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.cli import duplicity_backup_s3
+from duplicity_backup_s3.freshness import (
+    CRITICAL,
+    OK,
+    UNKNOWN,
+    WARNING,
+    check_freshness,
+)
+from duplicity_backup_s3.state import update_state
+from tests.test_base import TestSetup
+
+REMOTE = "s3://host/bucket/path"
+
+
+class TestCheckFreshness(TestCase):
+    def test_status_by_age(self):
+        with TemporaryDirectory() as state_dir:
+            state_dir = Path(state_dir)
+            result = check_freshness(REMOTE, 3600, 7200, state_dir=state_dir)
+            self.assertEqual(result.status, UNKNOWN)
+            self.assertIn("no successful backup", result.message)
+
+            update_state(REMOTE, state_dir, last_success=1000.0)
+            for now, status in ((1000, OK), (4600, WARNING), (8200, CRITICAL)):
+                with self.subTest(now=now):
+                    result = check_freshness(
+                        REMOTE, 3600, 7200, now=now, state_dir=state_dir
+                    )
+                    self.assertEqual(result.status, status)
+
+            self.assertEqual(
+                result.message,
+                f"FRESHNESS CRITICAL - last successful backup of {REMOTE} "
+                "2.0 hours ago | age=7200s;3600;7200",
+            )
+            self.assertIn(
+                'duplicity_backup_s3_last_success_timestamp_seconds{remote="'
+                f'{REMOTE}"}} 1000',
+                result.metrics(),
+            )
+
+    def test_does_not_import_duplicity_modules(self):
+        modules = subprocess.check_output(
+            [
+                sys.executable,
+                "-c",
+                "import sys, duplicity_backup_s3.commands.freshness; "
+                "print(sorted(sys.modules))",
+            ],
+            universal_newlines=True,
+        )
+        self.assertNotIn("duplicity_backup_s3.duplicity_s3", modules)
+        self.assertNotIn("cerberus", modules)
+
+
+class TestFreshnessCommand(TestSetup):
+    def test_exit_codes(self):
+        with TemporaryDirectory() as tempdir:
+            config = Path(tempdir) / "config.yaml"
+            config.write_text(f"remote:\n  uri: {REMOTE}\n")
+            args = ["freshness", "--config", str(config), "--warning", "1"]
+            with mock.patch("duplicity_backup_s3.state.STATE_DIR", Path(tempdir)):
+                result = self.runner.invoke(duplicity_backup_s3, args)
+                self.assertEqual(result.exit_code, UNKNOWN, result.output)
+
+                update_state(REMOTE, last_success=time.time())
+                result = self.runner.invoke(duplicity_backup_s3, args)
+                self.assertEqual(result.exit_code, OK, result.output)
+                self.assertTrue(result.output.startswith("FRESHNESS OK"))
+
+                update_state(REMOTE, last_success=time.time() - 7200)
+                result = self.runner.invoke(duplicity_backup_s3, args)
+                self.assertEqual(result.exit_code, WARNING, result.output)
+
+            result = self.runner.invoke(
+                duplicity_backup_s3,
+                ["freshness", "--config", str(Path(tempdir) / "missing.yaml")],
+            )
+            self.assertEqual(result.exit_code, UNKNOWN, result.output)
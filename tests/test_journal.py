@@ -0,0 +1,162 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.archive import TIME_FORMAT, parse_interval
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.journal import (
+    FLUSH_SIGNAL,
+    IN_Q_OVERFLOW,
+    JOURNAL_VERSION,
+    Event,
+    Watcher,
+    journal_path,
+    pending_changes,
+    request_flush,
+)
+from duplicity_backup_s3.state import update_state
+
+REMOTE = "s3://bucket/path"
+
+
+def write_journal(state_dir: Path, **changes) -> None:
+    now = time.time()
+    journal = dict(
+        version=JOURNAL_VERSION,
+        pid=os.getpid(),
+        since=now - 3600,
+        updated=now,
+        interval=10,
+        complete=True,
+        dirty={},
+    )
+    journal.update(changes)
+    journal_path(REMOTE, state_dir).write_text(json.dumps(journal))
+
+
+class TestPendingChanges(TestCase):
+    def test_parse_interval(self):
+        self.assertEqual(parse_interval("7D"), timedelta(days=7))
+        self.assertEqual(parse_interval("1h30m"), timedelta(minutes=90))
+        self.assertIsNone(parse_interval("2023-01-05"))
+
+    def test_journal_is_only_trusted_when_complete_and_current(self):
+        with TemporaryDirectory() as tempdir:
+            state_dir, now = Path(tempdir), time.time()
+            self.assertIsNone(pending_changes(REMOTE, now - 60, state_dir))
+
+            write_journal(
+                state_dir, dirty={"/a": [2, 300, now - 10], "/b": [1, 5, now - 120]}
+            )
+            # changes from before the checkpoint were in the last backup
+            self.assertEqual(pending_changes(REMOTE, now - 60, state_dir), (1, 2, 300))
+            # no successful backup since the watcher started
+            self.assertIsNone(pending_changes(REMOTE, now - 7200, state_dir))
+            self.assertIsNone(pending_changes(REMOTE, None, state_dir))
+
+            write_journal(state_dir, updated=now - 600)
+            self.assertIsNone(pending_changes(REMOTE, now - 60, state_dir))
+            write_journal(state_dir, complete=False)
+            self.assertIsNone(pending_changes(REMOTE, now - 60, state_dir))
+            # written before the backup started, later changes may be missing
+            write_journal(state_dir, updated=now - 1)
+            self.assertIsNone(
+                pending_changes(REMOTE, now - 60, state_dir, fresh_since=now)
+            )
+
+
+class TestWatcher(TestCase):
+    def test_watcher_journals_changes_and_resets_on_overflow(self):
+        with TemporaryDirectory() as tempdir:
+            root, state_dir = Path(tempdir) / "root", Path(tempdir) / "state"
+            (root / "docs").mkdir(parents=True)
+            watcher = Watcher(REMOTE, [root], state_dir=state_dir).start()
+            self.addCleanup(watcher.close)
+            update_state(REMOTE, state_dir, journal_checkpoint=time.time())
+
+            (root / "docs" / "report.txt").write_text("x" * 100)
+            (root / "new" / "deeper").mkdir(parents=True)
+            (root / "new" / "deeper" / "data.bin").write_bytes(b"x" * 50)
+            while watcher.poll(0.2):
+                pass
+
+            pending = watcher.flush()
+            self.assertEqual(watcher.watches, 4)
+            self.assertEqual(pending.bytes, 150)
+            journal = json.loads(journal_path(REMOTE, state_dir).read_text())
+            self.assertEqual(journal["dirty"][str(root / "docs")][:2], [1, 100])
+
+            since = watcher.since
+            watcher.handle(Event(-1, IN_Q_OVERFLOW, 0, ""))
+            self.assertGreaterEqual(watcher.since, since)
+            self.assertEqual(watcher.resets, 1)
+            self.assertEqual(watcher.flush().files, 0)
+
+    def test_watcher_flushes_on_request(self):
+        with TemporaryDirectory() as tempdir:
+            root, state_dir = Path(tempdir) / "root", Path(tempdir) / "state"
+            root.mkdir()
+            watcher = Watcher(REMOTE, [root], flush_interval=60, state_dir=state_dir)
+            watcher.start()
+            self.addCleanup(watcher.close)
+            # without a watcher to answer, the request times out
+            self.assertFalse(request_flush(REMOTE, state_dir, timeout=0.2))
+
+            requested = time.time()
+            os.kill(os.getpid(), FLUSH_SIGNAL)
+            watcher.run(
+                stop=lambda: json.loads(journal_path(REMOTE, state_dir).read_text())[
+                    "updated"
+                ]
+                >= requested
+            )
+            self.assertLess(time.time() - requested, 30)
+
+
+class TestIncrementalJournal(TestCase):
+    def test_unchanged_backup_is_skipped(self):
+        with TemporaryDirectory() as tempdir:
+            state_dir, archive = Path(tempdir) / "state", Path(tempdir) / "archive"
+            state_dir.mkdir()
+            archive.mkdir()
+            full = datetime.now(timezone.utc) - timedelta(days=1)
+            (archive / f"duplicity-full.{full:{TIME_FORMAT}}.manifest").touch()
+            update_state(REMOTE, state_dir, journal_checkpoint=time.time() - 60)
+            write_journal(state_dir)
+
+            dupe = DuplicityS3(dry_run=True)
+            dupe._config = dict(
+                backuproot=tempdir, remote=dict(uri=REMOTE), journal=dict()
+            )
+            with mock.patch(
+                "duplicity_backup_s3.state.STATE_DIR", state_dir
+            ), mock.patch(
+                "duplicity_backup_s3.journal.STATE_DIR", state_dir
+            ), mock.patch.object(
+                DuplicityS3, "archive_dir", new_callable=mock.PropertyMock
+            ) as archive_dir, mock.patch.object(
+                DuplicityS3, "_execute"
+            ) as execute, mock.patch(
+                "duplicity_backup_s3.journal.request_flush",
+                side_effect=lambda *args: write_journal(state_dir),
+            ) as flush:
+                archive_dir.return_value = archive
+                self.assertEqual(dupe.do_incremental(), 0)
+                execute.assert_not_called()
+
+                # the watcher did not write the journal since the request
+                flush.side_effect = None
+                flush.return_value = False
+                execute.return_value = 1
+                self.assertEqual(dupe.do_incremental(), 1)
+                execute.assert_called_once()
+
+                # a full backup is due
+                flush.side_effect = lambda *args: write_journal(state_dir)
+                dupe._config["full_if_older_than"] = "12h"
+                self.assertEqual(dupe.do_incremental(), 1)
+                self.assertEqual(execute.call_count, 2)
@@ -0,0 +1,95 @@
+import random
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from duplicity_backup_s3.cli import duplicity_backup_s3
+from duplicity_backup_s3.listing import (
+    ADDED,
+    MODIFIED,
+    REMOVED,
+    Entry,
+    diff_entries,
+    parse_listing,
+    sort_entries,
+)
+from tests.test_base import TestSetup
+
+OLD_LISTING = """Last full backup date: Thu Jan  5 10:00:00 2023
+Thu Jan  5 10:00:00 2023 .
+Thu Jan  5 10:00:00 2023 etc
+Thu Jan  5 10:00:00 2023 etc/hosts
+Thu Jan  5 10:00:00 2023 var/log/syslog
+Thu Jan  5 10:00:00 2023 var/old
+"""
+
+NEW_LISTING = """Last full backup date: Thu Jan  5 10:00:00 2023
+Thu Jan  5 10:00:00 2023 .
+Thu Jan  5 10:00:00 2023 etc
+Thu Jan  5 10:00:00 2023 etc/hosts
+Thu Jan 12 10:00:00 2023 var/log/syslog
+Thu Jan 12 10:00:00 2023 var/new
+"""
+
+
+class TestListing(TestCase):
+    def test_parse_listing_skips_header_and_filters_prefix(self):
+        entries = list(parse_listing(OLD_LISTING.splitlines(), prefix="var/"))
+        self.assertEqual(
+            entries,
+            [
+                Entry("var/log/syslog", "Thu Jan  5 10:00:00 2023"),
+                Entry("var/old", "Thu Jan  5 10:00:00 2023"),
+            ],
+        )
+
+    def test_parse_listing_prefix_matches_whole_components(self):
+        lines = [
+            "Thu Jan  5 10:00:00 2023 var",
+            "Thu Jan  5 10:00:00 2023 var/log",
+            "Thu Jan  5 10:00:00 2023 variable",
+            "Thu Jan  5 10:00:00 2023 variable/data",
+        ]
+        for prefix in ("var", "var/"):
+            with self.subTest(prefix=prefix):
+                entries = parse_listing(lines, prefix=prefix)
+                self.assertEqual([e.path for e in entries], ["var", "var/log"])
+
+    def test_sort_entries_spills_chunks(self):
+        entries = [Entry(f"dir/file{i:05d}", "mtime") for i in range(1000)]
+        shuffled = list(entries)
+        random.shuffle(shuffled)
+
+        self.assertEqual(list(sort_entries(shuffled, chunk_size=64)), entries)
+
+    def test_diff_entries(self):
+        old = sort_entries(parse_listing(OLD_LISTING.splitlines()))
+        new = sort_entries(parse_listing(NEW_LISTING.splitlines()))
+
+        self.assertEqual(
+            [(status, entry.path) for status, entry in diff_entries(old, new)],
+            [(MODIFIED, "var/log/syslog"), (ADDED, "var/new"), (REMOVED, "var/old")],
+        )
+
+
+class TestCommandDiff(TestSetup):
+    def test_diff_from_local_index(self):
+        cfg_file = Path(__file__).parent / "files" / "duplicity_backup_s3.tests.yaml"
+        with TemporaryDirectory() as tempdir:
+            old, new = Path(tempdir) / "old.txt", Path(tempdir) / "new.txt"
+            old.write_text(OLD_LISTING)
+            new.write_text(NEW_LISTING)
+            result = self.runner.invoke(
+                duplicity_backup_s3,
+                [
+                    "diff",
+                    f"--config={cfg_file}",
+                    f"--from-index={old}",
+                    f"--to-index={new}",
+                    "--prefix=var/",
+                ],
+            )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(
+            result.output.splitlines(), ["M var/log/syslog", "A var/new", "D var/old"]
+        )
@@ -0,0 +1,115 @@
+import gzip
+import os
+import stat
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.capabilities import Capabilities
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.logcapture import RotatingLog, log_files
+
+
+def read_log(directory: Path, stem: str) -> str:
+    """Content of a log, including the rotated parts."""
+    rotated = sorted(
+        directory.glob(f"{stem}.*.log.gz"), key=lambda p: int(p.name.split(".")[1])
+    )
+    content = b"".join(gzip.open(str(path)).read() for path in rotated)
+    return (content + (directory / f"{stem}.log").read_bytes()).decode()
+
+
+class TestRotatingLog(TestCase):
+    def test_rotation_and_compression(self):
+        with TemporaryDirectory() as tempdir:
+            lines = [f"line {i}\n" for i in range(100)]
+            with RotatingLog(Path(tempdir), max_size=100) as log:
+                for line in lines:
+                    log.write(line)
+
+            self.assertGreater(len(list(Path(tempdir).glob("*.log.gz"))), 5)
+            self.assertEqual(read_log(Path(tempdir), log.stem), "".join(lines))
+            self.assertEqual(log.dropped, 0)
+
+    def test_output_is_dropped_when_the_writer_falls_behind(self):
+        with TemporaryDirectory() as tempdir:
+            log = RotatingLog(Path(tempdir), buffer_size=100)
+            # the writer is not started yet, so nothing is written to disk
+            for i in range(10):
+                log.write(f"{i}" * 50)
+            self.assertEqual(log.dropped, 400)
+
+            log.open()
+            log.close()
+            content = log.path.read_text()
+            self.assertIn("[... 400 bytes of output dropped ...]", content)
+            self.assertTrue(content.endswith("8" * 50 + "9" * 50))
+
+    def test_old_logs_are_removed(self):
+        with TemporaryDirectory() as tempdir:
+            for i in range(5):
+                old = Path(tempdir) / f"duplicity_backup_s3-2023010{i}T010000.log"
+                old.write_text("old")
+                os.utime(str(old), (i, i))
+
+            with RotatingLog(Path(tempdir), keep=3) as log:
+                log.write("new")
+
+            files = log_files(Path(tempdir))
+            self.assertEqual(len(files), 3)
+            self.assertEqual(files[-1], log.path)
+
+    def test_concurrent_logs_of_profiles(self):
+        with TemporaryDirectory() as tempdir:
+            directory = Path(tempdir)
+            other = directory / "duplicity_backup_s3-other-20230101T010000000000-1.log"
+            other.write_text("other profile")
+            os.utime(str(other), (0, 0))
+
+            first = RotatingLog(directory, key="profile").open()
+            second = RotatingLog(directory, keep=1, key="profile").open()
+            self.assertNotEqual(first.path, second.path)
+            # a rotated file of the same name is not overwritten
+            taken = directory / f"{first.stem}.1.log.gz"
+            taken.write_bytes(gzip.compress(b"taken"))
+            first.max_size = 1
+            first.write("rotated")
+            first.close()
+            self.assertEqual(gzip.open(str(taken)).read(), b"taken")
+            self.assertTrue((directory / f"{first.stem}.2.log.gz").exists())
+
+            second.close()
+            self.assertTrue(other.exists())
+            self.assertEqual(
+                len(log_files(directory, "duplicity_backup_s3-profile")), 1
+            )
+
+
+class TestExecuteLog(TestCase):
+    def test_output_of_duplicity_is_logged(self):
+        with TemporaryDirectory() as tempdir:
+            binary = Path(tempdir) / "duplicity"
+            binary.write_text(
+                f"#!{sys.executable}\nimport sys\n"
+                "print('Error: collection not found')\nsys.exit(1)\n"
+            )
+            binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+
+            dupe = DuplicityS3()
+            dupe._config = {
+                "remote": dict(uri="s3://bucket/path"),
+                "log-path": str(Path(tempdir) / "logs"),
+            }
+            dupe._capabilities = Capabilities(
+                path="duplicity", version=None, options=[]
+            )
+            with mock.patch.object(
+                DuplicityS3, "duplicity_cmd", return_value=str(binary)
+            ):
+                self.assertEqual(dupe.do_collection_status(), 1)
+
+            log_path = Path(dupe.last_run.log_path)
+            self.assertEqual(log_path.parent, Path(tempdir) / "logs")
+            self.assertEqual(log_path.read_text(), "Error: collection not found\n")
+            self.assertEqual(dupe.last_run.errors, ["Error: collection not found"])
@@ -0,0 +1,159 @@
+import json
+import os
+import stat
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.capabilities import Capabilities
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.pagecache import (
+    PageCacheUsage,
+    drop_files,
+    read_meminfo,
+    usage,
+)
+from duplicity_backup_s3.state import load_state, update_state
+
+MEMINFO = """MemTotal:       16000000 kB
+Cached:          4000000 kB
+Active(file):    2000000 kB
+Inactive(file):  1500000 kB
+"""
+
+# records its arguments
+FAKE_DUPLICITY = """#!{python}
+import json
+import sys
+
+with open({calls!r}, "a") as fd:
+    fd.write(json.dumps(sys.argv) + "\\n")
+"""
+
+# records that it ran and runs its command, like the `nocache` helper
+FAKE_NOCACHE = """#!{python}
+import json
+import os
+import sys
+
+with open({calls!r}, "a") as fd:
+    fd.write(json.dumps(["nocache"]) + "\\n")
+os.execv(sys.argv[1], sys.argv[1:])
+"""
+
+
+def script(path, template, **kwargs):
+    path.write_text(template.format(python=sys.executable, **kwargs))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+class TestPageCache(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = Path(self.tempdir.name)
+
+    def test_read_meminfo(self):
+        meminfo = self.path / "meminfo"
+        meminfo.write_text(MEMINFO)
+        with mock.patch("duplicity_backup_s3.pagecache.MEMINFO", str(meminfo)):
+            self.assertEqual(read_meminfo(), (4_096_000_000, 2_048_000_000))
+            meminfo.write_text(MEMINFO.replace("4000000", "3000000"))
+            self.assertEqual(
+                usage((4_096_000_000, 2_548_000_000), 100).evicted, 500_000_000
+            )
+        with mock.patch("duplicity_backup_s3.pagecache.MEMINFO", str(self.path)):
+            self.assertIsNone(read_meminfo())
+
+    def test_summary(self):
+        page_cache = PageCacheUsage(4_000_000, 5_000_000, 3_000_000, 3_500_000, 0)
+        self.assertEqual(page_cache.evicted, 0)
+        self.assertEqual(
+            page_cache.summary,
+            "page cache 4.0 MB before, 5.0 MB after, "
+            "0.0 MB of active file pages evicted",
+        )
+
+    def test_drop_files(self):
+        old, new = self.path / "old", self.path / "new"
+        old.write_bytes(b"x" * 10)
+        new.write_bytes(b"x" * 20)
+        os.utime(str(old), (time.time() - 3600,) * 2)
+        files = [(str(path), path.stat()) for path in (old, new)]
+
+        with mock.patch("os.posix_fadvise") as fadvise:
+            self.assertEqual(drop_files(files), 30)
+            self.assertEqual(fadvise.call_count, 2)
+            since = datetime.fromtimestamp(time.time() - 60)
+            self.assertEqual(drop_files(files, since), 20)
+            self.assertEqual(drop_files([(str(self.path / "gone"), files[0][1])]), 0)
+        self.assertEqual(fadvise.call_args[0][1:], (0, 0, os.POSIX_FADV_DONTNEED))
+
+
+class TestCacheFriendlyBackup(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        directory = Path(self.tempdir.name)
+        self.root = directory / "root"
+        self.root.mkdir()
+        (self.root / "changed").write_text("changed")
+        (self.root / "unchanged").write_text("unchanged")
+        os.utime(str(self.root / "unchanged"), (time.time() - 3600,) * 2)
+        self.calls = directory / "calls"
+        self.binary = script(
+            directory / "duplicity", FAKE_DUPLICITY, calls=str(self.calls)
+        )
+        self.nocache = script(
+            directory / "nocache", FAKE_NOCACHE, calls=str(self.calls)
+        )
+        for patcher in (
+            mock.patch.object(DuplicityS3, "duplicity_cmd", return_value=self.binary),
+            mock.patch("duplicity_backup_s3.state.STATE_DIR", directory / "state"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def dupe(self, mode):
+        dupe = DuplicityS3()
+        dupe._config = dict(
+            backuproot=str(self.root),
+            remote=dict(uri="s3://bucket/path"),
+            cache_friendly=mode,
+            extra_args=["--archive-dir", self.tempdir.name, "--name", "archive"],
+        )
+        dupe._capabilities = Capabilities(path="duplicity", version=None, options=[])
+        return dupe
+
+    def test_evict_after_the_backup(self):
+        update_state("s3://bucket/path", journal_checkpoint=time.time() - 60)
+        with mock.patch(
+            "duplicity_backup_s3.duplicity_s3.nocache_command", return_value=None
+        ), mock.patch("os.posix_fadvise") as fadvise:
+            self.assertEqual(self.dupe("auto").do_incremental(), 0)
+
+        self.assertEqual(fadvise.call_count, 1)
+        (run,) = load_state("s3://bucket/path")["runs"]
+        self.assertEqual(run["page_cache"]["dropped"], len("changed"))
+        self.assertEqual((run["action"], run["returncode"]), ("incr", 0))
+
+    def test_nocache_helper(self):
+        with mock.patch(
+            "duplicity_backup_s3.duplicity_s3.nocache_command",
+            return_value=self.nocache,
+        ), mock.patch("os.posix_fadvise") as fadvise:
+            self.assertEqual(self.dupe("nocache").do_incremental(), 0)
+
+        helper, argv = [
+            json.loads(line) for line in self.calls.read_text().splitlines()
+        ]
+        self.assertEqual(helper, ["nocache"])
+        self.assertEqual((argv[0], argv[1]), (self.binary, "incr"))
+        fadvise.assert_not_called()
+        (run,) = load_state("s3://bucket/path")["runs"]
+        self.assertEqual(run["action"], "incr")
+        self.assertEqual(run["page_cache"]["dropped"], 0)
@@ -0,0 +1,214 @@
+import json
+import stat
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.capabilities import Capabilities
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.policies import (
+    EXCLUDED_FILELIST,
+    Policy,
+    filelist_line,
+    find_chain,
+    policy_args,
+    scan,
+)
+
+# records its arguments, a restore only succeeds from the chain of the media
+FAKE_DUPLICITY = """#!{python}
+import json
+import sys
+
+with open({calls!r}, "a") as fd:
+    fd.write(json.dumps(sys.argv[1:]) + "\\n")
+if sys.argv[1] == "restore" and not sys.argv[-2].endswith("/media"):
+    print("Error: file not found in backup", file=sys.stderr)
+    sys.exit(2)
+"""
+
+MEDIA = dict(name="media", extensions=["MP4", ".jpg"], compression=False, volsize=500)
+IMAGES = dict(name="images", patterns=["vm/*.img"], min_size=1, path="/big/")
+
+
+class TestPolicy(TestCase):
+    def test_from_config_and_matches(self):
+        media = Policy.from_config(MEDIA)
+        self.assertEqual(media.extensions, ["mp4", "jpg"])
+        self.assertEqual(media.path, "media")
+        self.assertTrue(media.matches("home/holiday.Mp4", 10))
+        self.assertFalse(media.matches("home/mp4", 10))
+
+        images = Policy.from_config(IMAGES)
+        self.assertEqual(images.path, "big")
+        self.assertEqual(images.min_size, 1024 * 1024)
+        self.assertTrue(images.matches("vm/disk.img", 10))
+        self.assertFalse(images.matches("other/vm/disk.img", 10))
+        self.assertTrue(images.matches("db/data", 2 * 1024 * 1024))
+
+        patterns = Policy.from_config(dict(name="iso", patterns=["*.iso"]))
+        self.assertTrue(patterns.matches("downloads/ubuntu.iso", 10))
+
+    def test_policy_args(self):
+        media = Policy.from_config(MEDIA)
+        self.assertEqual(
+            policy_args(media, encrypted=True),
+            [
+                "--volsize",
+                "500",
+                "--no-compression",
+                "--gpg-options=--compress-algo=none",
+            ],
+        )
+        self.assertEqual(
+            policy_args(media, supported=lambda option: False), ["--volsize", "500"]
+        )
+
+    def test_scan_writes_the_filelists(self):
+        with TemporaryDirectory() as tempdir:
+            root = Path(tempdir) / "root"
+            for path in ("home/a.jpg", "home/b.txt", "vm/disk.img", "vm/notes.jpg"):
+                (root / path).parent.mkdir(parents=True, exist_ok=True)
+                (root / path).write_text(path)
+            policies = [Policy.from_config(IMAGES), Policy.from_config(MEDIA)]
+
+            # the nested root is scanned once
+            result = scan(root, policies, [root, root / "home"], Path(tempdir) / "out")
+
+            def listed(name):
+                return sorted(result[name]["filelist"].read_text().splitlines())
+
+            self.assertEqual(listed("images"), [str(root / "vm/disk.img")])
+            self.assertEqual(
+                listed("media"), [str(root / "home/a.jpg"), str(root / "vm/notes.jpg")]
+            )
+            self.assertEqual(result[EXCLUDED_FILELIST]["files"], 3)
+            self.assertEqual(result["media"]["bytes"], len("home/a.jpgvm/notes.jpg"))
+
+            filelists = {name: result[name]["filelist"] for name in ("images", "media")}
+            self.assertEqual(find_chain(filelists, str(root / "vm/notes.jpg")), "media")
+            self.assertEqual(find_chain(filelists, str(root / "vm")), "images")
+            self.assertIsNone(find_chain(filelists, str(root / "home/b.txt")))
+
+    def test_scan_escapes_glob_characters(self):
+        with TemporaryDirectory() as tempdir:
+            root = Path(tempdir) / "root"
+            (root / "vm").mkdir(parents=True)
+            (root / "vm/a[1].img").write_text("img")
+            (root / "vm/a1.img").write_text("img")
+            policies = [Policy.from_config(IMAGES)]
+
+            result = scan(root, policies, [root], Path(tempdir) / "out")
+
+            self.assertEqual(
+                sorted(result["images"]["filelist"].read_text().splitlines()),
+                [str(root / "vm/a1.img"), str(root / "vm/a[[]1].img")],
+            )
+            filelists = {"images": result["images"]["filelist"]}
+            self.assertEqual(find_chain(filelists, str(root / "vm/a[1].img")), "images")
+
+    def test_filelist_line_escapes_directives(self):
+        self.assertEqual(filelist_line("- x/*.img"), "[-] x/[*].img")
+        self.assertEqual(filelist_line("+ x"), "[+] x")
+        self.assertEqual(filelist_line("-x"), "-x")
+
+
+class TestPolicyChains(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.root = Path(self.tempdir.name) / "root"
+        (self.root / "home").mkdir(parents=True)
+        (self.root / "home/a.jpg").write_text("jpg")
+        (self.root / "home/b.txt").write_text("txt")
+        self.calls = Path(self.tempdir.name) / "calls"
+        binary = Path(self.tempdir.name) / "duplicity"
+        binary.write_text(
+            FAKE_DUPLICITY.format(python=sys.executable, calls=str(self.calls))
+        )
+        binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+
+        for patcher in (
+            mock.patch.object(DuplicityS3, "duplicity_cmd", return_value=str(binary)),
+            mock.patch(
+                "duplicity_backup_s3.duplicity_s3.CACHE_DIR",
+                Path(self.tempdir.name) / "cache",
+            ),
+            mock.patch(
+                "duplicity_backup_s3.state.STATE_DIR",
+                Path(self.tempdir.name) / "state",
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def dupe(self, **options):
+        dupe = DuplicityS3(**options)
+        dupe._config = dict(
+            backuproot=str(self.root),
+            remote=dict(uri="s3://bucket/path"),
+            excludes=["**/tmp"],
+            policies=[MEDIA],
+        )
+        dupe._capabilities = Capabilities(
+            path="duplicity", version=None, options=["--no-compression"]
+        )
+        return dupe
+
+    def recorded(self):
+        return [json.loads(line) for line in self.calls.read_text().splitlines()]
+
+    def test_incremental_backs_up_every_chain(self):
+        self.assertEqual(self.dupe().do_incremental(), 0)
+
+        main, media = self.recorded()
+        self.assertEqual(main[-1], "s3://bucket/path")
+        exclude = [arg for arg in main if arg.startswith("--exclude-filelist=")]
+        self.assertEqual(len(exclude), 1)
+        self.assertLess(main.index(exclude[0]), main.index("--exclude=**/tmp"))
+
+        self.assertEqual(media[-1], "s3://bucket/path/media")
+        self.assertIn("--no-compression", media)
+        self.assertEqual(media[media.index("--volsize") + 1], "500")
+        self.assertTrue(media[-4].startswith("--include-filelist="))
+        self.assertEqual(media[-3], "--exclude=**")
+        filelist = Path(media[-4].split("=", 1)[1])
+        self.assertEqual(filelist.read_text(), f"{self.root / 'home/a.jpg'}\n")
+
+    def test_every_chain_has_its_own_name(self):
+        archive = Path(self.tempdir.name) / "archive"
+        dupe = self.dupe()
+        dupe._config["extra_args"] = ["--archive-dir", str(archive), "--name", "main"]
+        self.assertEqual(dupe.do_incremental(), 0)
+
+        main, media = self.recorded()
+        self.assertEqual(main.count("--name"), 1)
+        self.assertEqual(media[media.index("main-media") - 1], "--name")
+        media_uri = "s3://bucket/path/media"
+        self.assertEqual(dupe._chain_archive_dir(media_uri), archive / "main-media")
+        self.assertEqual(dupe._chain_archive_dir(dupe.remote_uri), archive / "main")
+
+        cleanup = dupe._cleanup_command(media_uri)
+        self.assertEqual(cleanup[cleanup.index("main-media") - 1], "--name")
+        self.assertNotIn("main-media", dupe._cleanup_command())
+
+    def test_restore_file_starts_with_its_chain(self):
+        self.dupe().do_incremental()
+        self.calls.unlink()
+
+        target = Path(self.tempdir.name) / "restore"
+        dupe = self.dupe(target=str(target), file="home/a.jpg")
+        self.assertEqual(dupe.do_restore(), 0)
+        self.assertEqual(
+            [call[-2] for call in self.recorded()], ["s3://bucket/path/media"]
+        )
+
+        # a file that was not routed is searched in the main chain first
+        self.calls.unlink()
+        dupe = self.dupe(target=str(target), file="home/b.txt")
+        self.assertEqual(dupe.do_restore(), 0)
+        self.assertEqual(
+            [call[-2] for call in self.recorded()],
+            ["s3://bucket/path", "s3://bucket/path/media"],
+        )
@@ -0,0 +1,65 @@
+import gzip
+import sys
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from duplicity_backup_s3.prebackup import run_pre_backup, staging_dir
+
+DUMP = [sys.executable, "-c", "import sys; sys.stdout.write('row\\n' * 10000)"]
+
+
+class TestPreBackup(TestCase):
+    def test_steps_stream_compressed_dumps_into_staging(self):
+        with TemporaryDirectory() as backuproot:
+            config = dict(
+                backuproot=backuproot,
+                pre_backup=dict(
+                    parallel=2,
+                    steps=[
+                        dict(name="db.sql", command=DUMP),
+                        dict(name="plain.txt", command=DUMP, compression="none"),
+                    ],
+                ),
+            )
+            results = run_pre_backup(config)
+
+            self.assertTrue(all(r.succeeded for r in results))
+            self.assertEqual(results[0].path, staging_dir(config) / "db.sql.gz")
+            self.assertEqual(results[0].bytes_in, 40000)
+            self.assertLess(results[0].bytes_out, results[0].bytes_in)
+            with gzip.open(str(results[0].path)) as fd:
+                self.assertEqual(fd.read(), b"row\n" * 10000)
+            self.assertEqual(results[1].path.read_bytes(), b"row\n" * 10000)
+
+    def test_failing_and_timed_out_steps(self):
+        with TemporaryDirectory() as backuproot:
+            config = dict(
+                backuproot=backuproot,
+                pre_backup=dict(
+                    steps=[
+                        dict(
+                            name="failing",
+                            command=[sys.executable, "-c", "raise SystemExit(3)"],
+                            on_failure="continue",
+                        ),
+                        dict(
+                            name="hanging",
+                            command=[
+                                sys.executable,
+                                "-c",
+                                "import time; time.sleep(60)",
+                            ],
+                            timeout=1,
+                        ),
+                    ]
+                ),
+            )
+            failing, hanging = run_pre_backup(config)
+
+            self.assertEqual(failing.returncode, 3)
+            self.assertFalse(failing.succeeded)
+            self.assertEqual(failing.on_failure, "continue")
+            self.assertIn("timed out", hanging.error)
+            self.assertLess(hanging.duration, 30)
+            # no partial dumps are left in the staging directory
+            self.assertEqual(list(staging_dir(config).iterdir()), [])
@@ -0,0 +1,165 @@
+import stat
+import sys
+import time
+from collections import namedtuple
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.capabilities import Capabilities
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.preflight import (
+    PreflightError,
+    check_gpg_key,
+    check_remote,
+    run_checks,
+)
+
+# records that it ran
+FAKE_DUPLICITY = """#!{python}
+open({calls!r}, "a").write("called\\n")
+"""
+
+# knows a single key, like `gpg --list-keys`
+FAKE_GPG = """#!{python}
+import sys
+
+sys.exit(0 if sys.argv[-1] == "ABCD1234" else 2)
+"""
+
+
+class S3Error(Exception):
+    def __init__(self, code):
+        super().__init__(f"An error occurred ({code})")
+        self.response = dict(Error=dict(Code=code))
+
+
+class FakeS3:
+    def __init__(self, code=None):
+        self.code = code
+        self.requests = []
+
+    def list_objects_v2(self, **kwargs):
+        self.requests.append(kwargs)
+        if self.code is not None:
+            raise S3Error(self.code)
+        return dict(Contents=[], IsTruncated=False)
+
+
+def script(path, template, **kwargs):
+    path.write_text(template.format(python=sys.executable, **kwargs))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+class TestPreflight(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = Path(self.tempdir.name)
+
+    def test_run_checks_concurrently(self):
+        def slow(seconds):
+            def check():
+                time.sleep(seconds)
+                return "done"
+
+            return check
+
+        def failing():
+            raise PreflightError("The GPG key X is not in the keyring of gpg.")
+
+        start = time.monotonic()
+        results = run_checks(
+            dict(a=slow(0.2), b=slow(0.2), c=failing, d=slow(1)), timeout=0.5
+        )
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual([r.name for r in results], ["a", "b", "c", "d"])
+        self.assertEqual([r.ok for r in results], [True, True, False, False])
+        self.assertEqual(
+            results[2].message, "The GPG key X is not in the keyring of gpg."
+        )
+        self.assertEqual(results[3].message, "did not finish within 0.5 seconds")
+
+    def test_check_remote(self):
+        client = FakeS3()
+        self.assertEqual(
+            check_remote("s3+http://bucket/path", lambda: client),
+            "s3://bucket/path/ is accessible",
+        )
+        self.assertEqual(
+            client.requests, [dict(Bucket="bucket", Prefix="path/", MaxKeys=1)]
+        )
+        with self.assertRaisesRegex(PreflightError, "the bucket bucket does not exist"):
+            check_remote("s3://bucket/path", lambda: FakeS3("NoSuchBucket"))
+        with self.assertRaisesRegex(PreflightError, "secret access key is wrong"):
+            check_remote("s3://bucket/path", lambda: FakeS3("SignatureDoesNotMatch"))
+
+        self.assertIn("is writable", check_remote(f"file://{self.path}", None))
+        with self.assertRaisesRegex(PreflightError, "does not exist"):
+            check_remote(f"file://{self.path}/missing", None)
+
+    def test_check_gpg_key(self):
+        self.assertEqual(check_gpg_key(None), "no GPG_KEY, symmetric encryption")
+        gpg = script(self.path / "gpg", FAKE_GPG)
+        with mock.patch("duplicity_backup_s3.preflight.which", return_value=gpg):
+            self.assertEqual(check_gpg_key("ABCD1234"), "key ABCD1234 found")
+            with self.assertRaisesRegex(PreflightError, "not in the secret keyring"):
+                check_gpg_key("FFFF0000", secret=True)
+        with mock.patch("duplicity_backup_s3.preflight.which", return_value=None):
+            with self.assertRaisesRegex(PreflightError, "gpg is not installed"):
+                check_gpg_key("ABCD1234")
+
+
+class TestPreflightCommand(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = Path(self.tempdir.name)
+        self.calls = self.path / "calls"
+        binary = script(self.path / "duplicity", FAKE_DUPLICITY, calls=str(self.calls))
+        patcher = mock.patch.object(DuplicityS3, "duplicity_cmd", return_value=binary)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def dupe(self, remote, **preflight):
+        dupe = DuplicityS3()
+        dupe._config = dict(
+            backuproot=self.tempdir.name,
+            remote=dict(uri=remote),
+            preflight=preflight,
+            extra_args=["--archive-dir", self.tempdir.name, "--name", "archive"],
+        )
+        dupe._capabilities = Capabilities(path="duplicity", version=(2, 1), options=[])
+        return dupe
+
+    def test_failing_check_stops_the_action(self):
+        dupe = self.dupe(f"file://{self.path}/missing")
+        self.assertEqual(dupe.do_collection_status(), 1)
+        self.assertFalse(self.calls.exists())
+
+        dupe = self.dupe(f"file://{self.path}/missing", checks=["duplicity"])
+        self.assertEqual(dupe.do_collection_status(), 0)
+        self.assertTrue(self.calls.exists())
+
+    def test_checks_of_the_action(self):
+        dupe = self.dupe(f"file://{self.path}")
+        dupe._config["gpg"] = dict(PASSPHRASE="secret", GPG_KEY="ABCD1234")
+
+        self.assertEqual(
+            [r.name for r in dupe._preflight_results("incr")],
+            ["remote", "gpg", "scratch", "duplicity"],
+        )
+        results = dupe._preflight_results("cleanup")
+        self.assertEqual([r.name for r in results], ["remote", "scratch", "duplicity"])
+        self.assertTrue(all(r.ok for r in results))
+        self.assertTrue(results[2].message.endswith("2.1"))
+        usage = namedtuple("usage", "total used free")(0, 0, 5 * 10**9)
+        with mock.patch("shutil.disk_usage", return_value=usage):
+            (_, scratch, _) = dupe._preflight_results("cleanup")
+        self.assertIn("has 5000 MB free, the run needs 105 MB", scratch.message)
+
+        dupe._config["scratch"] = dict(directories=[str(self.path)], reserve=10**9)
+        (scratch,) = [r for r in dupe._preflight_results("cleanup") if not r.ok]
+        self.assertIn("None of the scratch directories has", scratch.message)
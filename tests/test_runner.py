@@ -0,0 +1,103 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+from unittest import TestCase, skipUnless
+
+from duplicity_backup_s3.resources import ResourceMonitor
+from duplicity_backup_s3.runner import ProcessRunner
+
+
+class TestProcessRunner(TestCase):
+    def test_output_is_forwarded_and_tail_kept(self):
+        received = []
+        runner = ProcessRunner(
+            [sys.executable, "-c", "print('hello'); print('world')"],
+            output=received.append,
+        )
+        result = runner.run()
+
+        self.assertEqual(result.returncode, 0)
+        self.assertIn("hello", "".join(received))
+        self.assertEqual(list(runner.tail), ["hello", "world"])
+        self.assertIsNone(runner.stall_event)
+
+    def test_stalled_process_is_terminated(self):
+        runner = ProcessRunner(
+            [sys.executable, "-c", "import time; time.sleep(60)"],
+            stall_timeout=0.5,
+            grace_period=1,
+            poll_interval=0.1,
+            output=lambda text: None,
+        )
+        started = time.monotonic()
+        result = runner.run()
+
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIsNotNone(runner.stall_event)
+        self.assertGreater(runner.stall_event.idle_seconds, 0.5)
+
+    def test_progressing_process_is_not_terminated(self):
+        script = "import time\nfor i in range(8):\n    print(i, flush=True)\n    time.sleep(0.1)"
+        runner = ProcessRunner(
+            [sys.executable, "-c", script],
+            stall_timeout=0.5,
+            poll_interval=0.1,
+            output=lambda text: None,
+        )
+        result = runner.run()
+
+        self.assertEqual(result.returncode, 0)
+        self.assertIsNone(runner.stall_event)
+
+    def test_resources_of_the_child_are_accounted(self):
+        script = (
+            "import time\n"
+            "data = bytearray(64 * 1024 * 1024)\n"
+            "end = time.process_time() + 0.3\n"
+            "while time.process_time() < end:\n"
+            "    pass\n"
+        )
+        runner = ProcessRunner([sys.executable, "-c", script], output=lambda text: None)
+        runner.run()
+
+        usage = runner.resources
+        self.assertGreaterEqual(usage.user_cpu + usage.system_cpu, 0.25)
+        self.assertGreaterEqual(usage.max_rss, 64 * 1024 * 1024)
+        self.assertIn("peak RSS", usage.summary)
+
+
+@skipUnless(os.path.isdir("/proc"), "requires /proc")
+class TestResourceMonitor(TestCase):
+    def test_memory_of_the_session_is_summed(self):
+        # a grandchild holds the memory, the child itself is small
+        script = (
+            "import subprocess, sys\n"
+            "subprocess.run([sys.executable, '-c', 'import time; "
+            'data = b"x" * (96 * 1024 * 1024); print(1, flush=True); '
+            "time.sleep(60)'])\n"
+        )
+        process = subprocess.Popen(
+            [sys.executable, "-c", script],
+            stdout=subprocess.PIPE,
+            start_new_session=True,
+        )
+        try:
+            process.stdout.readline()
+            monitor = ResourceMonitor(process.pid, children_rusage=False, interval=0)
+            monitor.sample()
+        finally:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            process.stdout.close()
+
+        usage = monitor.finish()
+        self.assertEqual(monitor.samples, 1)
+        self.assertGreaterEqual(usage.max_rss, 96 * 1024 * 1024)
+
+    def test_nothing_measured(self):
+        monitor = ResourceMonitor(2**22 + 1, children_rusage=False)
+        monitor.sample()
+        self.assertIsNone(monitor.finish())
@@ -0,0 +1,123 @@
+from datetime import datetime, time, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.cli import duplicity_backup_s3
+from duplicity_backup_s3.schedule import (
+    cron_line,
+    peak_concurrency,
+    simulate,
+    slot_offset,
+    slot_start,
+    slot_time,
+    systemd_timer,
+)
+from duplicity_backup_s3.window import BackupWindow
+from tests.test_base import TestSetup
+
+REMOTE = "s3://host/bucket/path"
+WINDOW = BackupWindow(time(1, 0), time(5, 0))
+
+
+class TestSchedule(TestCase):
+    def test_slot_is_deterministic_and_within_the_window(self):
+        duration = timedelta(minutes=30)
+        offsets = {
+            slot_offset(f"web{i}", REMOTE, WINDOW, 50, duration) for i in range(50)
+        }
+        self.assertEqual(
+            slot_offset("web1", REMOTE, WINDOW, 50, duration),
+            slot_offset("web1", REMOTE, WINDOW, 50, duration),
+        )
+        self.assertGreater(len(offsets), 20)
+        for offset in offsets:
+            self.assertLessEqual(offset + duration, WINDOW.duration)
+
+    def test_slot_start(self):
+        offset = timedelta(minutes=75)
+        self.assertEqual(
+            slot_start(WINDOW, offset, datetime(2023, 1, 5, 1, 0)),
+            datetime(2023, 1, 5, 2, 15),
+        )
+        # the slot passed within the window, start right away
+        self.assertEqual(
+            slot_start(WINDOW, offset, datetime(2023, 1, 5, 3, 0)),
+            datetime(2023, 1, 5, 3, 0),
+        )
+        # outside of the window, wait for the slot of the next window
+        self.assertEqual(
+            slot_start(WINDOW, offset, datetime(2023, 1, 5, 12, 0)),
+            datetime(2023, 1, 6, 2, 15),
+        )
+        self.assertEqual(
+            cron_line(datetime(2023, 1, 6, 2, 15), "backup"), "15 2 * * * backup"
+        )
+        self.assertEqual(
+            cron_line(datetime(2023, 1, 6, 2, 15), "backup -c '50%.yaml'"),
+            "15 2 * * * backup -c '50\\%.yaml'",
+        )
+
+    def test_daily_slot_after_the_slot_passed(self):
+        # within the window after the slot, the timer still fires at the slot
+        offset = timedelta(minutes=75)
+        slot = slot_time(WINDOW, offset, datetime(2023, 1, 5, 3, 0))
+        self.assertEqual(cron_line(slot, "backup"), "15 2 * * * backup")
+        self.assertIn("OnCalendar=*-*-* 02:15:00", systemd_timer(slot, "backup"))
+        # before the opening, the slot of the previous window has the same time
+        slot = slot_time(WINDOW, offset, datetime(2023, 1, 5, 0, 30))
+        self.assertEqual(cron_line(slot, "backup"), "15 2 * * * backup")
+
+    def test_peak_concurrency(self):
+        minutes = [timedelta(minutes=m) for m in (0, 10, 20, 30)]
+        self.assertEqual(peak_concurrency(minutes, timedelta(minutes=10)), 1)
+        self.assertEqual(peak_concurrency(minutes, timedelta(minutes=25)), 3)
+
+    def test_simulation_staggers_the_fleet(self):
+        result = simulate(REMOTE, WINDOW, 1000, timedelta(minutes=30))
+        self.assertEqual(result["unstaggered"], 1000)
+        self.assertLess(result["peak"], 250)
+        self.assertGreaterEqual(result["peak"], result["expected"])
+
+
+class TestScheduleCommand(TestSetup):
+    def test_schedule_command(self):
+        with TemporaryDirectory() as tempdir:
+            config = Path(tempdir) / "config.yaml"
+            config.write_text(
+                f"backuproot: {tempdir}\nremote:\n  uri: {REMOTE}\n"
+                "window:\n  start: '01:00'\n  end: '05:00'\n"
+                "schedule:\n  fleet_size: 100\n"
+            )
+            with mock.patch("duplicity_backup_s3.state.STATE_DIR", Path(tempdir)):
+                result = self.runner.invoke(
+                    duplicity_backup_s3,
+                    ["schedule", "-c", str(config), "--cron", "--hostname", "web1"],
+                )
+                self.assertEqual(result.exit_code, 0, result.output)
+                self.assertTrue(
+                    result.output.strip().endswith(f"incr --config {config}")
+                )
+                minute, hour = result.output.split()[:2]
+                self.assertTrue(1 <= int(hour) < 5)
+
+                result = self.runner.invoke(
+                    duplicity_backup_s3, ["schedule", "-c", str(config), "--simulate"]
+                )
+                self.assertEqual(result.exit_code, 0, result.output)
+                self.assertIn("peak concurrent backups", result.output)
+
+    def test_cron_line_quotes_the_config(self):
+        with TemporaryDirectory() as tempdir:
+            config = Path(tempdir) / "my backups" / "config.yaml"
+            config.parent.mkdir()
+            config.write_text(
+                f"backuproot: {tempdir}\nremote:\n  uri: {REMOTE}\n"
+                "window:\n  start: '01:00'\n  end: '05:00'\n"
+            )
+            with mock.patch("duplicity_backup_s3.state.STATE_DIR", Path(tempdir)):
+                result = self.runner.invoke(
+                    duplicity_backup_s3, ["schedule", "-c", str(config), "--cron"]
+                )
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertTrue(result.output.strip().endswith(f"incr --config '{config}'"))
@@ -0,0 +1,139 @@
+import json
+import os
+import stat
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.capabilities import Capabilities
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.scratch import ScratchError, choose, clean_stale, make_scratch
+
+# records its arguments and the TMPDIR of its environment
+FAKE_DUPLICITY = """#!{python}
+import json
+import os
+import sys
+
+with open({calls!r}, "a") as fd:
+    fd.write(json.dumps([os.environ.get("TMPDIR"), *sys.argv[1:]]) + "\\n")
+"""
+
+Usage = namedtuple("Usage", "total used free")
+
+
+class TestScratch(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.small = Path(self.tempdir.name) / "small"
+        self.large = Path(self.tempdir.name) / "large"
+        self.small.mkdir()
+        self.large.mkdir()
+
+    def disk_usage(self, path):
+        free = 10 * 1024**2 if path == str(self.small) else 10 * 1024**3
+        return Usage(0, 0, free)
+
+    def test_choose_the_first_directory_with_room(self):
+        with mock.patch("shutil.disk_usage", self.disk_usage):
+            candidates = [str(self.small), str(self.large)]
+            self.assertEqual(choose(candidates, 1024**2), str(self.small))
+            self.assertEqual(choose(candidates, 1024**3), str(self.large))
+            with self.assertRaises(ScratchError) as cm:
+                choose(candidates + ["/does/not/exist"], 100 * 1024**3)
+        self.assertIn("/does/not/exist (not writable)", str(cm.exception))
+
+    def test_clean_stale(self):
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        dead = self.small / f"duplicity_s3__pid-{process.pid}__abc"
+        Path(make_scratch(str(self.small))).rename(dead)
+        alive = self.small / f"duplicity_s3__pid-{os.getppid()}__abc"
+        own = Path(make_scratch(str(self.small)))
+        # not created by make_scratch, eg. a pid-like name of another tool
+        other = self.small / f"duplicity_s3__{process.pid}_abc"
+        old = self.small / "duplicity_s3__xyz"
+        for path in (dead, alive, other, old):
+            (path / "duplicity-tempdir").mkdir(parents=True)
+        os.utime(str(old), (time.time() - 2 * 86400,) * 2)
+        (self.small / f"duplicity_s3__pid-{process.pid}__file").write_text("file")
+
+        removed = clean_stale([str(self.small), "/does/not/exist"])
+
+        self.assertEqual(removed, [str(dead)])
+        for path in (alive, own, other, old):
+            self.assertTrue(path.exists())
+
+
+class TestScratchPlacement(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.scratch = Path(self.tempdir.name) / "scratch"
+        self.scratch.mkdir()
+        self.calls = Path(self.tempdir.name) / "calls"
+        binary = Path(self.tempdir.name) / "duplicity"
+        binary.write_text(
+            FAKE_DUPLICITY.format(python=sys.executable, calls=str(self.calls))
+        )
+        binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+        for patcher in (
+            mock.patch.object(DuplicityS3, "duplicity_cmd", return_value=str(binary)),
+            mock.patch(
+                "duplicity_backup_s3.state.STATE_DIR", Path(self.tempdir.name) / "state"
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def dupe(self, **scratch):
+        dupe = DuplicityS3(dry_run=True)
+        dupe._config = dict(
+            backuproot=self.tempdir.name,
+            remote=dict(uri="s3://bucket/path"),
+            volsize=50,
+            transfer=dict(concurrency=3),
+            scratch=dict(directories=[str(self.scratch)], **scratch),
+        )
+        dupe._capabilities = Capabilities(path="duplicity", version=None, options=[])
+        return dupe
+
+    def test_duplicity_runs_in_a_scratch_directory(self):
+        self.assertEqual(self.dupe().do_incremental(), 0)
+
+        tmpdir, action, option, tempdir, *_ = json.loads(self.calls.read_text())
+        self.assertEqual((action, option), ("incr", "--tempdir"))
+        self.assertEqual(tmpdir, tempdir)
+        self.assertEqual(Path(tempdir).parent, self.scratch)
+        self.assertTrue(
+            Path(tempdir).name.startswith(f"duplicity_s3__pid-{os.getpid()}__")
+        )
+        # removed after the run
+        self.assertEqual(list(self.scratch.iterdir()), [])
+
+    def test_tempdir_follows_the_argument_of_the_action(self):
+        dupe = self.dupe()
+        dupe.options["time"] = "7D"
+        self.assertEqual(dupe._execute(*dupe._remove_older_command()), 0)
+
+        _, action, time, option, *_ = json.loads(self.calls.read_text())
+        self.assertEqual(
+            (action, time, option), ("remove-older-than", "7D", "--tempdir")
+        )
+
+    def test_scratch_need(self):
+        dupe = self.dupe(reserve=10)
+        self.assertEqual(dupe._scratch_need("incr"), (50 * 4 + 10) * 1024**2)
+        self.assertEqual(dupe._scratch_need("restore"), (50 * 2 + 10) * 1024**2)
+        self.assertEqual(dupe._scratch_need("collection-status"), 10 * 1024**2)
+
+    def test_fail_before_duplicity_without_room(self):
+        dupe = self.dupe(reserve=10**9)
+
+        self.assertEqual(dupe.do_incremental(), 1)
+        self.assertFalse(self.calls.exists())
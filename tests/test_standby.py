@@ -0,0 +1,220 @@
+import json
+import os
+import stat
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.capabilities import Capabilities
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.listing import ADDED, MODIFIED, REMOVED
+from duplicity_backup_s3.standby import Change, changes, read_index, write_index
+
+# lists and restores the files of the backup root, like duplicity
+FAKE_DUPLICITY = """#!{python}
+import json
+import os
+import shutil
+import sys
+import time
+
+root = {root!r}
+with open({calls!r}, "a") as fd:
+    fd.write(json.dumps(sys.argv[1:]) + "\\n")
+if sys.argv[1] == "list-current-files":
+    print("Last full backup date: Mon May  1 00:00:00 2023")
+    print(time.ctime(os.path.getmtime(root)), ".")
+    for directory, dirs, files in os.walk(root):
+        for name in sorted(dirs + files):
+            path = os.path.join(directory, name)
+            print(time.ctime(os.path.getmtime(path)), os.path.relpath(path, root))
+elif sys.argv[1] == "restore":
+    target = sys.argv[-1]
+    if "--file-to-restore" in sys.argv:
+        path = sys.argv[sys.argv.index("--file-to-restore") + 1]
+        if "broken" in path:
+            print("Error: the volume is corrupt")
+            sys.exit(30)
+        shutil.copy2(os.path.join(root, path), target)
+    else:
+        shutil.copytree(root, target)
+"""
+
+
+def listing(*paths):
+    return [f"Mon May  1 00:00:0{mtime} 2023 {path}" for path, mtime in paths]
+
+
+class TestChanges(TestCase):
+    def test_directories_precede_their_contents(self):
+        with TemporaryDirectory() as tempdir:
+            old, new = Path(tempdir) / "old", Path(tempdir) / "new"
+            write_index(listing((".", 0), ("a", 0), ("a.txt", 0), ("b", 0)), old)
+            write_index(
+                listing(
+                    (".", 1),
+                    ("a.txt", 1),
+                    ("a/b", 1),
+                    ("a/c/d", 1),
+                    ("a", 1),
+                    ("a/c", 1),
+                ),
+                new,
+            )
+            self.assertEqual(
+                list(changes(read_index(old), read_index(new))),
+                [
+                    Change(MODIFIED, "a", True),
+                    Change(ADDED, "a/b", False),
+                    Change(ADDED, "a/c", True),
+                    Change(ADDED, "a/c/d", False),
+                    Change(MODIFIED, "a.txt", False),
+                    Change(REMOVED, "b", False),
+                ],
+            )
+            self.assertEqual(len(list(changes(read_index(None), read_index(new)))), 5)
+
+
+class TestStandby(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        directory = Path(self.tempdir.name)
+        self.root = directory / "root"
+        (self.root / "docs").mkdir(parents=True)
+        (self.root / "docs" / "a").write_text("a")
+        (self.root / "b").write_text("b")
+        self.past(self.root / "docs" / "a", self.root / "b", self.root / "docs")
+        archive = directory / "archive"
+        archive.mkdir()
+        (archive / "duplicity-full.20230501T000000Z.manifest").touch()
+        self.target = directory / "standby"
+        self.calls = directory / "calls"
+        binary = directory / "duplicity"
+        binary.write_text(
+            FAKE_DUPLICITY.format(
+                python=sys.executable, root=str(self.root), calls=str(self.calls)
+            )
+        )
+        binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+        for patcher in (
+            mock.patch.object(DuplicityS3, "duplicity_cmd", return_value=str(binary)),
+            mock.patch("duplicity_backup_s3.state.STATE_DIR", directory / "state"),
+            mock.patch("duplicity_backup_s3.standby.STATE_DIR", directory / "state"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def past(*paths):
+        for path in paths:
+            os.utime(str(path), (time.time() - 3600,) * 2)
+
+    def sync(self, config=None, **options):
+        dupe = DuplicityS3(target=str(self.target), **options)
+        dupe._config = dict(
+            backuproot=str(self.root),
+            remote=dict(uri="s3://bucket/path"),
+            extra_args=["--archive-dir", self.tempdir.name, "--name", "archive"],
+            **(config or {}),
+        )
+        dupe._capabilities = Capabilities(path="duplicity", version=None, options=[])
+        return dupe.do_standby()
+
+    def restores(self):
+        calls = [json.loads(line) for line in self.calls.read_text().splitlines()]
+        self.calls.unlink()
+        return [args for args in calls if args[0] == "restore"]
+
+    def test_restores_only_the_changes(self):
+        (self.target / "stale").mkdir(parents=True)
+        self.assertEqual(self.sync(), 0)
+        (full,) = self.restores()
+        self.assertNotIn("--file-to-restore", full)
+        self.assertEqual(full[full.index("--time") + 1], "1682899200")
+        self.assertEqual((self.target / "docs" / "a").read_text(), "a")
+        self.assertFalse((self.target / "stale").exists())
+
+        (self.root / "docs" / "a").write_text("changed")
+        (self.root / "new" / "c").mkdir(parents=True)
+        (self.root / "new" / "c" / "d").write_text("d")
+        (self.root / "b").unlink()
+        self.assertEqual(self.sync(parallel=2), 0)
+
+        restores = self.restores()
+        self.assertEqual(
+            sorted(args[args.index("--file-to-restore") + 1] for args in restores),
+            ["docs/a", "new/c/d"],
+        )
+        # every concurrent restore has its own archive directory
+        archives = {
+            [
+                value
+                for option, value in zip(args, args[1:])
+                if option == "--archive-dir"
+            ][-1]
+            for args in restores
+        }
+        self.assertNotIn(self.tempdir.name, archives)
+        self.assertEqual((self.target / "docs" / "a").read_text(), "changed")
+        self.assertEqual((self.target / "new" / "c" / "d").read_text(), "d")
+        self.assertFalse((self.target / "b").exists())
+        self.assertEqual(sorted(p.name for p in self.target.iterdir()), ["docs", "new"])
+
+        self.assertEqual(self.sync(), 0)
+        self.assertEqual(self.restores(), [])
+
+    def test_failed_restores_are_retried(self):
+        self.assertEqual(self.sync(), 0)
+        self.restores()
+        (self.root / "broken").write_text("broken")
+        (self.root / "fine").write_text("fine")
+
+        self.assertEqual(self.sync(), 1)
+        self.assertEqual(len(self.restores()), 2)
+        self.assertEqual((self.target / "fine").read_text(), "fine")
+        self.assertFalse((self.target / "broken").exists())
+
+        (self.root / "broken").unlink()
+        self.assertEqual(self.sync(), 0)
+        (restore,) = self.restores()
+        self.assertEqual(restore[restore.index("--file-to-restore") + 1], "fine")
+
+    def test_restores_share_the_volume_mirror(self):
+        self.assertEqual(self.sync(), 0)
+        self.restores()
+        (self.root / "c").write_text("c")
+        (self.root / "d").write_text("d")
+        scratch = Path(self.tempdir.name) / "scratch"
+        scratch.mkdir()
+
+        mirrors = []
+
+        @contextmanager
+        def volume_mirror(dupe, remote):
+            mirrors.append(remote)
+            yield "file:///cache/view", "archive"
+
+        with mock.patch.object(DuplicityS3, "_volume_mirror", volume_mirror):
+            config = dict(scratch=dict(directories=[str(scratch)], reserve=0))
+            self.assertEqual(self.sync(config=config, parallel=2), 0)
+
+        self.assertEqual(mirrors, ["s3://bucket/path"])
+        restores = self.restores()
+        self.assertEqual(len(restores), 2)
+        for args in restores:
+            self.assertEqual(args[-2], "file:///cache/view")
+            tempdir = args[args.index("--tempdir") + 1]
+            self.assertEqual(Path(tempdir).parent, scratch)
+        self.assertEqual(list(scratch.iterdir()), [])
+        self.assertEqual((self.target / "d").read_text(), "d")
+
+    def test_dry_run(self):
+        with mock.patch("builtins.print") as print_:
+            self.assertEqual(self.sync(dry_run=True), 0)
+        self.assertEqual(self.restores(), [])
+        self.assertFalse(self.target.exists())
+        self.assertIn(mock.call("A docs/a"), print_.call_args_list)
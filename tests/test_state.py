@@ -0,0 +1,24 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from duplicity_backup_s3.state import load_state, state_path, update_state
+
+
+class TestState(TestCase):
+    def test_state_roundtrip(self):
+        with TemporaryDirectory() as state_dir:
+            remote = "s3://host/bucket/path"
+            self.assertDictEqual(load_state(remote, Path(state_dir)), {})
+
+            update_state(remote, Path(state_dir), partial_since="2023-01-02T05:00")
+            state = load_state(remote, Path(state_dir))
+            self.assertEqual(state["partial_since"], "2023-01-02T05:00")
+            self.assertEqual(state["remote"], remote)
+
+            update_state(remote, Path(state_dir), partial_since=None)
+            self.assertNotIn("partial_since", load_state(remote, Path(state_dir)))
+            # no temporary files are left behind
+            self.assertEqual(
+                list(Path(state_dir).iterdir()), [state_path(remote, Path(state_dir))]
+            )
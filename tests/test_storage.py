@@ -0,0 +1,277 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.storage import (
+    StorageError,
+    bucket_and_prefix,
+    chains,
+    list_files,
+    restore_files,
+    restore_time,
+    stage,
+    storage_args,
+    transitions,
+)
+
+NOW = datetime(2023, 6, 1, tzinfo=timezone.utc)
+
+
+class FakeClientError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeS3:
+    """Stand-in for an S3 client, restores complete after `delay` head requests."""
+
+    def __init__(self, objects, delay=2, page_size=3):
+        self.objects = dict(objects)  # key -> storage class
+        self.delay = delay
+        self.page_size = page_size
+        self.restores = {}  # key -> remaining head requests
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter, ContinuationToken=None):
+        keys = sorted(
+            k
+            for k in self.objects
+            if k.startswith(Prefix) and "/" not in k[len(Prefix) :]
+        )
+        start = int(ContinuationToken or 0)
+        page = keys[start : start + self.page_size]
+        response = dict(
+            Contents=[
+                dict(Key=k, Size=100, StorageClass=self.objects[k]) for k in page
+            ],
+            IsTruncated=start + self.page_size < len(keys),
+        )
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + self.page_size)
+        return response
+
+    def copy_object(self, Bucket, Key, CopySource, StorageClass, MetadataDirective):
+        assert CopySource == dict(Bucket=Bucket, Key=Key)
+        self.objects[Key] = StorageClass
+
+    def head_object(self, Bucket, Key):
+        with self.lock:
+            if Key not in self.restores:
+                return {}
+            self.restores[Key] -= 1
+            ongoing = "true" if self.restores[Key] > 0 else "false"
+            return dict(Restore=f'ongoing-request="{ongoing}"')
+
+    def restore_object(self, Bucket, Key, RestoreRequest):
+        with self.lock:
+            self.requests.append((Key, RestoreRequest))
+            if Key in self.restores:
+                raise FakeClientError("RestoreAlreadyInProgress")
+            self.restores[Key] = self.delay
+
+
+def stamp(days):
+    return (NOW - timedelta(days=days)).strftime("%Y%m%dT%H%M%SZ")
+
+
+def backup(prefix="path/", storage_class="STANDARD"):
+    """Two chains of 100 and 40 days old, and the current chain."""
+    objects = {}
+    for full, incs in ((100, [90]), (40, [35]), (10, [5])):
+        objects[f"{prefix}duplicity-full.{stamp(full)}.manifest"] = "STANDARD"
+        objects[
+            f"{prefix}duplicity-full-signatures.{stamp(full)}.sigtar.gpg"
+        ] = "STANDARD"
+        objects[
+            f"{prefix}duplicity-full.{stamp(full)}.vol1.difftar.gpg"
+        ] = storage_class
+        previous = full
+        for inc in incs:
+            name = f"duplicity-inc.{stamp(previous)}.to.{stamp(inc)}"
+            objects[f"{prefix}{name}.manifest"] = "STANDARD"
+            objects[f"{prefix}{name}.vol1.difftar.gpg"] = storage_class
+            previous = inc
+    objects[f"{prefix}unrelated.txt"] = "STANDARD"
+    return objects
+
+
+class TestStorage(TestCase):
+    def test_bucket_and_prefix(self):
+        self.assertEqual(bucket_and_prefix("s3+http://bucket/a/b"), ("bucket", "a/b/"))
+        self.assertEqual(bucket_and_prefix("boto3+s3://bucket"), ("bucket", ""))
+        self.assertEqual(
+            bucket_and_prefix("s3://s3.eu-west-1.amazonaws.com/bucket/path/"),
+            ("bucket", "path/"),
+        )
+        self.assertEqual(bucket_and_prefix("s3:///bucket/path"), ("bucket", "path/"))
+
+    def test_list_files_and_chains(self):
+        client = FakeS3({**backup(), **backup("path/media/")})
+        files = list_files(client, "bucket", "path/")
+
+        self.assertEqual(len(files), 15)  # paginated, not the policy chain
+        grouped = chains(files)
+        self.assertEqual([len(chain) for chain in grouped], [5, 5, 5])
+        self.assertTrue(all(f.file.type == "full" for f in grouped[1][:3]))
+
+    def test_transitions(self):
+        files = list_files(FakeS3(backup()), "bucket", "path/")
+        tiers = [
+            dict(after_days=20, **{"class": "GLACIER"}),
+            dict(after_days=0, **{"class": "STANDARD_IA"}),
+        ]
+
+        moves = {
+            f.key: storage_class for f, storage_class in transitions(files, tiers, NOW)
+        }
+
+        # the first chain was superseded 40 days ago, the second 10 days ago
+        self.assertEqual(
+            sorted(moves.items()),
+            sorted(
+                [
+                    (f"path/duplicity-full.{stamp(100)}.vol1.difftar.gpg", "GLACIER"),
+                    (
+                        f"path/duplicity-inc.{stamp(100)}.to.{stamp(90)}"
+                        f".vol1.difftar.gpg",
+                        "GLACIER",
+                    ),
+                    (
+                        f"path/duplicity-full.{stamp(40)}.vol1.difftar.gpg",
+                        "STANDARD_IA",
+                    ),
+                    (
+                        f"path/duplicity-inc.{stamp(40)}.to.{stamp(35)}"
+                        f".vol1.difftar.gpg",
+                        "STANDARD_IA",
+                    ),
+                ]
+            ),
+        )
+        # archived volumes are not moved back to a warmer class
+        archived = list_files(
+            FakeS3(backup(storage_class="GLACIER")), "bucket", "path/"
+        )
+        self.assertEqual(transitions(archived, tiers, NOW), [])
+
+    def test_restore_files(self):
+        files = list_files(FakeS3(backup()), "bucket", "path/")
+
+        latest = restore_files(files, None)
+        self.assertEqual(
+            [f.file.end for f in latest],
+            [NOW - timedelta(days=10), NOW - timedelta(days=5)],
+        )
+        old = restore_files(files, restore_time("95D", NOW))
+        self.assertEqual(
+            [f.key for f in old], [f"path/duplicity-full.{stamp(100)}.vol1.difftar.gpg"]
+        )
+        self.assertIsNone(restore_time("now"))
+        with self.assertRaises(ValueError):
+            restore_time("last tuesday")
+
+    def test_stage_waits_for_the_restores(self):
+        client = FakeS3(backup(storage_class="DEEP_ARCHIVE"), delay=3)
+        files = restore_files(list_files(client, "bucket", "path/"), None)
+        client.restores[files[0].key] = 1  # requested by an earlier restore
+        sleeps = []
+
+        staging = stage(client, "bucket", files, tier="Bulk", sleep=sleeps.append)
+
+        self.assertEqual(staging.archived, 2)
+        self.assertEqual(staging.requested, 1)
+        self.assertTrue(staging.ready)
+        self.assertEqual(len(sleeps), 3)
+        self.assertEqual(
+            client.requests[0][1]["GlacierJobParameters"], dict(Tier="Bulk")
+        )
+
+    def test_stage_times_out(self):
+        client = FakeS3(backup(storage_class="GLACIER"), delay=100)
+        files = restore_files(list_files(client, "bucket", "path/"), None)
+
+        staging = stage(
+            client, "bucket", files, poll_interval=60, timeout=300, sleep=lambda s: None
+        )
+
+        self.assertFalse(staging.ready)
+        # the restores in flight are picked up by the next attempt
+        staging = stage(client, "bucket", files, sleep=lambda s: None)
+        self.assertEqual(staging.requested, 0)
+        self.assertTrue(staging.ready)
+
+    def test_stage_reports_errors(self):
+        client = FakeS3(backup(storage_class="GLACIER"))
+        client.restore_object = mock.Mock(side_effect=FakeClientError("AccessDenied"))
+        files = restore_files(list_files(client, "bucket", "path/"), None)
+
+        with self.assertRaises(StorageError) as cm:
+            stage(client, "bucket", files, sleep=lambda s: None)
+        self.assertEqual(cm.exception.code, "AccessDenied")
+
+    def test_storage_args(self):
+        self.assertEqual(storage_args(dict(volumes="STANDARD_IA")), ["--s3-use-ia"])
+        self.assertEqual(storage_args(dict(volumes="STANDARD")), [])
+        self.assertEqual(
+            storage_args(dict(volumes="GLACIER"), supported=lambda option: False), []
+        )
+
+
+class TestStorageCommands(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.config = Path(self.tempdir.name) / "config.yaml"
+        self.config.write_text(
+            f"backuproot: {self.tempdir.name}\n"
+            "remote:\n  uri: s3+http://bucket/path\n"
+            "storage:\n  volumes: STANDARD_IA\n"
+            "  tiers:\n    - after_days: 20\n      class: GLACIER\n"
+            "  restore:\n    poll_interval: 1\n"
+        )
+
+    def test_tier(self):
+        client = FakeS3(backup())
+        dupe = DuplicityS3(config=str(self.config))
+        with mock.patch.object(DuplicityS3, "_s3_client", return_value=client):
+            self.assertEqual(dupe.do_tier(), 0)
+            glacier = sorted(k for k, c in client.objects.items() if c == "GLACIER")
+            # the volumes of both superseded chains, not of the current one
+            self.assertEqual(len(glacier), 4)
+            self.assertTrue(all(".vol1.difftar" in k for k in glacier))
+            # a second run has nothing left to move
+            dupe.do_tier()
+            self.assertEqual(
+                sorted(k for k, c in client.objects.items() if c == "GLACIER"), glacier
+            )
+
+    def test_restore_stages_the_archived_volumes(self):
+        client = FakeS3(backup(storage_class="GLACIER"), delay=2)
+        dupe = DuplicityS3(config=str(self.config), target=self.tempdir.name)
+        dupe._capabilities = None
+        with mock.patch.object(
+            DuplicityS3, "_s3_client", return_value=client
+        ), mock.patch.object(
+            DuplicityS3, "_execute", return_value=0
+        ) as execute, mock.patch(
+            "duplicity_backup_s3.storage.time.sleep"
+        ):
+            self.assertEqual(dupe.do_restore(), 0)
+
+        self.assertEqual(len(client.requests), 2)
+        self.assertTrue(all(remaining <= 0 for remaining in client.restores.values()))
+        execute.assert_called_once()
+        self.assertIn("--s3-use-ia", dupe._incremental_command(None))
+
+    def test_restore_fails_when_staging_fails(self):
+        dupe = DuplicityS3(config=str(self.config), target=self.tempdir.name)
+        with mock.patch.object(
+            DuplicityS3, "_s3_client", side_effect=StorageError("no boto3")
+        ), mock.patch.object(DuplicityS3, "_execute", return_value=0) as execute:
+            self.assertEqual(dupe.do_restore(), 1)
+        execute.assert_not_called()
@@ -0,0 +1,251 @@
+import stat
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+from urllib.parse import parse_qs, urlsplit
+
+from duplicity_backup_s3.capabilities import Capabilities
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.stats import parse_statistics, throughput
+from duplicity_backup_s3.transfer import auto_settings, transfer_args, transfer_settings
+
+STATISTICS = """Local and Remote metadata are synchronized, no sync needed.
+--------------[ Backup Statistics ]--------------
+StartTime 1673000000.00 (Fri Jan  6 10:13:20 2023)
+EndTime 1673000010.00 (Fri Jan  6 10:13:30 2023)
+ElapsedTime 10.00 (10.00 seconds)
+SourceFiles 42
+SourceFileSize 123456789 (118 MB)
+TotalDestinationSizeChange 50000000 (47.7 MB)
+Errors 0
+-------------------------------------------------
+"""
+
+
+class TestTransfer(TestCase):
+    def test_auto_settings_from_volsize_and_cpus(self):
+        self.assertEqual(
+            auto_settings(volsize=200, cpu_count=4),
+            dict(multipart_chunk_size=50, multipart_max_procs=4, concurrency=2),
+        )
+        # small volumes are not split in parts smaller than the S3 minimum
+        self.assertEqual(
+            auto_settings(volsize=10, cpu_count=16),
+            dict(multipart_chunk_size=5, multipart_max_procs=2, concurrency=4),
+        )
+
+    def test_auto_settings_use_measured_throughput(self):
+        settings = auto_settings(volsize=1000, cpu_count=8, throughput=800)
+        self.assertEqual(settings["multipart_chunk_size"], 125)
+
+        settings = auto_settings(volsize=1000, cpu_count=8, throughput=1600)
+        self.assertEqual(settings["multipart_chunk_size"], 200)
+        self.assertEqual(settings["multipart_max_procs"], 5)
+
+    def test_explicit_settings_take_precedence(self):
+        settings = transfer_settings(
+            dict(mode="auto", concurrency=1), volsize=200, throughput=None
+        )
+        self.assertEqual(settings["concurrency"], 1)
+        self.assertIn("multipart_chunk_size", settings)
+
+    def test_transfer_args_only_for_supported_options(self):
+        supported = {"--s3-multipart-chunk-size", "--concurrency"}
+        args = transfer_args(
+            dict(multipart_chunk_size=25, multipart_max_procs=4, concurrency=2),
+            supported=lambda option: option in supported,
+        )
+        self.assertEqual(
+            args, ["--s3-multipart-chunk-size", "25", "--concurrency", "2"]
+        )
+
+    def test_parse_statistics(self):
+        statistics = parse_statistics(STATISTICS.splitlines())
+
+        self.assertEqual(statistics["SourceFiles"], 42)
+        self.assertEqual(statistics["ElapsedTime"], 10.0)
+        self.assertEqual(statistics["Errors"], 0)
+        self.assertEqual(throughput(statistics), 5.0)
+        self.assertDictEqual(parse_statistics(["no statistics here"]), {})
+
+
+# uploads `VOLUMES` volumes of `--volsize` MB with S3 multipart uploads, like
+# duplicity: `--concurrency` volumes at once, every volume in parts of
+# `--s3-multipart-chunk-size` MB by `--s3-multipart-max-procs` threads
+FAKE_DUPLICITY = """#!{python}
+import math
+import re
+import sys
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+VOLUMES = 2
+args = sys.argv[1:]
+
+
+def option(name, default):
+    return type(default)(args[args.index(name) + 1]) if name in args else default
+
+
+endpoint = option("--s3-endpoint-url", "")
+chunk = option("--s3-multipart-chunk-size", 25) * 1024 * 1024
+procs = option("--s3-multipart-max-procs", 1)
+volsize = option("--volsize", 200) * 1024 * 1024
+remote = args[-1][len("s3://"):]
+
+
+def request(method, url, data=b""):
+    with urllib.request.urlopen(urllib.request.Request(url, data, method=method)) as r:
+        return r.read().decode()
+
+
+def upload_part(url, part):
+    request("PUT", url, b"x" * min(chunk, volsize - part * chunk))
+
+
+def upload_volume(number):
+    url = f"{{endpoint}}/{{remote}}/duplicity-full.vol{{number}}.difftar.gpg"
+    upload = re.search("<UploadId>(.*)</UploadId>", request("POST", url + "?uploads"))
+    query = f"uploadId={{upload.group(1)}}"
+    with ThreadPoolExecutor(procs) as pool:
+        for part in range(math.ceil(volsize / chunk)):
+            pool.submit(upload_part, f"{{url}}?partNumber={{part + 1}}&{{query}}", part)
+    request("POST", f"{{url}}?{{query}}", b"<CompleteMultipartUpload/>")
+
+
+with ThreadPoolExecutor(option("--concurrency", 1)) as pool:
+    list(pool.map(upload_volume, range(1, VOLUMES + 1)))
+print("--------------[ Backup Statistics ]--------------")
+print("ElapsedTime 0.10 (0.10 seconds)")
+print(f"TotalDestinationSizeChange {{VOLUMES * volsize}}")
+print("Errors 0")
+print("-------------------------------------------------")
+"""
+
+
+class S3StandIn(ThreadingMixIn, HTTPServer):
+    """Local S3 compatible stand-in for the multipart uploads of duplicity."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), S3Handler)
+        self.lock = threading.Lock()
+        self.uploads = {}  # upload id -> (key, {part number: size})
+        self.objects = {}  # key -> sizes of the parts
+        self.in_flight = self.peak = 0
+
+    @property
+    def endpoint(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body=""):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        with self.server.lock:
+            if "uploads" in query:
+                upload_id = str(len(self.server.uploads) + len(self.server.objects))
+                self.server.uploads[upload_id] = (url.path, {})
+                body = f"<Result><UploadId>{upload_id}</UploadId></Result>"
+            else:
+                key, parts = self.server.uploads.pop(query["uploadId"][0])
+                self.server.objects[key] = [parts[n] for n in sorted(parts)]
+                body = "<CompleteMultipartUploadResult/>"
+        self._reply(body)
+
+    def do_PUT(self):
+        query = parse_qs(urlsplit(self.path).query)
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.peak = max(self.server.peak, self.server.in_flight)
+        size = len(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(0.05)
+        with self.server.lock:
+            self.server.in_flight -= 1
+            _, parts = self.server.uploads[query["uploadId"][0]]
+            parts[int(query["partNumber"][0])] = size
+        self._reply()
+
+
+class TestTransferAgainstS3(TestCase):
+    def setUp(self):
+        self.server = S3StandIn()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        directory = Path(self.tempdir.name)
+        binary = directory / "duplicity"
+        binary.write_text(FAKE_DUPLICITY.format(python=sys.executable))
+        binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+        for patcher in (
+            mock.patch.object(DuplicityS3, "duplicity_cmd", return_value=str(binary)),
+            mock.patch("duplicity_backup_s3.state.STATE_DIR", directory / "state"),
+            mock.patch("duplicity_backup_s3.transfer.os.cpu_count", return_value=2),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def backup(self):
+        dupe = DuplicityS3()
+        dupe._config = dict(
+            backuproot=self.tempdir.name,
+            remote=dict(uri="s3://bucket/path", endpoint=self.server.endpoint),
+            volsize=10,
+            transfer=dict(mode="auto"),
+            extra_args=["--archive-dir", self.tempdir.name],
+        )
+        dupe._capabilities = Capabilities(
+            path="duplicity",
+            version=(2, 1),
+            options=[
+                "--concurrency",
+                "--s3-endpoint-url",
+                "--s3-multipart-chunk-size",
+                "--s3-multipart-max-procs",
+                "--s3-use-multiprocessing",
+            ],
+        )
+        self.assertEqual(dupe.do_incremental(), 0)
+        objects, self.server.objects = self.server.objects, {}
+        return objects
+
+    def test_auto_settings_upload_in_parallel_parts(self):
+        mib = 1024 * 1024
+        # 2 volumes at once, each in 2 parts of 5 MB by 2 processes
+        self.assertEqual(
+            self.backup(),
+            {
+                f"/bucket/path/duplicity-full.vol{n}.difftar.gpg": [5 * mib] * 2
+                for n in (1, 2)
+            },
+        )
+        self.assertGreater(self.server.peak, 1)
+        self.assertLessEqual(self.server.peak, 4)
+
+        # the throughput of the first backup makes the parts as large as a volume
+        self.assertEqual(
+            self.backup(),
+            {
+                f"/bucket/path/duplicity-full.vol{n}.difftar.gpg": [10 * mib]
+                for n in (1, 2)
+            },
+        )
@@ -0,0 +1,210 @@
+import io
+import json
+import os
+import stat
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from duplicity_backup_s3.archive import archive_dir
+from duplicity_backup_s3.capabilities import Capabilities
+from duplicity_backup_s3.duplicity_s3 import DuplicityS3
+from duplicity_backup_s3.storage import list_files
+from duplicity_backup_s3.volume_cache import (
+    VolumeCache,
+    containing_volumes,
+    needed_files,
+)
+
+FULL = "duplicity-full.20230501T000000Z"
+INC = "duplicity-inc.20230501T000000Z.to.20230502T000000Z"
+
+FULL_MANIFEST = """Hostname host
+Localdir /data
+Volume 1:
+    StartingPath   .
+    EndingPath     docs/b 2
+    Hash SHA1 abc
+Volume 2:
+    StartingPath   docs/b 3
+    EndingPath     "media/a\\x0ab"
+    Hash SHA1 abc
+Volume 3:
+    StartingPath   "media/a\\x0ab" 1
+    EndingPath     media/z
+    Hash SHA1 abc
+"""
+INC_MANIFEST = """Volume 1:
+    StartingPath   .
+    EndingPath     media/z
+"""
+
+# records its arguments and the size of every file of the remote it reads from
+FAKE_DUPLICITY = """#!{python}
+import json
+import os
+import sys
+
+view = [arg for arg in sys.argv if arg.startswith("file://")][0][len("file://"):]
+sizes = {{name: os.path.getsize(os.path.join(view, name)) for name in os.listdir(view)}}
+with open({calls!r}, "a") as fd:
+    fd.write(json.dumps([sys.argv[1:], sizes]) + "\\n")
+"""
+
+
+def remote_objects(prefix="path/"):
+    names = [
+        f"{FULL}.manifest.gpg",
+        f"{INC}.manifest.gpg",
+        "duplicity-full-signatures.20230501T000000Z.sigtar.gpg",
+        "duplicity-new-signatures.20230501T000000Z.to.20230502T000000Z.sigtar.gpg",
+        f"{FULL}.vol1.difftar.gpg",
+        f"{FULL}.vol2.difftar.gpg",
+        f"{FULL}.vol3.difftar.gpg",
+        f"{INC}.vol1.difftar.gpg",
+    ]
+    return {f"{prefix}{name}": name.encode() for name in names}
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.downloads = []
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter, ContinuationToken=None):
+        return dict(
+            Contents=[
+                dict(Key=key, Size=len(body), ETag='"etag"')
+                for key, body in sorted(self.objects.items())
+                if key.startswith(Prefix)
+            ],
+            IsTruncated=False,
+        )
+
+    def get_object(self, Bucket, Key):
+        self.downloads.append(Key)
+        return dict(Body=io.BytesIO(self.objects[Key]))
+
+
+class TestVolumeCache(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.archive = Path(self.tempdir.name) / "archive"
+        self.archive.mkdir()
+        (self.archive / f"{FULL}.manifest").write_text(FULL_MANIFEST)
+        (self.archive / f"{INC}.manifest").write_text(INC_MANIFEST)
+        (self.archive / "duplicity-full-signatures.20230501T000000Z.sigtar.gz").touch()
+
+    def test_containing_volumes(self):
+        manifest = self.archive / f"{FULL}.manifest"
+        self.assertEqual(containing_volumes(manifest, "docs/b"), {1, 2})
+        self.assertEqual(containing_volumes(manifest, "/docs/a/"), {1})
+        self.assertEqual(containing_volumes(manifest, "media"), {2, 3})
+        self.assertEqual(containing_volumes(manifest, "media/a\nb"), {2, 3})
+        self.assertEqual(containing_volumes(manifest, ""), {1, 2, 3})
+        self.assertIsNone(containing_volumes(self.archive / "missing", "docs"))
+
+    def test_needed_files(self):
+        files = list_files(FakeS3(remote_objects()), "bucket", "path/")
+        volumes = [f for f in files if f.file.kind == "volume"]
+
+        needed = needed_files(self.archive, files, volumes, "docs/a")
+
+        self.assertEqual(
+            sorted(key.replace("path/", "") for key in needed),
+            [
+                f"{FULL}.manifest.gpg",
+                f"{FULL}.vol1.difftar.gpg",
+                f"{INC}.manifest.gpg",
+                f"{INC}.vol1.difftar.gpg",
+                # the local archive lacks it, duplicity downloads it
+                "duplicity-new-signatures.20230501T000000Z.to.20230502T000000Z"
+                ".sigtar.gpg",
+            ],
+        )
+        self.assertEqual(
+            len(needed_files(self.archive, files, volumes)), len(files) - 1
+        )
+
+    def test_fetch_and_evict_the_least_recently_used(self):
+        client = FakeS3(remote_objects())
+        files = list_files(client, "bucket", "path/")
+        volumes = [f for f in files if f.file.kind == "volume"]
+        cache = VolumeCache(Path(self.tempdir.name) / "cache", max_size=100)
+
+        self.assertEqual(cache.fetch(client, "bucket", "remote", volumes[:2]), (0, 2))
+        self.assertEqual(cache.fetch(client, "bucket", "remote", volumes[:1]), (1, 0))
+        old = cache.directory / "remote" / volumes[1].file.name
+        os.utime(str(old), (time.time() - 60,) * 2)
+        # the third volume does not fit, the least recently used is evicted
+        cache.fetch(client, "bucket", "remote", volumes[2:3])
+        self.assertFalse(old.exists())
+        self.assertEqual(len(client.downloads), 3)
+
+        # pinned files are not evicted
+        with cache.pin([f"remote/{volumes[0].file.name}"]):
+            cache.fetch(client, "bucket", "remote", volumes[3:])
+            self.assertTrue(
+                (cache.directory / "remote" / volumes[0].file.name).exists()
+            )
+        self.assertEqual(list((cache.directory / cache.PINS).iterdir()), [])
+
+
+class TestCachedRestore(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        directory = Path(self.tempdir.name)
+        self.archive = archive_dir(
+            "s3+http://bucket/path", ["--archive-dir", str(directory)]
+        )
+        archive = self.archive
+        archive.mkdir()
+        (archive / f"{FULL}.manifest").write_text(FULL_MANIFEST)
+        (archive / f"{INC}.manifest").write_text(INC_MANIFEST)
+        self.calls = directory / "calls"
+        binary = directory / "duplicity"
+        binary.write_text(
+            FAKE_DUPLICITY.format(python=sys.executable, calls=str(self.calls))
+        )
+        binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+        self.client = FakeS3(remote_objects())
+        for patcher in (
+            mock.patch.object(DuplicityS3, "duplicity_cmd", return_value=str(binary)),
+            mock.patch.object(DuplicityS3, "_s3_client", return_value=self.client),
+            mock.patch("duplicity_backup_s3.state.STATE_DIR", directory / "state"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def dupe(self, **options):
+        dupe = DuplicityS3(target=str(Path(self.tempdir.name) / "target"), **options)
+        dupe._config = dict(
+            backuproot=self.tempdir.name,
+            remote=dict(uri="s3+http://bucket/path"),
+            volume_cache=dict(directory=str(Path(self.tempdir.name) / "cache")),
+            extra_args=["--archive-dir", self.tempdir.name],
+        )
+        dupe._capabilities = Capabilities(path="duplicity", version=None, options=[])
+        return dupe
+
+    def test_repeated_restores_read_from_the_cache(self):
+        self.assertEqual(self.dupe(file="docs/a").do_restore(), 0)
+        self.assertEqual(self.dupe(file="docs/b").do_restore(), 0)
+
+        calls = [json.loads(line) for line in self.calls.read_text().splitlines()]
+        (args, sizes), (_, second) = calls
+        self.assertEqual(args[0], "restore")
+        self.assertEqual(args[args.index("--name") + 1], self.archive.name)
+        # the view lists every file, only the needed ones have content
+        self.assertEqual(len(sizes), 8)
+        self.assertEqual(sizes[f"{FULL}.vol1.difftar.gpg"], 48)
+        self.assertEqual(sizes[f"{FULL}.vol2.difftar.gpg"], 0)
+        self.assertEqual(second[f"{FULL}.vol2.difftar.gpg"], 48)
+        # the manifests and volume 1 are downloaded once
+        self.assertEqual(len(self.client.downloads), 7)
+        self.assertEqual(len(set(self.client.downloads)), len(self.client.downloads))
+        self.assertEqual(list((Path(self.tempdir.name) / "cache").glob(".view_*")), [])
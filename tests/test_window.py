@@ -0,0 +1,57 @@
+import sys
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from duplicity_backup_s3.runner import ProcessRunner
+from duplicity_backup_s3.window import BackupWindow
+
+
+class TestBackupWindow(TestCase):
+    def test_window_within_a_day(self):
+        window = BackupWindow.from_config({"start": "01:00", "end": "05:00"})
+
+        self.assertTrue(window.contains(datetime(2023, 1, 2, 1, 0)))
+        self.assertTrue(window.contains(datetime(2023, 1, 2, 4, 59)))
+        self.assertFalse(window.contains(datetime(2023, 1, 2, 5, 0)))
+        self.assertFalse(window.contains(datetime(2023, 1, 2, 0, 59)))
+        self.assertEqual(
+            window.closes_at(datetime(2023, 1, 2, 3, 0)), datetime(2023, 1, 2, 5, 0)
+        )
+        self.assertEqual(
+            window.next_opening(datetime(2023, 1, 2, 6, 0)),
+            datetime(2023, 1, 3, 1, 0),
+        )
+
+    def test_window_wrapping_midnight(self):
+        window = BackupWindow.parse("22:00–04:00")
+
+        self.assertEqual(window.duration, timedelta(hours=6))
+        self.assertTrue(window.contains(datetime(2023, 1, 2, 23, 0)))
+        self.assertTrue(window.contains(datetime(2023, 1, 3, 2, 0)))
+        self.assertFalse(window.contains(datetime(2023, 1, 3, 12, 0)))
+        self.assertEqual(
+            window.closes_at(datetime(2023, 1, 2, 23, 0)), datetime(2023, 1, 3, 4, 0)
+        )
+
+    def test_incorrect_time_fails(self):
+        with self.assertRaises(ValueError):
+            BackupWindow.from_config({"start": "25:00", "end": "05:00"})
+
+
+class TestProcessRunnerDeadline(TestCase):
+    def test_process_stopped_at_boundary_after_deadline(self):
+        boundaries = iter([False, False, True])
+        runner = ProcessRunner(
+            [sys.executable, "-c", "import time; time.sleep(60)"],
+            poll_interval=0.1,
+            output=lambda text: None,
+            deadline=time.monotonic() + 0.3,
+            deadline_grace=30,
+            at_boundary=lambda: next(boundaries),
+        )
+        result = runner.run()
+
+        self.assertTrue(runner.deadline_reached)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIsNone(runner.stall_event)